@@ -0,0 +1,1829 @@
+"""
+Benchmarks for the slow parts of the annotation refinery, run against
+synthetic inputs sized like the real ones (e.g. the full GO DAG has about
+45,000 terms, most of them with more than one parent).
+
+Run one benchmark at a time, for example:
+
+    python benchmarks.py propagate --terms 45000
+"""
+
+import os
+import re
+import json
+import gzip
+import sys
+import time
+import random
+import shutil
+import resource
+import tempfile
+import argparse
+import threading
+import multiprocessing
+from StringIO import StringIO
+from urllib import urlencode
+from urlparse import parse_qs, urlsplit
+from ConfigParser import SafeConfigParser
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+import requests
+
+import go as go_module
+from go import go, AnnotationLayer
+import process_go
+import process_do
+import gaf_shards
+import utils
+import download_manager
+import download_files
+import run_refinery
+import tribe_loader
+import json_output
+import columnar_output
+
+# Import and set logger
+import logging
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+NAMESPACES = ['biological_process', 'molecular_function',
+              'cellular_component']
+
+RELATIONSHIPS = ['part_of', 'regulates', 'positively_regulates',
+                 'negatively_regulates']
+
+
+def build_synthetic_obo(num_terms, max_parents=4, relationship_rate=0.15,
+                        seed=0):
+    """
+    Build the text of an OBO file with num_terms terms spread over the
+    three GO namespaces. Every non-head term gets between one and
+    max_parents parents picked among the earlier terms of its namespace,
+    so the result is a DAG with multiple inheritance like the real GO. A
+    fraction (relationship_rate) of the parent links are 'relationship:'
+    lines instead of 'is_a:' lines.
+
+    Returns:
+    A string with the contents of the OBO file.
+    """
+    rand = random.Random(seed)
+    # Separate generator for the unused lines, so that they do not change
+    # the DAG built for a given seed
+    filler = random.Random(seed + 1)
+    lines = ['format-version: 1.2', '']
+    ns_terms = dict((namespace, []) for namespace in NAMESPACES)
+
+    for i in xrange(num_terms):
+        go_id = 'GO:%07d' % (i + 1)
+        namespace = NAMESPACES[i % len(NAMESPACES)]
+        lines.extend(['[Term]', 'id: ' + go_id,
+                      'name: synthetic term %d' % i,
+                      'namespace: ' + namespace,
+                      'def: "Synthetic term number %d, with a definition '
+                      'about as long as the ones of real GO terms, which '
+                      'take a sentence or two." [GOC:bench, PMID:%d]' % (
+                          i, filler.randint(1, 30000000))])
+        # Lines that go.parse() does not use, but which make up most of a
+        # real OBO file
+        for synonym_num in xrange(filler.randint(0, 4)):
+            lines.append('synonym: "synthetic synonym %d of term %d" '
+                         'EXACT []' % (synonym_num, i))
+        for xref_num in xrange(filler.randint(0, 2)):
+            lines.append('xref: Synthetic:%d' % filler.randint(1, 10 ** 6))
+
+        previous = ns_terms[namespace]
+        if previous:
+            # Most terms have one or two parents, a few have more
+            num_parents = 1
+            while (num_parents < min(max_parents, len(previous)) and
+                    rand.random() < 0.5):
+                num_parents += 1
+            parents = set(rand.choice(previous)
+                          for _ in xrange(num_parents))
+            for parent_id in sorted(parents):
+                if rand.random() < relationship_rate:
+                    lines.append('relationship: %s %s' % (
+                        rand.choice(RELATIONSHIPS), parent_id))
+                else:
+                    lines.append('is_a: ' + parent_id)
+        previous.append(go_id)
+        lines.append('')
+
+    return '\n'.join(lines) + '\n'
+
+
+def build_synthetic_ontology(num_terms, seed=0, backend='objects'):
+    """
+    Parse a synthetic OBO with num_terms terms into a go() object that uses
+    the given backend.
+    """
+    ontology = go(backend=backend)
+    ontology.parse(StringIO(build_synthetic_obo(num_terms, seed=seed)))
+    return ontology
+
+
+def add_synthetic_annotations(ontology, num_genes, per_gene=5, seed=0,
+                              layer=None):
+    """
+    Directly annotate each of num_genes synthetic genes to per_gene random
+    terms in ontology, or in the go.AnnotationLayer layer on top of it if
+    one is given.
+    """
+    rand = random.Random(seed)
+    term_ids = sorted(ontology.go_terms.keys())
+    target = ontology if layer is None else layer
+    for gene_num in xrange(num_genes):
+        gene = 'GENE%06d' % gene_num
+        for go_id in rand.sample(term_ids, per_gene):
+            target.add_annotation(go_id=go_id, gid=gene, xdb='Synthetic',
+                                  ref=str(rand.randint(1, 30000000)),
+                                  date='20170101', direct=True)
+
+
+def build_synthetic_gaf_annotations(ontology, num_genes, per_gene=5,
+                                    seed=0):
+    """
+    Return annotation tuples like the ones get_filtered_annotations()
+    returns, annotating each of num_genes synthetic genes to per_gene
+    random terms in ontology, most of them with a PubMed reference.
+    """
+    rand = random.Random(seed)
+    term_ids = sorted(ontology.go_terms.keys())
+    annotations = []
+    for gene_num in xrange(num_genes):
+        gene = 'GENE%06d' % gene_num
+        for go_id in rand.sample(term_ids, per_gene):
+            if rand.random() < 0.8:
+                refstring = 'PMID:%d' % rand.randint(1, 30000000)
+            else:
+                refstring = 'GO_REF:0000024'
+            annotations.append(('Synthetic', gene, go_id, refstring,
+                                '20170101'))
+    return annotations
+
+
+def split_parse(ontology, obo_fh):
+    """
+    The parsing loop that go.parse() used before obo.iter_tags(), which
+    splits every line of the file. Kept here only as the baseline for
+    benchmark_parse().
+    """
+    inside = False
+    gterm = None
+    for line in obo_fh:
+        fields = line.rstrip().split()
+
+        if len(fields) < 1:
+            continue
+        elif fields[0] == '[Term]':
+            if gterm and gterm.head:
+                ontology.heads.append(gterm)
+            inside = True
+        elif fields[0] == '[Typedef]':
+            if gterm and gterm.head:
+                ontology.heads.append(gterm)
+            inside = False
+        elif inside and fields[0] == 'id:':
+            if fields[1] in ontology.go_terms:
+                gterm = ontology.go_terms[fields[1]]
+            else:
+                gterm = go_module.GOTerm(fields[1])
+                ontology.go_terms[gterm.get_id()] = gterm
+        elif inside and fields[0] == 'def:':
+            gterm.description = ' '.join(fields[1:]).split('"')[1]
+        elif inside and fields[0] == 'name:':
+            fields.pop(0)
+            name = '_'.join(fields)
+            name = re.sub('[^\w\s_-]', '_', name).strip().lower()
+            name = re.sub('[-\s_]+', '_', name)
+            gterm.name = name
+            gterm.full_name = ' '.join(fields)
+        elif inside and fields[0] == 'namespace:':
+            gterm.namespace = fields[1]
+        elif inside and fields[0] == 'alt_id:':
+            gterm.alt_id.append(fields[1])
+            ontology.alt_id2std_id[fields[1]] = gterm.get_id()
+        elif inside and fields[0] == 'is_a:':
+            gterm.head = False
+            pgo_id = fields[1]
+            if pgo_id not in ontology.go_terms:
+                ontology.go_terms[pgo_id] = go_module.GOTerm(pgo_id)
+            gterm.is_a.append(ontology.go_terms[pgo_id])
+            ontology.go_terms[pgo_id].parent_of.add(gterm)
+            gterm.child_of.add(ontology.go_terms[pgo_id])
+        elif inside and fields[0] == 'relationship:':
+            if fields[1].find('has_part') != -1:
+                continue
+            gterm.head = False
+            pgo_id = fields[2]
+            if pgo_id not in ontology.go_terms:
+                ontology.go_terms[pgo_id] = go_module.GOTerm(pgo_id)
+            if fields[1] in ('regulates', 'positively_regulates',
+                             'negatively_regulates'):
+                gterm.relationship_regulates.append(
+                    ontology.go_terms[pgo_id])
+            elif fields[1] == 'part_of':
+                gterm.relationship_part_of.append(ontology.go_terms[pgo_id])
+            ontology.go_terms[pgo_id].parent_of.add(gterm)
+            gterm.child_of.add(ontology.go_terms[pgo_id])
+        elif inside and fields[0] == 'is_obsolete:':
+            gterm.head = False
+            del ontology.go_terms[gterm.get_id()]
+
+    for term in ontology.go_terms.itervalues():
+        if term.head and term not in ontology.heads:
+            ontology.heads.append(term)
+
+
+def term_summary(term):
+    """
+    The parsed fields of a GOTerm, for comparing two parsers.
+    """
+    return (term.name, term.full_name, term.namespace, term.description,
+            term.alt_id, sorted(parent.go_id for parent in term.is_a),
+            sorted(parent.go_id for parent in term.relationship_part_of),
+            sorted(parent.go_id for parent in term.relationship_regulates),
+            sorted(child.go_id for child in term.parent_of))
+
+
+def recursive_propagate(ontology):
+    """
+    The recursive propagation that go.propagate() used before it walked the
+    DAG in topological order. It re-descends into a subtree every time the
+    subtree is reached through a different parent. Kept here only as the
+    baseline for benchmark_propagate().
+    """
+    def recurse(gterm):
+        for child_term in gterm.parent_of:
+            recurse(child_term)
+            regulates_relation = (gterm in child_term.relationship_regulates)
+            part_of_relation = (gterm in child_term.relationship_part_of)
+            new_annotations = set()
+            for annotation in child_term.annotations:
+                if regulates_relation:
+                    if annotation.ready_regulates_cutoff:
+                        continue
+                    copied = annotation.prop_copy(ready_regulates_cutoff=True)
+                elif part_of_relation:
+                    copied = annotation.prop_copy(ready_regulates_cutoff=True)
+                else:
+                    copied = annotation.prop_copy()
+                new_annotations.add(copied)
+            gterm.annotations = gterm.annotations | new_annotations
+
+    for head_gterm in ontology.heads:
+        recurse(head_gterm)
+
+
+class LegacyAnnotation(object):
+    """
+    The dict-based annotation that go.Annotation replaced, which allocates
+    a new object for every prop_copy() and builds a tuple on every hash.
+    Kept here only as the baseline for benchmark_memory().
+    """
+    def __init__(self, xdb=None, gid=None, ref=None, evidence=None, date=None,
+                 direct=False, cross_annotated=False, origin=None,
+                 ortho_evidence=None, ready_regulates_cutoff=False):
+        super(LegacyAnnotation, self).__setattr__('xdb', xdb)
+        super(LegacyAnnotation, self).__setattr__('gid', gid)
+        super(LegacyAnnotation, self).__setattr__('ref', ref)
+        super(LegacyAnnotation, self).__setattr__('evidence', evidence)
+        super(LegacyAnnotation, self).__setattr__('date', date)
+        super(LegacyAnnotation, self).__setattr__('direct', direct)
+        super(LegacyAnnotation, self).__setattr__('cross_annotated',
+                                                  cross_annotated)
+        super(LegacyAnnotation, self).__setattr__('origin', origin)
+        super(LegacyAnnotation, self).__setattr__('ortho_evidence',
+                                                  ortho_evidence)
+        super(LegacyAnnotation, self).__setattr__('ready_regulates_cutoff',
+                                                  ready_regulates_cutoff)
+
+    def prop_copy(self, ready_regulates_cutoff=None):
+        if ready_regulates_cutoff is None:
+            ready_regulates_cutoff = self.ready_regulates_cutoff
+
+        return LegacyAnnotation(
+            xdb=self.xdb, gid=self.gid, ref=self.ref, evidence=self.evidence,
+            date=self.date, direct=False, cross_annotated=False,
+            ortho_evidence=self.ortho_evidence,
+            ready_regulates_cutoff=ready_regulates_cutoff)
+
+    def __hash__(self):
+        return hash((self.xdb, self.gid, self.ref, self.evidence, self.date,
+                     self.direct, self.cross_annotated, self.ortho_evidence,
+                     self.ready_regulates_cutoff, self.origin))
+
+    def __eq__(self, other):
+        return (self.xdb, self.gid, self.ref, self.evidence, self.date,
+                self.direct, self.cross_annotated, self.ortho_evidence,
+                self.ready_regulates_cutoff, self.origin).__eq__((
+                    other.xdb, other.gid, other.ref, other.evidence,
+                    other.date, other.direct, other.cross_annotated,
+                    other.ortho_evidence, other.ready_regulates_cutoff,
+                    other.origin))
+
+    def __setattr__(self, *args):
+        raise TypeError("Attempt to modify immutable object.")
+    __delattr__ = __setattr__
+
+
+def peak_rss_mb():
+    """
+    Return the peak resident set size of this process in MB.
+    """
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def recursive_descendents(ontology, go_id):
+    """
+    The recursive go.get_descendents() that recomputed every subtree on
+    every call, before the descendents of all terms were cached. Kept here
+    only as the baseline for benchmark_reachability().
+    """
+    if go_id not in ontology.go_terms:
+        return set()
+    term = ontology.go_terms[go_id]
+    child_terms = set()
+    for child_term in term.parent_of:
+        if child_term.namespace != term.namespace:
+            continue
+        child_terms.add(child_term.go_id)
+        child_terms = child_terms | recursive_descendents(ontology,
+                                                          child_term.go_id)
+    return child_terms
+
+
+def recursive_ancestors(ontology, go_id):
+    """
+    The recursive go.get_ancestors(), the counterpart of
+    recursive_descendents().
+    """
+    if go_id not in ontology.go_terms:
+        return set()
+    term = ontology.go_terms[go_id]
+    parent_terms = set()
+    for parent_term in term.child_of:
+        if parent_term.namespace != term.namespace:
+            continue
+        parent_terms.add(parent_term.go_id)
+        parent_terms = parent_terms | recursive_ancestors(ontology,
+                                                          parent_term.go_id)
+    return parent_terms
+
+
+def load_benchmark_ontology(args, backend='objects'):
+    """
+    Parse the OBO file passed with --obo, or build a synthetic ontology
+    with --terms terms if there is none.
+    """
+    if args.obo:
+        ontology = go(backend=backend)
+        ontology.load_obo(args.obo)
+        return ontology
+    return build_synthetic_ontology(args.terms, seed=args.seed,
+                                    backend=backend)
+
+
+def timed(label, func, *args, **kwargs):
+    """
+    Call func(*args, **kwargs), print how long it took and return the
+    elapsed time in seconds.
+    """
+    start = time.time()
+    func(*args, **kwargs)
+    elapsed = time.time() - start
+    print '%-40s %10.3f s' % (label, elapsed)
+    return elapsed
+
+
+def benchmark_propagate(args):
+    """
+    Time go.propagate() against the old recursive propagation on the same
+    synthetic ontology and annotations, and check that both produce the
+    same annotations for every term. The recursive baseline grows
+    exponentially with the depth of shared subtrees, so pass --skip-baseline
+    for full-size ontologies.
+    """
+    runs = [('go.propagate()', go.propagate)]
+    if not args.skip_baseline:
+        runs.insert(0, ('recursive propagation', recursive_propagate))
+
+    results = {}
+    for label, propagate in runs:
+        ontology = build_synthetic_ontology(args.terms, seed=args.seed)
+        add_synthetic_annotations(ontology, args.genes, seed=args.seed)
+        sys.setrecursionlimit(max(sys.getrecursionlimit(), 10 * args.terms))
+        results[label] = (timed(label, propagate, ontology), ontology)
+
+    if args.skip_baseline:
+        return
+
+    (old_time, old_ontology) = results['recursive propagation']
+    (new_time, new_ontology) = results['go.propagate()']
+    for go_id, term in new_ontology.go_terms.iteritems():
+        if term.annotations != old_ontology.go_terms[go_id].annotations:
+            print 'Annotations differ for term %s' % go_id
+            sys.exit(1)
+    print 'Identical annotations, speedup: %.1fx' % (old_time / new_time)
+
+
+def propagate_peak_rss(args, annotation_class, results):
+    """
+    Build, annotate and propagate a synthetic ontology using
+    annotation_class for every annotation, and put the peak RSS of the
+    process in the results queue. Meant to be run in a fresh process.
+    """
+    go_module.Annotation = annotation_class
+    ontology = build_synthetic_ontology(args.terms, seed=args.seed)
+    add_synthetic_annotations(ontology, args.genes, seed=args.seed)
+    ontology.propagate()
+    num_annotations = sum(len(term.annotations) for term in
+                          ontology.go_terms.itervalues())
+    results.put((num_annotations, peak_rss_mb()))
+
+
+def benchmark_memory(args):
+    """
+    Report the peak RSS of a full synthetic GO propagation with the old
+    dict-based annotations and with go.Annotation. Each run happens in its
+    own process so that the peaks are independent.
+    """
+    runs = [('go.Annotation', go_module.Annotation)]
+    if not args.skip_baseline:
+        runs.insert(0, ('legacy annotations', LegacyAnnotation))
+
+    for label, annotation_class in runs:
+        results = multiprocessing.Queue()
+        worker = multiprocessing.Process(
+            target=propagate_peak_rss,
+            args=(args, annotation_class, results))
+        worker.start()
+        (num_annotations, peak_rss) = results.get()
+        worker.join()
+        print '%-40s %10.1f MB peak RSS (%d annotations)' % (
+            label, peak_rss, num_annotations)
+
+
+def benchmark_index(args):
+    """
+    Compare the 'objects' and 'indexed' go() backends: ancestor and
+    descendant queries for --queries random terms, and full propagation.
+    Checks that both backends give the same answers.
+    """
+    backends = {}
+    for backend in ('objects', 'indexed'):
+        ontology = build_synthetic_ontology(args.terms, seed=args.seed,
+                                            backend=backend)
+        add_synthetic_annotations(ontology, args.genes, seed=args.seed)
+        backends[backend] = ontology
+
+    timed('build index', backends['indexed'].get_index)
+
+    rand = random.Random(args.seed)
+    query_ids = rand.sample(sorted(backends['objects'].go_terms.keys()),
+                            min(args.queries, args.terms))
+
+    index = backends['indexed'].get_index()
+    queries = (
+        ('get_ancestors', recursive_ancestors, index.get_ancestors),
+        ('get_descendents', recursive_descendents, index.get_descendents))
+    for (query, objects_query, indexed_query) in queries:
+        answers = {}
+        for (backend, method) in (('objects', objects_query),
+                                  ('indexed', indexed_query)):
+            results = []
+            ontology = backends['objects']
+            if backend == 'objects':
+                method = lambda go_id: objects_query(ontology, go_id)
+            timed('%s (%s)' % (query, backend),
+                  lambda: results.extend(method(go_id)
+                                         for go_id in query_ids))
+            answers[backend] = results
+        if answers['objects'] != answers['indexed']:
+            print 'Backends disagree on %s' % query
+            sys.exit(1)
+
+    for backend in ('objects', 'indexed'):
+        timed('propagate (%s)' % backend, backends[backend].propagate)
+    for go_id, term in backends['objects'].go_terms.iteritems():
+        if term.annotations != backends['indexed'].go_terms[go_id].annotations:
+            print 'Annotations differ for term %s' % go_id
+            sys.exit(1)
+    print 'Identical results from both backends'
+
+
+def object_term_annotations(ontology, annotations):
+    """
+    The default ('objects') GO propagation of process_go_terms(), returning
+    the same dictionary as process_go.get_bitset_term_annotations().
+    """
+    for (xrdb, xrid, goid, refstring, date) in annotations:
+        ontology.add_annotation(go_id=goid, gid=xrid, xdb=xrdb, date=date,
+                                ref=process_go.get_pubmed_id(refstring),
+                                direct=True)
+    ontology.propagate()
+
+    term_annotations = {}
+    for (term_id, term) in ontology.go_terms.iteritems():
+        if term.annotations:
+            term_annotations[term_id] = process_go.get_term_annotations(term)
+    return term_annotations
+
+
+def benchmark_bitset(args):
+    """
+    Time the 'objects' and 'bitset' GO propagation modes of
+    process_go_terms() on the same synthetic ontology and annotations, and
+    check that they give every term the same genes and publications.
+    """
+    outputs = {}
+    for (label, func) in (('objects', object_term_annotations),
+                          ('bitset', process_go.get_bitset_term_annotations)):
+        ontology = build_synthetic_ontology(args.terms, seed=args.seed)
+        annotations = build_synthetic_gaf_annotations(ontology, args.genes,
+                                                      seed=args.seed)
+        result = []
+        timed('propagation (%s)' % label,
+              lambda: result.append(func(ontology, annotations)))
+        outputs[label] = result[0]
+
+    for (term_id, (term_genes, xrdb)) in outputs['objects'].iteritems():
+        term_genes = dict((gene, sorted(set(pubs))) for (gene, pubs) in
+                          term_genes.iteritems())
+        if outputs['bitset'].get(term_id) != (term_genes, xrdb):
+            print 'Propagation modes differ for term %s' % term_id
+            sys.exit(1)
+    if len(outputs['bitset']) != len(outputs['objects']):
+        print 'Propagation modes annotate different terms'
+        sys.exit(1)
+    print 'Identical gene sets from both propagation modes'
+
+
+def benchmark_reachability(args):
+    """
+    Time go.get_ancestors() and go.get_descendents() (which build a closure
+    of the whole ontology on their first call) on every term of the
+    ontology, against the old recursive queries on --queries random terms,
+    and check that they agree on those terms. Use --obo to run it on a
+    real OBO file such as go-basic.obo.
+    """
+    ontology = load_benchmark_ontology(args)
+    go_ids = sorted(ontology.go_terms.keys())
+    rand = random.Random(args.seed)
+    query_ids = rand.sample(go_ids, min(args.queries, len(go_ids)))
+
+    queries = (('get_ancestors', recursive_ancestors),
+               ('get_descendents', recursive_descendents))
+    for (query, recursive_query) in queries:
+        method = getattr(ontology, query)
+        elapsed = timed('%s, all %d terms' % (query, len(go_ids)),
+                        lambda: [method(go_id) for go_id in go_ids])
+        print '%-40s %10.1f us/query' % ('', elapsed * 1e6 / len(go_ids))
+
+        if args.skip_baseline:
+            continue
+        expected = []
+        elapsed = timed('recursive %s, %d terms' % (query, len(query_ids)),
+                        lambda: expected.extend(recursive_query(
+                            ontology, go_id) for go_id in query_ids))
+        print '%-40s %10.1f us/query' % ('', elapsed * 1e6 / len(query_ids))
+        if expected != [method(go_id) for go_id in query_ids]:
+            print 'Cached and recursive %s disagree' % query
+            sys.exit(1)
+
+    ontology.prune('False')
+    timed('rebuild after prune()',
+          lambda: ontology.get_ancestors(go_ids[0]))
+
+
+def benchmark_parse(args):
+    """
+    Time go.load_obo() plus the DO OMIM xref extraction, which now share a
+    single pass over the OBO file, against the old split()-based parser
+    followed by process_do.build_doid_omim_dict() as it was before (a
+    second read of the whole file), and check that both parsers produce
+    the same terms. Use --obo to run it on a real file such as
+    go-basic.obo; otherwise a synthetic OBO with --terms terms is written
+    to a temporary file.
+    """
+    obo_file = args.obo
+    if obo_file is None:
+        (obo_fd, obo_file) = tempfile.mkstemp(suffix='.obo')
+        with os.fdopen(obo_fd, 'w') as obo_fh:
+            obo_fh.write(build_synthetic_obo(args.terms, seed=args.seed))
+
+    try:
+        def single_pass():
+            ontology = go()
+            ontology.load_obo(obo_file)
+            process_do.get_doid_omim_dict(ontology)
+            return ontology
+
+        def two_passes():
+            ontology = go()
+            with open(obo_file) as obo_fh:
+                split_parse(ontology, obo_fh)
+            with open(obo_file) as obo_fh:
+                lines = obo_fh.readlines()[::-1]
+                while lines:
+                    line = lines.pop()
+                    if line.startswith('xref: OMIM:'):
+                        re.search('[0-9]+', line)
+            return ontology
+
+        results = {}
+        runs = [('load_obo() + get_doid_omim_dict()', single_pass)]
+        if not args.skip_baseline:
+            runs.insert(0, ('split() parse + build_doid_omim_dict()',
+                            two_passes))
+        for (label, run) in runs:
+            # Best of three, as a single parse is short and noisy
+            elapsed = []
+            for _ in xrange(3):
+                results[label] = None
+                start = time.time()
+                results[label] = run()
+                elapsed.append(time.time() - start)
+            print '%-40s %10.3f s' % (label, min(elapsed))
+    finally:
+        if args.obo is None:
+            os.remove(obo_file)
+
+    if args.skip_baseline:
+        return
+
+    new_ontology = results['load_obo() + get_doid_omim_dict()']
+    old_ontology = results['split() parse + build_doid_omim_dict()']
+    if sorted(new_ontology.go_terms) != sorted(old_ontology.go_terms):
+        print 'The parsers read different terms'
+        sys.exit(1)
+    for (go_id, term) in new_ontology.go_terms.iteritems():
+        if term_summary(term) != term_summary(old_ontology.go_terms[go_id]):
+            print 'The parsers disagree on term %s' % go_id
+            sys.exit(1)
+    print 'Identical terms (%d)' % len(new_ontology.go_terms)
+
+
+def benchmark_cache(args):
+    """
+    Time go.load_obo() with an empty OBO cache (parse and write the cache)
+    and with a warm one (load the cache), each in a fresh process so that
+    the garbage left by one load does not slow down the next. Use --obo to
+    run it on a real file such as go-basic.obo.
+    """
+    work_dir = tempfile.mkdtemp()
+    try:
+        obo_file = args.obo
+        if obo_file is None:
+            obo_file = os.path.join(work_dir, 'synthetic.obo')
+            with open(obo_file, 'w') as obo_fh:
+                obo_fh.write(build_synthetic_obo(args.terms, seed=args.seed))
+        cache_dir = os.path.join(work_dir, 'cache')
+
+        def load(results):
+            ontology = go()
+            start = time.time()
+            ontology.load_obo(obo_file, cache_dir=cache_dir)
+            results.put(time.time() - start)
+
+        runs = ['load_obo(), cold cache', 'load_obo(), warm cache']
+        if not args.skip_baseline:
+            runs.insert(0, 'load_obo(), no cache')
+        for label in runs:
+            if label.endswith('no cache'):
+                target = lambda results: results.put(timed_load(obo_file))
+            else:
+                target = load
+            results = multiprocessing.Queue()
+            process = multiprocessing.Process(target=target, args=(results,))
+            process.start()
+            elapsed = results.get()
+            process.join()
+            print '%-40s %10.3f s' % (label, elapsed)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def timed_load(obo_file):
+    """
+    Return how long go.load_obo() takes to parse obo_file without a cache.
+    """
+    ontology = go()
+    start = time.time()
+    ontology.load_obo(obo_file)
+    return time.time() - start
+
+
+def benchmark_species(args):
+    """
+    Time a run over --species species that all use the same OBO file:
+    parsing the ontology again for every species and propagating on its
+    GOTerm objects, against parsing it once and propagating each species
+    in its own go.AnnotationLayer. Each species annotates --genes genes
+    with a different seed. Checks that both give the first species the
+    same annotations.
+    """
+    obo_text = build_synthetic_obo(args.terms, seed=args.seed)
+    seeds = [args.seed + number for number in xrange(args.species)]
+
+    def parse():
+        ontology = go()
+        ontology.parse(StringIO(obo_text))
+        return ontology
+
+    def reparse_per_species():
+        first = None
+        for seed in seeds:
+            ontology = parse()
+            add_synthetic_annotations(ontology, args.genes, seed=seed)
+            ontology.propagate()
+            if first is None:
+                first = ontology
+        return first
+
+    def shared_ontology():
+        ontology = parse()
+        first = None
+        for seed in seeds:
+            layer = AnnotationLayer(ontology)
+            add_synthetic_annotations(ontology, args.genes, seed=seed,
+                                      layer=layer)
+            layer.propagate()
+            if first is None:
+                first = layer
+        return first
+
+    results = {}
+    runs = [('shared ontology + layers', shared_ontology)]
+    if not args.skip_baseline:
+        runs.insert(0, ('parse per species', reparse_per_species))
+    for (label, run) in runs:
+        start = time.time()
+        results[label] = run()
+        print '%-40s %10.3f s' % (label, time.time() - start)
+
+    if args.skip_baseline:
+        return
+    old_ontology = results['parse per species']
+    layer = results['shared ontology + layers']
+    for (go_id, term) in old_ontology.go_terms.iteritems():
+        if term.annotations != layer.get_annotations(go_id):
+            print 'Annotations differ for term %s' % go_id
+            sys.exit(1)
+    print 'Identical annotations for the first species'
+
+
+GAF_TAXA = ['9606', '10090', '10116', '7955', '7227', '6239', '559292',
+            '3702', '208964', '83333', '9913', '9031']
+
+EVIDENCE_CODES = ['EXP', 'IDA', 'IPI', 'IMP', 'IGI', 'IEP', 'IBA', 'ISS',
+                  'TAS', 'NAS', 'IC', 'ND']
+
+
+def write_synthetic_gaf(gaf_file, num_lines, seed=0, taxa=GAF_TAXA):
+    """
+    Write a gzipped GAF 2.0 file with num_lines annotation lines, spread
+    over the species of taxa (by default GAF_TAXA, like the multi-species
+    UniProt GAF).
+    """
+    rand = random.Random(seed)
+    with gzip.open(gaf_file, 'w') as gaf_fh:
+        gaf_fh.write('!gaf-version: 2.0\n!Synthetic GAF\n')
+        for line_num in xrange(num_lines):
+            gene = 'P%05d' % rand.randint(0, 99999)
+            qualifier = 'NOT' if rand.random() < 0.01 else ''
+            gaf_fh.write('\t'.join([
+                'UniProtKB', gene, 'GENE%s' % gene, qualifier,
+                'GO:%07d' % rand.randint(1, 45000),
+                'PMID:%d' % rand.randint(1, 30000000),
+                rand.choice(EVIDENCE_CODES), '', 'P',
+                'Synthetic protein %s' % gene, 'SYN%s|ALT%s' % (gene, gene),
+                'protein', 'taxon:' + rand.choice(taxa), '20170101',
+                'UniProt', '', '']) + '\n')
+
+
+def split_filtered_annotations(assoc_file, accepted_evcodes=None,
+                               tax_id=None):
+    """
+    The loop that get_filtered_annotations() used before it streamed the
+    file and pushed its filters down, which splits every line and builds
+    the whole list. Kept here only as the baseline for benchmark_gaf().
+    """
+    if assoc_file.endswith('.gz'):
+        assoc_fh = gzip.open(assoc_file, 'r')
+    else:
+        assoc_fh = open(assoc_file, 'r')
+
+    annotations = []
+    for line in assoc_fh:
+        if line.startswith('!'):
+            continue
+        toks = line.strip().split('\t')
+        (xrdb, xrid, details, goid, refstring, ev_code, taxon, date) = (
+            toks[0], toks[1], toks[3], toks[4], toks[5], toks[6],
+            toks[12].split(':')[1], toks[13])
+        if tax_id and (tax_id != taxon):
+            continue
+        if xrdb in process_go.DB_REMAP:
+            xrdb = process_go.DB_REMAP[xrdb]
+        if xrdb == 'TAIR':
+            tair_regex = re.compile('AT[0-9MC]G[0-9][0-9][0-9][0-9][0-9]')
+            first_alias = toks[10].split('|')[0]
+            if tair_regex.match(toks[2]):
+                xrid = toks[2]
+            elif tair_regex.match(toks[9]):
+                xrid = toks[9]
+            elif tair_regex.match(first_alias):
+                xrid = first_alias
+        if details == 'NOT':
+            continue
+        if accepted_evcodes is not None and (
+                ev_code not in accepted_evcodes):
+            continue
+        annotations.append((xrdb, xrid, goid, refstring, date))
+    return annotations
+
+
+def benchmark_gaf(args):
+    """
+    Measure the throughput, in lines per second, of reading a gzipped GAF
+    for one species with the old list-building reader and with
+    iter_filtered_annotations() in its "lines" and (if pandas is
+    installed) "columnar" modes, and check that they all return the same
+    annotations. Use --gaf to read a real file such as
+    goa_uniprot_all_noiea.gaf.gz; otherwise a synthetic multi-species GAF
+    with --gaf-lines lines is written to a temporary file.
+    """
+    evcodes = ['EXP', 'IDA', 'IPI', 'IMP', 'IGI', 'IEP']
+    work_dir = tempfile.mkdtemp()
+    try:
+        gaf_file = args.gaf
+        if gaf_file is None:
+            gaf_file = os.path.join(work_dir, 'synthetic.gaf.gz')
+            write_synthetic_gaf(gaf_file, args.gaf_lines, seed=args.seed)
+
+        with gzip.open(gaf_file) if gaf_file.endswith('.gz') else \
+                open(gaf_file) as gaf_fh:
+            num_lines = sum(1 for line in gaf_fh)
+
+        def stream(reader):
+            # Only count the annotations, like a consumer that does not
+            # keep them
+            annotations = process_go.iter_filtered_annotations(
+                gaf_file, evcodes, tax_id=args.tax_id, reader=reader)
+            return sum(1 for annotation in annotations)
+
+        runs = [('iter_filtered_annotations(), lines',
+                 lambda: stream('lines')),
+                ('iter_filtered_annotations(), columnar',
+                 lambda: stream('columnar'))]
+        if not args.skip_baseline:
+            runs.insert(0, ('split every line into a list',
+                            lambda: len(split_filtered_annotations(
+                                gaf_file, evcodes, tax_id=args.tax_id))))
+
+        counts = set()
+        for (label, run) in runs:
+            start = time.time()
+            try:
+                counts.add(run())
+            except ImportError:
+                print '%-40s %10s' % (label, 'no pandas')
+                continue
+            elapsed = time.time() - start
+            print '%-40s %10.3f s %12.0f lines/s' % (
+                label, elapsed, num_lines / elapsed)
+    finally:
+        shutil.rmtree(work_dir)
+
+    if len(counts) != 1:
+        print 'The readers found different numbers of annotations: %s' % (
+            sorted(counts))
+        sys.exit(1)
+    print '%d of %d lines kept by every reader' % (counts.pop(), num_lines)
+
+
+def benchmark_shards(args):
+    """
+    Measure the time to read the annotations of the first --species taxa
+    of GAF_TAXA from one multi-species gzipped GAF, by scanning the whole
+    file once per species, and by splitting it into per-taxon shards in
+    one pass (see gaf_shards.py) and reading each species' shard. Uses
+    --gaf, or a synthetic GAF with --gaf-lines lines.
+    """
+    evcodes = ['EXP', 'IDA', 'IPI', 'IMP', 'IGI', 'IEP']
+    tax_ids = GAF_TAXA[:args.species]
+    work_dir = tempfile.mkdtemp()
+    try:
+        gaf_file = args.gaf
+        if gaf_file is None:
+            gaf_file = os.path.join(work_dir, 'synthetic.gaf.gz')
+            write_synthetic_gaf(gaf_file, args.gaf_lines, seed=args.seed)
+
+        def read_all(get_file):
+            return [process_go.get_filtered_annotations(
+                get_file(tax_id), evcodes, tax_id=tax_id)
+                for tax_id in tax_ids]
+
+        runs = [('one pass, then read shards',
+                 lambda: read_all(lambda tax_id: gaf_shards.get_taxon_shard(
+                     gaf_file, work_dir, tax_id, tax_ids)))]
+        if not args.skip_baseline:
+            runs.insert(0, ('scan the whole file per species',
+                            lambda: read_all(lambda tax_id: gaf_file)))
+
+        results = []
+        for (label, run) in runs:
+            start = time.time()
+            results.append(run())
+            print '%-40s %10.3f s for %d species' % (
+                label, time.time() - start, len(tax_ids))
+    finally:
+        shutil.rmtree(work_dir)
+
+    if any(result != results[0] for result in results):
+        print 'The shards gave different annotations than the whole file'
+        sys.exit(1)
+
+
+def benchmark_ingest(args):
+    """
+    Measure the time to read the annotations of --tax-id from two gzipped
+    GAFs, like the human configuration's goa_human.gaf.gz and
+    goa_uniprot_all_noiea.gaf.gz: one file after another with in-process
+    gzip decompression, with decompression in an external process, and
+    with each file also read in its own process. The second file is --gaf,
+    or a synthetic multi-species GAF with --gaf-lines lines; the first is
+    a synthetic single-species GAF with a quarter as many lines.
+    """
+    evcodes = ['EXP', 'IDA', 'IPI', 'IMP', 'IGI', 'IEP']
+    work_dir = tempfile.mkdtemp()
+    decompressor = utils.GZIP_DECOMPRESSOR
+    try:
+        species_gaf = os.path.join(work_dir, 'species.gaf.gz')
+        write_synthetic_gaf(species_gaf, args.gaf_lines // 4,
+                            seed=args.seed, taxa=[args.tax_id])
+        multi_species_gaf = args.gaf
+        if multi_species_gaf is None:
+            multi_species_gaf = os.path.join(work_dir, 'synthetic.gaf.gz')
+            write_synthetic_gaf(multi_species_gaf, args.gaf_lines,
+                                seed=args.seed)
+        assoc_files = [species_gaf, multi_species_gaf]
+
+        def ingest(gzip_decompressor, concurrent):
+            utils.GZIP_DECOMPRESSOR = gzip_decompressor
+            return list(process_go.iter_concurrent_annotations(
+                assoc_files, evcodes, tax_id=args.tax_id,
+                concurrent=concurrent))
+
+        runs = [('in-process gzip, one file at a time', None, False)]
+        if decompressor is None:
+            print 'No external gzip decompressor found'
+        else:
+            runs.extend([
+                ('external %s, one file at a time' %
+                 os.path.basename(decompressor), decompressor, False),
+                ('external %s, files concurrently' %
+                 os.path.basename(decompressor), decompressor, True)])
+
+        results = []
+        for (label, gzip_decompressor, concurrent) in runs:
+            start = time.time()
+            results.append(ingest(gzip_decompressor, concurrent))
+            print '%-45s %10.3f s' % (label, time.time() - start)
+    finally:
+        utils.GZIP_DECOMPRESSOR = decompressor
+        shutil.rmtree(work_dir)
+
+    print '%d annotations, %d CPUs' % (len(results[0]),
+                                       multiprocessing.cpu_count())
+    if any(result != results[0] for result in results):
+        print 'The readers gave different annotations'
+        sys.exit(1)
+
+
+class SlowHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    Local HTTP server that answers every GET request with a small file,
+    after waiting latency seconds, and also waits latency seconds for
+    every new connection, like the TCP/TLS handshake with a remote server.
+    """
+    daemon_threads = True
+
+    def __init__(self, latency):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), SlowRequestHandler)
+        self.latency = latency
+        self.connections = 0
+        self.requests = 0
+
+
+class SlowRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send each response at once, as a real server would, rather than
+    # waiting for the client to acknowledge its first packet
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+        time.sleep(self.server.latency)
+
+    def do_GET(self):
+        self.server.requests += 1
+        time.sleep(self.server.latency)
+        # Like the KEGG REST API, /get/<id>+<id>... returns every entry
+        kegg_ids = os.path.basename(self.path).split('+')
+        body = ''.join('ENTRY       %s\n' % kegg_id + 'x' * 4000 + '\n///\n'
+                       for kegg_id in kegg_ids)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def benchmark_downloads(args):
+    """
+    Measure the time to download --files KEGG-like info files from a local
+    server with --latency seconds of latency per connection and per
+    request, one at a time with utils.download_from_url() and with a
+    download_manager.DownloadManager.
+    """
+    server = SlowHTTPServer(args.latency)
+    server_thread = threading.Thread(target=server.serve_forever,
+                                     kwargs={'poll_interval': 0.01})
+    server_thread.daemon = True
+    server_thread.start()
+    url = 'http://127.0.0.1:%d/get/' % server.server_address[1]
+    kegg_ids = ['hsa%05d' % number for number in range(args.files)]
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        runs = [('DownloadManager, %d at a time' % max_downloads,
+                 download_manager.DownloadManager(
+                     max_downloads=max_downloads).download_all)
+                for max_downloads in (1, 4, 8)]
+        if not args.skip_baseline:
+            runs.insert(0, ('download_from_url() one at a time',
+                            lambda downloads: [utils.download_from_url(*d)
+                                               for d in downloads]))
+
+        for (run_num, (label, download)) in enumerate(runs):
+            folder = os.path.join(work_dir, str(run_num))
+            os.mkdir(folder)
+            connections = server.connections
+            start = time.time()
+            download([(url + kegg_id, folder, None) for kegg_id in kegg_ids])
+            print '%-40s %8.3f s %6d connections' % (
+                label, time.time() - start, server.connections - connections)
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(work_dir)
+
+
+def benchmark_kegg_batches(args):
+    """
+    Measure the time and number of requests to download --files KEGG set
+    info files with download_files.download_kegg_info_files(), one /get
+    request per set and batched, from a local server with --latency seconds
+    of latency per connection and per request.
+    """
+    server = SlowHTTPServer(args.latency)
+    server_thread = threading.Thread(target=server.serve_forever,
+                                     kwargs={'poll_interval': 0.01})
+    server_thread.daemon = True
+    server_thread.start()
+    kegg_ids = ['hsa%05d' % number for number in range(args.files)]
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        runs = [('%d per request, %s' % (batch_size, label), batch_size,
+                 manager) for batch_size in (1, 10) for (label, manager) in
+                [('one at a time', None),
+                 ('DownloadManager', download_manager.DownloadManager())]]
+        if args.skip_baseline:
+            runs = [run for run in runs if run[1] > 1]
+
+        for (run_num, (label, batch_size, manager)) in enumerate(runs):
+            folder = os.path.join(work_dir, str(run_num))
+            os.makedirs(os.path.join(folder, 'KEGG'))
+            species_file = SafeConfigParser()
+            species_file.add_section('species_info')
+            species_file.set('species_info', 'SPECIES_DOWNLOAD_FOLDER',
+                             folder)
+            species_file.add_section('KEGG')
+            species_file.set('KEGG', 'KEGG_ROOT_URL',
+                             'http://127.0.0.1:%d' % server.server_address[1])
+            species_file.set('KEGG', 'SET_INFO_DIR', '/get/')
+            species_file.set('KEGG', 'SET_INFO_BATCH_SIZE', str(batch_size))
+            species_ini_file = os.path.join(folder, 'species.ini')
+            with open(species_ini_file, 'w') as species_fh:
+                species_file.write(species_fh)
+
+            connections = server.connections
+            request_count = server.requests
+            start = time.time()
+            download_files.download_kegg_info_files(kegg_ids,
+                                                    species_ini_file, manager)
+            print '%-40s %8.3f s %6d requests %6d connections' % (
+                label, time.time() - start, server.requests - request_count,
+                server.connections - connections)
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(work_dir)
+
+
+class LargeFileHTTPServer(HTTPServer):
+    """
+    Local HTTP server that answers every GET request with the same large
+    file, supporting Range requests. The next response is cut off after
+    cut_off bytes, if it is set.
+    """
+    def __init__(self, contents):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), LargeFileRequestHandler)
+        self.contents = contents
+        self.cut_off = None
+        self.bytes_sent = 0
+
+
+class LargeFileRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        contents = self.server.contents
+        start = 0
+        if self.headers.get('Range'):
+            start = int(self.headers['Range'][len('bytes='):].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                start, len(contents) - 1, len(contents)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(contents) - start))
+        self.send_header('ETag', '"large"')
+        self.end_headers()
+
+        end = len(contents)
+        if self.server.cut_off is not None:
+            end = min(end, start + self.server.cut_off)
+            self.server.cut_off = None
+            self.close_connection = 1
+        for offset in xrange(start, end, 1 << 20):
+            chunk = buffer(contents, offset, min(1 << 20, end - offset))
+            self.wfile.write(chunk)
+            self.server.bytes_sent += len(chunk)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def download_with_tempfile_copy(url, download_folder):
+    """
+    The previous HTTP download path of utils.download_from_url(): 4 KB
+    chunks written to a NamedTemporaryFile with a flush() after each, then
+    copied again to the target file.
+    """
+    target_filename = os.path.join(download_folder,
+                                   os.path.basename(url))
+    temp = tempfile.NamedTemporaryFile(dir=download_folder)
+    download_request = requests.get(url, stream=True)
+    for chunk in download_request.iter_content(chunk_size=4096):
+        if chunk:
+            temp.write(chunk)
+            temp.flush()
+    temp.seek(0)
+    with open(target_filename, 'w+b') as target_fh:
+        shutil.copyfileobj(temp, target_fh)
+    temp.close()
+
+
+def benchmark_large_download(args):
+    """
+    Measure the throughput of downloading a --size-mb MB file from a local
+    HTTP server, with the previous tempfile-and-copy download path and
+    with utils.download_from_url(), and the bytes sent to finish a
+    download that was cut off halfway, by resuming it.
+    """
+    size = args.size_mb << 20
+    contents = os.urandom(1 << 20) * args.size_mb
+    server = LargeFileHTTPServer(contents)
+    server_thread = threading.Thread(target=server.serve_forever,
+                                     kwargs={'poll_interval': 0.01})
+    server_thread.daemon = True
+    server_thread.start()
+    url = 'http://127.0.0.1:%d/large.gaf.gz' % server.server_address[1]
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        runs = [('download_from_url()', utils.download_from_url)]
+        if not args.skip_baseline:
+            runs.insert(0, ('tempfile and copy', download_with_tempfile_copy))
+
+        for (label, download) in runs:
+            start = time.time()
+            download(url, work_dir)
+            elapsed = time.time() - start
+            print '%-40s %8.3f s %8.1f MB/s' % (label, elapsed,
+                                                 args.size_mb / elapsed)
+            os.remove(os.path.join(work_dir, 'large.gaf.gz'))
+
+        server.cut_off = size // 2
+        utils.download_from_url(url, work_dir)
+        server.bytes_sent = 0
+        start = time.time()
+        utils.download_from_url(url, work_dir)
+        print '%-40s %8.3f s %8.1f MB sent' % (
+            'resume after cut off halfway', time.time() - start,
+            server.bytes_sent / float(1 << 20))
+        with open(os.path.join(work_dir, 'large.gaf.gz'), 'rb') as large_fh:
+            assert large_fh.read() == contents
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(work_dir)
+
+
+def benchmark_incremental(args):
+    """
+    Time run_refinery.process_all_organism_genesets() for a synthetic
+    species with GO terms (a --terms term ontology and a --gaf-lines line
+    GAF): without an incremental folder, with an empty one, with the
+    genesets saved by the previous run, and after the GAF changes.
+    """
+    work_dir = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(work_dir, 'synthetic.obo'), 'w') as obo_fh:
+            obo_fh.write(build_synthetic_obo(args.terms, seed=args.seed))
+        species_folder = os.path.join(work_dir, 'species')
+        os.makedirs(os.path.join(species_folder, 'GO'))
+        gaf_file = os.path.join(species_folder, 'GO', 'synthetic.gaf.gz')
+        write_synthetic_gaf(gaf_file, args.gaf_lines, seed=args.seed)
+
+        species_file = SafeConfigParser()
+        species_file.add_section('species_info')
+        species_file.set('species_info', 'SCIENTIFIC_NAME', 'Homo sapiens')
+        species_file.set('species_info', 'TAXONOMY_ID', args.tax_id)
+        species_file.set('species_info', 'SPECIES_DOWNLOAD_FOLDER',
+                         species_folder)
+        species_file.add_section('GO')
+        species_file.set('GO', 'DOWNLOAD', 'FALSE')
+        species_file.set('GO', 'GO_OBO_URL', 'ftp://example/synthetic.obo')
+        species_file.set('GO', 'ASSOC_FILE_URLS',
+                         'ftp://example/synthetic.gaf.gz')
+        species_file.set('GO', 'EVIDENCE_CODES', ', '.join(EVIDENCE_CODES))
+        species_ini_file = os.path.join(work_dir, 'synthetic.ini')
+        with open(species_ini_file, 'w') as species_fh:
+            species_file.write(species_fh)
+
+        incremental_dir = os.path.join(work_dir, 'incremental')
+
+        def run(label, incremental_dir=None):
+            start = time.time()
+            genesets = run_refinery.process_all_organism_genesets(
+                species_ini_file, work_dir, incremental_dir=incremental_dir)
+            print '%-40s %8.3f s %6d genesets' % (
+                label, time.time() - start, len(genesets))
+
+        if not args.skip_baseline:
+            run('no incremental folder')
+        run('first incremental run', incremental_dir)
+        run('no inputs changed', incremental_dir)
+        write_synthetic_gaf(gaf_file, args.gaf_lines, seed=args.seed + 1)
+        run('GAF changed', incremental_dir)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+class SlowTribeServer(ThreadingMixIn, HTTPServer):
+    """
+    Local mock of the parts of the Tribe API that gene sets are saved with,
+    which waits latency seconds for every new connection and every
+    request, like SlowHTTPServer. Every numeric gene ID is its own Entrez
+    ID, and the annotations of the saved gene sets are kept in genesets,
+    by slug. Gene sets are listed 1000 at a time, with the annotations of
+    their tip versions only if full_annotations is requested, and the
+    number of bytes of the responses is counted in bytes_sent.
+    """
+    daemon_threads = True
+
+    def __init__(self, latency):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), SlowTribeHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = 0
+        self.bytes_sent = 0
+        self.versions = 0
+        self.genesets = {}
+
+
+class SlowTribeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+        time.sleep(self.server.latency)
+
+    def send_json(self, status, data):
+        body = json.dumps(data)
+        with self.server.lock:
+            self.server.bytes_sent += len(body)
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def list_genesets(self, query):
+        params = parse_qs(query)
+        genesets = sorted(
+            (geneset for geneset in self.server.genesets.values()
+             if geneset['title'].startswith(params['title__startswith'][0])),
+            key=lambda geneset: geneset['slug'])
+        offset = int(params.get('offset', ['0'])[0])
+        next_page = None
+        if offset + 1000 < len(genesets):
+            params['offset'] = [str(offset + 1000)]
+            next_page = '/api/v1/geneset/?' + urlencode(params, doseq=True)
+        genesets = genesets[offset:offset + 1000]
+        if params.get('full_annotations') != ['true']:
+            genesets = [dict(geneset, tip=dict(
+                (key, value) for (key, value) in geneset['tip'].iteritems()
+                if key != 'annotations')) for geneset in genesets]
+        self.send_json(200, {'meta': {'next': next_page},
+                             'objects': genesets})
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests += 1
+        time.sleep(self.server.latency)
+        (path, query) = urlsplit(self.path)[2:4]
+        if path == '/api/v1/organism':
+            return self.send_json(200, {'objects': [
+                {'resource_uri': '/api/v1/organism/9606'}]})
+        if path == '/api/v1/geneset/':
+            return self.list_genesets(query)
+        slug = path.rstrip('/').split('/')[-1]
+        if slug not in self.server.genesets:
+            return self.send_json(404, {})
+        self.send_json(200, self.server.genesets[slug])
+
+    def do_POST(self):
+        with self.server.lock:
+            self.server.requests += 1
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        time.sleep(self.server.latency)
+        path = urlsplit(self.path).path
+        if path == '/oauth2/token/':
+            return self.send_json(200, {'access_token': 'token',
+                                        'expires_in': 36000})
+        if path == '/api/v1/gene/xrid_translate':
+            return self.send_json(200, dict(
+                (gene, [int(gene)]) for gene in
+                parse_qs(body).get('gene_list', [])))
+
+        data = json.loads(body)
+        geneset_uri = '/api/v1/geneset/' + data['slug']
+        with self.server.lock:
+            self.server.versions += 1
+            ver_hash = '%040x' % self.server.versions
+        self.server.genesets[data['slug']] = {
+            'slug': data['slug'], 'title': data['title'],
+            'resource_uri': geneset_uri,
+            'tip': {'resource_uri': geneset_uri + '/version',
+                    'ver_hash': ver_hash, 'annotations': [
+                        {'gene': {'entrezid': int(gene)},
+                         'pubs': [{'pmid': pub} for pub in pubs]}
+                        for (gene, pubs) in data['annotations'].iteritems()]}}
+        self.send_json(201, {'title': data['title'],
+                             'tip_item_count': len(data['annotations'])})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def benchmark_tribe_uploads(args):
+    """
+    Measure the time and number of connections to save --files gene sets
+    (of --genes / 10 genes each) to a local mock Tribe server with
+    --latency seconds of latency per connection and per request: creating
+    them, and then checking them with PREFER_UPDATE after a tenth of them
+    have changed. The gene sets are saved one at a time with
+    tribe_loader.load_to_tribe(), and with tribe_loader.upload_genesets().
+    """
+    server = SlowTribeServer(args.latency)
+    server_thread = threading.Thread(target=server.serve_forever,
+                                     kwargs={'poll_interval': 0.01})
+    server_thread.daemon = True
+    server_thread.start()
+    tribe_url = 'http://127.0.0.1:%d' % server.server_address[1]
+
+    rand = random.Random(args.seed)
+    genes_per_set = max(1, args.genes // 10)
+    genesets = [{'title': 'GO-BP-%07d:synthetic term' % number,
+                 'abstract': 'Synthetic gene set.', 'xrdb': 'Entrez',
+                 'organism': 'Homo sapiens',
+                 'slug': 'go%07d-homo-sapiens' % number,
+                 'annotations': dict(
+                     (gene, [rand.randint(1, 30000000)]) for gene in
+                     rand.sample(xrange(1, 40000), genes_per_set))}
+                for number in range(args.files)]
+    changed_genesets = [dict(geneset, annotations=dict(
+        geneset['annotations'], **{'0': []})) if number % 10 == 0
+        else geneset for (number, geneset) in enumerate(genesets)]
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        main_config_file = os.path.join(work_dir, 'main_config.ini')
+        main_config = SafeConfigParser()
+        main_config.add_section('Tribe parameters')
+        main_config.set('Tribe parameters', 'TRIBE_URL', tribe_url)
+        with open(main_config_file, 'w') as main_config_fh:
+            main_config.write(main_config_fh)
+
+        def one_at_a_time(genesets, prefer_update):
+            return [tribe_loader.load_to_tribe(
+                main_config_file, dict(geneset), 'token', 'creator',
+                prefer_update=prefer_update) for geneset in genesets]
+
+        runs = [('upload_genesets(), %d at a time' % max_uploads,
+                 lambda genesets, prefer_update, max_uploads=max_uploads:
+                 tribe_loader.upload_genesets(
+                     tribe_url, [dict(geneset) for geneset in genesets],
+                     'token', 'creator', prefer_update=prefer_update,
+                     max_uploads=max_uploads))
+                for max_uploads in (1, 4, 8)]
+        if not args.skip_baseline:
+            runs.insert(0, ('load_to_tribe() one at a time', one_at_a_time))
+
+        for (label, upload) in runs:
+            for (stage, stage_genesets, prefer_update) in (
+                    ('create', genesets, False),
+                    ('update', changed_genesets, True)):
+                if not prefer_update:
+                    server.genesets.clear()
+                (connections, request_count) = (server.connections,
+                                                server.requests)
+                start = time.time()
+                responses = upload(stage_genesets, prefer_update)
+                elapsed = time.time() - start
+                assert all(tribe_loader.was_saved(response)
+                           for response in responses)
+                print '%-34s %-6s %8.3f s %6d requests %6d connections' % (
+                    label, stage, elapsed, server.requests - request_count,
+                    server.connections - connections)
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(work_dir)
+
+
+def benchmark_tribe_changes(args):
+    """
+    Measure the time, number of requests and amount of data transferred to
+    tell which of --files gene sets (of --genes / 10 genes each) have
+    changed since they were saved to a local mock Tribe server with
+    --latency seconds of latency, after a hundredth of them have changed:
+    with CHANGE_DETECTION: annotations (every gene set in Tribe is
+    retrieved with its full annotations), and with CHANGE_DETECTION:
+    digests, the first time (every gene set is compared in full) and once
+    the version hashes of the unchanged gene sets are recorded.
+    """
+    server = SlowTribeServer(args.latency)
+    server_thread = threading.Thread(target=server.serve_forever,
+                                     kwargs={'poll_interval': 0.01})
+    server_thread.daemon = True
+    server_thread.start()
+
+    rand = random.Random(args.seed)
+    genes_per_set = max(1, args.genes // 10)
+    genesets = [{'title': 'GO-BP-%07d:synthetic term' % number,
+                 'abstract': 'Synthetic gene set.', 'xrdb': 'Entrez',
+                 'organism': 'Homo sapiens',
+                 'slug': 'go%07d-homo-sapiens' % number,
+                 'annotations': dict(
+                     (gene, [rand.randint(1, 30000000)]) for gene in
+                     rand.sample(xrange(1, 40000), genes_per_set))}
+                for number in range(args.files)]
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        species_file = os.path.join(work_dir, 'human.ini')
+        with open(species_file, 'w') as species_fh:
+            species_fh.write('[species_info]\nSCIENTIFIC_NAME: Homo sapiens'
+                             '\n')
+        secrets_file = os.path.join(work_dir, 'secrets.ini')
+        with open(secrets_file, 'w') as secrets_fh:
+            secrets_fh.write('[Tribe secrets]\nTRIBE_ID: id\n'
+                             'TRIBE_SECRET: secret\nUSERNAME: creator\n'
+                             'PASSWORD: password\n')
+
+        def get_client(change_detection):
+            main_config = SafeConfigParser()
+            main_config.add_section('main')
+            main_config.set('main', 'SECRETS_FILE', secrets_file)
+            main_config.set('main', 'GENESET_HASHES_DIR',
+                            os.path.join(work_dir, 'hashes'))
+            main_config.add_section('Tribe parameters')
+            main_config.set('Tribe parameters', 'TRIBE_URL',
+                            'http://127.0.0.1:%d' % server.server_address[1])
+            main_config.set('Tribe parameters', 'MAX_UPLOADS', '8')
+            main_config.set('Tribe parameters', 'CHANGE_DETECTION',
+                            change_detection)
+            return tribe_loader.TribeClient(main_config)
+
+        client = get_client('annotations')
+        client.upload_genesets([dict(geneset) for geneset in genesets])
+        client.close()
+        for geneset in genesets[::100]:
+            geneset['annotations'][0] = []
+
+        for (label, change_detection) in (
+                ('annotations', 'annotations'),
+                ('digests, first run', 'digests'),
+                ('digests, versions recorded', 'digests')):
+            client = get_client(change_detection)
+            client.get_access_token()
+            (request_count, bytes_sent) = (server.requests,
+                                           server.bytes_sent)
+            start = time.time()
+            changed_genesets = client.get_all_changed_genesets(species_file,
+                                                               genesets)
+            elapsed = time.time() - start
+            client.close()
+            assert len(changed_genesets) == len(genesets[::100])
+            print '%-28s %8.3f s %6d requests %9.2f MB' % (
+                label, elapsed, server.requests - request_count,
+                (server.bytes_sent - bytes_sent) / 1e6)
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(work_dir)
+
+
+def benchmark_json_output(args):
+    """
+    Measure the time to write --files * 10 gene sets (of --genes / 10 genes
+    each) to a JSON file, and the size of the file: with
+    json.dump(genesets, indent=2), and with json_output.GenesetWriter in
+    each format.
+    """
+    rand = random.Random(args.seed)
+    genes_per_set = max(1, args.genes // 10)
+    genesets = [{'title': 'GO-BP-%07d:synthetic term' % number,
+                 'abstract': 'Synthetic gene set.', 'xrdb': 'Entrez',
+                 'organism': 'Homo sapiens', 'tags': ['synthetic'],
+                 'slug': 'go%07d-homo-sapiens' % number,
+                 'annotations': dict(
+                     (gene, [rand.randint(1, 30000000)]) for gene in
+                     rand.sample(xrange(1, 40000), genes_per_set))}
+                for number in range(args.files * 10)]
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        json_file = os.path.join(work_dir, 'genesets.json')
+
+        def json_dump():
+            with open(json_file, 'w') as json_fh:
+                json.dump(genesets, json_fh, indent=2)
+
+        def write(**writer_options):
+            writer = json_output.GenesetWriter(json_file, **writer_options)
+            writer.write_genesets(genesets)
+            writer.close()
+
+        runs = [('GenesetWriter, json', write, {}),
+                ('GenesetWriter, json, compact', write, {'compact': True}),
+                ('GenesetWriter, ndjson, compact', write,
+                 {'json_format': 'ndjson', 'compact': True}),
+                ('GenesetWriter, ndjson, compact, gzip', write,
+                 {'json_format': 'ndjson', 'compact': True,
+                  'compress': True})]
+        if not args.skip_baseline:
+            runs.insert(0, ('json.dump(indent=2)', json_dump, {}))
+
+        for (label, output, writer_options) in runs:
+            start = time.time()
+            output(**writer_options)
+            elapsed = time.time() - start
+            print '%-38s %8.3f s %9.2f MB' % (
+                label, elapsed, os.path.getsize(json_file) / 1e6)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def benchmark_columnar_output(args):
+    """
+    Measure the time to find the slugs of the gene sets that a gene is
+    annotated to, among --files * 10 gene sets (of --genes / 10 genes each)
+    written to a file: by loading the JSON output, by memory-mapping the npy
+    annotations table, and by reading the slug and gene columns of the
+    Parquet table, if pyarrow is installed.
+    """
+    import numpy
+
+    rand = random.Random(args.seed)
+    genes_per_set = max(1, args.genes // 10)
+    genesets = [{'title': 'GO-BP-%07d:synthetic term' % number,
+                 'abstract': 'Synthetic gene set.', 'xrdb': 'Entrez',
+                 'organism': 'Homo sapiens', 'tags': ['synthetic'],
+                 'slug': 'go%07d-homo-sapiens' % number,
+                 'annotations': dict(
+                     (gene, [rand.randint(1, 30000000)]) for gene in
+                     rand.sample(xrange(1, 40000), genes_per_set))}
+                for number in range(args.files * 10)]
+    gene = genesets[0]['annotations'].keys()[0]
+    expected = sorted(geneset['slug'] for geneset in genesets
+                      if gene in geneset['annotations'])
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        json_file = os.path.join(work_dir, 'genesets.json')
+        writer = json_output.GenesetWriter(json_file, compact=True)
+        writer.write_genesets(genesets)
+        writer.close()
+
+        columnar_dir = os.path.join(work_dir, 'columnar')
+        start = time.time()
+        columnar_output.write_columnar_tables(columnar_dir, 'human.ini',
+                                              genesets, 'npy')
+        print 'Wrote npy tables in %.3f s' % (time.time() - start)
+        try:
+            import pyarrow.parquet
+            start = time.time()
+            columnar_output.write_columnar_tables(columnar_dir, 'human.ini',
+                                                  genesets, 'parquet')
+            print 'Wrote Parquet tables in %.3f s' % (time.time() - start)
+        except ImportError:
+            pyarrow = None
+        del genesets
+
+        def json_query():
+            with open(json_file) as json_fh:
+                return [geneset['slug'] for geneset in json.load(json_fh)
+                        if str(gene) in geneset['annotations']]
+
+        def npy_query():
+            table = columnar_output.read_npy_table(
+                columnar_output.get_table_location(
+                    columnar_dir, 'human.ini', 'annotations', 'npy'))
+            genes = table['gene.dictionary']
+            index = numpy.searchsorted(genes, str(gene))
+            if index == len(genes) or genes[index] != str(gene):
+                return []
+            slug_indices = numpy.unique(
+                table['slug.indices'][table['gene.indices'] == index])
+            return list(table['slug.dictionary'][slug_indices])
+
+        def parquet_query():
+            table = pyarrow.parquet.read_table(
+                columnar_output.get_table_location(
+                    columnar_dir, 'human.ini', 'annotations'),
+                columns=['slug', 'gene'], memory_map=True).to_pydict()
+            return list(set(slug for (slug, table_gene) in
+                            zip(table['slug'], table['gene'])
+                            if table_gene == str(gene)))
+
+        runs = [('npy tables, memory-mapped', npy_query)]
+        if pyarrow is not None:
+            runs.append(('Parquet tables', parquet_query))
+        else:
+            print 'pyarrow is not installed: skipping the Parquet tables.'
+        if not args.skip_baseline:
+            runs.insert(0, ('json.load of the JSON output', json_query))
+
+        for (label, query) in runs:
+            start = time.time()
+            slugs = query()
+            elapsed = time.time() - start
+            assert sorted(slugs) == expected, label
+            print '%-38s %8.3f s %6d gene sets' % (label, elapsed,
+                                                    len(slugs))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def output_peak_rss(args, lazy, json_file, results):
+    """
+    Propagate synthetic annotations through a synthetic ontology, write
+    its GO terms to json_file with json_output.GenesetWriter, from a list
+    of them or (with lazy) as they are generated, and put the time that
+    took, and the peak RSS of the process, in the results queue. Meant to
+    be run in a fresh process.
+    """
+    ontology = build_synthetic_ontology(args.terms, seed=args.seed)
+    layer = AnnotationLayer(ontology)
+    add_synthetic_annotations(ontology, args.genes, seed=args.seed,
+                              layer=layer)
+    layer.propagate()
+
+    start = time.time()
+    go_terms = process_go.iter_go_terms(ontology, 'Homo sapiens',
+                                        annotation_layer=layer)
+    if not lazy:
+        go_terms = list(go_terms)
+    writer = json_output.GenesetWriter(json_file, compact=True)
+    writer.write_genesets(go_terms)
+    writer.close()
+    results.put((time.time() - start, peak_rss_mb()))
+
+
+def benchmark_pipeline(args):
+    """
+    Report the time and the peak RSS of writing the GO terms of a
+    synthetic ontology of --terms terms (with --genes genes) to a JSON
+    file, from a list of all of them and as they are generated. Each run
+    happens in its own process so that the peaks are independent.
+    """
+    runs = [('generated GO terms', True)]
+    if not args.skip_baseline:
+        runs.insert(0, ('list of GO terms', False))
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        json_file = os.path.join(work_dir, 'genesets.json')
+        for (label, lazy) in runs:
+            results = multiprocessing.Queue()
+            worker = multiprocessing.Process(
+                target=output_peak_rss,
+                args=(args, lazy, json_file, results))
+            worker.start()
+            (elapsed, peak_rss) = results.get()
+            worker.join()
+            print '%-40s %8.3f s %10.1f MB peak RSS' % (label, elapsed,
+                                                         peak_rss)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+BENCHMARKS = {
+    'propagate': benchmark_propagate,
+    'memory': benchmark_memory,
+    'index': benchmark_index,
+    'bitset': benchmark_bitset,
+    'reachability': benchmark_reachability,
+    'parse': benchmark_parse,
+    'cache': benchmark_cache,
+    'species': benchmark_species,
+    'gaf': benchmark_gaf,
+    'shards': benchmark_shards,
+    'ingest': benchmark_ingest,
+    'downloads': benchmark_downloads,
+    'kegg_batches': benchmark_kegg_batches,
+    'large_download': benchmark_large_download,
+    'incremental': benchmark_incremental,
+    'tribe_uploads': benchmark_tribe_uploads,
+    'tribe_changes': benchmark_tribe_changes,
+    'json_output': benchmark_json_output,
+    'columnar_output': benchmark_columnar_output,
+    'pipeline': benchmark_pipeline,
+}
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig()
+
+    parser = argparse.ArgumentParser(
+        description='Benchmarks for the annotation refinery.')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument('--terms', type=int, default=45000,
+                        help='Number of terms in the synthetic ontology.')
+    parser.add_argument('--genes', type=int, default=2000,
+                        help='Number of synthetically annotated genes.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for the synthetic data generators.')
+    parser.add_argument('--obo',
+                        help='OBO file to use instead of a synthetic '
+                        'ontology, where supported.')
+    parser.add_argument('--queries', type=int, default=500,
+                        help='Number of terms to run graph queries on.')
+    parser.add_argument('--species', type=int, default=9,
+                        help='Number of species sharing one ontology.')
+    parser.add_argument('--gaf',
+                        help='GAF file to use instead of a synthetic one.')
+    parser.add_argument('--gaf-lines', type=int, default=2000000,
+                        help='Number of lines in the synthetic GAF.')
+    parser.add_argument('--tax-id', default='9606',
+                        help='Taxonomy ID of the species read from the GAF.')
+    parser.add_argument('--files', type=int, default=300,
+                        help='Number of files to download.')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='Seconds of latency of the local HTTP server.')
+    parser.add_argument('--size-mb', type=int, default=256,
+                        help='Size of the large file to download, in MB.')
+    parser.add_argument('--skip-baseline', action='store_true',
+                        help='Only time the current implementation.')
+
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
@@ -0,0 +1,332 @@
+"""
+Columnar output of the processed gene sets, for PROCESS_TO: Columnar
+files.
+
+The gene sets of each species are written to two tables in COLUMNAR_DIR:
+
+* <species file name>.genesets, with one row per gene set: its slug,
+  title, abstract, organism, xrdb and tags (a list of strings), and
+
+* <species file name>.annotations, with one row per gene set, gene and
+  publication: the slug of the gene set, the gene (as a string), and the
+  PubMed ID of the publication, or null (0 in npy tables) for a gene that
+  is annotated without publications.
+
+Consumers can then read and filter only the columns they need, instead of
+parsing the nested annotations of every gene set in the JSON output.
+
+With COLUMNAR_FORMAT: parquet (the default), each table is a Parquet file,
+<table>.parquet, whose columns are dictionary-encoded. Writing it requires
+pyarrow. With COLUMNAR_FORMAT: npy, or if pyarrow is not installed, each
+table is a folder with a numpy .npy file per column, which can be
+memory-mapped (see read_npy_table()). Its string columns are
+dictionary-encoded: <column>.indices.npy has the index of the value of each
+row in <column>.dictionary.npy, the sorted, UTF-8 encoded values. The tags
+of row i are the values of tags.indices[tags.offsets[i]:tags.offsets[i + 1]].
+
+The tables of a species are replaced by every run, and always have all of
+its gene sets, whatever the OUTPUT_MODE. Unlike the JSON output, this
+output is not memory-bounded: the gene sets of a species can be a
+generator, but all the rows of its tables are held in memory while they
+are written.
+"""
+
+import os
+import sys
+import glob
+import shutil
+import tempfile
+
+from utils import write_atomically
+
+# Import and set logger
+import logging
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Formats of the tables
+COLUMNAR_FORMATS = ('parquet', 'npy')
+
+# String columns of the gene sets table, besides tags
+GENESET_COLUMNS = ('slug', 'title', 'abstract', 'organism', 'xrdb')
+
+
+def get_columnar_output_options(main_config_file):
+    """
+    Read the settings of the columnar output from the "main" section of
+    the main configuration file.
+
+    Arguments:
+    main_config_file -- The SafeConfigParser of the main configuration
+    file.
+
+    Returns:
+    A tuple (columnar_dir, columnar_format), of the COLUMNAR_DIR that the
+    tables are written to, and the COLUMNAR_FORMAT (one of
+    COLUMNAR_FORMATS).
+    """
+    if not main_config_file.has_option('main', 'COLUMNAR_DIR'):
+        logger.error('Main configuration file must have a "COLUMNAR_DIR" '
+                     'option in the "main" section for PROCESS_TO to be '
+                     '"Columnar files".')
+        sys.exit(1)
+    columnar_dir = main_config_file.get('main', 'COLUMNAR_DIR')
+
+    columnar_format = 'parquet'
+    if main_config_file.has_option('main', 'COLUMNAR_FORMAT'):
+        columnar_format = main_config_file.get('main',
+                                               'COLUMNAR_FORMAT').lower()
+        if columnar_format not in COLUMNAR_FORMATS:
+            logger.error('COLUMNAR_FORMAT option in the main configuration '
+                         'file must be one of: %s.',
+                         ', '.join(COLUMNAR_FORMATS))
+            sys.exit(1)
+    return (columnar_dir, columnar_format)
+
+
+def get_table_location(columnar_dir, species_ini_file, table,
+                       columnar_format='parquet'):
+    """
+    Return the location of a table ('genesets' or 'annotations') of a
+    species in columnar_dir: a Parquet file, or a folder of npy files.
+    """
+    location = os.path.join(columnar_dir, '%s.%s' % (
+        os.path.basename(species_ini_file), table))
+    if columnar_format == 'parquet':
+        location += '.parquet'
+    return location
+
+
+def get_pmid(pub):
+    """
+    Return the PubMed ID pub as an integer, or None if it is missing or is
+    not a number (e.g. the empty PMID of a malformed GAF reference).
+    """
+    try:
+        return int(pub)
+    except (TypeError, ValueError):
+        return None
+
+
+def get_table_columns(genesets):
+    """
+    Return the columns of the gene sets and annotations tables of
+    genesets, as two dictionaries of column name -> list of values. Missing
+    titles, abstracts, organisms and xrdbs are empty strings. Publications
+    that are not PubMed IDs are left out, with a warning.
+
+    All the values are held in lists, so this holds all the rows of the
+    tables of genesets in memory, even if genesets is a generator.
+    """
+    geneset_columns = dict((column, []) for column in GENESET_COLUMNS)
+    geneset_columns['tags'] = []
+    annotation_columns = {'slug': [], 'gene': [], 'pmid': []}
+
+    slugs = annotation_columns['slug']
+    genes = annotation_columns['gene']
+    pmids = annotation_columns['pmid']
+    invalid_pmids = 0
+    for geneset in genesets:
+        for column in GENESET_COLUMNS:
+            geneset_columns[column].append(geneset.get(column) or '')
+        geneset_columns['tags'].append(list(geneset.get('tags') or ()))
+
+        slug = geneset['slug']
+        for (gene, pubs) in geneset['annotations'].iteritems():
+            gene = '%s' % (gene,)
+            pmid_list = []
+            for pub in pubs or ():
+                pmid = get_pmid(pub)
+                if pmid is not None:
+                    pmid_list.append(pmid)
+                elif pub is not None:
+                    invalid_pmids += 1
+            for pmid in pmid_list or (None,):
+                slugs.append(slug)
+                genes.append(gene)
+                pmids.append(pmid)
+
+    if invalid_pmids:
+        logger.warning('%s publications of the annotations that are not '
+                       'PubMed IDs were left out of the columnar tables.',
+                       invalid_pmids)
+    return (geneset_columns, annotation_columns)
+
+
+def write_parquet_tables(columnar_dir, species_ini_file, geneset_columns,
+                         annotation_columns):
+    """
+    Write the gene sets and annotations tables of a species as Parquet
+    files, with pyarrow. Raises ImportError if pyarrow is not installed.
+    """
+    import pyarrow
+    import pyarrow.parquet
+
+    tables = {
+        'genesets': pyarrow.Table.from_arrays(
+            [pyarrow.array(geneset_columns[column], type=pyarrow.string())
+             for column in GENESET_COLUMNS] +
+            [pyarrow.array(geneset_columns['tags'],
+                           type=pyarrow.list_(pyarrow.string()))],
+            names=list(GENESET_COLUMNS) + ['tags']),
+        'annotations': pyarrow.Table.from_arrays(
+            [pyarrow.array(annotation_columns['slug'],
+                           type=pyarrow.string()),
+             pyarrow.array(annotation_columns['gene'],
+                           type=pyarrow.string()),
+             pyarrow.array(annotation_columns['pmid'],
+                           type=pyarrow.int64())],
+            names=['slug', 'gene', 'pmid'])}
+
+    for (table, arrow_table) in tables.iteritems():
+        write_atomically(
+            get_table_location(columnar_dir, species_ini_file, table),
+            lambda table_fh, arrow_table=arrow_table:
+            pyarrow.parquet.write_table(arrow_table, table_fh,
+                                        use_dictionary=True))
+
+
+def encode_strings(values):
+    """
+    Dictionary-encode a list of strings.
+
+    Returns:
+    A tuple (dictionary, indices) of numpy arrays: the sorted, UTF-8
+    encoded distinct values, and the index of each value in dictionary.
+    """
+    import numpy
+
+    encoded = numpy.array([value.encode('utf-8')
+                           if isinstance(value, unicode) else value
+                           for value in values], dtype=str)
+    (dictionary, indices) = numpy.unique(encoded, return_inverse=True)
+    return (dictionary, indices.astype(numpy.int32))
+
+
+def write_npy_table(table_dir, columns, list_columns=(),
+                    integer_columns=()):
+    """
+    Write the columns (a dictionary of name -> list of values) of a table
+    to a folder table_dir of npy files, which replaces any earlier one.
+    The columns in integer_columns are written as they are, and the other
+    ones, of strings, dictionary encoded (see encode_strings()). The
+    columns in list_columns have lists of strings as values, whose offsets
+    are written as well.
+    """
+    import numpy
+
+    parent_dir = os.path.dirname(table_dir) or '.'
+    tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(table_dir) + '.',
+                               dir=parent_dir)
+
+    def save(name, array):
+        numpy.save(os.path.join(tmp_dir, name + '.npy'), array)
+
+    try:
+        for (column, values) in columns.iteritems():
+            if column in list_columns:
+                offsets = numpy.zeros(len(values) + 1, dtype=numpy.int64)
+                numpy.cumsum([len(value) for value in values],
+                             out=offsets[1:])
+                save(column + '.offsets', offsets)
+                values = [item for value in values for item in value]
+            elif column in integer_columns:
+                save(column, numpy.array(values, dtype=numpy.int64))
+                continue
+
+            (dictionary, indices) = encode_strings(values)
+            save(column + '.dictionary', dictionary)
+            save(column + '.indices', indices)
+
+        if os.path.isdir(table_dir):
+            shutil.rmtree(table_dir)
+        os.rename(tmp_dir, table_dir)
+    finally:
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+
+
+def write_npy_tables(columnar_dir, species_ini_file, geneset_columns,
+                     annotation_columns):
+    """
+    Write the gene sets and annotations tables of a species as folders of
+    npy files, with numpy. Raises ImportError if numpy is not installed.
+    """
+    import numpy  # noqa
+
+    annotation_columns = dict(annotation_columns)
+    annotation_columns['pmid'] = [pmid or 0 for pmid in
+                                  annotation_columns['pmid']]
+
+    write_npy_table(get_table_location(columnar_dir, species_ini_file,
+                                       'genesets', 'npy'),
+                    geneset_columns, list_columns=('tags',))
+    write_npy_table(get_table_location(columnar_dir, species_ini_file,
+                                       'annotations', 'npy'),
+                    annotation_columns, integer_columns=('pmid',))
+
+
+def write_columnar_tables(columnar_dir, species_ini_file, genesets,
+                          columnar_format='parquet'):
+    """
+    Write the gene sets and annotations tables of the genesets of a
+    species to columnar_dir.
+
+    Arguments:
+    columnar_dir -- A string, the folder the tables are written to, which
+    is created if it does not exist.
+
+    species_ini_file -- A string, location of the species INI file.
+
+    genesets -- Any iterable of the processed gene sets of the species,
+    such as a generator of them, which is only gone through once.
+
+    columnar_format -- Optional. One of COLUMNAR_FORMATS. If it is
+    'parquet' and pyarrow is not installed, npy tables are written instead.
+
+    Returns:
+    The format that the tables were written in.
+    """
+    if not os.path.isdir(columnar_dir):
+        try:
+            os.makedirs(columnar_dir)
+        except OSError:
+            if not os.path.isdir(columnar_dir):
+                raise
+
+    (geneset_columns, annotation_columns) = get_table_columns(genesets)
+
+    if columnar_format == 'parquet':
+        try:
+            write_parquet_tables(columnar_dir, species_ini_file,
+                                 geneset_columns, annotation_columns)
+            return 'parquet'
+        except ImportError:
+            logger.warning('pyarrow is needed for Parquet columnar files. '
+                           'Writing npy files instead.')
+
+    try:
+        write_npy_tables(columnar_dir, species_ini_file, geneset_columns,
+                         annotation_columns)
+    except ImportError:
+        logger.error('numpy (or pyarrow, for Parquet files) is needed for '
+                     'PROCESS_TO to be "Columnar files".')
+        sys.exit(1)
+    return 'npy'
+
+
+def read_npy_table(table_dir, mmap_mode='r'):
+    """
+    Return the columns of a folder of npy files written by
+    write_npy_table(), as a dictionary of file name (without .npy, e.g.
+    'gene.indices') -> numpy array, memory-mapped with mmap_mode (see
+    numpy.load()) so that only the parts of the columns that are used are
+    read.
+    """
+    import numpy
+
+    columns = {}
+    for npy_file in glob.glob(os.path.join(table_dir, '*.npy')):
+        name = os.path.basename(npy_file)[:-len('.npy')]
+        columns[name] = numpy.load(npy_file, mmap_mode=mmap_mode)
+    return columns
@@ -5,6 +5,8 @@ script_directory=`dirname "${BASH_SOURCE[0]}" | xargs realpath`
 cd $script_directory
 source annotenv/bin/activate
 
-rm -r download_files/
+# The download folder is kept between runs: with REVALIDATE: TRUE in
+# main_config.ini, only the files that have changed upstream are
+# downloaded again.
 
 python run_refinery.py --INI_file=main_config.ini
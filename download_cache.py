@@ -0,0 +1,319 @@
+"""
+Revalidation of downloaded files, so that a nightly run can keep its
+download folder instead of deleting it and downloading every GAF and OBO
+file again.
+
+When files are downloaded with revalidate=True (see the REVALIDATE option
+of the [download_folder] section of the main configuration file), a
+sidecar manifest, <file>.download.json, is written next to each of them,
+with the SHA-1 digest of its URL (not the URL itself, which can hold a
+secret, such as the OMIM API key of the genemap file), its size, SHA-1
+checksum, and the validators the server sent for it: the ETag and Last-Modified headers of HTTP(S) files, and the MDTM
+(modification time) and SIZE of FTP files.
+
+The next revalidating run sends a conditional GET request (If-None-Match
+and If-Modified-Since) for HTTP(S) files, which the server answers with
+"304 Not Modified" if the file has not changed, and compares the MDTM and
+SIZE of FTP files with those in the manifest. Only files that have changed
+are downloaded again. Files from servers that send no validators are
+downloaded again, but if their checksum has not changed, the existing file
+is kept as it is, so that the caches keyed by its contents or
+modification time (see go_cache.py and gaf_shards.py) stay valid.
+
+Files are downloaded to <file>.partial, with the validators of the version
+being downloaded in <file>.partial.download.json. If a download is
+interrupted, the next attempt resumes it from the end of the partial file,
+with an HTTP Range request or an FTP REST command, as long as the file has
+not changed on the server since (see get_resume_validator()).
+"""
+
+import os
+import json
+import errno
+import hashlib
+import ftplib
+import tempfile
+from urlparse import urlsplit
+
+from go_cache import file_digest
+
+# Import and set logger
+import logging
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+MANIFEST_SUFFIX = '.download.json'
+
+
+def get_manifest_file(target_filename):
+    """
+    Return the location of the manifest of the downloaded file
+    target_filename.
+    """
+    return target_filename + MANIFEST_SUFFIX
+
+
+def get_url_digest(url):
+    """
+    Return the SHA-1 digest of url, which manifests record instead of the
+    URL itself, so that secrets in URLs are not written to the download
+    folder.
+    """
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+def read_manifest(target_filename, url):
+    """
+    Read the manifest of target_filename.
+
+    Returns:
+    manifest -- The dictionary in the manifest file, or None if there is
+    no manifest, or if it is for another URL or a file of another size
+    (e.g. because the file was replaced by hand), in which case the file
+    is downloaded again.
+    """
+    try:
+        with open(get_manifest_file(target_filename), 'r') as manifest_fh:
+            manifest = json.load(manifest_fh)
+        size = os.path.getsize(target_filename)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if (manifest.get('url_sha1') != get_url_digest(url) or
+            manifest.get('size') != size):
+        return None
+    return manifest
+
+
+def write_manifest(target_filename, url, validators, checksum=None):
+    """
+    Write the manifest of the downloaded file target_filename.
+
+    Arguments:
+    target_filename -- A string. Location of the downloaded file.
+
+    url -- The URL string the file was downloaded from.
+
+    validators -- A dictionary of the validators of the file ('etag' and
+    'last_modified' for HTTP(S) files, 'mdtm' and 'remote_size' for FTP
+    files), as returned by get_http_validators() and get_ftp_validators().
+
+    checksum -- Optional. The SHA-1 digest of the file, if it is already
+    known.
+    """
+    manifest = dict((key, value) for (key, value) in validators.iteritems()
+                    if value is not None)
+    manifest['url_sha1'] = get_url_digest(url)
+    manifest['size'] = os.path.getsize(target_filename)
+    manifest['sha1'] = checksum or file_digest(target_filename)
+
+    manifest_file = get_manifest_file(target_filename)
+    (tmp_fd, tmp_file) = tempfile.mkstemp(
+        prefix=os.path.basename(manifest_file) + '.',
+        dir=os.path.dirname(manifest_file) or '.')
+    with os.fdopen(tmp_fd, 'w') as tmp_fh:
+        json.dump(manifest, tmp_fh, indent=2, sort_keys=True)
+    os.rename(tmp_file, manifest_file)
+
+
+def get_conditional_headers(manifest):
+    """
+    Return the headers of a conditional GET request for a file with the
+    given manifest (which may be None), which the server answers with
+    "304 Not Modified" if the file has not changed since.
+    """
+    headers = {}
+    if manifest:
+        if manifest.get('etag'):
+            headers['If-None-Match'] = manifest['etag']
+        if manifest.get('last_modified'):
+            headers['If-Modified-Since'] = manifest['last_modified']
+    return headers
+
+
+def get_http_validators(response):
+    """
+    Return the validators of an HTTP(S) file from the headers of the
+    requests.Response it was downloaded with.
+    """
+    return {'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified')}
+
+
+def connect_ftp(url, timeout=60):
+    """
+    Connect and log in to the FTP server of url, with the user name and
+    password in url, or anonymously.
+
+    Returns:
+    The logged in ftplib.FTP connection, in binary (TYPE I) mode.
+    """
+    url_parts = urlsplit(url)
+    ftp = ftplib.FTP(url_parts.hostname, timeout=timeout)
+    try:
+        ftp.login(url_parts.username or 'anonymous',
+                  url_parts.password or '')
+        ftp.voidcmd('TYPE I')
+    except ftplib.all_errors:
+        ftp.close()
+        raise
+    return ftp
+
+
+def read_ftp_validators(ftp, path):
+    """
+    Ask the ftplib.FTP connection ftp for the modification time (MDTM) and
+    size (SIZE) of the file at path.
+
+    Returns:
+    A dictionary with the 'mdtm' and 'remote_size' of the file, either of
+    which is None if the server could not send it.
+    """
+    validators = {'mdtm': None, 'remote_size': None}
+    try:
+        reply = ftp.sendcmd('MDTM ' + path)
+        validators['mdtm'] = reply.split(None, 1)[1]
+    except ftplib.all_errors + (IndexError,):
+        pass
+    try:
+        validators['remote_size'] = ftp.size(path)
+    except ftplib.all_errors:
+        pass
+    return validators
+
+
+def get_ftp_validators(url, timeout=60):
+    """
+    Ask the FTP server of url for the modification time (MDTM) and size
+    (SIZE) of the file, as read_ftp_validators() does.
+    """
+    try:
+        ftp = connect_ftp(url, timeout)
+    except ftplib.all_errors as e:
+        logger.warning('Could not connect to the FTP server of %s: %s',
+                       url, e)
+        return {'mdtm': None, 'remote_size': None}
+
+    try:
+        return read_ftp_validators(ftp, urlsplit(url).path)
+    finally:
+        try:
+            ftp.quit()
+        except ftplib.all_errors:
+            ftp.close()
+
+
+def is_unchanged_on_ftp(manifest, validators):
+    """
+    Return True if the MDTM and SIZE validators of an FTP file are known
+    and the same as those in its manifest (which may be None).
+    """
+    if not manifest or validators['mdtm'] is None:
+        return False
+    return (manifest.get('mdtm') == validators['mdtm'] and
+            manifest.get('remote_size') == validators['remote_size'])
+
+
+def get_resume_validator(partial_file, url):
+    """
+    Return the validator that a download of url may be resumed from the
+    end of partial_file with (an HTTP If-Range value, or the MDTM of an FTP
+    file), as recorded by write_resume_validators() when partial_file was
+    started, or None if it cannot be resumed.
+
+    Weak ETags cannot be used with If-Range, so HTTP downloads are resumed
+    with the Last-Modified date instead if that is all there is.
+    """
+    if not os.path.exists(partial_file):
+        return None
+    try:
+        with open(get_manifest_file(partial_file), 'r') as manifest_fh:
+            manifest = json.load(manifest_fh)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if manifest.get('url_sha1') != get_url_digest(url):
+        return None
+    etag = manifest.get('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return manifest.get('last_modified') or manifest.get('mdtm')
+
+
+def write_resume_validators(partial_file, url, validators):
+    """
+    Record the validators of the version of url that is being downloaded
+    to partial_file, so that an interrupted download can be resumed later
+    only if the file has not changed on the server since.
+    """
+    manifest = dict((key, value) for (key, value) in validators.iteritems()
+                    if value is not None)
+    manifest['url_sha1'] = get_url_digest(url)
+    with open(get_manifest_file(partial_file), 'w') as manifest_fh:
+        json.dump(manifest, manifest_fh, indent=2, sort_keys=True)
+
+
+def remove_partial_download(partial_file):
+    """
+    Delete partial_file and its resume validators, if they exist.
+    """
+    for filename in (partial_file, get_manifest_file(partial_file)):
+        try:
+            os.remove(filename)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+def save_download(tmp_file, target_filename, url, validators,
+                  revalidate=False, manifest=None):
+    """
+    Move a complete download from tmp_file to target_filename. With
+    revalidate, write its manifest, and keep the existing target_filename
+    instead if it has the same contents. Either way, tmp_file and its
+    resume validators are removed.
+
+    Arguments:
+    tmp_file -- A string. Location of the downloaded (partial) file.
+
+    target_filename -- A string. Location to save the file to.
+
+    url -- The URL string the file was downloaded from.
+
+    validators -- A dictionary of the validators of the file, for its
+    manifest.
+
+    revalidate -- Optional. If False, tmp_file just replaces
+    target_filename, and no manifest is written.
+
+    manifest -- Optional. The manifest of the existing target_filename, as
+    returned by read_manifest(), whose checksum spares hashing the file
+    again.
+
+    Returns:
+    True if target_filename was created or changed. Otherwise, False.
+    """
+    if not revalidate:
+        os.rename(tmp_file, target_filename)
+        remove_partial_download(tmp_file)
+        return True
+
+    checksum = file_digest(tmp_file)
+    try:
+        if manifest and manifest.get('sha1'):
+            unchanged = manifest['sha1'] == checksum
+        else:
+            unchanged = file_digest(target_filename) == checksum
+    except (IOError, OSError) as e:
+        if e.errno != errno.ENOENT:
+            raise
+        unchanged = False
+
+    if unchanged:
+        logger.info('File %s has not changed since it was last downloaded.',
+                    target_filename)
+    else:
+        os.rename(tmp_file, target_filename)
+    remove_partial_download(tmp_file)
+    write_manifest(target_filename, url, validators, checksum)
+    return not unchanged
@@ -1,24 +1,56 @@
 import os
 import sys
 import re
+import tempfile
 from ConfigParser import SafeConfigParser
 
+import requests
+
 from utils import check_create_folder, download_from_url
-from process_kegg import KEGGSET_INFO_FOLDER
+from process_kegg import (
+    KEGGSET_INFO_FOLDER, get_kegg_info, remove_stale_kegg_info_files)
 
 # Import and set logger
 import logging
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
+# Maximum number of entries that the KEGG REST API returns for a single
+# /get request, with the entry IDs joined by '+'
+KEGG_GET_BATCH_SIZE = 10
+
+# Line that ends every entry of a KEGG flat file
+KEGG_ENTRY_END = '///'
+
+
+def download_urls(downloads, download_manager=None, revalidate=False):
+    """
+    Download each (url, download_folder, file_name) tuple in downloads,
+    several at a time with download_manager (a
+    download_manager.DownloadManager) if it is given, or else one after
+    another with download_from_url(). With revalidate, files that already
+    exist are downloaded again if they have changed on the server.
+
+    Returns:
+    A list of the return values of download_from_url() for each file.
+    """
+    if download_manager is not None:
+        return download_manager.download_all(downloads, revalidate)
+    return [download_from_url(*args, revalidate=revalidate)
+            for args in downloads]
+
 
 def download_all_files(species_ini_file, base_download_folder,
-                       secrets_location=None):
+                       secrets_location=None, download_manager=None,
+                       revalidate=False):
     """
     Reads config INI file for a species, which contains the files (and
     their locations, or URLs) that must be loaded for this species, and calls
     the download_from_url function for each of those files.
 
+    The files are only downloaded once all the settings they need have
+    been checked, with download_urls().
+
     Arguments:
     species_ini_file -- Path to the particular species INI file. This
     is a string.
@@ -30,6 +62,14 @@ def download_all_files(species_ini_file, base_download_folder,
     secrets_location -- Optional string of location of the secrets INI
     file.
 
+    download_manager -- Optional download_manager.DownloadManager to
+    download the files with, several at a time.
+
+    revalidate -- Optional. If True, files that were already downloaded are
+    checked against the server, and downloaded again only if they have
+    changed (see download_cache.py). Otherwise, they are not downloaded
+    again.
+
     Returns:
     Nothing, just downloads and saves files to download_folder
 
@@ -42,11 +82,14 @@ def download_all_files(species_ini_file, base_download_folder,
     sd_folder = species_file.get('species_info', 'SPECIES_DOWNLOAD_FOLDER')
     check_create_folder(sd_folder)
 
+    # (url, download_folder, file_name) of every file to download
+    downloads = []
+
     if species_file.has_section('GO'):
         if species_file.getboolean('GO', 'DOWNLOAD'):
 
             obo_url = species_file.get('GO', 'GO_OBO_URL')
-            download_from_url(obo_url, base_download_folder)
+            downloads.append((obo_url, base_download_folder, None))
 
             go_dir = os.path.join(sd_folder, 'GO')
             check_create_folder(go_dir)
@@ -55,8 +98,9 @@ def download_all_files(species_ini_file, base_download_folder,
             goa_urls = re.sub(r'\s', '', goa_urls).split(',')
 
             for goa_url in goa_urls:
-                download_from_url(goa_url, go_dir)
+                downloads.append((goa_url, go_dir, None))
 
+    keggset_info_folder = None
     if species_file.has_section('KEGG'):
         if species_file.getboolean('KEGG', 'DOWNLOAD'):
 
@@ -65,18 +109,20 @@ def download_all_files(species_ini_file, base_download_folder,
             kegg_info_url = kegg_root_url + species_file.get('KEGG',
                                                              'DB_INFO_URL')
 
-            download_from_url(kegg_info_url, base_download_folder,
-                              'kegg_db_info')
+            downloads.append((kegg_info_url, base_download_folder,
+                              'kegg_db_info'))
 
             kegg_dir = os.path.join(sd_folder, 'KEGG')
             check_create_folder(kegg_dir)
+            keggset_info_folder = os.path.join(sd_folder,
+                                               KEGGSET_INFO_FOLDER)
 
             ks_urls = species_file.get('KEGG', 'SETS_TO_DOWNLOAD')
             kegg_urls = [kegg_root_url + url.strip() for url in
                          ks_urls.split(',')]
 
             for kegg_url in kegg_urls:
-                download_from_url(kegg_url, kegg_dir)
+                downloads.append((kegg_url, kegg_dir, None))
 
     if species_file.has_section('DO'):
         if species_file.getboolean('DO', 'DOWNLOAD'):
@@ -84,10 +130,10 @@ def download_all_files(species_ini_file, base_download_folder,
             check_create_folder(do_dir)
 
             obo_url = species_file.get('DO', 'DO_OBO_URL')
-            download_from_url(obo_url, do_dir)
+            downloads.append((obo_url, do_dir, None))
 
             mim2gene_url = species_file.get('DO', 'MIM2GENE_URL')
-            download_from_url(mim2gene_url, do_dir)
+            downloads.append((mim2gene_url, do_dir, None))
 
             # The genemap_file needs a special Secret Key, which must be
             # retrieved from the secrets file if the user wishes to download
@@ -115,15 +161,34 @@ def download_all_files(species_ini_file, base_download_folder,
                                                'SECRET_KEY')
             genemap_url = genemap_url.replace('<SecretKey>', omim_secret_key)
 
-            download_from_url(genemap_url, do_dir)
+            downloads.append((genemap_url, do_dir, None))
+
+    download_urls(downloads, download_manager, revalidate)
 
+    # KEGG set info files are not revalidated one by one, but downloaded
+    # again when the KEGG release changes.
+    kegg_info_file = os.path.join(base_download_folder, 'kegg_db_info')
+    if (revalidate and keggset_info_folder is not None and
+            os.path.exists(kegg_info_file)):
+        release = get_kegg_info(kegg_info_file)['release']
+        if release:
+            remove_stale_kegg_info_files(keggset_info_folder, release)
 
-def download_kegg_info_files(kegg_set_ids, species_ini_file):
+
+def download_kegg_info_files(kegg_set_ids, species_ini_file,
+                             download_manager=None):
     """
     This is a KEGG-specific function that downloads the files containing
     information about the KEGG sets, such as their title, abstract, supporting
     publications, etc.
 
+    The info files are requested from the KEGG REST API in batches of up to
+    SET_INFO_BATCH_SIZE (an optional setting of the KEGG section of the
+    species file, KEGG_GET_BATCH_SIZE by default) sets per /get request,
+    and the response of each batch is split into one file per set, with
+    download_kegg_info_batch(). With a SET_INFO_BATCH_SIZE of 1, every
+    info file is downloaded with its own request instead.
+
     Arguments:
     kegg_set_ids -- List of kegg set identifiers (e.g. hsa00010) for which
     info files will be downloaded.
@@ -131,6 +196,9 @@ def download_kegg_info_files(kegg_set_ids, species_ini_file):
     species_ini_file -- Path to the species INI config file. This
     is a string.
 
+    download_manager -- Optional download_manager.DownloadManager to
+    download the files with, several at a time over pooled connections.
+
     Returns:
     Nothing, just downloads and saves files to keggset_info folder, which will
     be the SPECIES_DOWNLOAD_FOLDER + 'KEGG/keggset_info_folder'
@@ -147,6 +215,137 @@ def download_kegg_info_files(kegg_set_ids, species_ini_file):
     full_info_url = species_file.get('KEGG', 'KEGG_ROOT_URL') + \
         species_file.get('KEGG', 'SET_INFO_DIR')
 
-    for kegg_id in kegg_set_ids:
-        kegg_info_file = full_info_url + kegg_id
-        download_from_url(kegg_info_file, keggset_info_folder)
+    batch_size = KEGG_GET_BATCH_SIZE
+    if species_file.has_option('KEGG', 'SET_INFO_BATCH_SIZE'):
+        try:
+            batch_size = species_file.getint('KEGG', 'SET_INFO_BATCH_SIZE')
+        except ValueError:
+            batch_size = 0
+        if not 1 <= batch_size <= KEGG_GET_BATCH_SIZE:
+            logger.error('SET_INFO_BATCH_SIZE in the KEGG section of the '
+                         'species file must be a number between 1 and %d.',
+                         KEGG_GET_BATCH_SIZE)
+            sys.exit(1)
+
+    if batch_size > 1:
+        # Files that are already there are skipped before batching, so that
+        # the remaining sets are fetched in as few requests as possible.
+        kegg_set_ids = [kegg_id for kegg_id in kegg_set_ids if not
+                        os.path.exists(os.path.join(keggset_info_folder,
+                                                    kegg_id))]
+        batches = [kegg_set_ids[start:start + batch_size] for start in
+                   range(0, len(kegg_set_ids), batch_size)]
+
+        def download_batch(batch):
+            return download_kegg_info_batch(batch, full_info_url,
+                                            keggset_info_folder,
+                                            download_manager)
+
+        if download_manager is not None:
+            missing_ids = download_manager.map(download_batch, batches)
+        else:
+            missing_ids = [download_batch(batch) for batch in batches]
+
+        # Sets that could not be found in the response of their batch are
+        # requested one by one below.
+        kegg_set_ids = [kegg_id for batch_missing_ids in missing_ids
+                        for kegg_id in batch_missing_ids]
+
+    download_urls([(full_info_url + kegg_id, keggset_info_folder, None)
+                   for kegg_id in kegg_set_ids], download_manager)
+
+
+def split_kegg_entries(kegg_text):
+    """
+    Split the text of a KEGG flat file with several entries, such as the
+    response to a /get request for several IDs, into the text of each
+    entry, ending with its KEGG_ENTRY_END line.
+    """
+    entries = []
+    entry_lines = []
+    for line in kegg_text.splitlines(True):
+        entry_lines.append(line)
+        if line.rstrip() == KEGG_ENTRY_END:
+            entries.append(''.join(entry_lines))
+            entry_lines = []
+    return entries
+
+
+def get_kegg_entry_id(kegg_entry):
+    """
+    Return the ID in the ENTRY line of the text of a KEGG entry (e.g.
+    'hsa00010' for 'ENTRY       hsa00010                    Pathway'), or
+    None if it has no ENTRY line.
+    """
+    for line in kegg_entry.splitlines():
+        if line.startswith('ENTRY'):
+            toks = line.split()
+            if len(toks) > 1:
+                return toks[1]
+    return None
+
+
+def download_kegg_info_batch(kegg_set_ids, full_info_url,
+                             keggset_info_folder, download_manager=None):
+    """
+    Download the info files of several KEGG sets with a single KEGG REST
+    API request (e.g. /get/hsa00010+hsa00020), and save each entry of the
+    response to the file of its set in keggset_info_folder, which is the
+    same file that downloading it on its own would have written.
+
+    Entries are matched to their set by the ID in their ENTRY line. As
+    KEGG leaves out the entries that it cannot find, if some entries do not
+    match any set, they are only matched by their position when the
+    response has one entry per set.
+
+    Arguments:
+    kegg_set_ids -- List of up to KEGG_GET_BATCH_SIZE kegg set identifiers.
+
+    full_info_url -- A string. The KEGG_ROOT_URL + SET_INFO_DIR of the
+    species file (e.g. 'http://rest.kegg.jp/get/').
+
+    keggset_info_folder -- A string. The folder to save the info files to.
+
+    download_manager -- Optional download_manager.DownloadManager to send
+    the request with.
+
+    Returns:
+    missing_ids -- A list of the IDs in kegg_set_ids whose info file could
+    not be saved from the response, to be downloaded on their own.
+    """
+    url = full_info_url + '+'.join(kegg_set_ids)
+    try:
+        if download_manager is not None:
+            response = download_manager.get(url)
+        else:
+            response = requests.get(url)
+            response.raise_for_status()
+        try:
+            entries = split_kegg_entries(response.content)
+        finally:
+            response.close()
+    except requests.RequestException as e:
+        logger.warning('Could not download the KEGG set info files of %s '
+                       'in a single request, downloading them one by one '
+                       'instead: %s', ', '.join(kegg_set_ids), e)
+        return list(kegg_set_ids)
+
+    set_ids = dict((kegg_id.lower(), kegg_id) for kegg_id in kegg_set_ids)
+    entry_ids = [set_ids.get((get_kegg_entry_id(entry) or '').lower())
+                 for entry in entries]
+    if None in entry_ids and len(entries) == len(kegg_set_ids):
+        entry_ids = kegg_set_ids
+
+    missing_ids = set(kegg_set_ids)
+    for (kegg_id, entry) in zip(entry_ids, entries):
+        if kegg_id is None or kegg_id not in missing_ids:
+            continue
+
+        (tmp_fd, tmp_file) = tempfile.mkstemp(prefix=kegg_id + '.',
+                                              dir=keggset_info_folder)
+        with os.fdopen(tmp_fd, 'wb') as tmp_fh:
+            tmp_fh.write(entry)
+        os.rename(tmp_file, os.path.join(keggset_info_folder, kegg_id))
+        missing_ids.remove(kegg_id)
+
+    return [kegg_id for kegg_id in kegg_set_ids if kegg_id in missing_ids]
@@ -0,0 +1,312 @@
+"""
+Concurrent downloader for the annotation files of a species, and for the
+hundreds of KEGG set info files (/get/<kegg_id>) that KEGG processing
+downloads one by one.
+
+A DownloadManager sends every HTTP(S) request through one pooled
+requests.Session, so requests to the same host reuse their connections
+instead of opening a new one each time. It downloads up to MAX_DOWNLOADS
+files at the same time, waits at least MIN_REQUEST_INTERVAL seconds
+between the requests it sends to each host (KEGG asks users of its REST
+API not to send too many at once), and retries failed requests with
+exponential backoff. FTP URLs are still downloaded with
+utils.download_from_url().
+
+These settings are read from the optional [downloads] section of the main
+configuration file (see get_download_options()).
+"""
+
+import os
+import sys
+import time
+import threading
+from multiprocessing.pool import ThreadPool
+from urlparse import urlsplit
+
+import requests
+
+import download_cache
+from utils import (
+    PARTIAL_SUFFIX, download_from_url, download_http_file, file_lock)
+
+# Import and set logger
+import logging
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# HTTP status codes that are worth retrying, as the server may be able to
+# answer the same request later
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Options of the [downloads] section of the main configuration file, and
+# the DownloadManager arguments and types they are read as
+DOWNLOAD_OPTIONS = {
+    'MAX_DOWNLOADS': ('max_downloads', int),
+    'MIN_REQUEST_INTERVAL': ('min_request_interval', float),
+    'RETRIES': ('retries', int),
+    'RETRY_BACKOFF': ('retry_backoff', float),
+    'TIMEOUT': ('timeout', float),
+}
+
+
+class DownloadManager(object):
+    """
+    Downloads files with a pooled requests.Session, several at a time,
+    with per-host rate limiting and retries.
+
+    A DownloadManager can be shared by the threads of a process. When it
+    is pickled (e.g. to be sent to a worker process), only its settings
+    are kept, and the copy gets its own session.
+    """
+    def __init__(self, max_downloads=4, min_request_interval=0.0, retries=3,
+                 retry_backoff=1.0, timeout=60.0):
+        """
+        Arguments:
+        max_downloads -- Maximum number of files that download_all()
+        downloads at the same time, and of connections kept open to each
+        host.
+
+        min_request_interval -- Minimum number of seconds between the
+        start of two requests to the same host.
+
+        retries -- Number of times a failed request is retried, after a
+        connection error or a RETRY_STATUS_CODES response.
+
+        retry_backoff -- Number of seconds to wait before the first retry
+        of a request. The wait doubles with every further retry, unless
+        the server asks for a longer one with a Retry-After header.
+
+        timeout -- Number of seconds to wait for the server to answer or
+        to send more data before a request fails.
+        """
+        self.max_downloads = max_downloads
+        self.min_request_interval = min_request_interval
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.timeout = timeout
+        self._start()
+
+    def _start(self):
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=self.max_downloads,
+            pool_maxsize=self.max_downloads)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # Time before which no new request may be sent to each host
+        self._next_request_times = {}
+        self._rate_lock = threading.Lock()
+
+    def __getstate__(self):
+        return dict((key, value) for (key, value) in self.__dict__.items()
+                    if key not in ('session', '_next_request_times',
+                                   '_rate_lock'))
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._start()
+
+    def close(self):
+        """
+        Close the connections of the session.
+        """
+        self.session.close()
+
+    def wait_for_host(self, host):
+        """
+        Wait until a request may be sent to host, and reserve the next
+        min_request_interval seconds for it.
+        """
+        with self._rate_lock:
+            now = time.time()
+            request_time = max(now, self._next_request_times.get(host, now))
+            self._next_request_times[host] = (request_time +
+                                              self.min_request_interval)
+        if request_time > now:
+            time.sleep(request_time - now)
+
+    def get(self, url, headers=None):
+        """
+        Send a GET request for url, with the optional dictionary of extra
+        headers, retrying it as set up in __init__().
+
+        Returns:
+        The streamed requests.Response, with a successful status code
+        (which may be 304 Not Modified, for a conditional request).
+
+        Raises requests.RequestException if every attempt fails.
+        """
+        host = urlsplit(url).netloc
+        attempt = 0
+        while True:
+            self.wait_for_host(host)
+            retry_wait = self.retry_backoff * 2 ** attempt
+            try:
+                response = self.session.get(url, headers=headers,
+                                            stream=True,
+                                            timeout=self.timeout)
+                if response.status_code not in RETRY_STATUS_CODES:
+                    response.raise_for_status()
+                    return response
+
+                retry_after = response.headers.get('Retry-After', '')
+                if retry_after.isdigit():
+                    retry_wait = max(retry_wait, int(retry_after))
+                response.close()
+                error = requests.HTTPError('%s %s' % (
+                    response.status_code, response.reason),
+                    response=response)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+
+            if attempt >= self.retries:
+                raise error
+            attempt += 1
+            logger.info('Request for %s failed (%s), retrying in %s seconds',
+                        url, error, retry_wait)
+            time.sleep(retry_wait)
+
+    def download(self, url, download_folder, file_name=None,
+                 revalidate=False):
+        """
+        Download url to download_folder, like utils.download_from_url(),
+        unless the file already exists (and, with revalidate, has not
+        changed on the server). HTTP(S) files are downloaded to a partial
+        file in download_folder with utils.download_http_file(), which is
+        renamed to the target file once complete. A download that is
+        interrupted is resumed from the partial file, up to retries times.
+
+        Arguments:
+        The same as utils.download_from_url().
+
+        Returns:
+        True if the file did not already exist (or had changed) and was
+        downloaded. Otherwise, False.
+        """
+        if not url.startswith('http'):
+            return download_from_url(url, download_folder, file_name,
+                                     revalidate)
+
+        filename = file_name or os.path.basename(urlsplit(url).path)
+        target_filename = os.path.join(download_folder, filename)
+
+        if os.path.exists(target_filename) and not revalidate:
+            logger.warning('Not downloading file %s, as it already exists '
+                           'in the download_folder specified.', filename)
+            return False
+
+        with file_lock(target_filename + '.lock'):
+            manifest = None
+            if os.path.exists(target_filename):
+                if not revalidate:
+                    return False
+                manifest = download_cache.read_manifest(target_filename, url)
+
+            partial_file = target_filename + PARTIAL_SUFFIX
+            headers = download_cache.get_conditional_headers(manifest)
+            try:
+                attempt = 0
+                while True:
+                    try:
+                        response = download_http_file(url, partial_file,
+                                                      self.get, headers)
+                        break
+                    except requests.RequestException:
+                        # get() has already retried the request
+                        raise
+                    except IOError as e:
+                        # The connection was lost during the download, which
+                        # the next attempt resumes
+                        if attempt >= self.retries:
+                            raise
+                        retry_wait = self.retry_backoff * 2 ** attempt
+                        attempt += 1
+                        logger.info('Download of %s was interrupted (%s), '
+                                    'resuming in %s seconds', url, e,
+                                    retry_wait)
+                        time.sleep(retry_wait)
+
+                if response is None:
+                    logger.info('File %s has not changed on the server.',
+                                filename)
+                    return False
+                return download_cache.save_download(
+                    partial_file, target_filename, url,
+                    download_cache.get_http_validators(response), revalidate,
+                    manifest)
+            except (requests.RequestException, IOError, OSError) as e:
+                logger.error('There was an error when downloading the file '
+                             '"%s" - downloading could not be completed: %s',
+                             filename, e)
+                return False
+
+    def download_all(self, downloads, revalidate=False):
+        """
+        Download several files, up to max_downloads at the same time.
+
+        Arguments:
+        downloads -- An iterable of (url, download_folder, file_name)
+        tuples, with the arguments of download() for each file.
+
+        revalidate -- Optional. The revalidate argument of download().
+
+        Returns:
+        A list of the return values of download(), in the same order as
+        downloads.
+        """
+        return self.map(lambda args: self.download(*args,
+                                                   revalidate=revalidate),
+                        downloads)
+
+    def map(self, function, items):
+        """
+        Call function on every item of items, in up to max_downloads
+        threads at the same time, for functions that send their requests
+        with this manager (e.g. download() or get()).
+
+        Returns:
+        A list of the return values of function, in the same order as
+        items.
+        """
+        items = list(items)
+        if len(items) < 2 or self.max_downloads < 2:
+            return [function(item) for item in items]
+
+        pool = ThreadPool(min(self.max_downloads, len(items)))
+        try:
+            return pool.map(function, items)
+        finally:
+            pool.terminate()
+
+
+def get_download_options(main_config_file):
+    """
+    Read the settings of a DownloadManager from the [downloads] section of
+    the main configuration file.
+
+    Arguments:
+    main_config_file -- The SafeConfigParser of the main configuration
+    file.
+
+    Returns:
+    download_options -- A dictionary of the DownloadManager arguments set
+    in the [downloads] section, or None if there is no such section, in
+    which case files are downloaded one at a time with
+    utils.download_from_url().
+    """
+    if not main_config_file.has_section('downloads'):
+        return None
+
+    download_options = {}
+    for (option, (argument, option_type)) in DOWNLOAD_OPTIONS.iteritems():
+        if main_config_file.has_option('downloads', option):
+            value = main_config_file.get('downloads', option)
+            try:
+                download_options[argument] = option_type(value)
+            except ValueError:
+                logger.error('%s option in the "downloads" section of the '
+                             'main configuration file must be a number.',
+                             option)
+                sys.exit(1)
+    return download_options
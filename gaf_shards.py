@@ -0,0 +1,238 @@
+"""
+Per-taxon shards of multi-species GO association files, such as
+goa_uniprot_all_noiea.gaf.gz, which every species file lists in its
+ASSOC_FILE_URLS.
+
+Instead of decompressing and scanning the whole multi-species file once
+per species, it is read once, and the lines of each taxon that the species
+files ask for are written to their own uncompressed shard file in
+BASE_DOWNLOAD_FOLDER/gaf_shards. process_go_terms() then reads the small
+shard of its species in place of the multi-species file.
+
+Shards are kept in a folder named after the association file and the SHA-1
+digest of its contents, so a newly downloaded version of the file is
+sharded again, and copies of the same file in different species download
+folders share their shards.
+"""
+
+import os
+import re
+import tempfile
+from urlparse import urlsplit
+from ConfigParser import SafeConfigParser
+
+from go_cache import file_digest
+from utils import file_lock, open_assoc_file
+
+# Import and set logger
+import logging
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+SHARD_FOLDER = 'gaf_shards'
+
+LOCK_FILE = '.lock'
+
+# Digests of the association files seen by this process, keyed by
+# (location, size, modification time), so that a large file is only hashed
+# once per run.
+FILE_DIGESTS = {}
+
+
+def get_shared_assoc_taxa(species_ini_files):
+    """
+    Find the GO association files that are listed by more than one of the
+    species files, and the taxa that read them.
+
+    Arguments:
+    species_ini_files -- A list of the locations of the species INI files
+    of this run.
+
+    Returns:
+    shared_taxa -- A dictionary of association file name (e.g.
+    'goa_uniprot_all_noiea.gaf.gz') -> set of the TAXONOMY_IDs of every
+    species that lists it, for the files listed by two or more species.
+    """
+    assoc_taxa = {}
+    for species_ini_file in species_ini_files:
+        species_file = SafeConfigParser()
+        species_file.read(species_ini_file)
+
+        if not species_file.has_option('GO', 'ASSOC_FILE_URLS'):
+            continue
+
+        taxonomy_id = species_file.get('species_info', 'TAXONOMY_ID')
+        assoc_file_urls = re.sub(
+            r'\s', '', species_file.get('GO', 'ASSOC_FILE_URLS'))
+        for url in assoc_file_urls.split(','):
+            assoc_filename = os.path.basename(urlsplit(url).path)
+            assoc_taxa.setdefault(assoc_filename, set()).add(taxonomy_id)
+
+    shared_taxa = {}
+    for (assoc_filename, taxa) in assoc_taxa.iteritems():
+        if len(taxa) > 1:
+            shared_taxa[assoc_filename] = taxa
+    return shared_taxa
+
+
+def get_file_digest(filename):
+    """
+    Return the SHA-1 digest of filename, hashing it only the first time
+    it is asked for, or again if it has changed since.
+    """
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_size, stat.st_mtime)
+    if key not in FILE_DIGESTS:
+        FILE_DIGESTS[key] = file_digest(filename)
+    return FILE_DIGESTS[key]
+
+
+def get_shard_dir(base_download_folder, assoc_file, digest):
+    """
+    Return the folder of the shards of the version of assoc_file with the
+    given digest.
+    """
+    return os.path.join(base_download_folder, SHARD_FOLDER, '%s.%s' % (
+        os.path.basename(assoc_file), digest))
+
+
+def get_shard_file(shard_dir, tax_id):
+    """
+    Return the location of the shard of taxon tax_id in shard_dir.
+    """
+    return os.path.join(shard_dir, 'taxon_%s.gaf' % tax_id)
+
+
+def write_shards(assoc_file, shard_dir, tax_ids):
+    """
+    Read assoc_file once and write the annotation lines of each taxon in
+    tax_ids to its shard file in shard_dir. Lines are assigned to a taxon
+    with the same taxon column check as process_go.read_gaf_lines(), and
+    each shard starts with the header ('!') lines of assoc_file. A shard is
+    written for every taxon in tax_ids, even if it has no lines.
+
+    Shards are written under temporary names and renamed into place once
+    the whole file has been read, so an existing shard file is always
+    complete.
+    """
+    if not os.path.isdir(shard_dir):
+        os.makedirs(shard_dir)
+
+    tmp_files = {}
+    shard_fhs = {}
+    try:
+        for tax_id in tax_ids:
+            (tmp_fd, tmp_files[tax_id]) = tempfile.mkstemp(
+                dir=shard_dir, suffix='.tmp')
+            shard_fhs[tax_id] = os.fdopen(tmp_fd, 'wb')
+
+        with open_assoc_file(assoc_file) as assoc_fh:
+            for line in assoc_fh:
+                if line.startswith('!'):
+                    for shard_fh in shard_fhs.itervalues():
+                        shard_fh.write(line)
+                    continue
+
+                toks = line.split('\t', 13)
+                if len(toks) < 13:
+                    continue
+
+                taxon = toks[12].partition(':')[2].partition(':')[0]
+                shard_fh = shard_fhs.get(taxon)
+                if shard_fh is not None:
+                    shard_fh.write(line)
+
+        for shard_fh in shard_fhs.itervalues():
+            shard_fh.close()
+        for (tax_id, tmp_file) in tmp_files.iteritems():
+            os.rename(tmp_file, get_shard_file(shard_dir, tax_id))
+    finally:
+        for shard_fh in shard_fhs.itervalues():
+            shard_fh.close()
+        for tmp_file in tmp_files.itervalues():
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+
+def remove_stale_shards(base_download_folder, assoc_file, keep_dir):
+    """
+    Delete the shards of older versions of assoc_file, other than those in
+    keep_dir.
+    """
+    shards_root = os.path.join(base_download_folder, SHARD_FOLDER)
+    prefix = os.path.basename(assoc_file) + '.'
+    for dirname in os.listdir(shards_root):
+        path = os.path.join(shards_root, dirname)
+        if not dirname.startswith(prefix) or path == keep_dir:
+            continue
+        try:
+            for filename in os.listdir(path):
+                os.remove(os.path.join(path, filename))
+            os.rmdir(path)
+        except OSError as e:
+            logger.warning('Could not remove old GAF shards %s: %s', path, e)
+
+
+def get_taxon_shard(assoc_file, base_download_folder, tax_id,
+                    shard_tax_ids=None):
+    """
+    Return the shard of taxon tax_id of the multi-species association file
+    assoc_file, creating it if it does not exist yet.
+
+    The first call for a version of assoc_file shards it for tax_id and
+    every taxon in shard_tax_ids in a single pass, so the calls for the
+    other species of the run just return their existing shard.
+
+    Arguments:
+    assoc_file -- A string. Location of the downloaded multi-species GO
+    association file.
+
+    base_download_folder -- A string. The BASE_DOWNLOAD_FOLDER of the run,
+    in which the shards are stored.
+
+    tax_id -- A string. The taxonomy ID of the species being processed.
+
+    shard_tax_ids -- Optional. An iterable of the taxonomy IDs of the other
+    species that read assoc_file, as found by get_shared_assoc_taxa().
+
+    Returns:
+    The location of the shard file, or assoc_file itself if it could not
+    be sharded.
+    """
+    try:
+        digest = get_file_digest(assoc_file)
+    except (IOError, OSError) as e:
+        logger.error('Could not read GO association file %s: %s',
+                     assoc_file, e)
+        return assoc_file
+
+    shard_dir = get_shard_dir(base_download_folder, assoc_file, digest)
+    shard_file = get_shard_file(shard_dir, tax_id)
+    if os.path.exists(shard_file):
+        return shard_file
+
+    try:
+        try:
+            os.makedirs(shard_dir)
+        except OSError:
+            if not os.path.isdir(shard_dir):
+                raise
+
+        # In a parallel run (see run_refinery.py), the other species wait
+        # for the first one to shard the file, instead of reading it too.
+        with file_lock(os.path.join(shard_dir, LOCK_FILE)):
+            tax_ids = set(shard_tax_ids or ())
+            tax_ids.add(tax_id)
+            tax_ids = [taxon for taxon in sorted(tax_ids) if
+                       not os.path.exists(get_shard_file(shard_dir, taxon))]
+            if tax_ids:
+                logger.info('Sharding GO association file %s for taxa %s',
+                            assoc_file, ', '.join(tax_ids))
+                write_shards(assoc_file, shard_dir, tax_ids)
+                remove_stale_shards(base_download_folder, assoc_file,
+                                    shard_dir)
+    except (IOError, OSError) as e:
+        logger.warning('Could not write GAF shards of %s, reading the whole '
+                       'file instead: %s', assoc_file, e)
+        return assoc_file
+    return shard_file
@@ -0,0 +1,238 @@
+"""
+Content hashes of the processed gene sets, which tell which gene sets have
+changed since the last run without comparing their annotations one by one.
+
+Each gene set returned by process_go_terms(), process_kegg_sets() and
+process_do_terms() carries the SHA-1 digest of a canonical form of its
+title, abstract, tags and annotations, in its 'content_hash' key (see
+get_content_hash()). The canonical form does not depend on the order of
+the genes, publications and tags, or on whether a gene identifier is an
+integer or a string.
+
+With the GENESET_HASHES_DIR option of the [main] section of the main
+configuration file, the hashes of the gene sets of each species that were
+output are saved in <species file name>.hashes.json in that folder, and
+with OUTPUT_MODE: delta, the next run only outputs the gene sets that are
+new or have changed since, and lists the ones that were removed (see
+get_delta(), or iter_geneset_statuses() for a stream of gene sets).
+"""
+
+import os
+import gc
+import json
+import hashlib
+
+from utils import write_atomically
+
+# Import and set logger
+import logging
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Key of the content hash in each gene set
+CONTENT_HASH_KEY = 'content_hash'
+
+# Suffix of the names of the files of saved hashes of each species
+HASHES_FILE_SUFFIX = '.hashes.json'
+
+
+def get_annotations_digest(annotations):
+    """
+    Return the SHA-1 digest of a canonical form of annotations, a
+    dictionary of gene -> list of publications (PubMed IDs): one line per
+    gene, sorted, with the gene, a tab, and the sorted publications of the
+    gene joined with commas. Publications that are None are left out, as
+    are duplicate ones. Gene and publication identifiers are written as
+    strings, so that e.g. the Entrez ID 4160 and u'4160' (as read from
+    Tribe) are the same.
+    """
+    # The (gene, publications) tuples of large gene sets would otherwise
+    # set off the cyclic garbage collector again and again
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        lines = []
+        for (gene, pubs) in annotations.iteritems():
+            # Most genes have no publications (e.g. in KEGG sets) or only
+            # one
+            if not pubs:
+                lines.append('%s\t' % (gene,))
+            elif len(pubs) == 1 and pubs[0] is not None:
+                lines.append('%s\t%s' % (gene, pubs[0]))
+            else:
+                lines.append('%s\t%s' % (gene, ','.join(sorted(set(
+                    '%s' % pub for pub in pubs if pub is not None)))))
+        lines.sort()
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    text = '\n'.join(lines)
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return hashlib.sha1(text).hexdigest()
+
+
+def get_content_hash(geneset):
+    """
+    Return the content hash of geneset, the SHA-1 digest of its title,
+    abstract, sorted tags and annotations (see get_annotations_digest()).
+    Other keys, such as 'slug', 'organism' or 'public', are left out.
+    """
+    content = [geneset.get('title'), geneset.get('abstract'),
+               sorted(geneset.get('tags') or []),
+               get_annotations_digest(geneset.get('annotations') or {})]
+    return hashlib.sha1(json.dumps(content,
+                                   separators=(',', ':'))).hexdigest()
+
+
+def add_content_hash(geneset):
+    """
+    Set the 'content_hash' of geneset to get_content_hash(geneset), once
+    the rest of geneset is complete.
+    """
+    geneset[CONTENT_HASH_KEY] = get_content_hash(geneset)
+
+
+def get_geneset_hashes(genesets):
+    """
+    Return a dictionary of slug -> content hash of genesets, with the
+    'content_hash' each gene set carries, or a new one for gene sets that
+    do not have one.
+    """
+    return dict((geneset['slug'], geneset.get(CONTENT_HASH_KEY) or
+                 get_content_hash(geneset)) for geneset in genesets)
+
+
+def get_hashes_file(hashes_dir, species_ini_file,
+                    suffix=HASHES_FILE_SUFFIX):
+    """
+    Return the location of the saved hashes of a species in hashes_dir.
+    Other kinds of hashes of the gene sets of the species (such as the
+    Tribe versions of tribe_loader.TribeClient) are saved with another
+    file name suffix.
+    """
+    return os.path.join(hashes_dir, os.path.basename(species_ini_file) +
+                        suffix)
+
+
+def read_hashes(hashes_dir, species_ini_file, suffix=HASHES_FILE_SUFFIX):
+    """
+    Return the dictionary of slug -> content hash of the gene sets of a
+    species that were output by the last run, which is empty if there was
+    none (or its hashes file cannot be read).
+    """
+    try:
+        with open(get_hashes_file(hashes_dir, species_ini_file, suffix),
+                  'r') as hashes_fh:
+            return json.load(hashes_fh)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def write_hashes(hashes_dir, species_ini_file, hashes,
+                 suffix=HASHES_FILE_SUFFIX):
+    """
+    Save the dictionary of slug -> content hash of the gene sets of a
+    species that were output by this run, for the next run to compare its
+    gene sets with.
+    """
+    if not os.path.isdir(hashes_dir):
+        try:
+            os.makedirs(hashes_dir)
+        except OSError:
+            if not os.path.isdir(hashes_dir):
+                raise
+
+    write_atomically(get_hashes_file(hashes_dir, species_ini_file, suffix),
+                     lambda hashes_fh: json.dump(hashes, hashes_fh,
+                                                 sort_keys=True))
+
+
+def iter_geneset_statuses(genesets, previous_hashes, hashes, counts=None):
+    """
+    Compare processed gene sets with the content hashes of the gene sets
+    of the same species that were output by the last run, one at a time.
+
+    Arguments:
+    genesets -- Any iterable of processed gene sets, such as a generator
+    of them.
+
+    previous_hashes -- A dictionary of slug -> content hash, as returned by
+    read_hashes().
+
+    hashes -- A dictionary, to which the slug -> content hash of each gene
+    set is added as it is generated. Once all the gene sets have been
+    generated, the slugs that are no longer there are given by
+    get_removed_slugs(previous_hashes, hashes).
+
+    counts -- Optional. A dictionary, in which the number of gene sets of
+    each status is counted.
+
+    Returns:
+    A generator of a (status, geneset) tuple for each gene set, with status
+    'new' if its slug was not in previous_hashes, 'changed' if its content
+    hash has changed, and 'unchanged' otherwise.
+    """
+    for geneset in genesets:
+        slug = geneset['slug']
+        content_hash = (geneset.get(CONTENT_HASH_KEY) or
+                        get_content_hash(geneset))
+        hashes[slug] = content_hash
+        if slug not in previous_hashes:
+            status = 'new'
+        elif previous_hashes[slug] != content_hash:
+            status = 'changed'
+        else:
+            status = 'unchanged'
+        if counts is not None:
+            counts[status] = counts.get(status, 0) + 1
+        yield (status, geneset)
+
+
+def get_removed_slugs(previous_hashes, hashes):
+    """
+    Return the sorted slugs in previous_hashes that are not in hashes.
+    """
+    return sorted(slug for slug in previous_hashes if slug not in hashes)
+
+
+def get_delta(genesets, previous_hashes):
+    """
+    Compare processed gene sets with the content hashes of the gene sets
+    of the same species that were output by the last run (see
+    iter_geneset_statuses()).
+
+    Arguments:
+    genesets -- A list of processed gene sets.
+
+    previous_hashes -- A dictionary of slug -> content hash, as returned by
+    read_hashes().
+
+    Returns:
+    A tuple (new_genesets, changed_genesets, removed_slugs), of the lists of
+    gene sets whose slug was not in previous_hashes, of gene sets whose
+    content hash has changed, and of the sorted slugs in previous_hashes
+    that are no longer in genesets.
+    """
+    genesets_by_status = {'new': [], 'changed': [], 'unchanged': []}
+    hashes = {}
+    for (status, geneset) in iter_geneset_statuses(genesets, previous_hashes,
+                                                   hashes):
+        genesets_by_status[status].append(geneset)
+    removed_slugs = get_removed_slugs(previous_hashes, hashes)
+
+    log_delta(dict((status, len(status_genesets)) for (status, status_genesets)
+                   in genesets_by_status.iteritems()), removed_slugs)
+    return (genesets_by_status['new'], genesets_by_status['changed'],
+            removed_slugs)
+
+
+def log_delta(counts, removed_slugs):
+    """
+    Log the number of gene sets of each status in counts (see
+    iter_geneset_statuses()), and of removed_slugs.
+    """
+    logger.info('%s new, %s changed, %s removed and %s unchanged gene sets.',
+                counts.get('new', 0), counts.get('changed', 0),
+                len(removed_slugs), counts.get('unchanged', 0))
@@ -1,11 +1,21 @@
+import gc
 import sys
 import re
 from idmap import idmap
+from obo import iter_tags
 
 import logging
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
+# The OBO tags that go.parse() reads, all other lines are skipped
+PARSED_TAGS = ('id', 'name', 'namespace', 'def', 'alt_id', 'is_a',
+               'relationship', 'is_obsolete', 'xref')
+
+_NAME_INVALID_CHARS = re.compile('[^\w\s_-]')
+_NAME_SEPARATORS = re.compile('[-\s_]+')
+_WHITESPACE = re.compile('\s+')
+
 
 class go:
     heads = None
@@ -13,25 +23,47 @@ class go:
     alt_id2std_id = None
     populated = None
     s_orgs = None
+    backend = None
+    index = None
+    descendents = None
+    ancestors = None
+    propagation_plan = None
 
     # populate this field if you want to mark this GO as organism specific
     go_organism_tax_id = None
 
-    def __init__(self):
+    def __init__(self, backend='objects'):
         """
         Initialize data structures for storing the tree.
+
+        backend -- 'objects' (the default) walks the GOTerm objects for
+        propagation and graph queries, and answers ancestor and descendent
+        queries from closures of the whole ontology. 'indexed' runs them
+        over the integer-indexed arrays of go_index.GOIndex instead, which
+        requires numpy.
         """
+        if backend not in ('objects', 'indexed'):
+            raise ValueError('Unknown go() backend: %s' % backend)
         self.heads = []
         self.go_terms = {}
         self.alt_id2std_id = {}
         self.populated = False
         self.s_orgs = []
-
-    def load_obo(self, path, tries=3, timeout=5, remote_location=False):
+        self.backend = backend
+        self.index = None
+        self.descendents = None
+        self.ancestors = None
+        self.propagation_plan = None
+
+    def load_obo(self, path, tries=3, timeout=5, remote_location=False,
+                 cache_dir=None):
         """
         Load obo from the defined location. If remote_location = True; open
         with urllib2 with at most tries attempts and allowing timeout seconds
         for the server to respond.
+        If cache_dir is given, a local path is loaded from the go_cache
+        parsed-ontology cache in that directory when it has one for the
+        current contents of the file, and is parsed and cached otherwise.
         Returns "False" if failed to open path.
         """
         obo_fh = None
@@ -59,84 +91,120 @@ class go:
             logger.error('Could not open %s.', path)
             return False
 
+        if cache_dir is not None and not remote_location:
+            obo_fh.close()
+            from go_cache import load_cached_obo
+            load_cached_obo(self, path, cache_dir)
+            return True
+
         self.parse(obo_fh)
         return True
 
     def parse(self, obo_fh):
         """
-        Parse the passed obo handle.
+        Parse the passed obo handle, reading it once through
+        obo.iter_tags(). Besides the DAG, the xrefs of each term are kept
+        in GOTerm.xrefs, so that callers like process_do do not need to
+        read the file again.
+        """
+        # The parent/child links between terms are reference cycles, so
+        # creating tens of thousands of terms triggers the cyclic garbage
+        # collector over and over, although nothing can be freed yet.
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            self._read_terms(obo_fh)
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+
+        # This loop checks that all terms that have been marked as head=True
+        # have been added to self.heads
+        for term_id, term in self.go_terms.iteritems():
+            if term.head:
+                if term not in self.heads:
+                    logger.debug("Term %s not in self.heads, adding now", term)
+                    self.heads.append(term)
+
+        logger.debug("Terms that are heads: %s", self.heads)
+        self.graph_changed()
+
+    def _read_terms(self, obo_fh):
+        """
+        Add the terms and links of the obo handle to the ontology.
         """
         inside = False
         gterm = None
-        for line in obo_fh:
-            fields = line.rstrip().split()
-
-            if len(fields) < 1:
+        for (tag, value) in iter_tags(obo_fh, PARSED_TAGS):
+            if value is None:
+                if tag == '[Term]':
+                    if gterm:
+                        if gterm.head:
+                            self.heads.append(gterm)
+                    inside = True
+                elif tag == '[Typedef]':
+                    if gterm:
+                        if gterm.head:
+                            self.heads.append(gterm)
+                    inside = False
+
+            elif not inside:
                 continue
-            elif fields[0] == '[Term]':
-                if gterm:
-                    if gterm.head:
-                        self.heads.append(gterm)
-                inside = True
-            elif fields[0] == '[Typedef]':
-                if gterm:
-                    if gterm.head:
-                        self.heads.append(gterm)
-                inside = False
-
-            elif inside and fields[0] == 'id:':
-                if fields[1] in self.go_terms:
-                    logger.debug("Term %s exists in go()", fields[1])
-                    gterm = self.go_terms[fields[1]]
-                else:
-                    logger.debug("Adding term %s to go()", fields[1])
-                    gterm = GOTerm(fields[1])
-                    self.go_terms[gterm.get_id()] = gterm
-            elif inside and fields[0] == 'def:':
-                desc = ' '.join(fields[1:])
-                desc = desc.split('"')[1]
-                gterm.description = desc
-            elif inside and fields[0] == 'name:':
-                fields.pop(0)
-                name = '_'.join(fields)
-                name = re.sub('[^\w\s_-]', '_', name).strip().lower()
-                name = re.sub('[-\s_]+', '_', name)
-                gterm.name = name
-                gterm.full_name = ' '.join(fields)
-            elif inside and fields[0] == 'namespace:':
-                gterm.namespace = fields[1]
-            elif inside and fields[0] == 'def:':
-                gterm.desc = ' '.join(fields[1:]).split('\"')[1]
-            elif inside and fields[0] == 'alt_id:':
-                gterm.alt_id.append(fields[1])
-                self.alt_id2std_id[fields[1]] = gterm.get_id()
-            elif inside and fields[0] == 'is_a:':
+            elif tag == 'xref':
+                gterm.xrefs.append(value.split(None, 1)[0])
+            elif tag == 'is_a':
                 logger.debug("Making term.head for term %s = False", gterm)
                 gterm.head = False
-                fields.pop(0)
-                pgo_id = fields.pop(0)
+                pgo_id = value.split(None, 1)[0]
                 if pgo_id not in self.go_terms:
                     self.go_terms[pgo_id] = GOTerm(pgo_id)
 
                 gterm.is_a.append(self.go_terms[pgo_id])
                 self.go_terms[pgo_id].parent_of.add(gterm)
                 gterm.child_of.add(self.go_terms[pgo_id])
-            elif inside and fields[0] == 'relationship:':
-                if fields[1].find('has_part') != -1:
+            elif tag == 'id':
+                go_id = value.split(None, 1)[0]
+                if go_id in self.go_terms:
+                    logger.debug("Term %s exists in go()", go_id)
+                    gterm = self.go_terms[go_id]
+                else:
+                    logger.debug("Adding term %s to go()", go_id)
+                    gterm = GOTerm(go_id)
+                    self.go_terms[gterm.get_id()] = gterm
+            elif tag == 'name':
+                fields = value.split()
+                name = '_'.join(fields)
+                name = _NAME_INVALID_CHARS.sub('_', name).strip().lower()
+                name = _NAME_SEPARATORS.sub('_', name)
+                gterm.name = name
+                gterm.full_name = ' '.join(fields)
+            elif tag == 'namespace':
+                gterm.namespace = value.split(None, 1)[0]
+            elif tag == 'def':
+                # Runs of whitespace in the quoted definition are collapsed
+                # to single spaces
+                gterm.description = _WHITESPACE.sub(' ', value.split('"')[1])
+            elif tag == 'alt_id':
+                alt_id = value.split(None, 1)[0]
+                gterm.alt_id.append(alt_id)
+                self.alt_id2std_id[alt_id] = gterm.get_id()
+            elif tag == 'relationship':
+                fields = value.split(None, 2)
+                if fields[0].find('has_part') != -1:
                     # Has part is not a parental relationship --
                     # it is actually for children.
                     continue
                 logger.debug("Making term.head for term %s = False", gterm)
                 gterm.head = False
-                pgo_id = fields[2]
+                pgo_id = fields[1]
                 if pgo_id not in self.go_terms:
                     self.go_terms[pgo_id] = GOTerm(pgo_id)
                 # Check which relationship you are with this parent go term
-                if (fields[1] == 'regulates' or
-                        fields[1] == 'positively_regulates' or
-                        fields[1] == 'negatively_regulates'):
+                if (fields[0] == 'regulates' or
+                        fields[0] == 'positively_regulates' or
+                        fields[0] == 'negatively_regulates'):
                     gterm.relationship_regulates.append(self.go_terms[pgo_id])
-                elif fields[1] == 'part_of':
+                elif fields[0] == 'part_of':
                     gterm.relationship_part_of.append(self.go_terms[pgo_id])
                 else:
                     logger.info("Unkown relationship %s",
@@ -144,20 +212,20 @@ class go:
 
                 self.go_terms[pgo_id].parent_of.add(gterm)
                 gterm.child_of.add(self.go_terms[pgo_id])
-            elif inside and fields[0] == 'is_obsolete:':
+            elif tag == 'is_obsolete':
                 logger.debug("Making term.head for term %s = False", gterm)
                 gterm.head = False
                 del self.go_terms[gterm.get_id()]
 
-        # This loop checks that all terms that have been marked as head=True
-        # have been added to self.heads
-        for term_id, term in self.go_terms.iteritems():
-            if term.head:
-                if term not in self.heads:
-                    logger.debug("Term %s not in self.heads, adding now", term)
-                    self.heads.append(term)
-
-        logger.debug("Terms that are heads: %s", self.heads)
+    def get_index(self):
+        """
+        Return the go_index.GOIndex of the current terms, building it the
+        first time it is needed after parse() or prune().
+        """
+        if self.index is None:
+            from go_index import GOIndex
+            self.index = GOIndex(self)
+        return self.index
 
     def propagate(self):
         """
@@ -165,41 +233,81 @@ class go:
         """
         logger.info("Propagate gene annotations")
         logger.debug("Head term(s) = %s", self.heads)
-        for head_gterm in self.heads:
-            logger.info("Propagating %s", head_gterm.name)
-            self.propagate_recurse(head_gterm)
+        if self.backend == 'indexed':
+            self.get_index().propagate()
+            return
+        self.propagate_terms(self.children_first(self.heads))
 
     def propagate_recurse(self, gterm):
-        if not len(gterm.parent_of):
-            logger.debug("Base case with term %s", gterm.name)
-            return
+        """
+        propagate gene annotations for gterm and every term below it
+        """
+        self.propagate_terms(self.children_first([gterm]))
 
-        for child_term in gterm.parent_of:
-            self.propagate_recurse(child_term)
-            new_annotations = set()
+    def children_first(self, start_terms):
+        """
+        Return every term reachable from start_terms (through parent_of)
+        exactly once, ordered so that each term comes after all of its
+        children. The DAG is walked with an explicit stack instead of
+        recursion, so deep branches cannot hit Python's recursion limit.
+        """
+        ordered = []
+        visited = set()
+        for start_term in start_terms:
+            if start_term in visited:
+                continue
+            visited.add(start_term)
+            stack = [(start_term, iter(start_term.parent_of))]
+            while stack:
+                gterm, children = stack[-1]
+                for child_term in children:
+                    if child_term not in visited:
+                        visited.add(child_term)
+                        stack.append((child_term,
+                                      iter(child_term.parent_of)))
+                        break
+                else:
+                    stack.pop()
+                    ordered.append(gterm)
+        return ordered
 
-            regulates_relation = (gterm in child_term.relationship_regulates)
-            part_of_relation = (gterm in child_term.relationship_part_of)
-
-            for annotation in child_term.annotations:
-                copied_annotation = None
-                # If this relation with child is a regulates(and its sub class)
-                # filter annotations
-                if regulates_relation:
-                    # only add annotations that didn't come from a part of or
-                    # regulates relationship
-                    if annotation.ready_regulates_cutoff:
-                        continue
-                    else:
+    def propagate_terms(self, ordered_terms):
+        """
+        Close the annotations of ordered_terms under the ontology relations.
+        ordered_terms must list every child before its parents (see
+        children_first()), so that when a term is reached the annotation
+        sets of all of its children are already complete and each term is
+        only computed once.
+        """
+        for gterm in ordered_terms:
+            if not len(gterm.parent_of):
+                logger.debug("Base case with term %s", gterm.name)
+                continue
+
+            new_annotations = set()
+            for child_term in gterm.parent_of:
+                regulates_relation = (
+                    gterm in child_term.relationship_regulates)
+                part_of_relation = (gterm in child_term.relationship_part_of)
+
+                for annotation in child_term.annotations:
+                    # If this relation with child is a regulates(and its sub
+                    # class) filter annotations
+                    if regulates_relation:
+                        # only add annotations that didn't come from a part
+                        # of or regulates relationship
+                        if annotation.ready_regulates_cutoff:
+                            continue
+                        else:
+                            copied_annotation = annotation.prop_copy(
+                                ready_regulates_cutoff=True)
+                    elif part_of_relation:
                         copied_annotation = annotation.prop_copy(
                             ready_regulates_cutoff=True)
-                elif part_of_relation:
-                    copied_annotation = annotation.prop_copy(
-                        ready_regulates_cutoff=True)
-                else:
-                    copied_annotation = annotation.prop_copy()
+                    else:
+                        copied_annotation = annotation.prop_copy()
 
-                new_annotations.add(copied_annotation)
+                    new_annotations.add(copied_annotation)
             gterm.annotations = gterm.annotations | new_annotations
 
     def summarize(self, org):
@@ -384,6 +492,7 @@ class go:
                     term.child_of -= intersection
                     for hterm in intersection:
                         hterm.parent_of.remove(term)
+        self.graph_changed()
 
     def get_term(self, tid):
         logger.debug('get_term: %s', tid)
@@ -759,48 +868,115 @@ class go:
     def get_descendents(self, gterm):
         """
         get propagated descendents of term
+
+        With the 'indexed' backend, this is answered by the GOIndex.
+        Otherwise, the descendents of every term are computed together the
+        first time this is called and kept until the graph changes (parse()
+        or prune()), so each later call is a dictionary lookup. The returned
+        frozenset is shared and must not be modified.
         """
         if gterm not in self.go_terms:
-            return set()
-        term = self.go_terms[gterm]
-
-        if len(term.parent_of) == 0:
-            return set()
-
-        child_terms = set()
-        for child_term in term.parent_of:
-            if child_term.namespace != term.namespace:
-                continue
-            child_terms.add(child_term.go_id)
-            child_terms = child_terms | self.get_descendents(child_term.go_id)
-
-        return child_terms
+            return frozenset()
+        if self.backend == 'indexed':
+            return self.get_index().get_descendents(gterm)
+        if self.descendents is None:
+            self.descendents = self.build_reachability('parent_of')
+        return self.descendents[gterm]
 
     def get_ancestors(self, gterm):
         """
         get propagated ancestors of term
+
+        Like get_descendents(), this is answered by the GOIndex with the
+        'indexed' backend, and otherwise from a closure of the whole
+        ontology that is built on the first call.
         """
         if gterm not in self.go_terms:
-            return set()
-
-        term = self.go_terms[gterm]
+            return frozenset()
+        if self.backend == 'indexed':
+            return self.get_index().get_ancestors(gterm)
+        if self.ancestors is None:
+            self.ancestors = self.build_reachability('child_of')
+        return self.ancestors[gterm]
+
+    def is_descendent(self, gterm, ancestor):
+        """
+        Return True if the term with ID gterm is below the term with ID
+        ancestor (in the same namespace).
+        """
+        return ancestor in self.get_ancestors(gterm)
 
-        if len(term.child_of) == 0:
-            return set()
+    def build_reachability(self, direction):
+        """
+        Return a dictionary of GO ID -> frozenset of the GO IDs of the terms
+        reachable from that term through the given GOTerm attribute
+        ('parent_of' for descendents, 'child_of' for ancestors) without
+        leaving its namespace, for every term in go_terms.
+        """
+        # children_first() lists each term after everything below it, so
+        # reversing it lists each term after everything above it.
+        ordered = self.children_first(self.go_terms.values())
+        if direction == 'child_of':
+            ordered.reverse()
+
+        reachable = {}
+        for term in ordered:
+            term_reachable = set()
+            for next_term in getattr(term, direction):
+                if next_term.namespace != term.namespace:
+                    continue
+                term_reachable.add(next_term.go_id)
+                if next_term.go_id in self.go_terms:
+                    term_reachable |= reachable[next_term.go_id]
+            reachable[term.go_id] = frozenset(term_reachable)
+        return reachable
 
-        parent_terms = set()
-        for parent_term in term.child_of:
-            if parent_term.namespace != term.namespace:
-                continue
-            parent_terms.add(parent_term.go_id)
-            parent_terms = parent_terms | self.get_ancestors(parent_term.go_id)
+    def graph_changed(self):
+        """
+        Drop everything computed from the shape of the ontology (the
+        go_index.GOIndex and the ancestor/descendent closures), so that it
+        is rebuilt on the next query. Call this after changing parent_of or
+        child_of of any term.
+        """
+        self.index = None
+        self.descendents = None
+        self.ancestors = None
+        self.propagation_plan = None
 
-        return parent_terms
+    def get_propagation_plan(self):
+        """
+        Return the propagation order of the ontology as a list of
+        (go_id, edges) tuples, one for every term that has children, in
+        the children_first() order of the heads. edges is a list of
+        (child_go_id, relation) tuples, where relation is 'regulates',
+        'part_of' or 'is_a'. The plan only depends on the shape of the
+        ontology, so it is built once and shared by every AnnotationLayer.
+        """
+        if self.propagation_plan is None:
+            plan = []
+            for gterm in self.children_first(self.heads):
+                if not gterm.parent_of:
+                    continue
+                edges = []
+                for child_term in gterm.parent_of:
+                    if gterm in child_term.relationship_regulates:
+                        relation = 'regulates'
+                    elif gterm in child_term.relationship_part_of:
+                        relation = 'part_of'
+                    else:
+                        relation = 'is_a'
+                    edges.append((child_term.go_id, relation))
+                plan.append((gterm.go_id, edges))
+            self.propagation_plan = plan
+        return self.propagation_plan
 
     def get_leaves(self, namespace='biological_process', min_annot=10):
         """
         Return a set of leaf terms in ontology
         """
+        if self.backend == 'indexed':
+            return self.get_index().get_leaves(namespace=namespace,
+                                               min_annot=min_annot)
         leaves = set()
         for term in self.go_terms.values():
             if (len(term.parent_of) == 0 and term.namespace == namespace and
@@ -809,51 +985,180 @@ class go:
         return leaves
 
 
+class AnnotationLayer(object):
+    """
+    The annotations of one species (or of any other set of annotations)
+    on top of a go() ontology, kept apart from the GOTerm objects so that
+    one parsed ontology can be shared, read-only, by many layers. The
+    layer never modifies the ontology: annotations are stored in
+    self.annotations, a dictionary of GO ID -> set of Annotation objects
+    that only has entries for annotated terms.
+    """
+    def __init__(self, gene_ontology):
+        self.ontology = gene_ontology
+        self.annotations = {}
+
+    def add_annotation(self, go_id=None, xdb=None, gid=None, ref=None,
+                       evidence=None, date=None, direct=None):
+        """
+        Same as go.add_annotation(), but adds the annotation to this layer.
+        """
+        go_term = self.ontology.get_term(go_id)
+        if go_term is None:
+            logger.info("Couldn't get go_term for id %s.", go_id)
+            return False
+        annotation = Annotation(xdb=xdb, gid=gid, ref=ref, evidence=evidence,
+                                date=date, direct=direct)
+        self.annotations.setdefault(go_term.go_id, set()).add(annotation)
+        return True
+
+    def get_annotations(self, go_id):
+        """
+        Return the set of annotations of the term with go_id in this layer,
+        which is empty if the term has none.
+        """
+        return self.annotations.get(go_id, frozenset())
+
+    def propagate(self):
+        """
+        Propagate the annotations of the layer with the same relation
+        semantics as go.propagate(), following the shared
+        go.get_propagation_plan(). Terms whose children have no
+        annotations in this layer are skipped.
+        """
+        annotations = self.annotations
+        for (go_id, edges) in self.ontology.get_propagation_plan():
+            new_annotations = set()
+            for (child_id, relation) in edges:
+                child_annotations = annotations.get(child_id)
+                if not child_annotations:
+                    continue
+                if relation == 'regulates':
+                    # only add annotations that didn't come from a part of
+                    # or regulates relationship
+                    new_annotations.update([
+                        annotation.prop_copy(ready_regulates_cutoff=True)
+                        for annotation in child_annotations
+                        if not annotation.ready_regulates_cutoff])
+                elif relation == 'part_of':
+                    new_annotations.update([
+                        annotation.prop_copy(ready_regulates_cutoff=True)
+                        for annotation in child_annotations])
+                else:
+                    new_annotations.update([
+                        annotation.prop_copy()
+                        for annotation in child_annotations])
+            if new_annotations:
+                new_annotations.update(annotations.get(go_id, ()))
+                annotations[go_id] = new_annotations
+
+
 class Annotation(object):
+    """
+    Immutable record of one gene annotation. Instances use __slots__ and
+    cache their hash, and the propagated (non-direct) copies made by
+    prop_copy() are shared flyweights, so that propagating an annotation
+    to every ancestor term does not allocate a new object per term.
+    """
+    __slots__ = ('xdb', 'gid', 'ref', 'evidence', 'date', 'direct',
+                 'cross_annotated', 'origin', 'ortho_evidence',
+                 'ready_regulates_cutoff', '_hash', '_prop_copies')
+
     def __init__(self, xdb=None, gid=None, ref=None, evidence=None, date=None,
                  direct=False, cross_annotated=False, origin=None,
                  ortho_evidence=None, ready_regulates_cutoff=False):
-        super(Annotation, self).__setattr__('xdb', xdb)
-        super(Annotation, self).__setattr__('gid', gid)
-        super(Annotation, self).__setattr__('ref', ref)
-        super(Annotation, self).__setattr__('evidence', evidence)
-        super(Annotation, self).__setattr__('date', date)
-        super(Annotation, self).__setattr__('direct', direct)
-        super(Annotation, self).__setattr__('cross_annotated', cross_annotated)
-        super(Annotation, self).__setattr__('origin', origin)
-        super(Annotation, self).__setattr__('ortho_evidence', ortho_evidence)
-        super(Annotation, self).__setattr__('ready_regulates_cutoff',
-                                            ready_regulates_cutoff)
+        # The same identifiers, references and dates repeat across many
+        # annotations, so keep a single copy of each string.
+        xdb = _intern(xdb)
+        gid = _intern(gid)
+        ref = _intern(ref)
+        evidence = _intern(evidence)
+        date = _intern(date)
+
+        object.__setattr__(self, 'xdb', xdb)
+        object.__setattr__(self, 'gid', gid)
+        object.__setattr__(self, 'ref', ref)
+        object.__setattr__(self, 'evidence', evidence)
+        object.__setattr__(self, 'date', date)
+        object.__setattr__(self, 'direct', direct)
+        object.__setattr__(self, 'cross_annotated', cross_annotated)
+        object.__setattr__(self, 'origin', origin)
+        object.__setattr__(self, 'ortho_evidence', ortho_evidence)
+        object.__setattr__(self, 'ready_regulates_cutoff',
+                           ready_regulates_cutoff)
+
+        object.__setattr__(self, '_hash', hash((
+            xdb, gid, ref, evidence, date, direct, cross_annotated,
+            ortho_evidence, ready_regulates_cutoff, origin)))
+        object.__setattr__(self, '_prop_copies', None)
 
     def prop_copy(self, ready_regulates_cutoff=None):
+        """
+        Return the propagated (non-direct) version of this annotation.
+        The copy is created once per value of ready_regulates_cutoff and
+        then reused, and a propagated annotation is its own copy.
+        """
         if ready_regulates_cutoff is None:
             ready_regulates_cutoff = self.ready_regulates_cutoff
 
-        return Annotation(xdb=self.xdb, gid=self.gid, ref=self.ref,
-                          evidence=self.evidence, date=self.date, direct=False,
-                          cross_annotated=False,
-                          ortho_evidence=self.ortho_evidence,
-                          ready_regulates_cutoff=ready_regulates_cutoff)
+        if (not self.direct and not self.cross_annotated and
+                self.origin is None and
+                self.ready_regulates_cutoff == ready_regulates_cutoff):
+            return self
+
+        prop_copies = self._prop_copies
+        if prop_copies is None:
+            prop_copies = [None, None]
+            object.__setattr__(self, '_prop_copies', prop_copies)
+
+        index = 1 if ready_regulates_cutoff else 0
+        if prop_copies[index] is None:
+            prop_copies[index] = Annotation(
+                xdb=self.xdb, gid=self.gid, ref=self.ref,
+                evidence=self.evidence, date=self.date, direct=False,
+                cross_annotated=False, ortho_evidence=self.ortho_evidence,
+                ready_regulates_cutoff=ready_regulates_cutoff)
+        return prop_copies[index]
 
     def __hash__(self):
-        return hash((self.xdb, self.gid, self.ref, self.evidence, self.date,
-                     self.direct, self.cross_annotated, self.ortho_evidence,
-                     self.ready_regulates_cutoff, self.origin))
+        return self._hash
 
     def __eq__(self, other):
-        return (self.xdb, self.gid, self.ref, self.evidence, self.date,
-                self.direct, self.cross_annotated, self.ortho_evidence,
-                self.ready_regulates_cutoff, self.origin).__eq__((
-                    other.xdb, other.gid, other.ref, other.evidence,
-                    other.date, other.direct, other.cross_annotated,
-                    other.ortho_evidence, other.ready_regulates_cutoff,
-                    other.origin))
+        if self is other:
+            return True
+        return (self._hash == other._hash and self.gid == other.gid and
+                self.ref == other.ref and self.xdb == other.xdb and
+                self.evidence == other.evidence and
+                self.date == other.date and self.direct == other.direct and
+                self.cross_annotated == other.cross_annotated and
+                self.ortho_evidence == other.ortho_evidence and
+                self.ready_regulates_cutoff ==
+                other.ready_regulates_cutoff and
+                self.origin == other.origin)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __reduce__(self):
+        return (Annotation, (self.xdb, self.gid, self.ref, self.evidence,
+                             self.date, self.direct, self.cross_annotated,
+                             self.origin, self.ortho_evidence,
+                             self.ready_regulates_cutoff))
 
     def __setattr__(self, *args):
         raise TypeError("Attempt to modify immutable object.")
     __delattr__ = __setattr__
 
 
+def _intern(value):
+    """
+    Intern value if it is a plain string, otherwise return it unchanged.
+    """
+    if type(value) is str:
+        return intern(value)
+    return value
+
+
 class GOTerm:
     go_id = ''
     is_a = None
@@ -875,6 +1180,7 @@ class GOTerm:
     summary = None
     desc = None
     votes = None
+    xrefs = None
 
     def __init__(self, go_id):
         self.head = True
@@ -895,6 +1201,7 @@ class GOTerm:
         self.base_counts = None
         self.counts = None
         self.desc = None
+        self.xrefs = []
         self.votes = set([])
 
     def __cmp__(self, other):
@@ -0,0 +1,225 @@
+"""
+On-disk cache of parsed OBO files, so that the same ontology (e.g. the
+gene_ontology.1_2.obo shared by every species) is parsed once and then
+loaded from the cache by each later go.load_obo() call.
+
+A cache file holds the DAG that go.parse() builds (terms, names,
+namespaces, descriptions, alt ids, xrefs and typed parent links, but no
+annotations) as nested tuples of strings and integers, written with the
+marshal module. Its name includes the SHA-1 digest of the OBO file, so a
+changed OBO file never matches an old cache, and CACHE_VERSION, which must
+be increased whenever go.parse() or this format changes.
+"""
+
+import os
+import gc
+import errno
+import marshal
+import hashlib
+import tempfile
+
+from go import GOTerm
+
+# Import and set logger
+import logging
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+CACHE_VERSION = 1
+
+CACHE_SUFFIX = '.parsed'
+
+
+def file_digest(filename):
+    """
+    Return the hex SHA-1 digest of the contents of filename.
+    """
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as file_fh:
+        for chunk in iter(lambda: file_fh.read(1 << 22), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_cache_file(cache_dir, obo_file, digest):
+    """
+    Return the location of the cache file for the version of obo_file
+    with the given digest.
+    """
+    return os.path.join(cache_dir, '%s.%s.v%d%s' % (
+        os.path.basename(obo_file), digest, CACHE_VERSION, CACHE_SUFFIX))
+
+
+def read_cache(cache_file, gene_ontology):
+    """
+    Fill the empty go() object gene_ontology with the terms stored in
+    cache_file.
+
+    Returns:
+    True if the cache was loaded, or False if cache_file does not exist or
+    cannot be read, in which case gene_ontology is left unchanged.
+    """
+    try:
+        with open(cache_file, 'rb') as cache_fh:
+            (version, records, go_term_indices, head_indices,
+             alt_id2std_id) = marshal.load(cache_fh)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            logger.warning('Could not read OBO cache %s: %s', cache_file, e)
+        return False
+    except (EOFError, ValueError, TypeError) as e:
+        logger.warning('Ignoring corrupt OBO cache %s: %s', cache_file, e)
+        return False
+
+    if version != CACHE_VERSION:
+        logger.warning('Ignoring OBO cache %s with version %s',
+                       cache_file, version)
+        return False
+
+    # Like go.parse(), this creates a lot of reference cycles at once
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        terms = []
+        for record in records:
+            term = GOTerm(record[0])
+            (term.name, term.full_name, term.namespace, term.description,
+             term.head) = record[1:6]
+            term.alt_id = list(record[6])
+            term.xrefs = list(record[7])
+            terms.append(term)
+
+        for (term, record) in zip(terms, records):
+            (is_a, part_of, regulates, child_of, parent_of) = record[8:]
+            term.is_a = [terms[i] for i in is_a]
+            term.relationship_part_of = [terms[i] for i in part_of]
+            term.relationship_regulates = [terms[i] for i in regulates]
+            term.child_of = set([terms[i] for i in child_of])
+            term.parent_of = set([terms[i] for i in parent_of])
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    for i in go_term_indices:
+        gene_ontology.go_terms[terms[i].go_id] = terms[i]
+    gene_ontology.heads.extend(terms[i] for i in head_indices)
+    gene_ontology.alt_id2std_id.update(alt_id2std_id)
+    gene_ontology.graph_changed()
+    return True
+
+
+def write_cache(cache_file, gene_ontology):
+    """
+    Store the terms of the freshly parsed go() object gene_ontology in
+    cache_file. The file is written under a temporary name and renamed
+    into place, so that concurrent readers and writers never see a
+    partial cache.
+    """
+    # Building the records allocates a lot of small tuples, which would
+    # trigger the cyclic garbage collector over the whole ontology
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        data = _cache_data(gene_ontology)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    cache_dir = os.path.dirname(cache_file) or '.'
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    (tmp_fd, tmp_file) = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(tmp_fd, 'wb') as tmp_fh:
+            marshal.dump(data, tmp_fh, 2)
+        os.rename(tmp_file, cache_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def _cache_data(gene_ontology):
+    """
+    Return the tuple that write_cache() stores for gene_ontology, in which
+    terms refer to each other by their position in the list of records.
+    """
+    # Terms that were declared obsolete are no longer in go_terms, but
+    # other terms can still link to them, so every linked term is stored.
+    terms = sorted(gene_ontology.go_terms.values(),
+                   key=lambda term: term.go_id)
+    index = dict((id(term), i) for (i, term) in enumerate(terms))
+    position = 0
+    while position < len(terms):
+        term = terms[position]
+        position += 1
+        for links in (term.child_of, term.parent_of):
+            for linked in links:
+                if id(linked) not in index:
+                    index[id(linked)] = len(terms)
+                    terms.append(linked)
+    for head in gene_ontology.heads:
+        if id(head) not in index:
+            index[id(head)] = len(terms)
+            terms.append(head)
+
+    records = []
+    for term in terms:
+        records.append((
+            term.go_id, term.name, term.full_name, term.namespace,
+            term.description, term.head, tuple(term.alt_id),
+            tuple(term.xrefs),
+            tuple(index[id(parent)] for parent in term.is_a),
+            tuple(index[id(parent)] for parent in term.relationship_part_of),
+            tuple(index[id(parent)] for parent in
+                  term.relationship_regulates),
+            tuple(index[id(parent)] for parent in term.child_of),
+            tuple(index[id(child)] for child in term.parent_of)))
+
+    go_term_indices = tuple(index[id(term)] for term in
+                            gene_ontology.go_terms.itervalues())
+    head_indices = tuple(index[id(head)] for head in gene_ontology.heads)
+    return (CACHE_VERSION, tuple(records), go_term_indices, head_indices,
+            dict(gene_ontology.alt_id2std_id))
+
+
+def remove_stale_caches(cache_dir, obo_file, keep_file):
+    """
+    Delete the cache files of older versions of obo_file in cache_dir,
+    other than keep_file.
+    """
+    prefix = os.path.basename(obo_file) + '.'
+    for filename in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, filename)
+        if (filename.startswith(prefix) and filename.endswith(CACHE_SUFFIX)
+                and path != keep_file):
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.warning('Could not remove old OBO cache %s: %s',
+                               path, e)
+
+
+def load_cached_obo(gene_ontology, obo_file, cache_dir):
+    """
+    Fill the empty go() object gene_ontology with obo_file, from the cache
+    in cache_dir when it has one for the current contents of the file, or
+    else by parsing the file and then caching the result.
+
+    Returns:
+    True if the cache was used, False if the file was parsed.
+    """
+    digest = file_digest(obo_file)
+    cache_file = get_cache_file(cache_dir, obo_file, digest)
+    if read_cache(cache_file, gene_ontology):
+        logger.info('Loaded %s from OBO cache %s', obo_file, cache_file)
+        return True
+
+    with open(obo_file) as obo_fh:
+        gene_ontology.parse(obo_fh)
+
+    try:
+        write_cache(cache_file, gene_ontology)
+        remove_stale_caches(cache_dir, obo_file, cache_file)
+    except (IOError, OSError) as e:
+        logger.warning('Could not write OBO cache %s: %s', cache_file, e)
+    return False
@@ -0,0 +1,323 @@
+"""
+Integer-indexed representation of a parsed go.go() ontology. Every term
+gets a dense integer index and the DAG is stored as CSR-style NumPy
+arrays (parents and children of each term, plus the relation type of each
+edge), so that graph queries and propagation do not have to go through
+string GO IDs and Python sets of GOTerm objects.
+
+The GOTerm objects of the ontology are kept as they are: GOIndex.terms[i]
+is the GOTerm with index i, and annotations are still read from and
+written to GOTerm.annotations. This module depends on numpy.
+"""
+
+import numpy as np
+
+# Import and set logger
+import logging
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Edge relation types, from a child term to one of its parents
+RELATION_IS_A = 0
+RELATION_PART_OF = 1
+RELATION_REGULATES = 2
+
+
+class GOIndex(object):
+    """
+    Arrays describing the terms of a go.go() object at the time the index
+    was built. The index does not follow later changes to the ontology
+    (e.g. go.prune()), so it must be rebuilt after those.
+    """
+    def __init__(self, gene_ontology):
+        self.terms = sorted(gene_ontology.go_terms.values())
+        self.id2index = {}
+        for (index, term) in enumerate(self.terms):
+            self.id2index[term.go_id] = index
+        for (alt_id, std_id) in gene_ontology.alt_id2std_id.iteritems():
+            if std_id in self.id2index and alt_id not in self.id2index:
+                self.id2index[alt_id] = self.id2index[std_id]
+
+        self.namespaces = sorted(set(term.namespace for term in self.terms))
+        namespace_codes = dict((namespace, code) for (code, namespace) in
+                               enumerate(self.namespaces))
+        self.namespace = np.array(
+            [namespace_codes[term.namespace] for term in self.terms],
+            dtype=np.int8)
+
+        child_list = []
+        parent_list = []
+        relation_list = []
+        for (index, term) in enumerate(self.terms):
+            regulates = set(term.relationship_regulates)
+            part_of = set(term.relationship_part_of)
+            for parent_term in term.child_of:
+                parent_index = self.id2index.get(parent_term.go_id)
+                if parent_index is None:
+                    logger.debug('Parent %s of term %s is not in the index',
+                                 parent_term.go_id, term.go_id)
+                    continue
+                child_list.append(index)
+                parent_list.append(parent_index)
+                if parent_term in regulates:
+                    relation_list.append(RELATION_REGULATES)
+                elif parent_term in part_of:
+                    relation_list.append(RELATION_PART_OF)
+                else:
+                    relation_list.append(RELATION_IS_A)
+
+        edge_child = np.array(child_list, dtype=np.int32)
+        edge_parent = np.array(parent_list, dtype=np.int32)
+        edge_relation = np.array(relation_list, dtype=np.int8)
+
+        (self.parents_indptr, self.parents, self.parent_relations) = \
+            self._csr(edge_child, edge_parent, edge_relation)
+        (self.children_indptr, self.children, self.child_relations) = \
+            self._csr(edge_parent, edge_child, edge_relation)
+
+        # Plain-list copies of the arrays, which are much faster than NumPy
+        # arrays to index one element at a time from Python loops.
+        self._parents_lists = (self.parents_indptr.tolist(),
+                               self.parents.tolist())
+        self._children_lists = (self.children_indptr.tolist(),
+                                self.children.tolist(),
+                                self.child_relations.tolist())
+        self._namespace_list = self.namespace.tolist()
+        self._topological_order = None
+
+    def __len__(self):
+        return len(self.terms)
+
+    def _csr(self, rows, cols, relations):
+        """
+        Group the (rows[i], cols[i], relations[i]) edges by row and return
+        (indptr, cols, relations), where the edges of row r are at
+        indptr[r]:indptr[r + 1] of the other two arrays.
+        """
+        order = np.argsort(rows, kind='mergesort')
+        counts = np.bincount(rows, minlength=len(self.terms))
+        indptr = np.zeros(len(self.terms) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        return (indptr, cols[order], relations[order])
+
+    def get_index(self, go_id):
+        """
+        Return the index of the term with go_id (or alt_id), or None.
+        """
+        return self.id2index.get(go_id)
+
+    def get_parents(self, index):
+        return self.parents[self.parents_indptr[index]:
+                            self.parents_indptr[index + 1]]
+
+    def get_children(self, index):
+        return self.children[self.children_indptr[index]:
+                             self.children_indptr[index + 1]]
+
+    def topological_order(self):
+        """
+        Return an array with every term index, ordered so that each term
+        comes after all of its children.
+        """
+        if self._topological_order is None:
+            num_children = np.diff(self.children_indptr)
+            pending = num_children.tolist()
+            (parents_indptr, parents) = self._parents_lists
+
+            order = np.flatnonzero(num_children == 0).tolist()
+            position = 0
+            while position < len(order):
+                index = order[position]
+                position += 1
+                for parent in parents[parents_indptr[index]:
+                                      parents_indptr[index + 1]]:
+                    pending[parent] -= 1
+                    if pending[parent] == 0:
+                        order.append(parent)
+
+            if len(order) != len(self.terms):
+                logger.error('The ontology has a cycle, %s terms could not '
+                             'be ordered.', len(self.terms) - len(order))
+            self._topological_order = np.array(order, dtype=np.int32)
+        return self._topological_order
+
+    def _reachable(self, start, indptr, neighbors):
+        """
+        Return the set of indices reachable from start through
+        (indptr, neighbors), staying inside the namespace of start.
+        """
+        namespace = self._namespace_list
+        start_namespace = namespace[start]
+        reached = set()
+        stack = [start]
+        while stack:
+            index = stack.pop()
+            for neighbor in neighbors[indptr[index]:indptr[index + 1]]:
+                if neighbor in reached:
+                    continue
+                if namespace[neighbor] != start_namespace:
+                    continue
+                reached.add(neighbor)
+                stack.append(neighbor)
+        return reached
+
+    def get_descendents(self, go_id):
+        """
+        Same as go.get_descendents(): the GO IDs of the terms below go_id
+        in its namespace.
+        """
+        index = self.id2index.get(go_id)
+        if index is None:
+            return set()
+        (indptr, children, relations) = self._children_lists
+        return set(self.terms[i].go_id for i in
+                   self._reachable(index, indptr, children))
+
+    def get_ancestors(self, go_id):
+        """
+        Same as go.get_ancestors(): the GO IDs of the terms above go_id in
+        its namespace.
+        """
+        index = self.id2index.get(go_id)
+        if index is None:
+            return set()
+        (indptr, parents) = self._parents_lists
+        return set(self.terms[i].go_id for i in
+                   self._reachable(index, indptr, parents))
+
+    def get_leaves(self, namespace='biological_process', min_annot=10):
+        """
+        Same as go.get_leaves(): the leaf GOTerms of namespace that have
+        at least min_annot annotations.
+        """
+        if namespace not in self.namespaces:
+            return set()
+        code = self.namespaces.index(namespace)
+        candidates = np.flatnonzero((np.diff(self.children_indptr) == 0) &
+                                    (self.namespace == code))
+        leaves = set()
+        for index in candidates:
+            term = self.terms[index]
+            if len(term.annotations) >= min_annot:
+                leaves.add(term)
+        return leaves
+
+    def propagate(self):
+        """
+        Propagate the annotations of every term to its ancestors, with the
+        same relation semantics as go.propagate(), walking the terms in
+        topological order.
+        """
+        terms = self.terms
+        (children_indptr, children, child_relations) = self._children_lists
+
+        for index in self.topological_order().tolist():
+            start = children_indptr[index]
+            end = children_indptr[index + 1]
+            if start == end:
+                continue
+
+            new_annotations = set()
+            for edge in xrange(start, end):
+                relation = child_relations[edge]
+                child_annotations = terms[children[edge]].annotations
+                if relation == RELATION_REGULATES:
+                    # only add annotations that didn't come from a part of
+                    # or regulates relationship
+                    new_annotations.update([
+                        annotation.prop_copy(ready_regulates_cutoff=True)
+                        for annotation in child_annotations
+                        if not annotation.ready_regulates_cutoff])
+                elif relation == RELATION_PART_OF:
+                    new_annotations.update([
+                        annotation.prop_copy(ready_regulates_cutoff=True)
+                        for annotation in child_annotations])
+                else:
+                    new_annotations.update([
+                        annotation.prop_copy()
+                        for annotation in child_annotations])
+            term = terms[index]
+            term.annotations = term.annotations | new_annotations
+
+    def closure_matrix(self, relations):
+        """
+        Return a term x term scipy.sparse CSR matrix with a 1 at [p, c]
+        when c is p itself or is below p through edges whose relation is
+        in relations (e.g. (RELATION_IS_A,)).
+        """
+        from scipy import sparse
+
+        (children_indptr, children, child_relations) = self._children_lists
+        allowed = set(relations)
+        below = [np.array([index], dtype=np.int32)
+                 for index in xrange(len(self.terms))]
+        for index in self.topological_order().tolist():
+            parts = [below[index]]
+            for edge in xrange(children_indptr[index],
+                               children_indptr[index + 1]):
+                if child_relations[edge] in allowed:
+                    parts.append(below[children[edge]])
+            if len(parts) > 1:
+                below[index] = np.unique(np.concatenate(parts))
+
+        indptr = np.zeros(len(self.terms) + 1, dtype=np.int64)
+        np.cumsum([len(indices) for indices in below], out=indptr[1:])
+        indices = np.concatenate(below)
+        return sparse.csr_matrix(
+            (np.ones(len(indices), dtype=np.int32), indices, indptr),
+            shape=(len(self.terms), len(self.terms)))
+
+    def adjacency_matrix(self, relations):
+        """
+        Return a term x term scipy.sparse CSR matrix with a 1 at [p, c]
+        when c is a child of p through an edge whose relation is in
+        relations.
+        """
+        from scipy import sparse
+
+        keep = np.in1d(self.child_relations, relations)
+        rows = np.repeat(np.arange(len(self.terms), dtype=np.int32),
+                         np.diff(self.children_indptr))[keep]
+        return sparse.csr_matrix(
+            (np.ones(keep.sum(), dtype=np.int32),
+             (rows, self.children[keep])),
+            shape=(len(self.terms), len(self.terms)))
+
+    def propagate_matrix(self, direct):
+        """
+        Propagate a term x column scipy.sparse matrix of direct
+        annotations (e.g. terms x genes, with a nonzero where a gene is
+        directly annotated to a term) and return the propagated boolean
+        CSR matrix.
+
+        This follows the same rules as propagate(): annotations travel
+        up is_a edges unchanged, while those that have crossed a part_of
+        or regulates edge can no longer cross a regulates edge. Each
+        closure is computed with sparse matrix products instead of set
+        unions, but only membership is kept, not per-annotation metadata
+        such as dates or evidence codes.
+        """
+        direct = _binary(direct.tocsr().astype(np.int32))
+
+        # Annotations that have only crossed is_a edges
+        free = _binary(self.closure_matrix((RELATION_IS_A,)) * direct)
+
+        # Annotations that crossed at least one part_of or regulates edge,
+        # which then keep moving up is_a and part_of edges only
+        cutoff_edges = self.adjacency_matrix((RELATION_PART_OF,
+                                              RELATION_REGULATES))
+        cutoff = _binary(cutoff_edges * free)
+        cutoff = self.closure_matrix((RELATION_IS_A, RELATION_PART_OF)) * \
+            cutoff
+
+        return (free + cutoff).astype(np.bool_).tocsr()
+
+
+def _binary(matrix):
+    """
+    Set every stored value of a sparse matrix of counts to 1, so that
+    chained products count paths over at most one edge at a time and
+    cannot overflow.
+    """
+    matrix.data.fill(1)
+    return matrix
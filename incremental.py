@@ -0,0 +1,350 @@
+"""
+Incremental runs, which only process again the annotation types of a
+species whose inputs have changed since the last run.
+
+After the files of a species are downloaded (and revalidated, see
+download_cache.py), the inputs of each of its annotation types are
+fingerprinted: the SHA-1 digests of the files that the type reads (OBO,
+association, KEGG link, mim2gene, genemap and tag mapping files), of its
+settings in the species file, and of the code of the refinery itself. The
+fingerprint and the gene sets of each (species, annotation type) pair are
+saved in INCREMENTAL_DIR, with the digest of the saved gene sets, and the next
+run reuses the saved gene sets of every pair whose fingerprint has not
+changed, instead of processing it again.
+
+INCREMENTAL_DIR holds one manifest per species file,
+<species file name>.manifest.json, and one gene set file per annotation
+type, <species file name>.<type>.genesets, in marshal format (like the
+OBO cache of go_cache.py), which keeps the integer gene IDs of the
+annotations as they are. Each gene set is a marshal record of its own, so
+that the gene sets can be saved as they are generated, and reused one at a
+time (see iter_and_save_genesets() and load_unchanged_genesets()).
+"""
+
+import os
+import gc
+import json
+import glob
+import marshal
+import hashlib
+import tempfile
+from urlparse import urlsplit
+from ConfigParser import SafeConfigParser
+
+import download_cache
+from go_cache import file_digest
+from gaf_shards import get_file_digest
+from utils import write_atomically
+
+# Import and set logger
+import logging
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Files in the refinery folder that are not part of processing, and are
+# left out of the code digest
+NON_PROCESSING_FILES = ('tests.py', 'benchmarks.py')
+
+# Digest of the code of the refinery, computed once per process
+CODE_DIGEST = []
+
+
+def get_code_digest():
+    """
+    Return the SHA-1 digest of the Python files of the refinery, so that
+    changing the code invalidates the gene sets saved by earlier runs.
+    """
+    if not CODE_DIGEST:
+        digest = hashlib.sha1()
+        code_dir = os.path.dirname(os.path.abspath(__file__))
+        for code_file in sorted(glob.glob(os.path.join(code_dir, '*.py'))):
+            if os.path.basename(code_file) in NON_PROCESSING_FILES:
+                continue
+            digest.update(os.path.basename(code_file))
+            digest.update(get_file_digest(code_file))
+        CODE_DIGEST.append(digest.hexdigest())
+    return CODE_DIGEST[0]
+
+
+def get_input_digest(filename):
+    """
+    Return the SHA-1 digest of the input file filename. The checksum in
+    the download manifest of the file is used if the file has not been
+    modified since it was written (see download_cache.py), so that large
+    downloads are not hashed again.
+    """
+    manifest_file = download_cache.get_manifest_file(filename)
+    try:
+        with open(manifest_file, 'r') as manifest_fh:
+            manifest = json.load(manifest_fh)
+        manifest_stat = os.stat(manifest_file)
+        file_stat = os.stat(filename)
+        if manifest.get('sha1') and \
+                manifest.get('size') == file_stat.st_size and \
+                manifest_stat.st_mtime >= file_stat.st_mtime:
+            return manifest['sha1']
+    except (IOError, OSError, ValueError):
+        pass
+    return get_file_digest(filename)
+
+
+def get_url_file(folder, url):
+    """
+    Return the location of the file downloaded from url into folder.
+    """
+    return os.path.join(folder, os.path.basename(urlsplit(url.strip()).path))
+
+
+def get_input_files(species_file, annot_type, base_download_folder):
+    """
+    Return the list of the files that the genesets of annot_type are
+    processed from, in the same locations as download_files.py saves them.
+
+    Arguments:
+    species_file -- The SafeConfigParser of the species file.
+
+    annot_type -- A string. The annotation type, e.g. 'GO'.
+
+    base_download_folder -- A string. The BASE_DOWNLOAD_FOLDER of the run.
+    """
+    sd_folder = species_file.get('species_info', 'SPECIES_DOWNLOAD_FOLDER')
+    input_files = []
+
+    if annot_type == 'GO':
+        input_files.append(get_url_file(
+            base_download_folder, species_file.get('GO', 'GO_OBO_URL')))
+        for url in species_file.get('GO', 'ASSOC_FILE_URLS').split(','):
+            input_files.append(get_url_file(os.path.join(sd_folder, 'GO'),
+                                            url))
+
+    elif annot_type == 'KEGG':
+        # The KEGG set info files are downloaded while the sets are
+        # processed, and change with the KEGG release in kegg_db_info.
+        input_files.append(os.path.join(base_download_folder,
+                                        'kegg_db_info'))
+        for url in species_file.get('KEGG', 'SETS_TO_DOWNLOAD').split(','):
+            input_files.append(get_url_file(os.path.join(sd_folder, 'KEGG'),
+                                            url))
+
+    elif annot_type == 'DO':
+        for option in ('DO_OBO_URL', 'MIM2GENE_URL', 'GENEMAP_URL'):
+            input_files.append(get_url_file(os.path.join(sd_folder, 'DO'),
+                                            species_file.get('DO', option)))
+
+    if species_file.has_option(annot_type, 'TAG_MAPPING_FILE'):
+        input_files.append(species_file.get(annot_type, 'TAG_MAPPING_FILE'))
+    return input_files
+
+
+def get_fingerprint(species_ini_file, annot_type, base_download_folder):
+    """
+    Fingerprint the inputs of the genesets of annot_type for a species.
+
+    Arguments:
+    species_ini_file -- A string, location of the species INI file.
+
+    annot_type -- A string. The annotation type, e.g. 'GO'.
+
+    base_download_folder -- A string. The BASE_DOWNLOAD_FOLDER of the run.
+
+    Returns:
+    fingerprint -- A dictionary of the digests of the code ('code'), of the
+    species_info and annot_type settings of the species file ('settings'),
+    and of each input file ('inputs', a dictionary of location -> digest),
+    or None if an input file is missing, in which case the type is
+    processed as usual.
+    """
+    species_file = SafeConfigParser()
+    species_file.read(species_ini_file)
+
+    settings = hashlib.sha1()
+    for section in ('species_info', annot_type):
+        settings.update(json.dumps(sorted(species_file.items(section))))
+
+    inputs = {}
+    for input_file in get_input_files(species_file, annot_type,
+                                      base_download_folder):
+        try:
+            inputs[input_file] = get_input_digest(input_file)
+        except (IOError, OSError):
+            logger.info('Input file %s of %s terms is missing, so they are '
+                        'processed again.', input_file, annot_type)
+            return None
+
+    return {'code': get_code_digest(), 'settings': settings.hexdigest(),
+            'inputs': inputs}
+
+
+def get_manifest_file(incremental_dir, species_ini_file):
+    """
+    Return the location of the manifest of a species in incremental_dir.
+    """
+    return os.path.join(incremental_dir, os.path.basename(species_ini_file) +
+                        '.manifest.json')
+
+
+def get_genesets_file(incremental_dir, species_ini_file, annot_type):
+    """
+    Return the location of the saved genesets of annot_type for a species
+    in incremental_dir.
+    """
+    return os.path.join(incremental_dir, '%s.%s.genesets' % (
+        os.path.basename(species_ini_file), annot_type))
+
+
+def read_manifest(incremental_dir, species_ini_file):
+    """
+    Return the manifest of a species, a dictionary of annotation type ->
+    {'fingerprint': ..., 'output_sha1': ...}, which is empty if there is
+    none yet.
+    """
+    try:
+        with open(get_manifest_file(incremental_dir, species_ini_file),
+                  'r') as manifest_fh:
+            return json.load(manifest_fh)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def read_genesets_file(genesets_file):
+    """
+    Generate the genesets saved in genesets_file, one marshal record at a
+    time.
+    """
+    with open(genesets_file, 'rb') as genesets_fh:
+        while True:
+            try:
+                yield marshal.load(genesets_fh)
+            except EOFError:
+                return
+
+
+def load_unchanged_genesets(incremental_dir, species_ini_file, annot_type,
+                            fingerprint, lazy=False):
+    """
+    Load the genesets of annot_type that an earlier run saved for a
+    species, if their fingerprint is the same as fingerprint. The saved
+    genesets file must have the digest recorded in the manifest, so that a
+    truncated or modified file is not reused.
+
+    Returns:
+    genesets -- The saved list of genesets, or with lazy, a generator of
+    them that reads them one at a time, or None if they have to be
+    processed again.
+    """
+    if fingerprint is None:
+        return None
+    entry = read_manifest(incremental_dir, species_ini_file).get(annot_type)
+    if not entry or entry.get('fingerprint') != fingerprint:
+        return None
+
+    genesets_file = get_genesets_file(incremental_dir, species_ini_file,
+                                      annot_type)
+    try:
+        if file_digest(genesets_file) != entry.get('output_sha1'):
+            raise ValueError('the file has changed since it was saved')
+    except (IOError, OSError, ValueError) as e:
+        logger.warning('Could not load the saved %s genesets of %s: %s',
+                       annot_type, species_ini_file, e)
+        return None
+
+    if lazy:
+        logger.info('Reusing the saved %s genesets of %s, as none of their '
+                    'inputs have changed.', annot_type, species_ini_file)
+        return read_genesets_file(genesets_file)
+
+    # The many small dictionaries and lists of the genesets would otherwise
+    # set off the cyclic garbage collector again and again
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        genesets = list(read_genesets_file(genesets_file))
+    except (IOError, OSError, ValueError, TypeError) as e:
+        logger.warning('Could not load the saved %s genesets of %s: %s',
+                       annot_type, species_ini_file, e)
+        return None
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    logger.info('Reusing %d %s genesets of %s, as none of their inputs '
+                'have changed.', len(genesets), annot_type, species_ini_file)
+    return genesets
+
+
+def iter_and_save_genesets(incremental_dir, species_ini_file, annot_type,
+                           fingerprint, genesets):
+    """
+    Generate the genesets of annot_type for a species from genesets (any
+    iterable of them), saving each one as it goes by, for the next run to
+    reuse. Once all of them have been generated, the saved genesets file
+    replaces the one of the last run, and their fingerprint is recorded in
+    the manifest. If fingerprint is None, the genesets are not saved, and
+    the saved genesets of annot_type are forgotten. If the generator is not
+    run to the end, nothing is saved.
+    """
+    if not os.path.isdir(incremental_dir):
+        try:
+            os.makedirs(incremental_dir)
+        except OSError:
+            if not os.path.isdir(incremental_dir):
+                raise
+
+    genesets_file = get_genesets_file(incremental_dir, species_ini_file,
+                                      annot_type)
+    (tmp_fd, tmp_file) = tempfile.mkstemp(
+        prefix=os.path.basename(genesets_file) + '.', dir=incremental_dir)
+    digest = hashlib.sha1()
+    saving = fingerprint is not None
+    try:
+        with os.fdopen(tmp_fd, 'wb') as tmp_fh:
+            for geneset in genesets:
+                if saving:
+                    try:
+                        geneset_data = marshal.dumps(geneset, 2)
+                    except ValueError as e:
+                        # marshal only writes built-in types
+                        logger.warning('Could not save the %s genesets of '
+                                       '%s: %s', annot_type,
+                                       species_ini_file, e)
+                        saving = False
+                    else:
+                        tmp_fh.write(geneset_data)
+                        digest.update(geneset_data)
+                yield geneset
+
+        manifest = read_manifest(incremental_dir, species_ini_file)
+        previous = manifest.pop(annot_type, {})
+        if saving:
+            output_sha1 = digest.hexdigest()
+            if previous.get('output_sha1') == output_sha1:
+                logger.info('The %s genesets of %s are the same as in the '
+                            'last run.', annot_type, species_ini_file)
+            os.rename(tmp_file, genesets_file)
+            manifest[annot_type] = {'fingerprint': fingerprint,
+                                    'output_sha1': output_sha1}
+
+        write_atomically(get_manifest_file(incremental_dir, species_ini_file),
+                         lambda manifest_fh: json.dump(
+                             manifest, manifest_fh, indent=2,
+                             sort_keys=True))
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def save_genesets(incremental_dir, species_ini_file, annot_type,
+                  fingerprint, genesets):
+    """
+    Save the genesets of annot_type for a species and their fingerprint,
+    for the next run to reuse, as iter_and_save_genesets() does.
+
+    Returns:
+    output_sha1 -- The SHA-1 digest of the saved genesets file, or None if
+    they could not be saved.
+    """
+    for _ in iter_and_save_genesets(incremental_dir, species_ini_file,
+                                    annot_type, fingerprint, genesets):
+        pass
+    entry = read_manifest(incremental_dir, species_ini_file).get(annot_type)
+    return entry['output_sha1'] if entry else None
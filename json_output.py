@@ -0,0 +1,275 @@
+"""
+Streaming output of the processed gene sets to JSON files, for
+PROCESS_TO: JSON file.
+
+A GenesetWriter writes the gene sets one at a time as it is given them,
+so that the output is never held in memory as a whole, either as a JSON
+string or as one list of the gene sets of all the species. The output is
+either:
+
+* "json" (the default), one JSON document: the list of the gene sets, or
+  with OUTPUT_MODE: delta, an object with the "new" and "changed" gene sets
+  and the "removed" slugs (see geneset_hashes.py), or
+
+* "ndjson", newline-delimited JSON: one gene set per line, or with
+  OUTPUT_MODE: delta, one {"status": "new" or "changed", "geneset": ...} or
+  {"status": "removed", "slug": ...} object per line.
+
+The gene sets of all the species are written to JSON_FILE, or with
+JSON_DIR, those of each species to their own <species file name>.json (or
+.ndjson) file in that folder (see get_json_output_options()). The files are
+gzipped with JSON_GZIP: TRUE, or if JSON_FILE ends with .gz, and written
+without indentation or spaces with JSON_COMPACT: TRUE.
+"""
+
+import os
+import sys
+import gzip
+import json
+import shutil
+import tempfile
+
+# Import and set logger
+import logging
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Formats of the JSON files
+JSON_FORMATS = ('json', 'ndjson')
+
+# Number of spaces per level of indentation of "json" files that are not
+# compact, as with json.dump(..., indent=2)
+INDENT = 2
+
+# Separators of compact files
+COMPACT_SEPARATORS = (',', ':')
+
+# Compression level of gzipped files, which are about as small as with the
+# default level of 9, but much faster to write
+GZIP_COMPRESSLEVEL = 6
+
+
+def get_json_output_options(main_config_file):
+    """
+    Read the settings of the JSON output from the "main" section of the
+    main configuration file.
+
+    Arguments:
+    main_config_file -- The SafeConfigParser of the main configuration
+    file.
+
+    Returns:
+    A tuple (json_file, json_dir, writer_options), of the JSON_FILE that
+    the gene sets of all the species are written to (or None), the JSON_DIR
+    that the gene sets of each species are written to a file in instead (or
+    None), and a dictionary of the json_format, compact and compress
+    arguments of GenesetWriter.
+    """
+    json_file = None
+    if main_config_file.has_option('main', 'JSON_FILE'):
+        json_file = main_config_file.get('main', 'JSON_FILE')
+
+    json_dir = None
+    if main_config_file.has_option('main', 'JSON_DIR'):
+        json_dir = main_config_file.get('main', 'JSON_DIR')
+
+    if json_file is None and json_dir is None:
+        logger.error('Main configuration file must have a "JSON_FILE" or a '
+                     '"JSON_DIR" option in the "main" section for '
+                     'PROCESS_TO to be "JSON file".')
+        sys.exit(1)
+
+    json_format = 'json'
+    if main_config_file.has_option('main', 'JSON_FORMAT'):
+        json_format = main_config_file.get('main', 'JSON_FORMAT').lower()
+        if json_format not in JSON_FORMATS:
+            logger.error('JSON_FORMAT option in the main configuration file '
+                         'must be one of: %s.', ', '.join(JSON_FORMATS))
+            sys.exit(1)
+
+    compact = False
+    if main_config_file.has_option('main', 'JSON_COMPACT'):
+        compact = main_config_file.getboolean('main', 'JSON_COMPACT')
+
+    compress = json_dir is None and json_file.endswith('.gz')
+    if main_config_file.has_option('main', 'JSON_GZIP'):
+        compress = main_config_file.getboolean('main', 'JSON_GZIP')
+
+    return (json_file, json_dir, {'json_format': json_format,
+                                  'compact': compact, 'compress': compress})
+
+
+def get_species_json_file(json_dir, species_ini_file, json_format='json',
+                          compress=False):
+    """
+    Return the location of the JSON file of the gene sets of a species in
+    json_dir.
+    """
+    return os.path.join(json_dir, '%s.%s%s' % (
+        os.path.basename(species_ini_file), json_format,
+        '.gz' if compress else ''))
+
+
+class GenesetWriter(object):
+    """
+    Writer of gene sets to a JSON file, one at a time (see the description
+    of the formats at the top of this module). Call close() once all the
+    gene sets have been written, to end the JSON document and close the
+    file.
+
+    In the delta output mode, the changed gene sets and the removed slugs
+    of a "json" file are kept in temporary files until close(), as they
+    come after all the new gene sets in the document.
+    """
+
+    def __init__(self, filename, json_format='json', delta=False,
+                 compact=False, compress=False):
+        """
+        Arguments:
+        filename -- A string, location of the file to write, which is
+        replaced if it exists.
+
+        json_format -- Optional. One of JSON_FORMATS.
+
+        delta -- Optional. If True, gene sets are written as new or changed
+        ones, and slugs as removed ones, for OUTPUT_MODE: delta.
+
+        compact -- Optional. If True, the JSON is written without
+        indentation, and without spaces after the separators.
+
+        compress -- Optional. If True, the file is gzipped.
+        """
+        if json_format not in JSON_FORMATS:
+            raise ValueError('Unknown JSON format: %s' % json_format)
+        self.filename = filename
+        self.json_format = json_format
+        self.delta = delta
+        self.compact = compact
+
+        if compress:
+            self.fh = gzip.GzipFile(filename, 'wb', GZIP_COMPRESSLEVEL)
+        else:
+            self.fh = open(filename, 'wb')
+
+        # Number of items written to each list of the "json" document, and
+        # the files that the changed and removed items are spooled to
+        self.counts = {'new': 0, 'changed': 0, 'removed': 0}
+        self.spools = {}
+
+        if json_format == 'json':
+            if not delta:
+                self.fh.write('[')
+            else:
+                self.spools = {'changed': tempfile.TemporaryFile(),
+                               'removed': tempfile.TemporaryFile()}
+                self.fh.write('{' if compact else '{\n' + ' ' * INDENT)
+                self.start_list('new')
+
+    def format_value(self, value, depth):
+        """
+        Return the JSON text of value, indented for depth levels of nesting
+        in a "json" document that is not compact.
+        """
+        if self.compact:
+            return json.dumps(value, separators=COMPACT_SEPARATORS)
+        if self.json_format == 'ndjson':
+            return json.dumps(value)
+        return json.dumps(value, indent=INDENT).replace(
+            '\n', '\n' + ' ' * INDENT * depth)
+
+    def write_item(self, section, value):
+        """
+        Write value as the next item of the section ('new', 'changed' or
+        'removed') list of a "json" document.
+        """
+        fh = self.spools.get(section, self.fh)
+        depth = 2 if self.delta else 1
+        if self.compact:
+            if self.counts[section]:
+                fh.write(',')
+        else:
+            fh.write(', \n' if self.counts[section] else '\n')
+            fh.write(' ' * INDENT * depth)
+        fh.write(self.format_value(value, depth))
+        self.counts[section] += 1
+
+    def start_list(self, section):
+        """
+        Start the section list of a "json" document in the delta output
+        mode.
+        """
+        self.fh.write('"%s":%s[' % (section, '' if self.compact else ' '))
+
+    def end_list(self, section):
+        """
+        End the section list of a "json" document.
+        """
+        if self.counts[section] and not self.compact:
+            depth = 2 if self.delta else 1
+            self.fh.write('\n' + ' ' * INDENT * (depth - 1))
+        self.fh.write(']')
+
+    def write(self, geneset, status='new'):
+        """
+        Write geneset, which in the delta output mode is a 'new' or
+        'changed' gene set, as given by status.
+        """
+        if status not in ('new', 'changed'):
+            raise ValueError('Unknown gene set status: %s' % status)
+        if self.json_format == 'ndjson':
+            if self.delta:
+                geneset = {'status': status, 'geneset': geneset}
+            self.fh.write(self.format_value(geneset, 0) + '\n')
+            self.counts[status] += 1
+        else:
+            self.write_item(status if self.delta else 'new', geneset)
+
+    def write_genesets(self, genesets, status='new'):
+        """
+        Write each geneset in genesets (any iterable of gene sets), as
+        write() does.
+        """
+        for geneset in genesets:
+            self.write(geneset, status)
+
+    def write_removed(self, slug):
+        """
+        Write the slug of a gene set that is no longer processed, in the
+        delta output mode.
+        """
+        if not self.delta:
+            raise ValueError('Removed gene sets are only written in the '
+                             'delta output mode.')
+        if self.json_format == 'ndjson':
+            self.fh.write(self.format_value(
+                {'status': 'removed', 'slug': slug}, 0) + '\n')
+            self.counts['removed'] += 1
+        else:
+            self.write_item('removed', slug)
+
+    def close(self):
+        """
+        End the JSON document, and close the file.
+        """
+        try:
+            if self.json_format == 'json':
+                self.end_list('new')
+                if self.delta:
+                    for section in ('changed', 'removed'):
+                        self.fh.write(',' if self.compact else
+                                      ', \n' + ' ' * INDENT)
+                        self.start_list(section)
+                        spool = self.spools.pop(section)
+                        spool.seek(0)
+                        shutil.copyfileobj(spool, self.fh)
+                        spool.close()
+                        self.end_list(section)
+                    self.fh.write('}' if self.compact else '\n}')
+        finally:
+            for spool in self.spools.values():
+                spool.close()
+            self.fh.close()
+
+        logger.info('Wrote %s gene sets to %s.',
+                    self.counts['new'] + self.counts['changed'],
+                    self.filename)
@@ -0,0 +1,47 @@
+"""
+Single-pass tokenizer for OBO files (e.g. the Gene Ontology and Disease
+Ontology). It reads an OBO handle once, line by line, and turns it into a
+stream of stanza headers and (tag, value) pairs, which go.parse() and the
+DO cross-reference extraction consume directly.
+"""
+
+# Import and set logger
+import logging
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+def iter_tags(obo_fh, tags=None):
+    """
+    Read obo_fh once and yield its stanza headers and tag-value lines in
+    file order.
+
+    Arguments:
+    obo_fh -- An iterable of the lines of an OBO file, such as an open
+    file handle.
+
+    tags -- Optional. An iterable of the tag names (e.g. 'id', 'is_a') to
+    yield. Lines of any other tag are skipped by a prefix check, without
+    slicing or splitting them. By default, every tag is yielded.
+
+    Returns:
+    A generator of (tag, value) tuples. For stanza headers such as
+    '[Term]', tag is the header itself and value is None. For tag-value
+    lines, value is the rest of the line after 'tag:', without surrounding
+    whitespace, and still includes any trailing modifiers or '!' comment.
+    Blank lines and lines without a tag are skipped.
+    """
+    prefixes = None
+    if tags is not None:
+        prefixes = tuple(tag + ':' for tag in tags) + ('[',)
+
+    for line in obo_fh:
+        if prefixes is not None and not line.startswith(prefixes):
+            continue
+        if line[:1] == '[':
+            yield (line.strip(), None)
+            continue
+        colon = line.find(':')
+        if colon == -1:
+            continue
+        yield (line[:colon], line[colon + 1:].strip())
@@ -5,8 +5,10 @@ from urlparse import urlsplit
 from ConfigParser import SafeConfigParser
 
 from go import go
+from obo import iter_tags
 from slugify import slugify
 from utils import build_tags_dictionary
+from geneset_hashes import add_content_hash
 
 # Import and set logger
 import logging
@@ -36,37 +38,54 @@ def build_doid_omim_dict(obo_file):
     that have OMIM xrefs. The keys in the dictionary are DOIDs, and the
     values are sets of OMIM xref IDs.
     """
-    obo_fh = open(obo_file, 'r')
     doid_omim_dict = {}
+    doid = None
+    inside = False
+
+    # Only the stanza headers, 'id:' and 'xref:' lines are tokenized, in a
+    # single streaming pass over the file.
+    with open(obo_file, 'r') as obo_fh:
+        for (tag, value) in iter_tags(obo_fh, ('id', 'xref')):
+            if value is None:
+                # Only the id and xrefs of [Term] stanzas are read
+                inside = (tag == '[Term]')
+                doid = None
+            elif not inside:
+                continue
+            elif tag == 'id':
+                doid = re.search('DOID:[0-9]+', value)
+                if doid:
+                    doid = doid.group(0)
+            elif value.startswith('OMIM:'):
+                # If term has OMIM xref, get it and add it to the
+                # doid_omim_dict. Otherwise, ignore.
+                omim = re.search('[0-9]+', value).group(0)
+                doid_omim_dict.setdefault(doid, set()).add(omim)
+
+    return doid_omim_dict
 
-    # This statement builds a list of the lines in the file and reverses
-    # its order. This is because the list 'pop()' method pops out list
-    # elements starting from the end. This way the lines will be read in
-    # the following loop in order, from top to bottom of the file.
-    obo_reversed_str_array = obo_fh.readlines()[::-1]
-
-    while obo_reversed_str_array:  # Loop adapted from Dima @ Princeton
-        line = obo_reversed_str_array.pop()
-        line = line.strip()
-        if line == '[Term]':
-            while line != '' and obo_reversed_str_array:
-                line = obo_reversed_str_array.pop()
-
-                if line.startswith('id:'):
-                    doid = re.search('DOID:[0-9]+', line)
-                    if doid:
-                        doid = doid.group(0)
-
-                if line.startswith('xref: OMIM:'):
-                    # If term has OMIM xref, get it and add it to the
-                    # doid_omim_dict. Otherwise, ignore.
-                    omim = re.search('[0-9]+', line).group(0)
-
-                    if doid not in doid_omim_dict:
-                        doid_omim_dict[doid] = set()
-                    if omim not in doid_omim_dict[doid]:
-                        doid_omim_dict[doid].add(omim)
 
+def get_doid_omim_dict(disease_ontology):
+    """
+    Build the same dictionary as build_doid_omim_dict() from the xrefs
+    that go.parse() already read into the terms of disease_ontology, so
+    that the DO OBO file does not have to be read a second time.
+
+    Arguments:
+    disease_ontology -- A go() object with the parsed Disease Ontology.
+
+    Returns:
+    doid_omim_dict -- A dictionary of only the DO terms in the ontology
+    that have OMIM xrefs. The keys in the dictionary are DOIDs, and the
+    values are sets of OMIM xref IDs. Obsolete terms, which go.parse()
+    drops, are not included.
+    """
+    doid_omim_dict = {}
+    for (doid, do_term) in disease_ontology.go_terms.iteritems():
+        for xref in do_term.xrefs:
+            if xref.startswith('OMIM:'):
+                omim = re.search('[0-9]+', xref).group(0)
+                doid_omim_dict.setdefault(doid, set()).add(omim)
     return doid_omim_dict
 
 
@@ -323,10 +342,62 @@ def create_do_term_abstract(do_term, doid_omim_dict):
     return abstract
 
 
-def process_do_terms(species_ini_file):
+def iter_do_terms(disease_ontology, doid_omim_dict, organism, xrdb,
+                  tags_dictionary=None):
+    """
+    Generate the processed DO term of each term of disease_ontology (whose
+    annotations have been added and propagated) that has annotations, one
+    at a time.
+
+    Arguments:
+    disease_ontology -- A go() object of the parsed and annotated DO OBO
+    file.
+
+    doid_omim_dict -- A dictionary of DOIDs and OMIM IDs, as returned by
+    get_doid_omim_dict().
+
+    organism -- A string, the scientific name of the organism.
+
+    xrdb -- A string, the type of gene identifier of the annotations.
+
+    tags_dictionary -- Optional. A dictionary of tags to be added to the DO
+    terms, made by the utils.build_tags_dictionary() function.
+    """
+    for term_id, term in disease_ontology.go_terms.iteritems():
+
+        do_term = {}
+
+        do_term['title'] = create_do_term_title(term)
+        do_term['abstract'] = create_do_term_abstract(term, doid_omim_dict)
+        do_term['xrdb'] = xrdb
+        do_term['organism'] = organism
+        do_term['slug'] = slugify(term_id + '-' + organism)
+
+        do_term['annotations'] = {}
+
+        for annotation in term.annotations:
+            if annotation.gid not in do_term['annotations']:
+                do_term['annotations'][annotation.gid] = []
+            else:
+                do_term['annotations'][annotation.gid].append(annotation.ref)
+
+        if do_term['annotations']:
+            if tags_dictionary and term_id in tags_dictionary:
+                do_term['tags'] = tags_dictionary[term_id]['gs_tags']
+            add_content_hash(do_term)
+            yield do_term
+
+
+def process_do_terms(species_ini_file, obo_cache_dir=None, lazy=False):
     """
     Function to read in config INI file and run the other functions to
     process DO terms.
+
+    If obo_cache_dir is given, the parsed DO OBO file is loaded from (or
+    saved to) the go_cache cache in that directory.
+
+    The DO terms are returned as a list, or with lazy, as a generator of
+    them (see iter_do_terms()).
     """
     species_file = SafeConfigParser()
     species_file.read(species_ini_file)
@@ -353,12 +424,13 @@ def process_do_terms(species_ini_file):
     genemap_file = os.path.join(sd_folder, 'DO', genemap_filename)
 
     disease_ontology = go()
-    loaded_obo_bool = disease_ontology.load_obo(do_obo_file)
+    loaded_obo_bool = disease_ontology.load_obo(do_obo_file,
+                                                cache_dir=obo_cache_dir)
 
     if loaded_obo_bool is False:
         logger.error('DO OBO file could not be loaded.')
 
-    doid_omim_dict = build_doid_omim_dict(do_obo_file)
+    doid_omim_dict = get_doid_omim_dict(disease_ontology)
 
     mim2entrez_dict = build_mim2entrez_dict(mim2gene_file)
 
@@ -380,29 +452,8 @@ def process_do_terms(species_ini_file):
         tags_dictionary = build_tags_dictionary(
             tag_mapping_file, do_id_column, do_name_column, tag_column, header)
 
-    do_terms = []
-
-    for term_id, term in disease_ontology.go_terms.iteritems():
-
-        do_term = {}
-
-        do_term['title'] = create_do_term_title(term)
-        do_term['abstract'] = create_do_term_abstract(term, doid_omim_dict)
-        do_term['xrdb'] = xrdb
-        do_term['organism'] = organism
-        do_term['slug'] = slugify(term_id + '-' + organism)
-
-        do_term['annotations'] = {}
-
-        for annotation in term.annotations:
-            if annotation.gid not in do_term['annotations']:
-                do_term['annotations'][annotation.gid] = []
-            else:
-                do_term['annotations'][annotation.gid].append(annotation.ref)
-
-        if do_term['annotations']:
-            if tags_dictionary and term_id in tags_dictionary:
-                do_term['tags'] = tags_dictionary[term_id]['gs_tags']
-            do_terms.append(do_term)
-
-    return do_terms
+    do_terms = iter_do_terms(disease_ontology, doid_omim_dict, organism,
+                             xrdb, tags_dictionary)
+    if lazy:
+        return do_terms
+    return list(do_terms)
@@ -1,13 +1,21 @@
+import gc
+import csv
 import os
 import re
 import sys
-import gzip
+import multiprocessing
+from Queue import Empty
+from itertools import chain, islice, izip
+from StringIO import StringIO
 from urlparse import urlsplit
 from ConfigParser import SafeConfigParser
 
-from go import go
+from go import go, AnnotationLayer
+from go_cache import file_digest
+from gaf_shards import get_taxon_shard
 from slugify import slugify
-from utils import build_tags_dictionary
+from utils import build_tags_dictionary, open_assoc_file
+from geneset_hashes import add_content_hash
 
 # Import and set logger
 import logging
@@ -26,6 +34,28 @@ DB_REMAP = {
     'WB': 'WormBase',
 }
 
+# Parsed GO ontologies shared by every species processed in this run (and
+# by processes forked after they are loaded), keyed by OBO file location
+# and content digest. They are never annotated: each species adds its
+# annotations to its own go.AnnotationLayer.
+SHARED_ONTOLOGIES = {}
+
+# Arabidopsis gene IDs, which TAIR annotations can have in one of several
+# columns of the association file
+TAIR_REGEX = re.compile('AT[0-9MC]G[0-9][0-9][0-9][0-9][0-9]')
+
+# Number of association file rows that the "columnar" GAF reader parses at
+# a time
+GAF_CHUNK_SIZE = 100000
+
+# Number of annotations that each reader process of
+# iter_concurrent_annotations() sends back at a time
+ANNOTATION_BATCH_SIZE = 10000
+
+# Number of annotation batches that each reader process of
+# iter_concurrent_annotations() reads ahead of the ones being used
+READER_QUEUE_SIZE = 4
+
 
 def get_filtered_annotations(assoc_file, accepted_evcodes=None,
                              remove_leading_gene_id=None,
@@ -36,6 +66,9 @@ def get_filtered_annotations(assoc_file, accepted_evcodes=None,
     'accepted_evcodes' (if accepted_evcodes is not None) and annotations
     that do not have details == 'NOT' will be included in this list.
 
+    This is list(iter_filtered_annotations(...)), see that function for
+    a version that does not keep every annotation in memory.
+
     Arguments:
     assoc_file -- A string. Location of the GO association file to be
     read in.
@@ -55,61 +88,305 @@ def get_filtered_annotations(assoc_file, accepted_evcodes=None,
     criteria. Each annotation in the list will be a tuple, which will
     contain: (<crossrefDB>, <crossrefID>, <goid>, <refstring>, <date>)
     """
+    return list(iter_filtered_annotations(
+        assoc_file, accepted_evcodes=accepted_evcodes,
+        remove_leading_gene_id=remove_leading_gene_id,
+        use_symbol=use_symbol, tax_id=tax_id))
+
+
+def iter_filtered_annotations(assoc_file, accepted_evcodes=None,
+                              remove_leading_gene_id=None,
+                              use_symbol=None, tax_id=None, reader='lines'):
+    """
+    Same as get_filtered_annotations(), but returns a generator that
+    reads the association file as it is consumed and yields one
+    annotation tuple at a time, so that the annotations of a large
+    (e.g. multi-species) file are never all in memory.
+
+    The taxon, 'NOT' and evidence code filters are applied before the
+    rest of each line is processed. With tax_id, lines that do not even
+    contain the taxonomy ID are skipped before they are split.
 
-    if assoc_file.endswith('.gz'):
-        assoc_fh = gzip.open(assoc_file, 'r')
+    Arguments:
+    The same as get_filtered_annotations(), plus:
+
+    reader -- Optional. "lines" (the default) reads the file line by line.
+    "columnar" reads it in chunks of GAF_CHUNK_SIZE rows with pandas and
+    filters each chunk as whole columns, which is faster for large files.
+    It requires pandas, and raises ImportError right away if pandas is
+    not installed.
+
+    Returns:
+    A generator of annotation tuples, in file order.
+    """
+    if reader == 'columnar':
+        rows = read_gaf_chunks(assoc_file, accepted_evcodes, tax_id)
     else:
-        assoc_fh = open(assoc_file, 'r')
+        rows = read_gaf_lines(assoc_file, accepted_evcodes, tax_id)
 
-    annotations = []
+    return (build_annotation(toks, remove_leading_gene_id, use_symbol)
+            for toks in rows)
 
-    for line in assoc_fh:
-        if line.startswith('!'):
-            continue
 
-        toks = line.strip().split('\t')
+def iter_concurrent_annotations(assoc_files, accepted_evcodes=None,
+                                remove_leading_gene_id=None, use_symbol=None,
+                                tax_id=None, reader='lines', concurrent=False):
+    """
+    Read several association files, with concurrent, at the same time,
+    each with iter_filtered_annotations() in its own process, and merge
+    their annotations into one stream.
+
+    The annotations are yielded file by file, in the same order as
+    chaining iter_filtered_annotations() over assoc_files, while the
+    readers of the next files keep reading and filtering in the
+    background. At most one reader per CPU runs at a time, and each one
+    sends its annotations back in batches of ANNOTATION_BATCH_SIZE, with
+    at most READER_QUEUE_SIZE batches waiting to be used, so that readers
+    ahead of the file being used wait instead of holding all of its
+    annotations.
+
+    The files are read one after another in this process instead without
+    concurrent, or when new processes cannot be started (e.g. in a
+    daemonic multiprocessing.Pool worker).
 
-        (xrdb, xrid, details, goid, refstring, ev_code, taxon, date) = (
-            toks[0], toks[1], toks[3], toks[4], toks[5], toks[6],
-            toks[12].split(':')[1], toks[13])
+    Arguments:
+    assoc_files -- A list of the locations of the association files.
 
-        if tax_id and (tax_id != taxon):
-            continue
+    concurrent -- Optional. True to read the files in separate processes.
+    Defaults to False, which reads them one after another in this process.
 
-        if remove_leading_gene_id:
-            xrid = xrid.split(':')[1]
-
-        if xrdb in DB_REMAP:
-            xrdb = DB_REMAP[xrdb]
-
-        if use_symbol:
-            xrdb = 'Symbol'
-            if toks[0] == 'UniProtKB':
-                xrid = toks[2]
-
-        # These next few lines are needed for processing
-        # Arabidopsis annotations
-        if xrdb == 'TAIR':
-            tair_regex = re.compile('AT[0-9MC]G[0-9][0-9][0-9][0-9][0-9]')
-            first_alias = toks[10].split('|')[0]
-            if tair_regex.match(toks[2]):
-                xrid = toks[2]
-            elif tair_regex.match(toks[9]):
-                xrid = toks[9]
-            elif tair_regex.match(first_alias):
-                xrid = first_alias
-
-        if details == 'NOT':
-            continue
+    The other arguments are the same as iter_filtered_annotations(), and
+    apply to every file. As there, ImportError is raised right away if
+    reader is "columnar" and pandas is not installed.
 
-        if accepted_evcodes is not None and (ev_code not in accepted_evcodes):
-            continue
+    Returns:
+    A generator of annotation tuples.
+    """
+    if reader == 'columnar':
+        # Fail here rather than in the reader processes
+        import pandas  # noqa
+
+    options = {'accepted_evcodes': accepted_evcodes,
+               'remove_leading_gene_id': remove_leading_gene_id,
+               'use_symbol': use_symbol, 'tax_id': tax_id, 'reader': reader}
 
-        annotation = (xrdb, xrid, goid, refstring, date)
+    if (not concurrent or len(assoc_files) < 2 or
+            multiprocessing.current_process().daemon):
+        return chain.from_iterable(
+            iter_filtered_annotations(assoc_file, **options)
+            for assoc_file in assoc_files)
 
-        annotations.append(annotation)
+    try:
+        max_readers = multiprocessing.cpu_count()
+    except NotImplementedError:
+        max_readers = 1
+    return _receive_annotations(assoc_files, options, max(max_readers, 1))
 
-    return annotations
+
+def _start_reader(assoc_file, options):
+    """
+    Start the reader process of assoc_file for _receive_annotations().
+
+    Returns:
+    A (process, queue) tuple, or (None, None) if the process could not be
+    started, in which case assoc_file is read in this process.
+    """
+    queue = multiprocessing.Queue(READER_QUEUE_SIZE)
+    process = multiprocessing.Process(target=_send_annotations,
+                                      args=(queue, assoc_file, options))
+    process.daemon = True
+    try:
+        process.start()
+    except (AssertionError, OSError) as e:
+        logger.warning('Could not start the association file reader process '
+                       'of %s, reading it in this process: %s', assoc_file, e)
+        return (None, None)
+    return (process, queue)
+
+
+def _send_annotations(queue, assoc_file, options):
+    """
+    Reader process of iter_concurrent_annotations(). Puts lists of the
+    annotations of assoc_file on queue, followed by None, or by the
+    exception that stopped the reader.
+    """
+    try:
+        annotations = iter_filtered_annotations(assoc_file, **options)
+        while True:
+            batch = list(islice(annotations, ANNOTATION_BATCH_SIZE))
+            if not batch:
+                break
+            queue.put(batch)
+    except Exception as e:
+        queue.put(e)
+    else:
+        queue.put(None)
+
+
+def _receive_annotations(assoc_files, options, max_readers):
+    """
+    Yield the annotations of assoc_files, read by the reader processes of
+    iter_concurrent_annotations(), one file after another, with at most
+    max_readers readers running at a time, and re-raise any exception that
+    stopped a reader. Readers that are still running when the generator is
+    closed are stopped.
+    """
+    # (assoc_file, process, queue) of the files being read, in order
+    workers = []
+    pending_files = list(assoc_files)
+    try:
+        while workers or pending_files:
+            while pending_files and len(workers) < max_readers:
+                assoc_file = pending_files.pop(0)
+                workers.append((assoc_file,) +
+                               _start_reader(assoc_file, options))
+
+            (assoc_file, process, queue) = workers.pop(0)
+            if process is None:
+                for annotation in iter_filtered_annotations(assoc_file,
+                                                            **options):
+                    yield annotation
+                continue
+
+            while True:
+                try:
+                    batch = queue.get(timeout=1)
+                except Empty:
+                    if process.is_alive() or not queue.empty():
+                        continue
+                    raise IOError('Association file reader process exited '
+                                  'with code %s' % process.exitcode)
+                if batch is None:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                for annotation in batch:
+                    yield annotation
+            process.join()
+    finally:
+        for (assoc_file, process, queue) in workers:
+            if process is not None and process.is_alive():
+                process.terminate()
+
+
+def read_gaf_lines(assoc_file, accepted_evcodes=None, tax_id=None):
+    """
+    Yield the columns of every annotation line of assoc_file that passes
+    the taxon, 'NOT' and evidence code filters of
+    get_filtered_annotations(). Only the first 14 columns are split apart.
+    """
+    with open_assoc_file(assoc_file) as assoc_fh:
+        for line in assoc_fh:
+            if line.startswith('!'):
+                continue
+
+            # The taxon column is checked exactly below, this only skips
+            # the lines of other species without splitting them.
+            if tax_id and tax_id not in line:
+                continue
+
+            toks = line.strip().split('\t', 14)
+
+            if tax_id and (tax_id != toks[12].split(':')[1]):
+                continue
+
+            if toks[3] == 'NOT':
+                continue
+
+            if accepted_evcodes is not None and (
+                    toks[6] not in accepted_evcodes):
+                continue
+
+            yield toks
+
+
+def read_gaf_chunks(assoc_file, accepted_evcodes=None, tax_id=None,
+                    chunksize=GAF_CHUNK_SIZE):
+    """
+    Same as read_gaf_lines(), but parses the lines of assoc_file with
+    pandas, chunksize lines at a time, and applies the filters to whole
+    columns of each chunk (see filter_gaf_chunks()). As in
+    read_gaf_lines(), header lines and (with tax_id) the lines that do not
+    contain the taxonomy ID are dropped before they are parsed. Yields
+    tuples of the first 14 columns. Raises ImportError when called, not
+    when the result is first iterated, if pandas is not installed.
+    """
+    import pandas
+
+    def parsed_chunks():
+        with open_assoc_file(assoc_file) as assoc_fh:
+            lines = (line for line in assoc_fh if not line.startswith('!'))
+            if tax_id:
+                lines = (line for line in lines if tax_id in line)
+            while True:
+                chunk_lines = list(islice(lines, chunksize))
+                if not chunk_lines:
+                    break
+                yield pandas.read_csv(
+                    StringIO(''.join(chunk_lines)), sep='\t', header=None,
+                    usecols=range(14), dtype=str, na_filter=False,
+                    quoting=csv.QUOTE_NONE)
+
+    return filter_gaf_chunks(parsed_chunks(), accepted_evcodes, tax_id)
+
+
+def filter_gaf_chunks(chunks, accepted_evcodes=None, tax_id=None):
+    """
+    Apply the filters of read_gaf_lines() to an iterable of pandas
+    DataFrame chunks of GAF columns, and yield the columns of the rows that
+    pass as tuples.
+    """
+    for chunk in chunks:
+        keep = (chunk[3] != 'NOT').values
+
+        # Each filter is decided once per distinct value in the chunk, with
+        # the same comparisons as read_gaf_lines()
+        if tax_id:
+            taxa = [taxon for taxon in chunk[12].unique()
+                    if taxon.split(':')[1] == tax_id]
+            keep &= chunk[12].isin(taxa).values
+        if accepted_evcodes is not None:
+            codes = [code for code in chunk[6].unique()
+                     if code in accepted_evcodes]
+            keep &= chunk[6].isin(codes).values
+
+        chunk = chunk[keep]
+        columns = [chunk[column].values.tolist() for column in range(14)]
+        for toks in izip(*columns):
+            yield toks
+
+
+def build_annotation(toks, remove_leading_gene_id=None, use_symbol=None):
+    """
+    Build the (<crossrefDB>, <crossrefID>, <goid>, <refstring>, <date>)
+    tuple of get_filtered_annotations() from the columns of a GAF line.
+    """
+    (xrdb, xrid, goid, refstring, date) = (
+        toks[0], toks[1], toks[4], toks[5], toks[13])
+
+    if remove_leading_gene_id:
+        xrid = xrid.split(':')[1]
+
+    if xrdb in DB_REMAP:
+        xrdb = DB_REMAP[xrdb]
+
+    if use_symbol:
+        xrdb = 'Symbol'
+        if toks[0] == 'UniProtKB':
+            xrid = toks[2]
+
+    # These next few lines are needed for processing
+    # Arabidopsis annotations
+    if xrdb == 'TAIR':
+        first_alias = toks[10].split('|')[0]
+        if TAIR_REGEX.match(toks[2]):
+            xrid = toks[2]
+        elif TAIR_REGEX.match(toks[9]):
+            xrid = toks[9]
+        elif TAIR_REGEX.match(first_alias):
+            xrid = first_alias
+
+    return (xrdb, xrid, goid, refstring, date)
 
 
 def create_go_term_title(go_term):
@@ -167,10 +444,299 @@ def create_go_term_abstract(go_term, evlist=None):
     return description
 
 
-def process_go_terms(species_ini_file, base_download_folder):
+def get_pubmed_id(refstring):
+    """
+    Return the PubMed ID in the reference column (refstring) of a GO
+    annotation, or None if the annotation has no PubMed reference. If
+    there is more than one, the last one is returned.
+    """
+    pub = None
+    for ref in refstring.split('|'):
+        # Check if publication source is PubMed (PMID).
+        # Otherwise, keep pub as None.
+        if ref.startswith('PMID:'):
+            pub = ref.split(':')[1]
+    return pub
+
+
+def get_term_annotations(term, term_annotations=None):
+    """
+    Build the 'annotations' dictionary (gene -> list of PubMed IDs) and
+    find the 'xrdb' of a GO term from its propagated Annotation objects.
+
+    Arguments:
+    term -- A go_term object from the go() class (go.go), after
+    propagation.
+
+    term_annotations -- Optional. The propagated Annotation objects of
+    term, when they are kept in a go.AnnotationLayer instead of in
+    term.annotations.
+
+    Returns:
+    A tuple (annotations, xrdb).
+    """
+    annotations = {}
+    go_term_xrdb = None
+
+    if term_annotations is None:
+        term_annotations = term.annotations
+
+    for annotation in term_annotations:
+        if annotation.gid not in annotations:
+            # If annotation.gid is not already a key in the dictionary,
+            # make it one and initialize list. Else, the key and list
+            # already exist.
+            annotations[annotation.gid] = []
+
+        if annotation.ref is not None:
+            try:
+                annotations[annotation.gid].append(int(annotation.ref))
+            except ValueError:
+                logger.error('Pubmed ID %s for GO term %s could not be '
+                             'converted to an integer.', annotation.ref,
+                             term.go_id)
+
+        if annotation.xdb is not None:
+            if go_term_xrdb and go_term_xrdb != annotation.xdb:
+                logger.info("There is more than one xrdb for annotations "
+                            "in this GO term (%s and %s). Only the first "
+                            "one will be saved in this GO term's 'xrdb' "
+                            "field.", go_term_xrdb, annotation.xdb)
+            else:
+                go_term_xrdb = annotation.xdb
+
+    return (annotations, go_term_xrdb)
+
+
+def get_bitset_term_annotations(gene_ontology, annotations):
+    """
+    Propagate annotations as sparse boolean term x gene and term x (gene,
+    PubMed ID) matrices (see go_index.GOIndex.propagate_matrix()) instead
+    of as Annotation objects, and build the same 'annotations' dictionary
+    and 'xrdb' for every term that get_term_annotations() builds after
+    go.propagate(). PubMed ID lists are sorted and have no duplicates.
+    Dates and evidence codes are not kept, so the object path must be used
+    if those are needed. Requires numpy and scipy.
+
+    Arguments:
+    gene_ontology -- A go() object that has parsed the OBO file, with no
+    annotations added.
+
+    annotations -- An iterable of annotation tuples, as returned by
+    get_filtered_annotations() or iter_filtered_annotations().
+
+    Returns:
+    term_annotations -- A dictionary of GO term ID -> (annotations, xrdb)
+    for every term that has at least one propagated annotation.
+    """
+    import numpy as np
+    from scipy import sparse
+
+    index = gene_ontology.get_index()
+
+    gene_columns = {}
+    pub_columns = {}
+    gene_entries = set()
+    pub_entries = set()
+
+    for (xrdb, xrid, goid, refstring, date) in annotations:
+        term_index = index.get_index(goid)
+        if term_index is None:
+            logger.info("Couldn't get go_term for id %s.", goid)
+            continue
+
+        gene = (xrdb, xrid)
+        gene_column = gene_columns.setdefault(gene, len(gene_columns))
+        gene_entries.add((term_index, gene_column))
+
+        pub = get_pubmed_id(refstring)
+        if pub is None:
+            continue
+        try:
+            pub = int(pub)
+        except ValueError:
+            logger.error('Pubmed ID %s for GO term %s could not be '
+                         'converted to an integer.', pub, goid)
+            continue
+        pub_column = pub_columns.setdefault((gene, pub), len(pub_columns))
+        pub_entries.add((term_index, pub_column))
+
+    # Number the (gene, PubMed ID) columns in PubMed ID order, so that each
+    # propagated row lists the publications of a gene already sorted.
+    gene_pubs = sorted(pub_columns, key=lambda gene_pub: gene_pub[1])
+    pub_order = np.zeros(len(gene_pubs), dtype=np.int32)
+    for (rank, gene_pub) in enumerate(gene_pubs):
+        pub_order[pub_columns[gene_pub]] = rank
+
+    propagated = []
+    for (entries, num_columns, column_order) in (
+            (gene_entries, len(gene_columns), None),
+            (pub_entries, len(pub_columns), pub_order)):
+        entries = np.array(list(entries), dtype=np.int32).reshape(-1, 2)
+        columns = entries[:, 1]
+        if column_order is not None:
+            columns = column_order[columns]
+        direct = sparse.csr_matrix(
+            (np.ones(len(entries), dtype=np.int32), (entries[:, 0], columns)),
+            shape=(len(index), num_columns))
+        matrix = index.propagate_matrix(direct)
+        matrix.sort_indices()
+        propagated.append(matrix)
+    (gene_matrix, pub_matrix) = propagated
+
+    genes = sorted(gene_columns, key=gene_columns.get)
+    gene_xrids = [xrid for (xrdb, xrid) in genes]
+    xrdbs = sorted(set(xrdb for (xrdb, xrid) in genes))
+    gene_xrdb_codes = np.array([xrdbs.index(xrdb) for (xrdb, xrid) in genes],
+                               dtype=np.int32)
+    pub_xrids = [xrid for ((xrdb, xrid), pub) in gene_pubs]
+    pub_ids = [pub for (gene, pub) in gene_pubs]
+
+    gene_indptr = gene_matrix.indptr.tolist()
+    pub_indptr = pub_matrix.indptr.tolist()
+
+    # Building millions of small lists triggers the cyclic garbage collector
+    # over and over, although none of them can be part of a cycle.
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+
+    term_annotations = {}
+    term_rows = np.flatnonzero(np.diff(gene_matrix.indptr)).tolist()
+    try:
+        for term_index in term_rows:
+            term_id = index.terms[term_index].go_id
+            row = gene_matrix.indices[gene_indptr[term_index]:
+                                      gene_indptr[term_index + 1]]
+            term_genes = dict((gene_xrids[column], []) for column in
+                              row.tolist())
+
+            xrdb_codes = gene_xrdb_codes[row]
+            go_term_xrdb = xrdbs[xrdb_codes[0]]
+            if (xrdb_codes != xrdb_codes[0]).any():
+                logger.info("There is more than one xrdb for annotations "
+                            "in GO term %s. Only %s will be saved in this "
+                            "GO term's 'xrdb' field.", term_id, go_term_xrdb)
+
+            pub_row = pub_matrix.indices[pub_indptr[term_index]:
+                                         pub_indptr[term_index + 1]]
+            for column in pub_row.tolist():
+                term_genes[pub_xrids[column]].append(pub_ids[column])
+
+            term_annotations[term_id] = (term_genes, go_term_xrdb)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    return term_annotations
+
+
+def get_shared_ontology(obo_file, obo_cache_dir=None):
+    """
+    Return the go() object of obo_file shared by every species in this
+    run, loading it the first time it is asked for (and again if the file
+    has changed since).
+
+    Arguments:
+    obo_file -- A string. Location of the OBO file.
+
+    obo_cache_dir -- Optional. Folder of the go_cache cache of parsed OBO
+    files.
+
+    Returns:
+    gene_ontology -- The shared go() object, which must not be modified or
+    annotated, or None if the OBO file could not be loaded.
+    """
+    try:
+        key = (os.path.abspath(obo_file), file_digest(obo_file))
+    except IOError:
+        logger.error('Could not open %s on the local filesystem.', obo_file)
+        return None
+
+    if key not in SHARED_ONTOLOGIES:
+        gene_ontology = go()
+        if gene_ontology.load_obo(obo_file, cache_dir=obo_cache_dir) is False:
+            return None
+        # Keep only the newest version of each file
+        for old_key in SHARED_ONTOLOGIES.keys():
+            if old_key[0] == key[0]:
+                del SHARED_ONTOLOGIES[old_key]
+        SHARED_ONTOLOGIES[key] = gene_ontology
+    return SHARED_ONTOLOGIES[key]
+
+
+def iter_go_terms(gene_ontology, organism, evcodes=None,
+                  term_annotations=None, annotation_layer=None,
+                  tags_dictionary=None):
+    """
+    Generate the processed GO term of each term of gene_ontology that has
+    annotations, one at a time, so that the annotations dictionary of a
+    term is only built once the term before it has been used.
+
+    Arguments:
+    gene_ontology -- A go() object that has parsed the OBO file.
+
+    organism -- A string, the scientific name of the organism.
+
+    evcodes -- Optional. The list of evidence codes in the abstracts (see
+    create_go_term_abstract()).
+
+    term_annotations -- A dictionary of GO term ID -> (annotations, xrdb),
+    as returned by get_bitset_term_annotations(), or None to take the
+    annotations of each term from annotation_layer.
+
+    annotation_layer -- The propagated AnnotationLayer of the organism, if
+    term_annotations is None.
+
+    tags_dictionary -- Optional. A dictionary of tags to be added to the GO
+    terms, made by the utils.build_tags_dictionary() function.
+    """
+    for (term_id, term) in gene_ontology.go_terms.iteritems():
+
+        if term_annotations is not None:
+            if term_id not in term_annotations:
+                continue
+            (annotations, go_term_xrdb) = term_annotations[term_id]
+        elif not annotation_layer.get_annotations(term_id):
+            continue
+        else:
+            (annotations, go_term_xrdb) = get_term_annotations(
+                term, annotation_layer.get_annotations(term_id))
+
+        go_term = {}
+        go_term['title'] = create_go_term_title(term)
+        go_term['abstract'] = create_go_term_abstract(term, evcodes)
+        go_term['organism'] = organism
+        go_term['slug'] = slugify(term_id + '-' + organism)
+        go_term['annotations'] = annotations
+        go_term['xrdb'] = go_term_xrdb
+
+        if go_term['annotations']:
+            if tags_dictionary and term_id in tags_dictionary:
+                go_term['tags'] = tags_dictionary[term_id]['gs_tags']
+            add_content_hash(go_term)
+            yield go_term
+
+
+def process_go_terms(species_ini_file, base_download_folder,
+                     obo_cache_dir=None, shared_assoc_taxa=None,
+                     lazy=False):
     """
     Function to read in config INI file and run the other functions to
     process GO terms.
+
+    The annotations are read and propagated right away. The GO terms are
+    returned as a list, or with lazy, as a generator of them (see
+    iter_go_terms()).
+
+    If obo_cache_dir is given, the parsed GO OBO file is loaded from (or
+    saved to) the go_cache cache in that directory.
+
+    shared_assoc_taxa is an optional dictionary of association file name
+    -> taxonomy IDs of the species that read it, as returned by
+    gaf_shards.get_shared_assoc_taxa(). Association files in it are read
+    from their per-taxon shard in base_download_folder (see gaf_shards.py),
+    which is created for all of those taxa at once the first time it is
+    needed.
     """
     species_file = SafeConfigParser()
     species_file.read(species_ini_file)
@@ -199,6 +765,16 @@ def process_go_terms(species_ini_file, base_download_folder):
     assoc_filenames = [os.path.basename(x.path) for x in assoc_file_url_list]
     assoc_files = [os.path.join(sd_folder, 'GO', x) for x in assoc_filenames]
 
+    # Multi-species association files are read from the shard of this
+    # species, so that they are only scanned once for all species.
+    if shared_assoc_taxa:
+        assoc_files = [
+            get_taxon_shard(assoc_file, base_download_folder, taxonomy_id,
+                            shared_assoc_taxa[assoc_filename])
+            if assoc_filename in shared_assoc_taxa else assoc_file
+            for (assoc_filename, assoc_file) in zip(assoc_filenames,
+                                                    assoc_files)]
+
     evcodes = species_file.get('GO', 'EVIDENCE_CODES')
     evcodes = re.sub(r'\s', '', evcodes).split(',')
 
@@ -211,39 +787,81 @@ def process_go_terms(species_ini_file, base_download_folder):
         remove_leading_gene_id = species_file.getboolean(
             'GO', 'REMOVE_LEADING_GENE_ID')
 
-    annotations = []
-    for assoc_file in assoc_files:
-        new_annotations = get_filtered_annotations(
-            assoc_file, evcodes,
+    # PROPAGATION can be "objects" (the default), which propagates
+    # Annotation objects through the go() tree, or "bitset", which
+    # propagates sparse gene membership matrices and is much faster for
+    # large association files.
+    propagation = 'objects'
+    if species_file.has_option('GO', 'PROPAGATION'):
+        propagation = species_file.get('GO', 'PROPAGATION').strip().lower()
+        if propagation not in ('objects', 'bitset'):
+            logger.error('Unknown GO PROPAGATION option %s, it must be '
+                         '"objects" or "bitset".', propagation)
+            sys.exit(1)
+
+    # GAF_READER can be "lines" (the default), or "columnar", which reads
+    # association files in chunks with pandas.
+    gaf_reader = 'lines'
+    if species_file.has_option('GO', 'GAF_READER'):
+        gaf_reader = species_file.get('GO', 'GAF_READER').strip().lower()
+        if gaf_reader not in ('lines', 'columnar'):
+            logger.error('Unknown GO GAF_READER option %s, it must be '
+                         '"lines" or "columnar".', gaf_reader)
+            sys.exit(1)
+
+    # With CONCURRENT_GAF_READERS, the association files are read at the
+    # same time, each in its own process.
+    concurrent_readers = False
+    if species_file.has_option('GO', 'CONCURRENT_GAF_READERS'):
+        concurrent_readers = species_file.getboolean(
+            'GO', 'CONCURRENT_GAF_READERS')
+
+    # The annotations are read lazily, as they are added to the ontology.
+    try:
+        annotations = iter_concurrent_annotations(
+            assoc_files, evcodes,
             remove_leading_gene_id=remove_leading_gene_id,
-            use_symbol=use_symbol, tax_id=taxonomy_id)
-
-        annotations.extend(new_annotations)
-
-    gene_ontology = go()
-    loaded_obo_bool = gene_ontology.load_obo(obo_file)
-    if loaded_obo_bool is False:
+            use_symbol=use_symbol, tax_id=taxonomy_id, reader=gaf_reader,
+            concurrent=concurrent_readers)
+    except ImportError:
+        logger.warning('pandas is needed for the "columnar" GAF reader. '
+                       'Reading association files line by line instead.')
+        annotations = iter_concurrent_annotations(
+            assoc_files, evcodes,
+            remove_leading_gene_id=remove_leading_gene_id,
+            use_symbol=use_symbol, tax_id=taxonomy_id, reader='lines',
+            concurrent=concurrent_readers)
+
+    # The parsed ontology is shared with the other species of this run and
+    # is not modified here. The annotations of this species go into their
+    # own AnnotationLayer (or into matrices, for "bitset" propagation).
+    gene_ontology = get_shared_ontology(obo_file, obo_cache_dir)
+    if gene_ontology is None:
         logger.error('GO OBO file could not be loaded.')
+        gene_ontology = go()
 
-    for annotation in annotations:
-        (xrdb, xrid, goid, refstring, date) = annotation
-
-        refs = refstring.split('|')
+    term_annotations = None
+    if propagation == 'bitset':
+        try:
+            term_annotations = get_bitset_term_annotations(gene_ontology,
+                                                           annotations)
+        except ImportError:
+            logger.warning('numpy and scipy are needed for "bitset" GO '
+                           'propagation. Propagating annotation objects '
+                           'instead.')
 
-        pub = None
-        for ref in refs:
-            # Check if publication source is PubMed (PMID).
-            # Otherwise, keep pub as None.
-            if ref.startswith('PMID:'):
-                pub = ref.split(':')[1]
+    annotation_layer = None
+    if term_annotations is None:
+        annotation_layer = AnnotationLayer(gene_ontology)
+        for annotation in annotations:
+            (xrdb, xrid, goid, refstring, date) = annotation
 
-        gene_ontology.add_annotation(go_id=goid, gid=xrid, ref=pub,
-                                     date=date, xdb=xrdb, direct=True)
+            pub = get_pubmed_id(refstring)
 
-    gene_ontology.populated = True
-    gene_ontology.propagate()
+            annotation_layer.add_annotation(go_id=goid, gid=xrid, ref=pub,
+                                            date=date, xdb=xrdb, direct=True)
 
-    GO_terms = []
+        annotation_layer.propagate()
 
     tags_dictionary = None
     if species_file.has_option('GO', 'TAG_MAPPING_FILE'):
@@ -256,50 +874,10 @@ def process_go_terms(species_ini_file, base_download_folder):
         tags_dictionary = build_tags_dictionary(
             tag_mapping_file, go_id_column, go_name_column, tag_column, header)
 
-    for (term_id, term) in gene_ontology.go_terms.iteritems():
-
-        if not term.annotations:
-            continue
-
-        go_term = {}
-        go_term['title'] = create_go_term_title(term)
-        go_term['abstract'] = create_go_term_abstract(term, evcodes)
-        go_term['organism'] = organism
-        go_term['slug'] = slugify(term_id + '-' + organism)
-
-        go_term['annotations'] = {}
-        go_term_xrdb = None
-
-        for annotation in term.annotations:
-            if annotation.gid not in go_term['annotations']:
-                # If annotation.gid is not already a key in the dictionary,
-                # make it one and initialize list. Else, the key and list
-                # already exist.
-                go_term['annotations'][annotation.gid] = []
-
-            if annotation.ref is not None:
-                try:
-                    go_term['annotations'][annotation.gid].append(
-                        int(annotation.ref))
-                except ValueError:
-                    logger.error('Pubmed ID %s for GO term %s could not be '
-                                 'converted to an integer.', annotation.ref,
-                                 term_id)
-
-            if annotation.xdb is not None:
-                if go_term_xrdb and go_term_xrdb != annotation.xdb:
-                    logger.info("There is more than one xrdb for annotations "
-                                "in this GO term (%s and %s). Only the first "
-                                "one will be saved in this GO term's 'xrdb' "
-                                "field.", go_term_xrdb, annotation.xdb)
-                else:
-                    go_term_xrdb = annotation.xdb
-
-        go_term['xrdb'] = go_term_xrdb
-
-        if go_term['annotations']:
-            if tags_dictionary and term_id in tags_dictionary:
-                go_term['tags'] = tags_dictionary[term_id]['gs_tags']
-            GO_terms.append(go_term)
-
-    return GO_terms
+    GO_terms = iter_go_terms(gene_ontology, organism, evcodes,
+                             term_annotations=term_annotations,
+                             annotation_layer=annotation_layer,
+                             tags_dictionary=tags_dictionary)
+    if lazy:
+        return GO_terms
+    return list(GO_terms)
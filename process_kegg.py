@@ -5,6 +5,7 @@ from ConfigParser import SafeConfigParser
 
 from slugify import slugify
 from utils import build_tags_dictionary
+from geneset_hashes import add_content_hash
 
 # Import and set logger
 import logging
@@ -13,6 +14,10 @@ logger.addHandler(logging.NullHandler())
 
 KEGGSET_INFO_FOLDER = 'KEGG/keggset_info_folder'
 
+# File in the keggset_info_folder with the KEGG release that its info files
+# were downloaded from
+KEGG_RELEASE_FILE = '.kegg_release'
+
 
 def get_kegg_info(kegg_info_file):
     """
@@ -138,38 +143,50 @@ def get_kegg_set_info(kegg_set_info_file, org_slug):
     return set_info_dict
 
 
-def build_kegg_sets(kegg_sets_members, keggset_info_folder, organism, xrdb,
-                    tags_dictionary=None):
+def remove_stale_kegg_info_files(keggset_info_folder, release):
     """
-    Function to build all KEGG sets **for a given set type** (e.g. pathway,
-    module, disease, etc.), since members_file will only contain members
-    for KEGG sets of a specific type.
+    Delete the KEGG set info files in keggset_info_folder if they were
+    downloaded from a different (or an unknown) KEGG release, so that they
+    are downloaded again when the download folder is kept between runs (see
+    the REVALIDATE option of the main configuration file), and record the
+    current release.
 
     Arguments:
-    kegg_sets_members -- This is a dictionary of each KEGG set ID as a key
-    and the members in that set as the value.
-
     keggset_info_folder -- A string - folder where all KEGG set info files
-    have been saved to. The files were saved to this folder by the
-    download_kegg_info_files() function if running the full annotation-refinery
+    are saved.
 
-    organims -- A string of the scientific name for our desired organism
-    (e.g. 'Homo sapiens').
+    release -- A string. The current KEGG release, as returned in the
+    'release' key of get_kegg_info().
 
-    xrdb -- A string. The name of the cross-reference database (i.e. type of
-    gene identifier) used by KEGG in the members file(s) for this species.
+    Returns:
+    Nothing, just deletes the stale files.
+    """
+    if not os.path.isdir(keggset_info_folder):
+        os.makedirs(keggset_info_folder)
 
-    tags_dictionary -- A dictionary of tags to be added to the KEGG sets,
-    made by the utils.build_tags_dictionary() function
+    release_file = os.path.join(keggset_info_folder, KEGG_RELEASE_FILE)
+    try:
+        with open(release_file, 'r') as release_fh:
+            if release_fh.read() == release:
+                return
+    except IOError:
+        pass
 
-    Returns:
-    all_kegg_sets -- A list of processed KEGG sets, where each KEGG set is
-    a Python dictionary, containing its title, abstract, and annotations.
+    logger.info('Removing KEGG set info files that are not from %s.',
+                release)
+    for filename in os.listdir(keggset_info_folder):
+        os.remove(os.path.join(keggset_info_folder, filename))
 
-    """
+    with open(release_file, 'w') as release_fh:
+        release_fh.write(release)
 
-    all_kegg_sets = []
 
+def iter_kegg_sets(kegg_sets_members, keggset_info_folder, organism, xrdb,
+                   tags_dictionary=None):
+    """
+    Generate the KEGG sets that build_kegg_sets() returns, one at a time,
+    reading the KEGG set info file of each set as it is generated.
+    """
     for kegg_id in kegg_sets_members.keys():
         info_file = os.path.join(keggset_info_folder, kegg_id)
         org_slug = slugify(organism)
@@ -197,12 +214,45 @@ def build_kegg_sets(kegg_sets_members, keggset_info_folder, organism, xrdb,
         if tags_dictionary and kegg_id in tags_dictionary:
             kegg_set_info['tags'] = tags_dictionary[kegg_id]['gs_tags']
 
-        all_kegg_sets.append(kegg_set_info)
+        add_content_hash(kegg_set_info)
+        yield kegg_set_info
 
-    return all_kegg_sets
 
+def build_kegg_sets(kegg_sets_members, keggset_info_folder, organism, xrdb,
+                    tags_dictionary=None):
+    """
+    Function to build all KEGG sets **for a given set type** (e.g. pathway,
+    module, disease, etc.), since members_file will only contain members
+    for KEGG sets of a specific type.
+
+    Arguments:
+    kegg_sets_members -- This is a dictionary of each KEGG set ID as a key
+    and the members in that set as the value.
+
+    keggset_info_folder -- A string - folder where all KEGG set info files
+    have been saved to. The files were saved to this folder by the
+    download_kegg_info_files() function if running the full annotation-refinery
+
+    organims -- A string of the scientific name for our desired organism
+    (e.g. 'Homo sapiens').
+
+    xrdb -- A string. The name of the cross-reference database (i.e. type of
+    gene identifier) used by KEGG in the members file(s) for this species.
+
+    tags_dictionary -- A dictionary of tags to be added to the KEGG sets,
+    made by the utils.build_tags_dictionary() function
+
+    Returns:
+    all_kegg_sets -- A list of processed KEGG sets, where each KEGG set is
+    a Python dictionary, containing its title, abstract, and annotations.
 
-def process_kegg_sets(species_ini_file, base_download_folder):
+    """
+    return list(iter_kegg_sets(kegg_sets_members, keggset_info_folder,
+                               organism, xrdb, tags_dictionary))
+
+
+def process_kegg_sets(species_ini_file, base_download_folder,
+                      download_manager=None, lazy=False):
     """
     Function to process all KEGG sets using the build_kegg_sets()
     function above.
@@ -211,6 +261,14 @@ def process_kegg_sets(species_ini_file, base_download_folder):
     species_ini_file -- Path to the species INI config file. This
     is a string.
 
+    download_manager -- Optional download_manager.DownloadManager, with
+    which the KEGG set info files are downloaded several at a time.
+
+    lazy -- Optional. If True, a generator of the KEGG sets is returned
+    instead of a list. The set info files of each type of KEGG sets (e.g.
+    pathways) are then downloaded once the sets of the type before it have
+    been generated, so download_manager must be kept open until then.
+
     Returns:
     all_kegg_sets -- A list of processed KEGG sets, where each KEGG set is
     a Python dictionary with the required information as its keys and values.
@@ -254,12 +312,18 @@ def process_kegg_sets(species_ini_file, base_download_folder):
 
     keggset_info_folder = os.path.join(sd_folder, KEGGSET_INFO_FOLDER)
 
-    all_kegg_sets = []
-    for kegg_type in kegg_types:
-        members_file = os.path.join(sd_folder, 'KEGG', kegg_type)
-        kegg_sets_members = get_kegg_sets_members(members_file)
-        download_kegg_info_files(kegg_sets_members.keys(), species_ini_file)
-        kegg_sets = build_kegg_sets(kegg_sets_members, keggset_info_folder,
-                                    organism, xrdb, tags_dictionary)
-        all_kegg_sets.extend(kegg_sets)
-    return all_kegg_sets
+    def iter_all_kegg_sets():
+        for kegg_type in kegg_types:
+            members_file = os.path.join(sd_folder, 'KEGG', kegg_type)
+            kegg_sets_members = get_kegg_sets_members(members_file)
+            download_kegg_info_files(kegg_sets_members.keys(),
+                                     species_ini_file, download_manager)
+            for kegg_set in iter_kegg_sets(kegg_sets_members,
+                                           keggset_info_folder, organism,
+                                           xrdb, tags_dictionary):
+                yield kegg_set
+
+    all_kegg_sets = iter_all_kegg_sets()
+    if lazy:
+        return all_kegg_sets
+    return list(all_kegg_sets)
@@ -1,15 +1,29 @@
 import os
 import sys
-import json
+import time
 import argparse
+import multiprocessing
+from itertools import imap
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from urlparse import urlsplit
 from ConfigParser import SafeConfigParser
 
-from download_files import download_all_files
+from download_files import download_all_files, download_urls
 from process_kegg import process_kegg_sets
-from process_go import process_go_terms
+from process_go import process_go_terms, get_shared_ontology
 from process_do import process_do_terms
-from tribe_loader import (
-    get_oauth_token, load_to_tribe, get_all_changed_genesets)
+from gaf_shards import get_shared_assoc_taxa
+from incremental import (
+    get_fingerprint, iter_and_save_genesets, load_unchanged_genesets)
+from geneset_hashes import (
+    get_removed_slugs, iter_geneset_statuses, log_delta, read_hashes,
+    write_hashes)
+from download_manager import DownloadManager, get_download_options
+from tribe_loader import TribeClient, was_saved
+from json_output import (
+    GenesetWriter, get_json_output_options, get_species_json_file)
+from columnar_output import get_columnar_output_options, write_columnar_tables
 
 # Import and set logger
 import logging
@@ -17,8 +31,71 @@ logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
 
+class SpeciesLogFilter(logging.Filter):
+    """
+    Logging filter that marks each record with the name of the species
+    file being processed, as its species_file and species_prefix
+    attributes, so that the interleaved log output of the worker
+    processes of a parallel run can be told apart (see
+    SpeciesLogFormatter). The message of the record is left as it is.
+    """
+    species_file = None
+
+    def filter(self, record):
+        # A record that goes through several handlers is only marked once
+        if self.species_file and not getattr(record, 'species_file', None):
+            record.species_file = self.species_file
+            record.species_prefix = '[%s] ' % self.species_file
+        return True
+
+
+class SpeciesLogFormatter(logging.Formatter):
+    """
+    Logging formatter that starts each message with the species_prefix
+    set by SpeciesLogFilter, if there is one. It takes the same arguments
+    as logging.Formatter, and adds %(species_prefix)s before the
+    %(message)s of fmt.
+    """
+
+    def __init__(self, fmt=None, datefmt=None):
+        fmt = fmt or '%(message)s'
+        if '%(species_prefix)s' not in fmt:
+            fmt = fmt.replace('%(message)s',
+                              '%(species_prefix)s%(message)s')
+        logging.Formatter.__init__(self, fmt, datefmt)
+
+    def format(self, record):
+        if not hasattr(record, 'species_prefix'):
+            record.species_prefix = ''
+        return logging.Formatter.format(self, record)
+
+
+SPECIES_LOG_FILTER = SpeciesLogFilter()
+
+ANNOTATION_TYPE_FUNCTIONS = {
+    'GO': process_go_terms,
+    'KEGG': process_kegg_sets,
+    'DO': process_do_terms
+}
+
+# Options for OUTPUT_MODE: every gene set of each species, or only the
+# ones that are new or have changed since the last run (see
+# geneset_hashes.py)
+OUTPUT_MODES = ('full', 'delta')
+
+# Annotation types whose processing is CPU-bound (parsing and propagating
+# an ontology). With concurrent_types, these run in their own processes,
+# and the others (KEGG, which mostly reads files) in threads.
+CPU_BOUND_TYPES = ('GO', 'DO')
+
+
 def process_all_organism_genesets(organism_ini_file, download_folder,
-                                  secrets_file=None):
+                                  secrets_file=None, obo_cache_dir=None,
+                                  shared_assoc_taxa=None,
+                                  concurrent_types=False,
+                                  download_options=None,
+                                  revalidate_downloads=False,
+                                  incremental_dir=None, lazy=False):
     """
     Downloads and processes files for all geneset types (such as GO and
     KEGG) specified in the .ini config file for a given organism.
@@ -36,43 +113,369 @@ def process_all_organism_genesets(organism_ini_file, download_folder,
     to process any genesets specified in the organism_ini_file require
     a password or a secret API key to be downloaded.
 
+    obo_cache_dir (Optional) -- A string, location of the folder where
+    parsed GO and DO OBO files are cached between runs (see go_cache.py).
+    OBO files are parsed every time if this is not given.
+
+    shared_assoc_taxa (Optional) -- A dictionary of GO association file
+    name -> taxonomy IDs of all the species in this run that read it, as
+    returned by gaf_shards.get_shared_assoc_taxa(). These files are split
+    into per-taxon shards in download_folder, which are read instead of the
+    whole file.
+
+    concurrent_types (Optional) -- If True, the annotation types (GO, KEGG
+    and DO) of the organism are processed at the same time, GO and DO in
+    their own processes and KEGG in a thread (see
+    process_annotation_types_concurrently()). The genesets are returned
+    in the same order either way.
+
+    download_options (Optional) -- A dictionary of the arguments of a
+    download_manager.DownloadManager (see
+    download_manager.get_download_options()), which then downloads this
+    organism's files and KEGG set info files several at a time. If this is
+    None, files are downloaded one after another.
+
+    revalidate_downloads (Optional) -- If True, files that are already in
+    download_folder are downloaded again only if they have changed on the
+    server (see download_cache.py). Otherwise, they are used as they are.
+
+    incremental_dir (Optional) -- A string, location of the folder where
+    the genesets of each annotation type are saved with a fingerprint of
+    their inputs (see incremental.py). The saved genesets of the types
+    whose inputs have not changed since the last run are reused instead of
+    processing them again.
+
+    lazy (Optional) -- If True, a generator of the genesets is returned
+    instead of a list (see iter_all_organism_genesets()), so that they do
+    not have to be held in memory all at once.
+
     Returns:
     all_genesets -- A Python list of all the genesets specified to be
     processed in the organism_ini_file. Each geneset in this list is a
     Python dictionary.
     """
+    all_genesets = iter_all_organism_genesets(
+        organism_ini_file, download_folder, secrets_file=secrets_file,
+        obo_cache_dir=obo_cache_dir, shared_assoc_taxa=shared_assoc_taxa,
+        concurrent_types=concurrent_types, download_options=download_options,
+        revalidate_downloads=revalidate_downloads,
+        incremental_dir=incremental_dir)
+    if lazy:
+        return all_genesets
+    return list(all_genesets)
+
+
+def iter_all_organism_genesets(organism_ini_file, download_folder,
+                               secrets_file=None, obo_cache_dir=None,
+                               shared_assoc_taxa=None,
+                               concurrent_types=False,
+                               download_options=None,
+                               revalidate_downloads=False,
+                               incremental_dir=None):
+    """
+    Generate the genesets that process_all_organism_genesets() returns
+    (with the same arguments), one at a time. The files of the organism are
+    downloaded once the first geneset is asked for.
+
+    Unless concurrent_types, each annotation type is processed once the
+    genesets of the type before it have been generated, and the genesets
+    of its ontology are built one at a time (see process_go_terms()). With
+    incremental_dir, the genesets of each type are saved as they are
+    generated, and the saved genesets of the types that are reused are
+    read one at a time (see incremental.py).
+    """
+    download_manager = None
+    if download_options is not None:
+        download_manager = DownloadManager(**download_options)
+
+    try:
+        logger.info('Starting to download all files for organism file %s',
+                    organism_ini_file)
+        download_all_files(organism_ini_file, download_folder,
+                           secrets_location=secrets_file,
+                           download_manager=download_manager,
+                           revalidate=revalidate_downloads)
+        logger.info('Finished downloading all files for organism file %s',
+                    organism_ini_file)
+
+        species_config_file = SafeConfigParser()
+        species_config_file.read(organism_ini_file)
+
+        annot_types = [annot_type for annot_type in ANNOTATION_TYPE_FUNCTIONS
+                       if species_config_file.has_section(annot_type)]
+        type_args = (organism_ini_file, download_folder, obo_cache_dir,
+                     shared_assoc_taxa, download_manager)
+
+        # With incremental_dir, only the types whose inputs have changed
+        # are processed again.
+        saved_sets = {}
+        fingerprints = {}
+        if incremental_dir is not None:
+            for annot_type in annot_types:
+                fingerprints[annot_type] = get_fingerprint(
+                    organism_ini_file, annot_type, download_folder)
+                type_sets = load_unchanged_genesets(
+                    incremental_dir, organism_ini_file, annot_type,
+                    fingerprints[annot_type], lazy=True)
+                if type_sets is not None:
+                    saved_sets[annot_type] = type_sets
+        types_to_process = [annot_type for annot_type in annot_types
+                            if annot_type not in saved_sets]
+
+        processed_sets = {}
+        if concurrent_types and len(types_to_process) > 1:
+            processed_sets = process_annotation_types_concurrently(
+                types_to_process, type_args)
+
+        # The genesets of every type are generated in the same order,
+        # however they were processed
+        for annot_type in annot_types:
+            if annot_type in saved_sets:
+                type_sets = saved_sets[annot_type]
+            elif annot_type in processed_sets:
+                type_sets = processed_sets.pop(annot_type)
+            else:
+                type_sets = process_annotation_type(annot_type, *type_args,
+                                                    lazy=True)
+
+            if incremental_dir is not None and \
+                    annot_type in types_to_process:
+                type_sets = iter_and_save_genesets(
+                    incremental_dir, organism_ini_file, annot_type,
+                    fingerprints[annot_type], type_sets)
+
+            for geneset in type_sets:
+                yield geneset
+    finally:
+        if download_manager is not None:
+            download_manager.close()
+
+
+def process_annotation_type(annot_type, organism_ini_file, download_folder,
+                            obo_cache_dir=None, shared_assoc_taxa=None,
+                            download_manager=None, lazy=False):
+    """
+    Process the genesets of one annotation type (e.g. 'GO') for an
+    organism, with its function in ANNOTATION_TYPE_FUNCTIONS, and log how
+    long that took. download_manager is the optional
+    download_manager.DownloadManager for KEGG set info files, and the other
+    arguments are the same as process_all_organism_genesets().
 
-    logger.info('Starting to download all files for organism file %s',
-                organism_ini_file)
-    download_all_files(organism_ini_file, download_folder,
-                       secrets_location=secrets_file)
-    logger.info('Finished downloading all files for organism file %s',
-                organism_ini_file)
+    Returns:
+    processed_sets -- The list of genesets of this annotation type, or with
+    lazy, a generator of them, which logs how long processing took once
+    all of them have been generated.
+    """
+    logger.info('Starting to process %s terms for %s',
+                annot_type, organism_ini_file)
+    start_time = time.time()
+
+    func_name = ANNOTATION_TYPE_FUNCTIONS[annot_type]
+    if annot_type == 'DO':
+        processed_sets = func_name(organism_ini_file,
+                                   obo_cache_dir=obo_cache_dir, lazy=lazy)
+    elif annot_type == 'GO':
+        processed_sets = func_name(
+            organism_ini_file, download_folder,
+            obo_cache_dir=obo_cache_dir,
+            shared_assoc_taxa=shared_assoc_taxa, lazy=lazy)
+    else:
+        processed_sets = func_name(organism_ini_file, download_folder,
+                                   download_manager=download_manager,
+                                   lazy=lazy)
 
-    all_genesets = []
+    if lazy:
+        return log_processing_time(processed_sets, annot_type,
+                                   organism_ini_file, start_time)
 
-    species_config_file = SafeConfigParser()
-    species_config_file.read(organism_ini_file)
+    logger.info('Finished processing %s terms for %s in %.1f seconds',
+                annot_type, organism_ini_file, time.time() - start_time)
+    return processed_sets
 
-    annotation_type_dict = {
-        'GO': process_go_terms,
-        'KEGG': process_kegg_sets,
-        'DO': process_do_terms
-    }
 
-    for annot_type, func_name in annotation_type_dict.iteritems():
-        if species_config_file.has_section(annot_type):
-            logger.info('Starting to process %s terms for %s',
-                        annot_type, organism_ini_file)
-            if annot_type == 'DO':
-                processed_sets = func_name(organism_ini_file)
-            else:
-                processed_sets = func_name(organism_ini_file, download_folder)
-            all_genesets.extend(processed_sets)
-            logger.info('Finished processing %s terms for %s',
-                        annot_type, organism_ini_file)
+def log_processing_time(processed_sets, annot_type, organism_ini_file,
+                        start_time):
+    """
+    Generate the genesets of the processed_sets generator of
+    process_annotation_type(), and log how long processing them took once
+    all of them have been generated.
+    """
+    for geneset in processed_sets:
+        yield geneset
+    logger.info('Finished processing %s terms for %s in %.1f seconds',
+                annot_type, organism_ini_file, time.time() - start_time)
+
+
+def run_annotation_type(annot_type, type_args):
+    """
+    Run process_annotation_type() in a pool worker process or thread of
+    process_annotation_types_concurrently().
+
+    Returns:
+    A tuple of the list of genesets and None, or of None and the exit
+    code if processing stopped with sys.exit(), which would otherwise stop
+    the worker without the pool noticing.
+    """
+    try:
+        return (process_annotation_type(annot_type, *type_args), None)
+    except SystemExit as e:
+        return (None, e.code)
+
+
+def process_annotation_types_concurrently(annot_types, type_args):
+    """
+    Process several annotation types of an organism at the same time. The
+    CPU_BOUND_TYPES run in a pool of processes, one per type, and the
+    others in a pool of threads. In a daemonic process (such as a worker
+    of a parallel run_refinery.py run), which cannot start processes of
+    its own, all of them run in threads.
 
-    return all_genesets
+    Arguments:
+    annot_types -- A list of the annotation types to process (e.g. ['GO',
+    'KEGG']).
+
+    type_args -- A tuple of the other arguments of
+    process_annotation_type().
+
+    Returns:
+    processed_sets -- A dictionary of annotation type -> list of genesets.
+    If any type stops with sys.exit(), this exits the same way once the
+    types before it in annot_types are done.
+    """
+    cpu_types = [annot_type for annot_type in annot_types
+                 if annot_type in CPU_BOUND_TYPES]
+    process_pool = None
+    if cpu_types and not multiprocessing.current_process().daemon:
+        process_pool = multiprocessing.Pool(len(cpu_types))
+    thread_pool = ThreadPool(len(annot_types))
+
+    try:
+        async_results = {}
+        for annot_type in annot_types:
+            pool = thread_pool
+            if process_pool is not None and annot_type in cpu_types:
+                pool = process_pool
+            async_results[annot_type] = pool.apply_async(
+                run_annotation_type, (annot_type, type_args))
+
+        processed_sets = {}
+        for annot_type in annot_types:
+            (type_sets, exit_code) = async_results[annot_type].get()
+            if type_sets is None:
+                sys.exit(exit_code)
+            processed_sets[annot_type] = type_sets
+    finally:
+        for pool in (process_pool, thread_pool):
+            if pool is not None:
+                pool.terminate()
+
+    return processed_sets
+
+
+def init_species_worker():
+    """
+    Initializer of the worker processes of a parallel run, which marks
+    the log messages of each worker with its current species file (see
+    SpeciesLogFilter), keeping the format of their handlers.
+    """
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(SPECIES_LOG_FILTER)
+        formatter = handler.formatter
+        if not isinstance(formatter, SpeciesLogFormatter):
+            handler.setFormatter(SpeciesLogFormatter(
+                getattr(formatter, '_fmt', None),
+                getattr(formatter, 'datefmt', None)))
+
+
+def process_species_file(species_args, lazy=False):
+    """
+    Run process_all_organism_genesets() for one species, in the worker
+    processes of a parallel run or in the main process. With lazy (in the
+    main process), the genesets are a generator, and processing them only
+    starts, and can only stop with sys.exit(), once they are used.
+
+    Arguments:
+    species_args -- A tuple of the species file location and the other
+    arguments of process_all_organism_genesets(): (species_file,
+    download_folder, secrets_file, obo_cache_dir, shared_assoc_taxa,
+    concurrent_types, download_options, revalidate_downloads,
+    incremental_dir).
+
+    Returns:
+    A tuple of the species file location and its list (or generator) of
+    genesets, or None instead of the list if processing stopped with
+    sys.exit().
+    """
+    (species_file, download_folder, secrets_file, obo_cache_dir,
+     shared_assoc_taxa, concurrent_types, download_options,
+     revalidate_downloads, incremental_dir) = species_args
+
+    SPECIES_LOG_FILTER.species_file = os.path.basename(species_file)
+    try:
+        return (species_file, process_all_organism_genesets(
+            species_file, download_folder, secrets_file,
+            obo_cache_dir=obo_cache_dir,
+            shared_assoc_taxa=shared_assoc_taxa,
+            concurrent_types=concurrent_types,
+            download_options=download_options,
+            revalidate_downloads=revalidate_downloads,
+            incremental_dir=incremental_dir, lazy=lazy))
+    except SystemExit:
+        # Exiting would stop a worker process without the pool noticing
+        logger.error('Processing of species file %s was stopped.',
+                     species_file)
+        return (species_file, None)
+    finally:
+        SPECIES_LOG_FILTER.species_file = None
+
+
+def load_shared_ontologies(species_files, download_folder,
+                           obo_cache_dir=None, revalidate_downloads=False):
+    """
+    Download and parse the GO OBO files of species_files with
+    process_go.get_shared_ontology(), before the worker processes of a
+    parallel run are started. The workers are forked from this process, so
+    they all use these parsed ontologies instead of each parsing its own
+    copy.
+
+    Arguments:
+    species_files -- A list of the locations of the species INI files.
+
+    download_folder -- A string, the base download folder, where the OBO
+    files are saved.
+
+    obo_cache_dir (Optional) -- A string, location of the go_cache cache of
+    parsed OBO files.
+
+    revalidate_downloads (Optional) -- If True, OBO files that are already
+    in download_folder are downloaded again if they have changed.
+
+    Returns:
+    Nothing, only loads the ontologies into process_go.SHARED_ONTOLOGIES.
+    """
+    obo_urls = []
+    for species_file in species_files:
+        species_config = SafeConfigParser()
+        species_config.read(species_file)
+        if not species_config.has_section('GO'):
+            continue
+        obo_url = species_config.get('GO', 'GO_OBO_URL')
+        if obo_url in obo_urls:
+            continue
+        obo_urls.append(obo_url)
+        if species_config.getboolean('GO', 'DOWNLOAD'):
+            download_urls([(obo_url, download_folder, None)],
+                          revalidate=revalidate_downloads)
+
+    for obo_url in obo_urls:
+        obo_file = os.path.join(download_folder,
+                                os.path.basename(urlsplit(obo_url).path))
+        # Species whose OBO file is missing report it when they are
+        # processed
+        if os.path.exists(obo_file):
+            gene_ontology = get_shared_ontology(obo_file, obo_cache_dir)
+            if gene_ontology is not None:
+                gene_ontology.get_propagation_plan()
 
 
 def main(ini_file_path):
@@ -97,28 +500,104 @@ def main(ini_file_path):
     download_folder = main_config_file.get('download_folder',
                                            'BASE_DOWNLOAD_FOLDER')
 
+    # Whether files that are already in the download folder are checked
+    # for changes on their server, instead of being used as they are
+    revalidate_downloads = False
+    if main_config_file.has_option('download_folder', 'REVALIDATE'):
+        revalidate_downloads = main_config_file.getboolean(
+            'download_folder', 'REVALIDATE')
+
     secrets_file = None
     if main_config_file.has_option('main', 'SECRETS_FILE'):
         secrets_file = main_config_file.get('main', 'SECRETS_FILE')
 
-    process_to = main_config_file.get('main', 'PROCESS_TO')
+    obo_cache_dir = None
+    if main_config_file.has_option('main', 'OBO_CACHE_DIR'):
+        obo_cache_dir = main_config_file.get('main', 'OBO_CACHE_DIR')
 
-    if main_config_file.has_option('Tribe parameters', 'TRIBE_PUBLIC'):
-        tribe_public = main_config_file.getboolean('Tribe parameters',
-                                                   'TRIBE_PUBLIC')
-    else:
-        tribe_public = False
+    incremental_dir = None
+    if main_config_file.has_option('main', 'INCREMENTAL_DIR'):
+        incremental_dir = main_config_file.get('main', 'INCREMENTAL_DIR')
 
-    if main_config_file.has_option('Tribe parameters', 'PREFER_UPDATE'):
-        prefer_update = main_config_file.getboolean('Tribe parameters',
-                                                    'PREFER_UPDATE')
-    else:
-        prefer_update = False
+    process_to = main_config_file.get('main', 'PROCESS_TO')
 
-    if main_config_file.has_option('Tribe parameters', 'TRIBE_URL'):
-        tribe_url = main_config_file.get('Tribe parameters', 'TRIBE_URL')
-    else:
-        tribe_url = False
+    # Folder where the content hashes of the gene sets that were output are
+    # saved, for the next run to find out which gene sets have changed
+    hashes_dir = None
+    if main_config_file.has_option('main', 'GENESET_HASHES_DIR'):
+        hashes_dir = main_config_file.get('main', 'GENESET_HASHES_DIR')
+
+    output_mode = 'full'
+    if main_config_file.has_option('main', 'OUTPUT_MODE'):
+        output_mode = main_config_file.get('main', 'OUTPUT_MODE').lower()
+        if output_mode not in OUTPUT_MODES:
+            logger.error('OUTPUT_MODE option in the main configuration file '
+                         'must be one of: %s.', ', '.join(OUTPUT_MODES))
+            sys.exit(1)
+        if output_mode == 'delta' and hashes_dir is None:
+            logger.error('Main configuration file must have a '
+                         '"GENESET_HASHES_DIR" option in the "main" section '
+                         'for OUTPUT_MODE to be "delta".')
+            sys.exit(1)
+
+    # Number of species that are downloaded and processed at the same
+    # time, each in its own process
+    species_workers = 1
+    if main_config_file.has_option('main', 'SPECIES_WORKERS'):
+        try:
+            species_workers = main_config_file.getint('main',
+                                                      'SPECIES_WORKERS')
+        except ValueError:
+            species_workers = 0
+        if species_workers < 1:
+            logger.error('SPECIES_WORKERS option in the main configuration '
+                         'file must be a positive integer.')
+            sys.exit(1)
+
+    # Whether the GO, KEGG and DO genesets of each species are processed
+    # at the same time
+    concurrent_types = False
+    if main_config_file.has_option('main', 'CONCURRENT_ANNOTATION_TYPES'):
+        concurrent_types = main_config_file.getboolean(
+            'main', 'CONCURRENT_ANNOTATION_TYPES')
+
+    # Settings of the concurrent downloader, if there is a [downloads]
+    # section
+    download_options = get_download_options(main_config_file)
+
+    # The Tribe settings and secrets are read once, and the access token
+    # and connections to Tribe are shared by all species
+    tribe_client = None
+    if process_to == 'Tribe':
+        tribe_client = TribeClient(main_config_file)
+        # Changed gene sets already exist in Tribe, so they can only be
+        # saved as new versions of them
+        if output_mode == 'delta' and not tribe_client.prefer_update:
+            logger.error('OUTPUT_MODE can only be "delta" with PROCESS_TO '
+                         '"Tribe" if the "Tribe parameters" section of the '
+                         'main configuration file has "PREFER_UPDATE: '
+                         'TRUE".')
+            sys.exit(1)
+
+    # The gene sets of each species are written to the JSON file(s) as soon
+    # as it is output: to JSON_FILE for all species, or to a file of each
+    # species in JSON_DIR
+    json_writer = None
+    if process_to == 'JSON file':
+        (json_file, json_dir, json_options) = get_json_output_options(
+            main_config_file)
+        json_options['delta'] = (output_mode == 'delta')
+        if json_dir is not None:
+            if not os.path.isdir(json_dir):
+                os.makedirs(json_dir)
+        else:
+            json_writer = GenesetWriter(json_file, **json_options)
+
+    # Folder and format of the tables of gene sets and annotations of each
+    # species
+    if process_to == 'Columnar files':
+        (columnar_dir, columnar_format) = get_columnar_output_options(
+            main_config_file)
 
     species_dir = main_config_file.get('species files', 'SPECIES_DIR')
     species_files = main_config_file.get('species files', 'SPECIES_FILES')
@@ -126,48 +605,147 @@ def main(ini_file_path):
     # Make a list of the locations of all species files:
     species_files = [filename.strip() for filename in species_files.split(',')]
 
-    for species_file in species_files:
-
-        # Build full species_file path
-        species_file = os.path.join(species_dir, species_file)
-
-        all_org_genesets = process_all_organism_genesets(
-            species_file, download_folder, secrets_file)
+    # GO association files that several species read (such as the
+    # multi-species UniProt file) are split by taxon in a single pass.
+    shared_assoc_taxa = get_shared_assoc_taxa(
+        [os.path.join(species_dir, species_file) for species_file in
+         species_files])
+
+    # Build full species_file paths
+    species_args = [(os.path.join(species_dir, species_file), download_folder,
+                     secrets_file, obo_cache_dir, shared_assoc_taxa,
+                     concurrent_types, download_options, revalidate_downloads,
+                     incremental_dir)
+                    for species_file in species_files]
+
+    # With more than one worker, the gene sets of each species are saved
+    # as soon as it is processed, while the other species are processed.
+    # Otherwise, the gene sets of each species are generated one at a time,
+    # and each one goes through the output stage as it is generated.
+    pool = None
+    if species_workers > 1:
+        load_shared_ontologies([species_arg[0] for species_arg in
+                                species_args], download_folder,
+                               obo_cache_dir=obo_cache_dir,
+                               revalidate_downloads=revalidate_downloads)
+        pool = multiprocessing.Pool(min(species_workers, len(species_args)),
+                                    initializer=init_species_worker)
+        results = pool.imap_unordered(process_species_file, species_args)
+        # Mark the messages of the output stage in this process as well
+        init_species_worker()
+    else:
+        results = imap(partial(process_species_file, lazy=True),
+                       species_args)
+
+    # Pool workers are daemonic, so they are stopped if this loop exits
+    # early.
+    for (species_file, all_org_genesets) in results:
+        if all_org_genesets is None:
+            sys.exit(1)
+
+        SPECIES_LOG_FILTER.species_file = os.path.basename(species_file)
+
+        # Content hashes of the gene sets that were output by the last run,
+        # and of the ones that are output by this one, which are added as
+        # the gene sets go by
+        previous_hashes = {}
+        if hashes_dir is not None:
+            previous_hashes = read_hashes(hashes_dir, species_file)
+        output_hashes = {}
+        status_counts = {}
+        all_statuses = iter_geneset_statuses(all_org_genesets,
+                                             previous_hashes, output_hashes,
+                                             status_counts)
+
+        # In delta mode, only the new and changed gene sets are output
+        geneset_statuses = all_statuses
+        if output_mode == 'delta':
+            geneset_statuses = ((status, geneset) for (status, geneset) in
+                                all_statuses if status != 'unchanged')
+        genesets_to_output = (geneset for (status, geneset) in
+                              geneset_statuses)
 
         if process_to == 'Tribe':
-            if not tribe_url:
-                logger.error('"Tribe parameters" section needs "TRIBE_URL" '
-                             'option to be able to save to Tribe.')
-                sys.exit(1)
-
-            tribe_token, creator_username = get_oauth_token(
-                tribe_url, secrets_file)
-
-            if prefer_update:
-                genesets_to_save = get_all_changed_genesets(
-                    species_file, all_org_genesets, tribe_token,
-                    creator_username)
-
-                if genesets_to_save == []:
-                    logger.info('Annotations have not changed in any gene sets'
-                                ' for species_file %s.', species_file)
-            else:
-                genesets_to_save = all_org_genesets
-
-            logger.info('Starting to save %s gene sets to Tribe',
-                        len(genesets_to_save))
-
-            for geneset in genesets_to_save:
-                geneset['public'] = tribe_public
-                load_to_tribe(ini_file_path, geneset, tribe_token,
-                              creator_username, prefer_update=prefer_update)
-            logger.info('Finished saving gene sets to Tribe')
+            genesets_to_save = genesets_to_output
+            if tribe_client.prefer_update:
+                genesets_to_save = tribe_client.iter_changed_genesets(
+                    species_file, genesets_to_output)
+
+            logger.info('Starting to save gene sets to Tribe')
+
+            saved_count = 0
+            for (geneset, response) in tribe_client.iter_upload_responses(
+                    genesets_to_save):
+                saved_count += 1
+                if not was_saved(response):
+                    # Output this gene set again in the next run
+                    if geneset['slug'] in previous_hashes:
+                        output_hashes[geneset['slug']] = \
+                            previous_hashes[geneset['slug']]
+                    else:
+                        del output_hashes[geneset['slug']]
+
+            if tribe_client.prefer_update and saved_count == 0:
+                logger.info('Annotations have not changed in any gene sets'
+                            ' for species_file %s.', species_file)
+
+            if output_mode == 'delta':
+                removed_slugs = get_removed_slugs(previous_hashes,
+                                                  output_hashes)
+                if removed_slugs:
+                    logger.warning('%s gene sets are no longer processed, '
+                                   'but are not removed from Tribe: %s',
+                                   len(removed_slugs),
+                                   ', '.join(removed_slugs))
+            logger.info('Finished saving %s gene sets to Tribe',
+                        saved_count)
 
         elif process_to == 'JSON file':
-            json_filepath = main_config_file.get('main', 'JSON_FILE')
-
-            with open(json_filepath, "w") as outfile:
-                json.dump(all_org_genesets, outfile, indent=2)
+            species_writer = json_writer
+            if species_writer is None:
+                species_writer = GenesetWriter(get_species_json_file(
+                    json_dir, species_file, json_options['json_format'],
+                    json_options['compress']), **json_options)
+
+            if output_mode == 'delta':
+                for (status, geneset) in geneset_statuses:
+                    species_writer.write(geneset, status)
+                for slug in get_removed_slugs(previous_hashes,
+                                              output_hashes):
+                    species_writer.write_removed(slug)
+            else:
+                species_writer.write_genesets(genesets_to_output)
+
+            if json_writer is None:
+                species_writer.close()
+
+        elif process_to == 'Columnar files':
+            # The tables always have all the gene sets of the species
+            write_columnar_tables(columnar_dir, species_file,
+                                  (geneset for (status, geneset) in
+                                   all_statuses), columnar_format)
+
+        # The gene sets that no output stage used (e.g. with PROCESS_TO:
+        # Python list) are still processed, for their hashes
+        for _ in all_statuses:
+            pass
+
+        if output_mode == 'delta':
+            log_delta(status_counts, get_removed_slugs(previous_hashes,
+                                                        output_hashes))
+
+        if hashes_dir is not None:
+            write_hashes(hashes_dir, species_file, output_hashes)
+
+        SPECIES_LOG_FILTER.species_file = None
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if tribe_client is not None:
+        tribe_client.close()
+    if json_writer is not None:
+        json_writer.close()
 
 
 if __name__ == "__main__":
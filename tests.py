@@ -1,10 +1,35 @@
+import os
+import sys
+import gzip
+import json
+import pickle
+import shutil
+import time
+import threading
+import tempfile
 import unittest
-from go import go
+from StringIO import StringIO
+from urllib import urlencode
+from urlparse import parse_qs, urlsplit
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from go import go, Annotation, AnnotationLayer
+import go_cache
+import gaf_shards
 import download_files
+import download_manager
+import download_cache
+import incremental
+import geneset_hashes
+import json_output
+import columnar_output
 import process_kegg
 import process_go
 import process_do
-from tribe_loader import get_oauth_token, load_to_tribe
+import utils
+import run_refinery
+import tribe_loader
+from tribe_loader import TribeClient
 
 import logging
 from ConfigParser import SafeConfigParser
@@ -34,6 +59,457 @@ class DownloadTest(unittest.TestCase):
         self.assertEqual(se.exception.code, 1)
 
 
+def pop_content_hashes(test, genesets):
+    """
+    Check the content hash that each of genesets carries, and remove it, so
+    that genesets can be compared with the expected gene sets.
+    """
+    for geneset in genesets:
+        test.assertEqual(geneset.pop('content_hash'),
+                         geneset_hashes.get_content_hash(geneset))
+
+
+def stand_in_kegg_entry(kegg_id):
+    """
+    Return the text of the KEGG entry of kegg_id sent by StandInHTTPServer.
+    """
+    return ('ENTRY       %s                    Pathway\n'
+            'NAME        Pathway %s\n'
+            'DESCRIPTION Description of %s\n'
+            '///\n' % (kegg_id, kegg_id, kegg_id))
+
+
+class StandInHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    Local stand-in for the KEGG REST API and other download servers. Like
+    KEGG, GET requests for /get/<id>+<id>... are answered with the entries
+    of those IDs, leaving out the IDs in missing_entries (or with a 404 if
+    none is left). Every other GET request for /<path> is answered with the
+    text "<path> contents", or with contents[<path>] if it is set. The
+    paths in failures get the given status code instead, as many times as
+    set there (or always, for a negative count). The paths in etags are
+    sent with that ETag, and answered with 304 Not Modified if the request
+    has it in its If-None-Match header. Range requests are answered with
+    206 Partial Content (unless their If-Range is not the current ETag),
+    and the responses for the paths in interruptions are cut off after the
+    given number of bytes, as many times as set there.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInRequestHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = []
+        self.failures = {}
+        self.missing_entries = set()
+        self.contents = {}
+        self.etags = {}
+        self.interruptions = {}
+        self.ranges = []
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+
+class StandInRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send each response at once, as a real server would, rather than
+    # waiting for the client to acknowledge its first packet
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append((self.path, time.time()))
+            (status, count) = self.server.failures.get(self.path, (200, 0))
+            if count != 0:
+                self.server.failures[self.path] = (status, count - 1)
+            else:
+                status = 200
+            (cut_off, cuts) = self.server.interruptions.get(self.path,
+                                                            (None, 0))
+            if cuts:
+                self.server.interruptions[self.path] = (cut_off, cuts - 1)
+            else:
+                cut_off = None
+            self.server.ranges.append(self.headers.get('Range'))
+
+        body = self.server.contents.get(
+            self.path, '%s contents' % self.path.lstrip('/'))
+        etag = self.server.etags.get(self.path)
+        if etag is not None and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        if self.path.startswith('/get/'):
+            body = ''.join(stand_in_kegg_entry(kegg_id) for kegg_id in
+                           self.path[len('/get/'):].split('+')
+                           if kegg_id not in self.server.missing_entries)
+            if not body:
+                status = 404
+        if status != 200:
+            body = 'error'
+
+        content_range = None
+        range_header = self.headers.get('Range')
+        if status == 200 and range_header and \
+                self.headers.get('If-Range') in (None, etag):
+            start = int(range_header[len('bytes='):].rstrip('-'))
+            if start < len(body):
+                (status, content_range) = (206, 'bytes %d-%d/%d' % (
+                    start, len(body) - 1, len(body)))
+                body = body[start:]
+            else:
+                (status, body) = (416, 'error')
+
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        if etag is not None:
+            self.send_header('ETag', etag)
+        if content_range is not None:
+            self.send_header('Content-Range', content_range)
+        self.end_headers()
+        if cut_off is not None:
+            self.wfile.write(body[:cut_off])
+            self.close_connection = 1
+        else:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DownloadManagerTest(unittest.TestCase):
+    """
+    Tests for the DownloadManager in download_manager.py, against a local
+    stand-in HTTP server
+    """
+    def setUp(self):
+        self.server = StandInHTTPServer()
+        self.server_thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={'poll_interval': 0.01})
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.download_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.download_folder)
+
+    def downloaded_files(self):
+        return sorted(filename for filename in
+                      os.listdir(self.download_folder)
+                      if not filename.endswith('.lock'))
+
+    def testDownloadAllReusesConnections(self):
+        """
+        Test that many files are downloaded over a few pooled connections,
+        and that existing files are not downloaded again.
+        """
+        manager = download_manager.DownloadManager(max_downloads=4)
+        kegg_ids = ['hsa%05d' % number for number in range(30)]
+        downloads = [(self.server.url + '/get/' + kegg_id,
+                      self.download_folder, None) for kegg_id in kegg_ids]
+
+        self.assertEqual(manager.download_all(downloads), [True] * 30)
+        self.assertEqual(self.downloaded_files(), kegg_ids)
+        with open(os.path.join(self.download_folder, 'hsa00007')) as fh:
+            self.assertEqual(fh.read(), stand_in_kegg_entry('hsa00007'))
+        self.assertEqual(len(self.server.requests), 30)
+        self.assertLessEqual(self.server.connections, 4)
+
+        self.assertEqual(manager.download_all(downloads), [False] * 30)
+        self.assertEqual(len(self.server.requests), 30)
+
+    def testRetries(self):
+        """
+        Test that requests are retried after server errors, but not after
+        client errors, and that failed downloads leave no files behind.
+        """
+        self.server.failures = {'/flaky': (503, 2), '/down': (500, -1),
+                                '/missing': (404, -1)}
+        manager = download_manager.DownloadManager(retries=2,
+                                                   retry_backoff=0.01)
+
+        self.assertTrue(manager.download(self.server.url + '/flaky',
+                                         self.download_folder))
+        self.assertFalse(manager.download(self.server.url + '/down',
+                                          self.download_folder))
+        self.assertFalse(manager.download(self.server.url + '/missing',
+                                          self.download_folder))
+
+        paths = [path for (path, request_time) in self.server.requests]
+        self.assertEqual(paths.count('/flaky'), 3)
+        self.assertEqual(paths.count('/down'), 3)
+        self.assertEqual(paths.count('/missing'), 1)
+        self.assertEqual(self.downloaded_files(), ['flaky'])
+
+    def testRateLimit(self):
+        """
+        Test that concurrent requests to the same host are spaced by at
+        least min_request_interval.
+        """
+        manager = download_manager.DownloadManager(
+            max_downloads=3, min_request_interval=0.05)
+        manager.download_all([(self.server.url + '/file%d' % number,
+                               self.download_folder, None)
+                              for number in range(6)])
+
+        request_times = sorted(request_time for (path, request_time) in
+                               self.server.requests)
+        self.assertEqual(len(request_times), 6)
+        for (earlier, later) in zip(request_times, request_times[1:]):
+            self.assertGreater(later - earlier, 0.04)
+
+    def write_kegg_species_file(self, batch_size=None):
+        """
+        Write a species file for the stand-in KEGG server, and return its
+        location.
+        """
+        species_ini_file = os.path.join(self.download_folder, 'species.ini')
+        species_file = SafeConfigParser()
+        species_file.add_section('species_info')
+        species_file.set('species_info', 'SPECIES_DOWNLOAD_FOLDER',
+                         self.download_folder)
+        species_file.add_section('KEGG')
+        species_file.set('KEGG', 'KEGG_ROOT_URL', self.server.url)
+        species_file.set('KEGG', 'SET_INFO_DIR', '/get/')
+        if batch_size is not None:
+            species_file.set('KEGG', 'SET_INFO_BATCH_SIZE', str(batch_size))
+        with open(species_ini_file, 'w') as species_fh:
+            species_file.write(species_fh)
+        os.mkdir(os.path.join(self.download_folder, 'KEGG'))
+        return species_ini_file
+
+    def testDownloadKeggInfoFiles(self):
+        """
+        Test that download_kegg_info_files() downloads the info file of
+        every KEGG set with a DownloadManager, one request per set when
+        SET_INFO_BATCH_SIZE is 1.
+        """
+        species_ini_file = self.write_kegg_species_file(batch_size=1)
+
+        manager = download_manager.DownloadManager()
+        download_files.download_kegg_info_files(
+            ['hsa00010', 'hsa00020', 'M00001'], species_ini_file, manager)
+
+        info_folder = os.path.join(self.download_folder,
+                                   process_kegg.KEGGSET_INFO_FOLDER)
+        for kegg_id in ['hsa00010', 'hsa00020', 'M00001']:
+            with open(os.path.join(info_folder, kegg_id)) as info_fh:
+                self.assertEqual(info_fh.read(), stand_in_kegg_entry(kegg_id))
+        self.assertEqual(len(self.server.requests), 3)
+
+    def testBatchedKeggInfoFiles(self):
+        """
+        Test that download_kegg_info_files() requests the info files of
+        KEGG_GET_BATCH_SIZE sets at a time, writes the same files as
+        requesting them one by one, skips the files that already exist, and
+        requests the sets left out of a batch response on their own.
+        """
+        species_ini_file = self.write_kegg_species_file()
+        info_folder = os.path.join(self.download_folder,
+                                   process_kegg.KEGGSET_INFO_FOLDER)
+        os.mkdir(info_folder)
+        with open(os.path.join(info_folder, 'hsa00000'), 'w') as info_fh:
+            info_fh.write('existing')
+        kegg_ids = ['hsa%05d' % number for number in range(25)]
+        self.server.missing_entries = set(['hsa00003'])
+
+        for manager in (None, download_manager.DownloadManager()):
+            download_files.download_kegg_info_files(
+                kegg_ids, species_ini_file, manager)
+
+            paths = [path for (path, request_time) in self.server.requests]
+            self.assertEqual(len(paths), 4)
+            self.assertIn('/get/' + '+'.join(kegg_ids[1:11]), paths)
+            self.assertIn('/get/' + '+'.join(kegg_ids[21:]), paths)
+            self.assertIn('/get/hsa00003', paths)
+            for kegg_id in kegg_ids[1:]:
+                if kegg_id == 'hsa00003':
+                    continue
+                with open(os.path.join(info_folder, kegg_id)) as info_fh:
+                    self.assertEqual(info_fh.read(),
+                                     stand_in_kegg_entry(kegg_id))
+            with open(os.path.join(info_folder, 'hsa00000')) as info_fh:
+                self.assertEqual(info_fh.read(), 'existing')
+
+            for filename in os.listdir(info_folder):
+                if filename != 'hsa00000':
+                    os.remove(os.path.join(info_folder, filename))
+            self.server.requests = []
+
+    def testSplitKeggEntries(self):
+        """
+        Test that a multi-entry KEGG response is split into its entries, and
+        that their IDs are read from their ENTRY lines.
+        """
+        entries = [stand_in_kegg_entry('hsa00010'),
+                   stand_in_kegg_entry('M00001')]
+        self.assertEqual(download_files.split_kegg_entries(''.join(entries)),
+                         entries)
+        self.assertEqual([download_files.get_kegg_entry_id(entry)
+                          for entry in entries], ['hsa00010', 'M00001'])
+
+    def testRevalidateDownloads(self):
+        """
+        Test that with revalidate, files are downloaded again only when
+        their ETag changes, and that their manifest records it.
+        """
+        url = self.server.url + '/data.txt'
+        target_filename = os.path.join(self.download_folder, 'data.txt')
+        manager = download_manager.DownloadManager()
+        for download in (utils.download_from_url, manager.download):
+            self.server.etags['/data.txt'] = '"v1"'
+            self.server.contents['/data.txt'] = 'version 1'
+            self.server.requests = []
+
+            self.assertTrue(download(url, self.download_folder,
+                                     revalidate=True))
+            manifest = download_cache.read_manifest(target_filename, url)
+            self.assertEqual(manifest['etag'], '"v1"')
+            self.assertEqual(manifest['size'], len('version 1'))
+            self.assertEqual(manifest['sha1'],
+                             go_cache.file_digest(target_filename))
+            # URLs can hold secrets, so only their digest is recorded
+            with open(download_cache.get_manifest_file(
+                    target_filename)) as manifest_fh:
+                self.assertNotIn(url, manifest_fh.read())
+
+            self.assertFalse(download(url, self.download_folder,
+                                      revalidate=True))
+            self.assertFalse(download(url, self.download_folder))
+            self.assertEqual(len(self.server.requests), 2)
+
+            self.server.etags['/data.txt'] = '"v2"'
+            self.server.contents['/data.txt'] = 'version 2'
+            self.assertTrue(download(url, self.download_folder,
+                                     revalidate=True))
+            with open(target_filename) as data_fh:
+                self.assertEqual(data_fh.read(), 'version 2')
+            self.assertEqual(download_cache.read_manifest(
+                target_filename, url)['etag'], '"v2"')
+
+            os.remove(target_filename)
+            os.remove(download_cache.get_manifest_file(target_filename))
+
+    def testRevalidateWithoutValidators(self):
+        """
+        Test that a file without an ETag or Last-Modified header is
+        downloaded again with revalidate, but that the existing file is
+        kept if its contents have not changed.
+        """
+        url = self.server.url + '/data.txt'
+        target_filename = os.path.join(self.download_folder, 'data.txt')
+        self.assertTrue(utils.download_from_url(url, self.download_folder,
+                                                revalidate=True))
+        os.utime(target_filename, (1000000000, 1000000000))
+
+        self.assertFalse(utils.download_from_url(url, self.download_folder,
+                                                 revalidate=True))
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(os.path.getmtime(target_filename), 1000000000)
+
+        self.server.contents['/data.txt'] = 'new contents'
+        self.assertTrue(utils.download_from_url(url, self.download_folder,
+                                                revalidate=True))
+        with open(target_filename) as data_fh:
+            self.assertEqual(data_fh.read(), 'new contents')
+        self.assertEqual(self.downloaded_files(),
+                         ['data.txt', 'data.txt.download.json'])
+
+    def testUnchangedOnFTP(self):
+        """
+        Test that FTP files are only considered unchanged if both their
+        MDTM and SIZE are the same as in their manifest.
+        """
+        manifest = {'mdtm': '20170101000000', 'remote_size': 100}
+        self.assertTrue(download_cache.is_unchanged_on_ftp(
+            manifest, {'mdtm': '20170101000000', 'remote_size': 100}))
+        self.assertFalse(download_cache.is_unchanged_on_ftp(
+            manifest, {'mdtm': '20170102000000', 'remote_size': 100}))
+        self.assertFalse(download_cache.is_unchanged_on_ftp(
+            manifest, {'mdtm': '20170101000000', 'remote_size': 101}))
+        self.assertFalse(download_cache.is_unchanged_on_ftp(
+            manifest, {'mdtm': None, 'remote_size': None}))
+        self.assertFalse(download_cache.is_unchanged_on_ftp(
+            None, {'mdtm': '20170101000000', 'remote_size': 100}))
+
+    def testResumeInterruptedDownload(self):
+        """
+        Test that a download that is cut off is resumed from its partial
+        file with a Range request, by the retries of a DownloadManager and
+        by the next call of download_from_url().
+        """
+        url = self.server.url + '/big.gaf'
+        target_filename = os.path.join(self.download_folder, 'big.gaf')
+        contents = ''.join('line %d\n' % number for number in range(2000))
+        self.server.contents['/big.gaf'] = contents
+        self.server.etags['/big.gaf'] = '"big"'
+
+        self.server.interruptions['/big.gaf'] = (5000, 1)
+        manager = download_manager.DownloadManager(retries=1,
+                                                   retry_backoff=0)
+        self.assertTrue(manager.download(url, self.download_folder))
+        with open(target_filename) as big_fh:
+            self.assertEqual(big_fh.read(), contents)
+        self.assertEqual(self.server.ranges, [None, 'bytes=5000-'])
+        self.assertEqual(self.downloaded_files(), ['big.gaf'])
+
+        os.remove(target_filename)
+        self.server.ranges = []
+        self.server.interruptions['/big.gaf'] = (7000, 1)
+        self.assertFalse(utils.download_from_url(url, self.download_folder))
+        self.assertEqual(os.path.getsize(target_filename + '.partial'), 7000)
+        self.assertFalse(os.path.exists(target_filename))
+        self.assertTrue(utils.download_from_url(url, self.download_folder))
+        with open(target_filename) as big_fh:
+            self.assertEqual(big_fh.read(), contents)
+        self.assertEqual(self.server.ranges, [None, 'bytes=7000-'])
+        self.assertEqual(self.downloaded_files(), ['big.gaf'])
+
+    def testRestartChangedDownload(self):
+        """
+        Test that a partial download of a file that has changed on the
+        server since is started over instead of resumed.
+        """
+        url = self.server.url + '/big.gaf'
+        target_filename = os.path.join(self.download_folder, 'big.gaf')
+        self.server.contents['/big.gaf'] = 'a' * 10000
+        self.server.etags['/big.gaf'] = '"a"'
+        self.server.interruptions['/big.gaf'] = (5000, 1)
+        self.assertFalse(utils.download_from_url(url, self.download_folder))
+
+        self.server.contents['/big.gaf'] = 'b' * 10000
+        self.server.etags['/big.gaf'] = '"b"'
+        self.assertTrue(utils.download_from_url(url, self.download_folder))
+        with open(target_filename) as big_fh:
+            self.assertEqual(big_fh.read(), 'b' * 10000)
+        self.assertEqual(self.server.ranges, [None, 'bytes=5000-'])
+
+    def testPickledManager(self):
+        """
+        Test that a pickled DownloadManager keeps its settings and gets a
+        session of its own.
+        """
+        manager = download_manager.DownloadManager(max_downloads=2,
+                                                   retries=5)
+        copy = pickle.loads(pickle.dumps(manager))
+        self.assertEqual(copy.max_downloads, 2)
+        self.assertEqual(copy.retries, 5)
+        self.assertIsNot(copy.session, manager.session)
+        self.assertTrue(copy.download(self.server.url + '/file',
+                                      self.download_folder))
+
+
 class KeggTest(unittest.TestCase):
     """
     Test case for functions in process_kegg.py file
@@ -117,6 +593,31 @@ class KeggTest(unittest.TestCase):
 
         self.assertEqual(kegg_set_info, desired_output)
 
+    def testRemoveStaleKeggInfoFiles(self):
+        """
+        Test that KEGG set info files are kept while the KEGG release does
+        not change, and removed when it does.
+        """
+        keggset_info_folder = tempfile.mkdtemp()
+        try:
+            process_kegg.remove_stale_kegg_info_files(keggset_info_folder,
+                                                      'Release 77.0')
+            with open(os.path.join(keggset_info_folder, 'hsa00010'),
+                      'w') as info_fh:
+                info_fh.write('info')
+
+            process_kegg.remove_stale_kegg_info_files(keggset_info_folder,
+                                                      'Release 77.0')
+            self.assertTrue(os.path.exists(
+                os.path.join(keggset_info_folder, 'hsa00010')))
+
+            process_kegg.remove_stale_kegg_info_files(keggset_info_folder,
+                                                      'Release 78.0')
+            self.assertEqual(os.listdir(keggset_info_folder),
+                             [process_kegg.KEGG_RELEASE_FILE])
+        finally:
+            shutil.rmtree(keggset_info_folder)
+
     def testAddOrganismToSlug(self):
         kegg_set_info = process_kegg.get_kegg_set_info(
             'test_files/KEGG/keggset_info_folder/M00001', 'mus-musculus')
@@ -203,6 +704,7 @@ class KeggTest(unittest.TestCase):
              'xrdb': 'Entrez'}
         ]
 
+        pop_content_hashes(self, test_keggsets)
         self.assertEqual(test_keggsets, desired_keggsets)
 
     def testProcessKeggSets(self):
@@ -278,6 +780,7 @@ class KeggTest(unittest.TestCase):
              'tags': ['epsilon', 'zeta', 'eta', 'theta', 'iota']
              }
         ]
+        pop_content_hashes(self, all_kegg_sets)
         self.assertEqual(all_kegg_sets, desired_keggsets)
 
 
@@ -313,6 +816,156 @@ class GO_Test(unittest.TestCase):
 
         self.assertEqual(filtered_annotations, desired_output)
 
+    def testColumnarGAFReader(self):
+        """
+        Test that the chunked pandas GAF reader yields the same annotations
+        as the line reader, with and without taxon and evidence filters.
+        """
+        evcodes = ['EXP', 'IDA', 'IPI', 'IMP', 'IGI', 'IEP']
+        for (assoc_file, tax_id) in (
+                ('test_files/GO/test_go_assoc_file.csv', None),
+                ('test_files/GO/test_gene_association.zfin', '7955'),
+                ('test_files/GO/test_gene_association.pseudocap', '208964')):
+            for accepted_evcodes in (None, evcodes):
+                line_annotations = list(process_go.iter_filtered_annotations(
+                    assoc_file, accepted_evcodes, tax_id=tax_id))
+                columnar_annotations = list(
+                    process_go.iter_filtered_annotations(
+                        assoc_file, accepted_evcodes, tax_id=tax_id,
+                        reader='columnar'))
+
+                self.assertTrue(line_annotations)
+                self.assertEqual(columnar_annotations, line_annotations)
+
+    def testGAFShards(self):
+        """
+        Test that a multi-species association file is split into shards
+        that give the same annotations as the whole file for each taxon,
+        and that existing shards are not written again.
+        """
+        evcodes = ['EXP', 'IDA', 'IPI', 'IMP', 'IGI', 'IEP']
+        base_folder = tempfile.mkdtemp()
+        assoc_file = os.path.join(base_folder, 'test_multi_species.gaf.gz')
+        with gzip.open(assoc_file, 'wb') as assoc_fh:
+            for filename in ('test_gene_association.zfin',
+                             'test_gene_association.pseudocap'):
+                with open(os.path.join('test_files/GO', filename)) as fh:
+                    assoc_fh.write(fh.read())
+        try:
+            tax_ids = ['7955', '208964', '9606']
+            shard_files = {}
+            for tax_id in tax_ids:
+                shard_files[tax_id] = gaf_shards.get_taxon_shard(
+                    assoc_file, base_folder, tax_id, tax_ids)
+
+            # All taxa were sharded by the first call
+            shard_dirs = os.listdir(os.path.join(base_folder,
+                                                 gaf_shards.SHARD_FOLDER))
+            self.assertEqual(len(shard_dirs), 1)
+            self.assertEqual(
+                len(set(os.path.dirname(shard_file) for shard_file in
+                        shard_files.values())), 1)
+
+            for tax_id in tax_ids:
+                self.assertNotEqual(shard_files[tax_id], assoc_file)
+                self.assertEqual(
+                    process_go.get_filtered_annotations(
+                        shard_files[tax_id], evcodes, tax_id=tax_id),
+                    process_go.get_filtered_annotations(
+                        assoc_file, evcodes, tax_id=tax_id))
+            self.assertTrue(process_go.get_filtered_annotations(
+                shard_files['7955'], evcodes, tax_id='7955'))
+            self.assertEqual(process_go.get_filtered_annotations(
+                shard_files['9606'], tax_id='9606'), [])
+
+            os.utime(shard_files['7955'], (1000000000, 1000000000))
+            self.assertEqual(
+                gaf_shards.get_taxon_shard(assoc_file, base_folder, '7955'),
+                shard_files['7955'])
+            self.assertEqual(os.path.getmtime(shard_files['7955']),
+                             1000000000)
+        finally:
+            shutil.rmtree(base_folder)
+
+    def testDecompressPipe(self):
+        """
+        Test that gzipped association files read through an external
+        decompressor have the same lines as with the gzip module, and that
+        closing the pipe early is not an error.
+        """
+        if utils.GZIP_DECOMPRESSOR is None:
+            self.skipTest('No external gzip decompressor found')
+
+        work_dir = tempfile.mkdtemp()
+        assoc_file = os.path.join(work_dir, 'test_gene_association.zfin.gz')
+        with open('test_files/GO/test_gene_association.zfin') as fh:
+            lines = fh.readlines()
+        with gzip.open(assoc_file, 'wb') as assoc_fh:
+            assoc_fh.writelines(lines)
+        try:
+            with utils.open_assoc_file(assoc_file) as assoc_fh:
+                self.assertEqual(list(assoc_fh), lines)
+            decompressor = utils.GZIP_DECOMPRESSOR
+            utils.GZIP_DECOMPRESSOR = None
+            try:
+                with utils.open_assoc_file(assoc_file) as assoc_fh:
+                    self.assertEqual(list(assoc_fh), lines)
+            finally:
+                utils.GZIP_DECOMPRESSOR = decompressor
+            with utils.open_assoc_file(assoc_file) as assoc_fh:
+                self.assertEqual(assoc_fh.readline(), lines[0])
+
+            with open(assoc_file, 'r+b') as assoc_fh:
+                assoc_fh.truncate(os.path.getsize(assoc_file) // 2)
+            with self.assertRaises(IOError):
+                with utils.open_assoc_file(assoc_file) as assoc_fh:
+                    list(assoc_fh)
+        finally:
+            shutil.rmtree(work_dir)
+
+    def testConcurrentAnnotations(self):
+        """
+        Test that reading several association files in separate processes
+        gives the annotations in the same order as reading them one after
+        another, and that reader errors are raised.
+        """
+        evcodes = ['EXP', 'IDA', 'IPI', 'IMP', 'IGI', 'IEP']
+        assoc_files = ['test_files/GO/test_gene_association.zfin',
+                       'test_files/GO/test_go_assoc_file.csv',
+                       'test_files/GO/test_gene_association.zfin']
+        sequential = list(process_go.iter_concurrent_annotations(
+            assoc_files, evcodes, concurrent=False))
+        expected = []
+        for assoc_file in assoc_files:
+            expected.extend(process_go.get_filtered_annotations(
+                assoc_file, evcodes))
+        self.assertTrue(expected)
+        self.assertEqual(sequential, expected)
+
+        self.assertEqual(list(process_go.iter_concurrent_annotations(
+            assoc_files, evcodes)), sequential)
+
+        original_batch_size = process_go.ANNOTATION_BATCH_SIZE
+        original_cpu_count = process_go.multiprocessing.cpu_count
+        process_go.ANNOTATION_BATCH_SIZE = 7
+        try:
+            concurrent = list(process_go.iter_concurrent_annotations(
+                assoc_files, evcodes, concurrent=True))
+            # One reader at a time, each started once the last one is done
+            process_go.multiprocessing.cpu_count = lambda: 1
+            one_reader = list(process_go.iter_concurrent_annotations(
+                assoc_files, evcodes, concurrent=True))
+        finally:
+            process_go.ANNOTATION_BATCH_SIZE = original_batch_size
+            process_go.multiprocessing.cpu_count = original_cpu_count
+        self.assertEqual(concurrent, sequential)
+        self.assertEqual(one_reader, sequential)
+
+        with self.assertRaises(IOError):
+            list(process_go.iter_concurrent_annotations(
+                assoc_files + ['test_files/GO/no_such_file'], evcodes,
+                concurrent=True))
+
     def testCreateGOTermTitle(self):
         all_titles = set()
 
@@ -449,6 +1102,7 @@ class GO_Test(unittest.TestCase):
              'tags': ['alpha', 'beta', 'gamma']}
         ]
 
+        pop_content_hashes(self, go_terms)
         self.assertEqual(go_terms, desired_output)
 
     def testHeadTermOBOFile(self):
@@ -458,6 +1112,235 @@ class GO_Test(unittest.TestCase):
         self.assertEqual(loaded_obo_bool, True)
         self.assertEqual(gene_ontology2.heads, self.gene_ontology.heads)
 
+    def testOBOCache(self):
+        """
+        Test that a cached ontology has the same terms, links and heads as
+        a parsed one, and that a changed OBO file is parsed again.
+        """
+        cache_dir = tempfile.mkdtemp()
+        obo_file = os.path.join(cache_dir, 'test_go_obo_file.obo')
+        shutil.copy('test_files/test_go_obo_file.obo', obo_file)
+        try:
+            parsed = go()
+            self.assertFalse(go_cache.load_cached_obo(parsed, obo_file,
+                                                      cache_dir))
+            cached = go()
+            self.assertTrue(go_cache.load_cached_obo(cached, obo_file,
+                                                     cache_dir))
+
+            self.assertEqual(sorted(cached.go_terms),
+                             sorted(parsed.go_terms))
+            self.assertEqual(cached.alt_id2std_id, parsed.alt_id2std_id)
+            self.assertEqual([term.go_id for term in cached.heads],
+                             [term.go_id for term in parsed.heads])
+            for (go_id, term) in parsed.go_terms.iteritems():
+                cached_term = cached.go_terms[go_id]
+                self.assertEqual(cached_term.full_name, term.full_name)
+                self.assertEqual(cached_term.namespace, term.namespace)
+                self.assertEqual(cached_term.description, term.description)
+                self.assertEqual(cached_term.is_a, term.is_a)
+                self.assertEqual(cached_term.relationship_part_of,
+                                 term.relationship_part_of)
+                self.assertEqual(cached_term.child_of, term.child_of)
+                self.assertEqual(cached_term.parent_of, term.parent_of)
+            self.assertEqual(cached.get_ancestors('GO:0000001'),
+                             set(['GO:0000006', 'GO:0000007']))
+
+            with open(obo_file, 'a') as obo_fh:
+                obo_fh.write('\n[Term]\nid: GO:0000100\nname: new term\n'
+                             'namespace: biological_process\n'
+                             'is_a: GO:0000007\n')
+            changed = go()
+            self.assertTrue(changed.load_obo(obo_file, cache_dir=cache_dir))
+            self.assertIn('GO:0000100', changed.go_terms)
+
+            # The cache of the old version of the file was replaced
+            cache_files = [filename for filename in os.listdir(cache_dir)
+                           if filename.endswith(go_cache.CACHE_SUFFIX)]
+            self.assertEqual(len(cache_files), 1)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def testPropagateDeepOntology(self):
+        """
+        Test that propagation walks a chain of terms deeper than Python's
+        recursion limit, and that annotations reach the head term.
+        """
+        depth = sys.getrecursionlimit() + 100
+        obo_lines = []
+        for i in xrange(depth):
+            obo_lines.extend(['[Term]', 'id: GO:%07d' % i,
+                              'name: term %d' % i,
+                              'namespace: biological_process'])
+            if i:
+                obo_lines.append('is_a: GO:%07d' % (i - 1))
+            obo_lines.append('')
+
+        deep_ontology = go()
+        deep_ontology.parse(StringIO('\n'.join(obo_lines)))
+        deep_ontology.add_annotation(go_id='GO:%07d' % (depth - 1),
+                                     gid='A0A024R216', direct=True)
+        deep_ontology.propagate()
+
+        head_annotations = deep_ontology.go_terms['GO:0000000'].annotations
+        self.assertEqual([annotation.gid for annotation in head_annotations],
+                         ['A0A024R216'])
+        self.assertFalse(list(head_annotations)[0].direct)
+
+    def testIndexedBackend(self):
+        """
+        Test that the 'indexed' go() backend answers graph queries and
+        propagates annotations the same way as the default backend.
+        """
+        indexed_ontology = go(backend='indexed')
+        indexed_ontology.load_obo('test_files/test_go_obo_file.obo')
+
+        for ontology in (self.gene_ontology, indexed_ontology):
+            ontology.add_annotation(go_id='GO:0000001', gid='A0A024R216',
+                                    direct=True)
+            ontology.add_annotation(go_id='GO:0000004', gid='A0A024QZP7',
+                                    direct=True)
+
+        for go_id in self.gene_ontology.go_terms:
+            self.assertEqual(indexed_ontology.get_ancestors(go_id),
+                             self.gene_ontology.get_ancestors(go_id))
+            self.assertEqual(indexed_ontology.get_descendents(go_id),
+                             self.gene_ontology.get_descendents(go_id))
+        # The indexed backend answers from its GOIndex, not the closures
+        self.assertIsNone(indexed_ontology.ancestors)
+        self.assertIsNone(indexed_ontology.descendents)
+
+        self.gene_ontology.propagate()
+        indexed_ontology.propagate()
+        for (go_id, term) in self.gene_ontology.go_terms.iteritems():
+            self.assertEqual(indexed_ontology.go_terms[go_id].annotations,
+                             term.annotations)
+        self.assertEqual(
+            set(leaf.go_id for leaf in indexed_ontology.get_leaves(
+                min_annot=1)),
+            set(leaf.go_id for leaf in self.gene_ontology.get_leaves(
+                min_annot=1)))
+
+    def testReachabilityAfterPrune(self):
+        """
+        Test that ancestor and descendent queries are answered from the
+        cached closures, and that prune() makes them be rebuilt.
+        """
+        self.assertEqual(self.gene_ontology.get_ancestors('GO:0000001'),
+                         set(['GO:0000006', 'GO:0000007']))
+        self.assertEqual(self.gene_ontology.get_descendents('GO:0000007'),
+                         set(['GO:0000001', 'GO:0000002', 'GO:0000003',
+                              'GO:0000005', 'GO:0000006']))
+        self.assertTrue(self.gene_ontology.is_descendent('GO:0000001',
+                                                         'GO:0000006'))
+        self.assertEqual(self.gene_ontology.get_ancestors('GO:0000004'),
+                         set())
+
+        self.gene_ontology.prune("term.go_id == 'GO:0000006'")
+
+        self.assertEqual(self.gene_ontology.get_ancestors('GO:0000001'),
+                         set(['GO:0000007']))
+        self.assertEqual(self.gene_ontology.get_descendents('GO:0000007'),
+                         set(['GO:0000001', 'GO:0000002', 'GO:0000003',
+                              'GO:0000005']))
+        self.assertFalse(self.gene_ontology.is_descendent('GO:0000001',
+                                                          'GO:0000006'))
+
+    def testBitsetPropagation(self):
+        """
+        Test that propagating sparse gene membership matrices gives every
+        term the same genes, publications and xrdb as propagating
+        Annotation objects.
+        """
+        obo_file = 'test_files/test_zebrafish_gene_ontology.1_2.obo'
+        annotations = process_go.get_filtered_annotations(
+            'test_files/GO/test_gene_association.zfin',
+            ['EXP', 'IDA', 'IPI', 'IMP', 'IGI', 'IEP'], tax_id='7955')
+
+        object_ontology = go()
+        object_ontology.load_obo(obo_file)
+        for (xrdb, xrid, goid, refstring, date) in annotations:
+            object_ontology.add_annotation(
+                go_id=goid, gid=xrid, xdb=xrdb, date=date, direct=True,
+                ref=process_go.get_pubmed_id(refstring))
+        object_ontology.propagate()
+
+        desired_output = {}
+        for (term_id, term) in object_ontology.go_terms.iteritems():
+            if term.annotations:
+                (term_genes, xrdb) = process_go.get_term_annotations(term)
+                desired_output[term_id] = (
+                    dict((gene, sorted(set(pubs))) for (gene, pubs) in
+                         term_genes.iteritems()), xrdb)
+
+        bitset_ontology = go()
+        bitset_ontology.load_obo(obo_file)
+        term_annotations = process_go.get_bitset_term_annotations(
+            bitset_ontology, annotations)
+
+        self.assertEqual(term_annotations, desired_output)
+
+    def testAnnotationLayer(self):
+        """
+        Test that annotation layers on one shared ontology propagate like
+        go.propagate(), without adding annotations to the ontology or to
+        each other.
+        """
+        obo_file = 'test_files/test_zebrafish_gene_ontology.1_2.obo'
+        annotations = process_go.get_filtered_annotations(
+            'test_files/GO/test_gene_association.zfin',
+            ['EXP', 'IDA', 'IPI', 'IMP', 'IGI', 'IEP'], tax_id='7955')
+
+        object_ontology = go()
+        object_ontology.load_obo(obo_file)
+        for (xrdb, xrid, goid, refstring, date) in annotations:
+            object_ontology.add_annotation(
+                go_id=goid, gid=xrid, xdb=xrdb, date=date, direct=True,
+                ref=process_go.get_pubmed_id(refstring))
+        object_ontology.propagate()
+
+        shared_ontology = go()
+        shared_ontology.load_obo(obo_file)
+        layer = AnnotationLayer(shared_ontology)
+        other_layer = AnnotationLayer(shared_ontology)
+        for (xrdb, xrid, goid, refstring, date) in annotations:
+            layer.add_annotation(
+                go_id=goid, gid=xrid, xdb=xrdb, date=date, direct=True,
+                ref=process_go.get_pubmed_id(refstring))
+        other_layer.add_annotation(go_id=annotations[0][2], gid='other',
+                                   direct=True)
+        layer.propagate()
+        other_layer.propagate()
+
+        for (term_id, term) in object_ontology.go_terms.iteritems():
+            self.assertEqual(layer.get_annotations(term_id),
+                             term.annotations)
+            self.assertFalse(shared_ontology.go_terms[term_id].annotations)
+            self.assertNotIn('other', [annotation.gid for annotation in
+                                       layer.get_annotations(term_id)])
+
+    def testAnnotationPropCopyIsShared(self):
+        """
+        Test that propagated copies of an annotation are created once and
+        shared, and that they compare like freshly built annotations.
+        """
+        annotation = Annotation(xdb='UniProtKB', gid='A0A024R216',
+                                ref='10873824', date='20110516', direct=True)
+
+        prop_annotation = annotation.prop_copy()
+        self.assertIs(annotation.prop_copy(), prop_annotation)
+        self.assertIs(prop_annotation.prop_copy(), prop_annotation)
+        self.assertEqual(prop_annotation, Annotation(
+            xdb='UniProtKB', gid='A0A024R216', ref='10873824',
+            date='20110516', direct=False))
+
+        cutoff_annotation = annotation.prop_copy(ready_regulates_cutoff=True)
+        self.assertIsNot(cutoff_annotation, prop_annotation)
+        self.assertIs(prop_annotation.prop_copy(ready_regulates_cutoff=True),
+                      prop_annotation.prop_copy(ready_regulates_cutoff=True))
+        self.assertEqual(pickle.loads(pickle.dumps(cutoff_annotation, 2)),
+                         cutoff_annotation)
+
     def testCorrectPublications(self):
         test_ini_file = 'test_files/test_zebrafish.ini'
         go_terms = process_go.process_go_terms(test_ini_file, 'test_files/')
@@ -509,6 +1392,7 @@ class GO_Test(unittest.TestCase):
         """
         test_ini_file = 'test_files/test_pseudomonas.ini'
         go_terms = process_go.process_go_terms(test_ini_file, 'test_files/')
+        pop_content_hashes(self, go_terms)
 
         desired_go_term = None
         for term in go_terms:
@@ -560,6 +1444,30 @@ class DO_Test(unittest.TestCase):
 
         self.assertEqual(doid_omim_dict, desired_output)
 
+    def testBuildOmimDictSkipsOtherStanzas(self):
+        # The ids and xrefs of stanzas after the terms, such as [Typedef]
+        # ones, are not read
+        work_dir = tempfile.mkdtemp()
+        do_obo_file = os.path.join(work_dir, 'do.obo')
+        with open(do_obo_file, 'w') as obo_fh:
+            obo_fh.write('format-version: 1.2\n\n'
+                         '[Term]\nid: DOID:9970\nname: obesity\n'
+                         'xref: OMIM:601665\n\n'
+                         '[Typedef]\nid: DOID:0000001\nname: relation\n'
+                         'xref: OMIM:100100\n')
+        try:
+            self.assertEqual(process_do.build_doid_omim_dict(do_obo_file),
+                             {'DOID:9970': set(['601665'])})
+        finally:
+            shutil.rmtree(work_dir)
+
+    def testGetDoidOmimDictFromParsedOntology(self):
+        # The xrefs read by go.parse() give the same dictionary, without
+        # reading the OBO file again
+        doid_omim_dict = process_do.get_doid_omim_dict(self.disease_ontology)
+
+        self.assertEqual(doid_omim_dict, {'DOID:9970': set(['601665'])})
+
     def testBuildMim2EntrezDict(self):
         mim2gene_file = 'test_files/DO/test_mim2gene.csv'
 
@@ -751,9 +1659,1079 @@ class DO_Test(unittest.TestCase):
              'tags': ['pi', 'rho', 'sigma', 'tau']}
         ]
 
+        pop_content_hashes(self, do_terms)
         self.assertEqual(do_terms, desired_output)
 
 
+class RunRefineryTest(unittest.TestCase):
+    """
+    Tests for functions in run_refinery.py file
+    """
+
+    def testSpeciesLogFilter(self):
+        """
+        Test that log messages are marked with the current species file
+        once, however many handlers they go through, and only while a
+        species is being processed, by handlers with a SpeciesLogFormatter,
+        and that the messages themselves are left as they are.
+        """
+        streams = [StringIO(), StringIO(), StringIO()]
+        handlers = [logging.StreamHandler(stream) for stream in streams]
+        handlers[0].setFormatter(run_refinery.SpeciesLogFormatter())
+        handlers[1].setFormatter(run_refinery.SpeciesLogFormatter(
+            '%(levelname)s:%(message)s'))
+        test_logger = logging.getLogger('tests.species_log_filter')
+        test_logger.propagate = False
+        for handler in handlers:
+            handler.addFilter(run_refinery.SPECIES_LOG_FILTER)
+            test_logger.addHandler(handler)
+        try:
+            # A % in the species file name is not a format specifier
+            run_refinery.SPECIES_LOG_FILTER.species_file = 'hu%sman.ini'
+            test_logger.warning('Processing %s terms', 'GO')
+            run_refinery.SPECIES_LOG_FILTER.species_file = None
+            test_logger.warning('Done')
+        finally:
+            for handler in handlers:
+                test_logger.removeHandler(handler)
+            run_refinery.SPECIES_LOG_FILTER.species_file = None
+
+        self.assertEqual([stream.getvalue() for stream in streams],
+                         ['[hu%sman.ini] Processing GO terms\nDone\n',
+                          'WARNING:[hu%sman.ini] Processing GO terms\n'
+                          'WARNING:Done\n',
+                          'Processing GO terms\nDone\n'])
+
+    def testConcurrentAnnotationTypes(self):
+        """
+        Test that processing the GO, KEGG and DO genesets of a species at
+        the same time gives the same genesets as one after another.
+        """
+        def summary(genesets):
+            return [(geneset['title'], sorted(
+                (gene, sorted(pubs)) for (gene, pubs) in
+                geneset['annotations'].iteritems()))
+                for geneset in genesets]
+
+        annot_types = ['GO', 'KEGG', 'DO']
+        type_args = ('test_files/test_human.ini', 'test_files/', None, None)
+        concurrent_sets = run_refinery.process_annotation_types_concurrently(
+            annot_types, type_args)
+
+        for annot_type in annot_types:
+            sequential_sets = run_refinery.process_annotation_type(
+                annot_type, *type_args)
+            self.assertTrue(sequential_sets)
+            self.assertEqual(summary(concurrent_sets[annot_type]),
+                             summary(sequential_sets))
+
+    def testLoadSharedOntologies(self):
+        """
+        Test that the GO ontologies of the species files are parsed once,
+        before the worker processes of a parallel run are started, and
+        are the ones that the species then use.
+        """
+        saved_ontologies = dict(process_go.SHARED_ONTOLOGIES)
+        process_go.SHARED_ONTOLOGIES.clear()
+        try:
+            run_refinery.load_shared_ontologies(
+                ['test_files/test_human.ini', 'test_files/test_human.ini'],
+                'test_files/')
+            self.assertEqual(len(process_go.SHARED_ONTOLOGIES), 1)
+            gene_ontology = process_go.SHARED_ONTOLOGIES.values()[0]
+            self.assertIs(process_go.get_shared_ontology(
+                'test_files/test_go_obo_file.obo'), gene_ontology)
+        finally:
+            process_go.SHARED_ONTOLOGIES.clear()
+            process_go.SHARED_ONTOLOGIES.update(saved_ontologies)
+
+    def testIncrementalRun(self):
+        """
+        Test that with an incremental_dir, the genesets of the annotation
+        types whose inputs have not changed are reused from the last run
+        instead of being processed again.
+        """
+        incremental_dir = tempfile.mkdtemp()
+        species_ini_file = os.path.join(incremental_dir, 'test_human.ini')
+        species_file = SafeConfigParser()
+        species_file.read('test_files/test_human.ini')
+        species_file.set('DO', 'DOWNLOAD', 'FALSE')
+        with open(species_ini_file, 'w') as species_fh:
+            species_file.write(species_fh)
+
+        processed_types = []
+        type_functions = dict(run_refinery.ANNOTATION_TYPE_FUNCTIONS)
+
+        def counted(annot_type):
+            def process(*args, **kwargs):
+                processed_types.append(annot_type)
+                return type_functions[annot_type](*args, **kwargs)
+            return process
+
+        try:
+            for annot_type in type_functions:
+                run_refinery.ANNOTATION_TYPE_FUNCTIONS[annot_type] = \
+                    counted(annot_type)
+
+            def run():
+                return run_refinery.process_all_organism_genesets(
+                    species_ini_file, 'test_files',
+                    incremental_dir=incremental_dir)
+
+            first_genesets = run()
+            self.assertEqual(sorted(processed_types), ['DO', 'GO', 'KEGG'])
+            self.assertTrue(first_genesets)
+
+            del processed_types[:]
+            self.assertEqual(run(), first_genesets)
+            self.assertEqual(processed_types, [])
+
+            species_file.set('GO', 'EVIDENCE_CODES', 'EXP, IDA')
+            with open(species_ini_file, 'w') as species_fh:
+                species_file.write(species_fh)
+            run()
+            self.assertEqual(processed_types, ['GO'])
+
+            manifest = incremental.read_manifest(incremental_dir,
+                                                 species_ini_file)
+            self.assertEqual(sorted(manifest), ['DO', 'GO', 'KEGG'])
+            self.assertIn('test_files/KEGG/test_pathway.csv',
+                          manifest['KEGG']['fingerprint']['inputs'])
+        finally:
+            run_refinery.ANNOTATION_TYPE_FUNCTIONS.update(type_functions)
+            shutil.rmtree(incremental_dir)
+
+    def testLazyGenesets(self):
+        """
+        Test that with lazy, the genesets of a species are only processed
+        (and saved for incremental runs) as they are generated, and are the
+        same as without it.
+        """
+        incremental_dir = tempfile.mkdtemp()
+        species_ini_file = os.path.join(incremental_dir, 'test_human.ini')
+        species_file = SafeConfigParser()
+        species_file.read('test_files/test_human.ini')
+        species_file.set('DO', 'DOWNLOAD', 'FALSE')
+        with open(species_ini_file, 'w') as species_fh:
+            species_file.write(species_fh)
+
+        processed_types = []
+        type_functions = dict(run_refinery.ANNOTATION_TYPE_FUNCTIONS)
+
+        def counted(annot_type):
+            def process(*args, **kwargs):
+                processed_types.append(annot_type)
+                return type_functions[annot_type](*args, **kwargs)
+            return process
+
+        try:
+            for annot_type in type_functions:
+                run_refinery.ANNOTATION_TYPE_FUNCTIONS[annot_type] = \
+                    counted(annot_type)
+
+            def run(lazy):
+                return run_refinery.process_all_organism_genesets(
+                    species_ini_file, 'test_files',
+                    incremental_dir=incremental_dir, lazy=lazy)
+
+            all_genesets = run(False)
+            del processed_types[:]
+            shutil.rmtree(incremental_dir)
+            os.mkdir(incremental_dir)
+            with open(species_ini_file, 'w') as species_fh:
+                species_file.write(species_fh)
+
+            genesets = run(True)
+            self.assertEqual(processed_types, [])
+            first_geneset = next(genesets)
+            self.assertEqual(len(processed_types), 1)
+            self.assertEqual(incremental.read_manifest(incremental_dir,
+                                                       species_ini_file), {})
+            self.assertEqual([first_geneset] + list(genesets), all_genesets)
+            self.assertEqual(len(processed_types), 3)
+
+            # The saved genesets are read back one at a time, unless their
+            # file is not the one that was saved
+            del processed_types[:]
+            self.assertEqual(list(run(True)), all_genesets)
+            self.assertEqual(processed_types, [])
+
+            genesets_file = incremental.get_genesets_file(
+                incremental_dir, species_ini_file, 'KEGG')
+            with open(genesets_file, 'rb') as genesets_fh:
+                genesets_data = genesets_fh.read()
+            with open(genesets_file, 'wb') as genesets_fh:
+                genesets_fh.write(genesets_data[:len(genesets_data) // 2])
+            self.assertEqual(list(run(True)), all_genesets)
+            self.assertEqual(processed_types, ['KEGG'])
+        finally:
+            run_refinery.ANNOTATION_TYPE_FUNCTIONS.update(type_functions)
+            shutil.rmtree(incremental_dir)
+
+    def testDeltaOutput(self):
+        """
+        Test that with OUTPUT_MODE: delta, main() only outputs the gene sets
+        that are new or have changed since the last run, and lists the ones
+        that were removed.
+        """
+        output_dir = tempfile.mkdtemp()
+        species_ini_file = os.path.join(output_dir, 'test_human.ini')
+        species_file = SafeConfigParser()
+        species_file.read('test_files/test_human.ini')
+        species_file.set('DO', 'DOWNLOAD', 'FALSE')
+        species_file.remove_section('KEGG')
+        with open(species_ini_file, 'w') as species_fh:
+            species_file.write(species_fh)
+
+        json_file = os.path.join(output_dir, 'genesets.json')
+        main_config_file = os.path.join(output_dir, 'main_config.ini')
+        main_config = SafeConfigParser()
+        main_config.add_section('main')
+        main_config.set('main', 'PROCESS_TO', 'JSON file')
+        main_config.set('main', 'JSON_FILE', json_file)
+        main_config.set('main', 'OUTPUT_MODE', 'delta')
+        main_config.set('main', 'GENESET_HASHES_DIR',
+                        os.path.join(output_dir, 'hashes'))
+        main_config.add_section('download_folder')
+        main_config.set('download_folder', 'BASE_DOWNLOAD_FOLDER',
+                        'test_files')
+        main_config.add_section('species files')
+        main_config.set('species files', 'SPECIES_DIR', output_dir)
+        main_config.set('species files', 'SPECIES_FILES', 'test_human.ini')
+        with open(main_config_file, 'w') as main_config_fh:
+            main_config.write(main_config_fh)
+
+        def run():
+            run_refinery.main(main_config_file)
+            with open(json_file) as json_fh:
+                return json.load(json_fh)
+
+        try:
+            delta = run()
+            self.assertTrue(delta['new'])
+            self.assertEqual((delta['changed'], delta['removed']), ([], []))
+            first_slugs = set(geneset['slug'] for geneset in delta['new'])
+
+            self.assertEqual(run(), {'new': [], 'changed': [],
+                                     'removed': []})
+
+            species_file.set('GO', 'EVIDENCE_CODES', 'IEP')
+            with open(species_ini_file, 'w') as species_fh:
+                species_file.write(species_fh)
+            delta = run()
+            self.assertEqual(delta['new'], [])
+            self.assertTrue(delta['changed'] or delta['removed'])
+            for geneset in delta['changed']:
+                self.assertIn(geneset['slug'], first_slugs)
+            for slug in delta['removed']:
+                self.assertIn(slug, first_slugs)
+            self.assertTrue(set(delta['removed']).isdisjoint(
+                geneset['slug'] for geneset in delta['changed']))
+        finally:
+            shutil.rmtree(output_dir)
+
+    def testDeltaTribeOutput(self):
+        """
+        Test that OUTPUT_MODE: delta is refused with PROCESS_TO: Tribe
+        unless changed gene sets are saved as new versions, with
+        PREFER_UPDATE.
+        """
+        output_dir = tempfile.mkdtemp()
+        secrets_file = os.path.join(output_dir, 'secrets.ini')
+        with open(secrets_file, 'w') as secrets_fh:
+            secrets_fh.write('[Tribe secrets]\nTRIBE_ID: id\n'
+                             'TRIBE_SECRET: secret\nUSERNAME: creator\n'
+                             'PASSWORD: password\n')
+
+        main_config_file = os.path.join(output_dir, 'main_config.ini')
+        main_config = SafeConfigParser()
+        main_config.add_section('main')
+        main_config.set('main', 'PROCESS_TO', 'Tribe')
+        main_config.set('main', 'SECRETS_FILE', secrets_file)
+        main_config.set('main', 'OUTPUT_MODE', 'delta')
+        main_config.set('main', 'GENESET_HASHES_DIR',
+                        os.path.join(output_dir, 'hashes'))
+        main_config.add_section('Tribe parameters')
+        main_config.set('Tribe parameters', 'TRIBE_URL',
+                        'http://127.0.0.1:9')
+        main_config.add_section('download_folder')
+        main_config.set('download_folder', 'BASE_DOWNLOAD_FOLDER',
+                        'test_files')
+        main_config.add_section('species files')
+        main_config.set('species files', 'SPECIES_DIR', output_dir)
+        main_config.set('species files', 'SPECIES_FILES', 'test_human.ini')
+        with open(main_config_file, 'w') as main_config_fh:
+            main_config.write(main_config_fh)
+
+        try:
+            with self.assertRaises(SystemExit):
+                run_refinery.main(main_config_file)
+        finally:
+            shutil.rmtree(output_dir)
+
+    def testJSONOutput(self):
+        """
+        Test that main() writes the gene sets of every species to one JSON
+        file, or with a JSON_DIR, to a file of each species.
+        """
+        output_dir = tempfile.mkdtemp()
+        species_file = SafeConfigParser()
+        species_file.read('test_files/test_human.ini')
+        species_file.set('DO', 'DOWNLOAD', 'FALSE')
+        for species_ini_file in ('human1.ini', 'human2.ini'):
+            with open(os.path.join(output_dir, species_ini_file),
+                      'w') as species_fh:
+                species_file.write(species_fh)
+
+        main_config_file = os.path.join(output_dir, 'main_config.ini')
+        main_config = SafeConfigParser()
+        main_config.add_section('main')
+        main_config.set('main', 'PROCESS_TO', 'JSON file')
+        main_config.add_section('download_folder')
+        main_config.set('download_folder', 'BASE_DOWNLOAD_FOLDER',
+                        'test_files')
+        main_config.add_section('species files')
+        main_config.set('species files', 'SPECIES_DIR', output_dir)
+        main_config.set('species files', 'SPECIES_FILES',
+                        'human1.ini, human2.ini')
+
+        def run(**options):
+            for (option, value) in options.iteritems():
+                main_config.set('main', option, value)
+            with open(main_config_file, 'w') as main_config_fh:
+                main_config.write(main_config_fh)
+            run_refinery.main(main_config_file)
+
+        try:
+            json_file = os.path.join(output_dir, 'genesets.json')
+            run(JSON_FILE=json_file)
+            with open(json_file) as json_fh:
+                genesets = json.load(json_fh)
+            species_genesets = run_refinery.process_all_organism_genesets(
+                os.path.join(output_dir, 'human1.ini'), 'test_files')
+            self.assertTrue(species_genesets)
+            self.assertEqual(len(genesets), 2 * len(species_genesets))
+
+            json_dir = os.path.join(output_dir, 'json')
+            run(JSON_DIR=json_dir, JSON_FORMAT='ndjson', JSON_GZIP='TRUE',
+                JSON_COMPACT='TRUE')
+            self.assertEqual(sorted(os.listdir(json_dir)),
+                             ['human1.ini.ndjson.gz', 'human2.ini.ndjson.gz'])
+            with gzip.open(os.path.join(json_dir,
+                                        'human2.ini.ndjson.gz')) as json_fh:
+                lines = json_fh.read().splitlines()
+            self.assertEqual([json.loads(line) for line in lines],
+                             genesets[len(species_genesets):])
+            self.assertNotIn('": ', lines[0])
+        finally:
+            shutil.rmtree(output_dir)
+
+    def testFileLock(self):
+        """
+        Test that file_lock() excludes other processes until released.
+        """
+        lock_dir = tempfile.mkdtemp()
+        lock_file = os.path.join(lock_dir, 'shared_file.lock')
+        try:
+            with utils.file_lock(lock_file):
+                pid = os.fork()
+                if pid == 0:
+                    # The child only gets the lock once the parent is done
+                    with utils.file_lock(lock_file):
+                        with open(lock_file + '.order', 'a') as order_fh:
+                            order_fh.write('child\n')
+                    os._exit(0)
+                with open(lock_file + '.order', 'a') as order_fh:
+                    order_fh.write('parent\n')
+            os.waitpid(pid, 0)
+            with open(lock_file + '.order') as order_fh:
+                self.assertEqual(order_fh.read(), 'parent\nchild\n')
+        finally:
+            shutil.rmtree(lock_dir)
+
+
+class GenesetHashesTest(unittest.TestCase):
+    """
+    Tests for functions in geneset_hashes.py file
+    """
+
+    def setUp(self):
+        self.geneset = {
+            'title': 'DO-374:nutrition disease',
+            'abstract': 'An acquired metabolic disease.',
+            'organism': 'Homo sapiens',
+            'slug': 'doid374-homo-sapiens',
+            'xrdb': 'Entrez',
+            'tags': ['epsilon', 'zeta'],
+            'annotations': {4160: [21294126, 15603738], 8431: []}
+        }
+
+    def testCanonicalContentHash(self):
+        """
+        Test that the content hash of a gene set does not depend on the
+        order of its genes, publications and tags, or on the types of its
+        gene and publication identifiers, but does on its contents.
+        """
+        content_hash = geneset_hashes.get_content_hash(self.geneset)
+
+        reordered = dict(self.geneset)
+        reordered['tags'] = ['zeta', 'epsilon']
+        reordered['annotations'] = {u'8431': [None],
+                                    '4160': [15603738, 21294126, 15603738]}
+        reordered['public'] = True
+        self.assertEqual(geneset_hashes.get_content_hash(reordered),
+                         content_hash)
+
+        for (key, value) in (('title', 'DO-374:disease'),
+                             ('abstract', ''),
+                             ('tags', ['epsilon']),
+                             ('annotations', {4160: [21294126], 8431: []}),
+                             ('annotations', {4160: [21294126, 15603738]})):
+            changed = dict(self.geneset)
+            changed[key] = value
+            self.assertNotEqual(geneset_hashes.get_content_hash(changed),
+                                content_hash)
+
+    def testDelta(self):
+        """
+        Test that get_delta() tells new, changed and removed gene sets
+        apart, and that hashes are saved and read back.
+        """
+        unchanged = dict(self.geneset, slug='unchanged')
+        changed = dict(self.geneset, slug='changed')
+        new = dict(self.geneset, slug='new')
+        for geneset in (unchanged, changed, new):
+            geneset_hashes.add_content_hash(geneset)
+
+        hashes_dir = tempfile.mkdtemp()
+        try:
+            geneset_hashes.write_hashes(
+                hashes_dir, 'test_human.ini',
+                {'unchanged': unchanged['content_hash'],
+                 'changed': 'outdated hash', 'removed': 'any hash'})
+            previous_hashes = geneset_hashes.read_hashes(
+                hashes_dir, 'test_human.ini')
+        finally:
+            shutil.rmtree(hashes_dir)
+
+        self.assertEqual(geneset_hashes.read_hashes(hashes_dir,
+                                                    'test_human.ini'), {})
+        self.assertEqual(
+            geneset_hashes.get_delta([unchanged, changed, new],
+                                     previous_hashes),
+            ([new], [changed], ['removed']))
+
+
+class JSONOutputTest(unittest.TestCase):
+    """
+    Tests for writing gene sets to JSON files with json_output.GenesetWriter
+    """
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.json_file = os.path.join(self.output_dir, 'genesets.json')
+        self.genesets = [
+            {'title': 'GO-BP-%07d:term' % number, 'tags': ['tag'],
+             'slug': 'go%07d-homo-sapiens' % number,
+             'annotations': {number: [], 1000 + number: [20, 30]}}
+            for number in range(3)]
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def read(self):
+        with open(self.json_file) as json_fh:
+            return json_fh.read()
+
+    def testSameAsJSONDump(self):
+        """
+        Test that a list of gene sets is written the same as with
+        json.dump(), with or without indentation.
+        """
+        for (compact, dump_options) in (
+                (False, {'indent': 2}),
+                (True, {'separators': (',', ':')})):
+            for genesets in (self.genesets, []):
+                writer = json_output.GenesetWriter(self.json_file,
+                                                   compact=compact)
+                writer.write_genesets(iter(genesets))
+                writer.close()
+                self.assertEqual(self.read(),
+                                 json.dumps(genesets, **dump_options))
+
+    def testDelta(self):
+        """
+        Test that in the delta output mode, the new and changed gene sets and
+        removed slugs are written to their own lists, in any order, or on
+        lines of their own.
+        """
+        for compact in (False, True):
+            writer = json_output.GenesetWriter(self.json_file, delta=True,
+                                               compact=compact)
+            writer.write(self.genesets[0], 'changed')
+            writer.write_removed('removed-slug')
+            writer.write_genesets(self.genesets[1:])
+            writer.close()
+            self.assertEqual(json.loads(self.read()), {
+                'new': json.loads(json.dumps(self.genesets[1:])),
+                'changed': json.loads(json.dumps(self.genesets[:1])),
+                'removed': ['removed-slug']})
+
+        writer = json_output.GenesetWriter(self.json_file, delta=True)
+        writer.close()
+        self.assertEqual(json.loads(self.read()),
+                         {'new': [], 'changed': [], 'removed': []})
+
+        self.json_file += '.gz'
+        writer = json_output.GenesetWriter(self.json_file, 'ndjson',
+                                           delta=True, compress=True)
+        writer.write(self.genesets[0], 'changed')
+        writer.write_removed('removed-slug')
+        writer.close()
+        with gzip.open(self.json_file) as json_fh:
+            self.assertEqual(
+                [json.loads(line) for line in json_fh], [
+                    {'status': 'changed',
+                     'geneset': json.loads(json.dumps(self.genesets[0]))},
+                    {'status': 'removed', 'slug': 'removed-slug'}])
+
+
+class ColumnarOutputTest(unittest.TestCase):
+    """
+    Tests for writing the tables of gene sets and annotations of a species
+    with columnar_output.write_columnar_tables()
+    """
+
+    def setUp(self):
+        self.columnar_dir = os.path.join(tempfile.mkdtemp(), 'columnar')
+        self.genesets = [
+            {'title': u'DO-374:nutrition disease \u2013 human', 'tags': [],
+             'abstract': 'A disease.', 'organism': 'Homo sapiens',
+             'xrdb': 'Entrez', 'slug': 'doid374-homo-sapiens',
+             'annotations': {4160: [], 5443: []}},
+            {'title': 'GO-BP-0000006:la liga', 'tags': ['b', 'a'],
+             'abstract': 'A term.', 'organism': 'Homo sapiens',
+             'xrdb': 'UniProtKB', 'slug': 'go0000006-homo-sapiens',
+             # The empty PubMed ID of a malformed GAF reference is left out
+             'annotations': {'A0A024R214': [123, '', 456],
+                             'A0A024QZP7': ['123']}}]
+        self.annotations = set([
+            ('doid374-homo-sapiens', '4160', None),
+            ('doid374-homo-sapiens', '5443', None),
+            ('go0000006-homo-sapiens', 'A0A024R214', 123),
+            ('go0000006-homo-sapiens', 'A0A024R214', 456),
+            ('go0000006-homo-sapiens', 'A0A024QZP7', 123)])
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.columnar_dir))
+
+    def testNpyTables(self):
+        """
+        Test that the npy tables have dictionary-encoded columns from which
+        the gene sets and their annotations can be read back.
+        """
+        import numpy
+
+        for _ in range(2):
+            self.assertEqual(columnar_output.write_columnar_tables(
+                self.columnar_dir, 'species/human.ini', self.genesets,
+                'npy'), 'npy')
+        self.assertEqual(sorted(os.listdir(self.columnar_dir)),
+                         ['human.ini.annotations', 'human.ini.genesets'])
+
+        genesets = columnar_output.read_npy_table(
+            os.path.join(self.columnar_dir, 'human.ini.genesets'))
+        titles = [genesets['title.dictionary'][index].decode('utf-8')
+                  for index in genesets['title.indices']]
+        self.assertEqual(titles, [geneset['title']
+                                  for geneset in self.genesets])
+        tags = genesets['tags.indices']
+        offsets = genesets['tags.offsets']
+        self.assertEqual([list(genesets['tags.dictionary'][
+            tags[offsets[row]:offsets[row + 1]]]) for row in range(2)],
+            [[], ['b', 'a']])
+
+        annotations = columnar_output.read_npy_table(
+            os.path.join(self.columnar_dir, 'human.ini.annotations'))
+        self.assertIsInstance(annotations['gene.indices'], numpy.memmap)
+        self.assertEqual(len(annotations['gene.dictionary']), 4)
+        self.assertEqual(set(zip(
+            annotations['slug.dictionary'][annotations['slug.indices']],
+            annotations['gene.dictionary'][annotations['gene.indices']],
+            [pmid or None for pmid in annotations['pmid']])),
+            self.annotations)
+
+    def testParquetTables(self):
+        """
+        Test that Parquet tables are written with pyarrow, or npy tables if
+        pyarrow is not installed.
+        """
+        columnar_format = columnar_output.write_columnar_tables(
+            self.columnar_dir, 'human.ini', self.genesets)
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            self.assertEqual(columnar_format, 'npy')
+            self.assertTrue(os.path.isdir(os.path.join(
+                self.columnar_dir, 'human.ini.annotations')))
+            return
+
+        self.assertEqual(columnar_format, 'parquet')
+        annotations = pyarrow.parquet.read_table(
+            os.path.join(self.columnar_dir, 'human.ini.annotations.parquet'),
+            memory_map=True).to_pydict()
+        self.assertEqual(set(zip(annotations['slug'], annotations['gene'],
+                                 annotations['pmid'])), self.annotations)
+        genesets = pyarrow.parquet.read_table(
+            os.path.join(self.columnar_dir, 'human.ini.genesets.parquet'),
+            columns=['slug', 'tags']).to_pydict()
+        self.assertEqual(genesets['tags'], [[], ['b', 'a']])
+
+
+class StandInTribeServer(ThreadingMixIn, HTTPServer):
+    """
+    Local stand-in for the parts of the Tribe API that gene sets are saved
+    with: OAuth2 tokens (which expire after token_expires_in seconds),
+    organisms, gene ID translation (every numeric gene ID is its own Entrez
+    ID), and the creation, lookup and listing (page_size gene sets at a
+    time, without the annotations of their tip versions unless
+    full_annotations is requested) of gene sets and versions. Every version
+    gets a new ver_hash. The annotations of the gene sets saved in it are
+    kept in genesets, by slug, the method and path of every request in
+    requests, and the data of every gene set and version POST request in
+    posted. Gene sets with a slug in failing_slugs cannot be created, and
+    the next failing_translations gene ID translation requests fail.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInTribeHandler)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.posted = []
+        self.genesets = {}
+        self.failing_slugs = set()
+        self.failing_translations = 0
+        self.tokens = 0
+        self.versions = 0
+        self.token_expires_in = 36000
+        self.page_size = 2
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+
+class StandInTribeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def send_json(self, status, data):
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def get_tip(self, geneset_uri, annotations):
+        self.server.versions += 1
+        return {'resource_uri': geneset_uri + '/version',
+                'ver_hash': '%040x' % self.server.versions,
+                'annotations': [
+                    {'gene': {'entrezid': int(gene)},
+                     'pubs': [{'pmid': pub} for pub in pubs]}
+                    for (gene, pubs) in annotations.iteritems()]}
+
+    def list_genesets(self, query):
+        params = parse_qs(query)
+        genesets = sorted(
+            (geneset for geneset in self.server.genesets.itervalues()
+             if geneset['title'].startswith(params['title__startswith'][0])),
+            key=lambda geneset: geneset['slug'])
+        offset = int(params.get('offset', ['0'])[0])
+        next_page = None
+        if offset + self.server.page_size < len(genesets):
+            params['offset'] = [str(offset + self.server.page_size)]
+            next_page = '/api/v1/geneset/?' + urlencode(params, doseq=True)
+        genesets = genesets[offset:offset + self.server.page_size]
+        if params.get('full_annotations') != ['true']:
+            genesets = [dict(geneset, tip=dict(
+                (key, value) for (key, value) in geneset['tip'].iteritems()
+                if key != 'annotations')) for geneset in genesets]
+        self.send_json(200, {'meta': {'next': next_page},
+                             'objects': genesets})
+
+    def do_GET(self):
+        (path, query) = urlsplit(self.path)[2:4]
+        with self.server.lock:
+            self.server.requests.append(('GET', path))
+            if path == '/api/v1/organism':
+                return self.send_json(200, {'objects': [
+                    {'resource_uri': '/api/v1/organism/9606'}]})
+            if path == '/api/v1/geneset/':
+                return self.list_genesets(query)
+
+            slug = path.rstrip('/').split('/')[-1]
+            if slug not in self.server.genesets:
+                return self.send_json(404, {})
+            self.send_json(200, self.server.genesets[slug])
+
+    def do_POST(self):
+        path = urlsplit(self.path).path
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        with self.server.lock:
+            self.server.requests.append(('POST', path))
+            if path == '/oauth2/token/':
+                self.server.tokens += 1
+                return self.send_json(200, {
+                    'access_token': 'token%d' % self.server.tokens,
+                    'expires_in': self.server.token_expires_in})
+            if path == '/api/v1/gene/xrid_translate':
+                if self.server.failing_translations:
+                    self.server.failing_translations -= 1
+                    return self.send_json(500, {})
+                return self.send_json(200, dict(
+                    (gene, [int(gene)]) for gene in
+                    parse_qs(body).get('gene_list', []) if gene.isdigit()))
+
+            data = json.loads(body)
+            self.server.posted.append(data)
+            if path == '/api/v1/geneset':
+                if data['slug'] in self.server.failing_slugs:
+                    return self.send_json(400, {})
+                geneset_uri = '/api/v1/geneset/' + data['slug']
+                self.server.genesets[data['slug']] = {
+                    'slug': data['slug'], 'title': data['title'],
+                    'resource_uri': geneset_uri,
+                    'organism': data['organism'],
+                    'tip': self.get_tip(geneset_uri, data['annotations'])}
+            else:
+                geneset_uri = data['geneset']
+                self.server.genesets[data['slug']]['tip'] = self.get_tip(
+                    geneset_uri, data['annotations'])
+            self.send_json(201, {'title': data['title'],
+                                 'resource_uri': geneset_uri,
+                                 'tip_item_count': len(data['annotations'])})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TribeUploadTest(unittest.TestCase):
+    """
+    Tests for saving many gene sets to Tribe with
+    tribe_loader.upload_genesets(), against a StandInTribeServer
+    """
+
+    def setUp(self):
+        self.server = StandInTribeServer()
+        self.server_thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={'poll_interval': 0.01})
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.genesets = [
+            {'title': 'KEGG-Pathway-hsa%05d' % number,
+             'abstract': '', 'organism': 'Homo sapiens', 'xrdb': 'Entrez',
+             'slug': 'homo-sapiens-hsa%05d' % number,
+             'annotations': dict((gene, [number]) for gene in
+                                 range(number, number + 3))}
+            for number in range(6)]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def upload(self, **kwargs):
+        del self.server.requests[:]
+        return tribe_loader.upload_genesets(
+            self.server.url, self.genesets, 'token', 'creator', **kwargs)
+
+    def testUploadGenesets(self):
+        """
+        Test that gene sets are created in Tribe, with the organism URI
+        requested once, and that the responses are in the same order as the
+        gene sets.
+        """
+        self.server.failing_slugs.add('homo-sapiens-hsa00004')
+        for geneset in self.genesets:
+            geneset_hashes.add_content_hash(geneset)
+        responses = self.upload(max_uploads=3)
+
+        self.assertEqual([response['title'] if isinstance(response, dict)
+                          else response.status_code
+                          for response in responses],
+                         ['KEGG-Pathway-hsa00000', 'KEGG-Pathway-hsa00001',
+                          'KEGG-Pathway-hsa00002', 'KEGG-Pathway-hsa00003',
+                          400, 'KEGG-Pathway-hsa00005'])
+        self.assertEqual([tribe_loader.was_saved(response)
+                          for response in responses],
+                         [True, True, True, True, False, True])
+        self.assertEqual(self.server.requests.count(
+            ('GET', '/api/v1/organism')), 1)
+        self.assertEqual(self.server.requests.count(
+            ('POST', '/api/v1/geneset')), 6)
+        self.assertEqual(
+            self.server.genesets['homo-sapiens-hsa00000']['organism'],
+            '/api/v1/organism/9606')
+        self.assertEqual(self.genesets[0]['organism'], 'Homo sapiens')
+        self.assertEqual(len(self.server.posted), 6)
+        for data in self.server.posted:
+            self.assertNotIn(geneset_hashes.CONTENT_HASH_KEY, data)
+
+    def testUploadChangedGenesets(self):
+        """
+        Test that with prefer_update, only the gene sets whose annotations
+        have changed get new versions, and that the genes of all the gene
+        sets are translated in batches.
+        """
+        self.upload()
+        self.genesets[2]['annotations'][100] = []
+        for geneset in self.genesets:
+            geneset_hashes.add_content_hash(geneset)
+
+        responses = self.upload(prefer_update=True, max_uploads=4,
+                                translate_batch_size=5)
+
+        genes = set()
+        for geneset in self.genesets:
+            genes.update(geneset['annotations'])
+        self.assertEqual(self.server.requests.count(
+            ('POST', '/api/v1/gene/xrid_translate')), (len(genes) + 4) // 5)
+        self.assertEqual(self.server.requests.count(
+            ('POST', '/api/v1/version')), 1)
+        self.assertNotIn(geneset_hashes.CONTENT_HASH_KEY,
+                         self.server.posted[-1])
+        self.assertEqual(self.server.requests.count(
+            ('POST', '/api/v1/geneset')), 0)
+        self.assertEqual([response['status_code'] for response in responses
+                          if 'status_code' in response], [409] * 5)
+        self.assertEqual(responses[2]['tip_item_count'], 4)
+        self.assertTrue(all(tribe_loader.was_saved(response)
+                            for response in responses))
+
+    def testUploadWithFailedTranslation(self):
+        """
+        Test that when the genes of all the gene sets cannot be translated
+        together, new gene sets are still created, and the genes of the
+        existing ones are translated one gene set at a time.
+        """
+        self.upload()
+        self.genesets[2]['annotations'][100] = []
+        self.genesets.append(
+            {'title': 'KEGG-Pathway-hsa00006', 'abstract': '',
+             'organism': 'Homo sapiens', 'xrdb': 'Entrez',
+             'slug': 'homo-sapiens-hsa00006', 'annotations': {6: [6]}})
+        self.server.failing_translations = 1
+
+        responses = self.upload(prefer_update=True, max_uploads=1)
+
+        self.assertTrue(all(tribe_loader.was_saved(response)
+                            for response in responses))
+        self.assertEqual(self.server.requests.count(
+            ('POST', '/api/v1/gene/xrid_translate')), 1 + 6)
+        self.assertEqual(self.server.requests.count(
+            ('POST', '/api/v1/geneset')), 1)
+        self.assertEqual(self.server.requests.count(
+            ('POST', '/api/v1/version')), 1)
+        self.assertEqual(responses[2]['tip_item_count'], 4)
+
+
+class TribeClientTest(unittest.TestCase):
+    """
+    Tests for tribe_loader.TribeClient, against a StandInTribeServer
+    """
+
+    def setUp(self):
+        self.server = StandInTribeServer()
+        self.server_thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={'poll_interval': 0.01})
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+        self.temp_dir = tempfile.mkdtemp()
+        self.secrets_file = os.path.join(self.temp_dir, 'secrets.ini')
+        with open(self.secrets_file, 'w') as secrets_fh:
+            secrets_fh.write('[Tribe secrets]\nTRIBE_ID: id\n'
+                             'TRIBE_SECRET: secret\nUSERNAME: creator\n'
+                             'PASSWORD: password\n')
+        self.genesets = [
+            {'title': '%s-%d' % (annot_type, number), 'abstract': '',
+             'organism': 'Homo sapiens', 'xrdb': 'Entrez',
+             'slug': '%s%d-homo-sapiens' % (annot_type.lower(), number),
+             'annotations': dict((gene, []) for gene in
+                                 range(number, number + 3))}
+            for annot_type in ('GO', 'KEGG') for number in range(3)]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.temp_dir)
+
+    def get_client(self, tribe_options='', main_options=''):
+        main_config_file = os.path.join(self.temp_dir, 'main_config.ini')
+        with open(main_config_file, 'w') as main_config_fh:
+            main_config_fh.write('[main]\nSECRETS_FILE: %s\n%s\n'
+                                 '[Tribe parameters]\nTRIBE_URL: %s\n%s' % (
+                                     self.secrets_file, main_options,
+                                     self.server.url, tribe_options))
+        client = TribeClient(main_config_file)
+        self.addCleanup(client.close)
+        return client
+
+    def testConfiguration(self):
+        """
+        Test that the Tribe settings and secrets are read when the client
+        is created, and that bad ones stop the run.
+        """
+        client = self.get_client('PREFER_UPDATE: TRUE\nMAX_UPLOADS: 2\n')
+        self.assertEqual(client.tribe_url, self.server.url)
+        self.assertTrue(client.prefer_update)
+        self.assertFalse(client.public)
+        self.assertEqual(client.max_uploads, 2)
+        self.assertEqual(client.creator_username, 'creator')
+        self.assertEqual(self.server.requests, [])
+
+        with self.assertRaises(SystemExit):
+            self.get_client('MAX_UPLOADS: 0\n')
+
+    def testTokenRefreshedOnExpiry(self):
+        """
+        Test that the access token is only requested again once it is
+        about to expire.
+        """
+        client = self.get_client()
+        self.assertEqual(client.get_access_token(), 'token1')
+        self.assertEqual(client.get_access_token(), 'token1')
+
+        self.server.token_expires_in = tribe_loader.TOKEN_EXPIRY_MARGIN
+        client.token_expiry = 0
+        self.assertEqual(client.get_access_token(), 'token2')
+        self.assertEqual(client.get_access_token(), 'token3')
+        self.assertEqual(self.server.requests.count(
+            ('POST', '/oauth2/token/')), 3)
+
+    def testChangedGenesets(self):
+        """
+        Test that gene sets saved with one client are compared with the
+        ones in Tribe, page after page, with the same token and organism
+        URI.
+        """
+        client = self.get_client()
+        for geneset in self.genesets[:4]:
+            client.load_to_tribe(geneset)
+        self.genesets[0]['annotations'][100] = []
+
+        changed_genesets = client.get_all_changed_genesets(
+            'test_files/test_human.ini', self.genesets)
+        self.assertEqual(sorted(geneset['slug']
+                                for geneset in changed_genesets),
+                         ['go0-homo-sapiens', 'kegg1-homo-sapiens',
+                          'kegg2-homo-sapiens'])
+
+        responses = client.upload_genesets(changed_genesets,
+                                           prefer_update=True)
+        self.assertTrue(all(tribe_loader.was_saved(response)
+                            for response in responses))
+        self.assertEqual(client.get_all_changed_genesets(
+            'test_files/test_human.ini', self.genesets), [])
+
+        self.assertEqual(self.server.requests.count(
+            ('POST', '/oauth2/token/')), 1)
+        self.assertEqual(self.server.requests.count(
+            ('GET', '/api/v1/organism')), 1)
+        # Two pages of GO sets, one and then two of KEGG sets, and one of
+        # (no) DO sets each time
+        self.assertEqual(self.server.requests.count(
+            ('GET', '/api/v1/geneset/')), 9)
+
+    def testDigestChangeDetection(self):
+        """
+        Test that with CHANGE_DETECTION: digests, the full annotations of a
+        gene set in Tribe are only retrieved when its version or processed
+        annotations have changed since they were last compared.
+        """
+        with self.assertRaises(SystemExit):
+            self.get_client('CHANGE_DETECTION: digests\n')
+        client = self.get_client(
+            'CHANGE_DETECTION: digests\n', 'GENESET_HASHES_DIR: %s\n' %
+            os.path.join(self.temp_dir, 'hashes'))
+        for geneset in self.genesets[:4]:
+            client.load_to_tribe(geneset)
+        self.genesets[0]['annotations'][100] = []
+
+        def changed_slugs():
+            del self.server.requests[:]
+            return sorted(geneset['slug'] for geneset in
+                          client.get_all_changed_genesets(
+                              'test_files/test_human.ini', self.genesets))
+
+        def fetched_slugs():
+            return sorted(path.split('/')[-1] for (method, path) in
+                          self.server.requests
+                          if path.startswith('/api/v1/geneset/creator/'))
+
+        changed = ['go0-homo-sapiens', 'kegg1-homo-sapiens',
+                   'kegg2-homo-sapiens']
+        # The first time, all the gene sets in Tribe are compared, with
+        # their full annotations listed along with their versions
+        self.assertEqual(changed_slugs(), changed)
+        self.assertEqual(fetched_slugs(), [])
+        self.assertEqual(self.server.requests.count(
+            ('GET', '/api/v1/geneset/')), 8)
+
+        # Only the gene set that is still different is compared again
+        self.assertEqual(changed_slugs(), changed)
+        self.assertEqual(fetched_slugs(), ['go0-homo-sapiens'])
+
+        # The saved gene sets have new versions
+        client.upload_genesets([geneset for geneset in self.genesets
+                                if geneset['slug'] in changed],
+                               prefer_update=True)
+        self.assertEqual(changed_slugs(), [])
+        self.assertEqual(fetched_slugs(), changed)
+        self.assertEqual(changed_slugs(), [])
+        self.assertEqual(fetched_slugs(), [])
+
+        self.genesets[1]['annotations'][200] = []
+        self.assertEqual(changed_slugs(), ['go1-homo-sapiens'])
+        self.assertEqual(fetched_slugs(), ['go1-homo-sapiens'])
+
+
+    def testStreamedUploads(self):
+        """
+        Test that gene sets from a generator are compared and saved a batch
+        at a time, without taking all of them from the generator first.
+        """
+        client = self.get_client('PREFER_UPDATE: TRUE\n')
+        taken = []
+
+        def genesets():
+            for geneset in self.genesets:
+                taken.append(geneset['slug'])
+                yield geneset
+
+        self.addCleanup(setattr, tribe_loader, 'GENESETS_PER_UPLOAD',
+                        tribe_loader.GENESETS_PER_UPLOAD)
+        tribe_loader.GENESETS_PER_UPLOAD = 4
+        responses = client.iter_upload_responses(
+            client.iter_changed_genesets('test_files/test_human.ini',
+                                         genesets()))
+        (geneset, response) = next(responses)
+        self.assertEqual(geneset['slug'], 'go0-homo-sapiens')
+        self.assertEqual(len(taken), 4)
+        self.assertTrue(tribe_loader.was_saved(response))
+        self.assertEqual(len(list(responses)), 5)
+        self.assertEqual(len(taken), 6)
+        self.assertEqual(sorted(self.server.genesets),
+                         sorted(geneset['slug'] for geneset in self.genesets))
+        self.assertTrue(all(geneset['public'] is False
+                            for geneset in self.genesets))
+
+        self.assertEqual(client.get_all_changed_genesets(
+            'test_files/test_human.ini', iter(self.genesets)), [])
+
+
 class LoaderTest(unittest.TestCase):
     """
     Test case for functions that load output from processed files into
@@ -773,20 +2751,15 @@ class LoaderTest(unittest.TestCase):
         self.do_terms = process_do.process_do_terms(species_ini_file)
 
         self.main_config_file = 'test_files/test_main_config.ini'
-        mc_file_parser = SafeConfigParser()
-        mc_file_parser.read(self.main_config_file)
-        tribe_url = mc_file_parser.get('Tribe parameters', 'TRIBE_URL')
-        secrets_file = mc_file_parser.get('main', 'SECRETS_FILE')
-
-        self.tribe_token = get_oauth_token(tribe_url, secrets_file)
+        self.tribe_client = TribeClient(self.main_config_file)
 
     def tearDown(self):
         """"""
-        pass
+        self.tribe_client.close()
 
     def testLoadKEGGToTribe(self):
-        geneset_response = load_to_tribe(self.main_config_file,
-                                         self.kegg_sets[0], self.tribe_token)
+        geneset_response = self.tribe_client.load_to_tribe(
+            self.kegg_sets[0])
 
         self.assertEqual(
             geneset_response['title'], 'KEGG-Pathway-hsa00010: Glycolysis / '
@@ -794,16 +2767,16 @@ class LoaderTest(unittest.TestCase):
         self.assertEqual(geneset_response['tip_item_count'], 10)
 
     def testLoadGOToTribe(self):
-        geneset_response = load_to_tribe(self.main_config_file,
-                                         self.go_terms[0], self.tribe_token)
+        geneset_response = self.tribe_client.load_to_tribe(
+            self.go_terms[0])
 
         self.assertEqual(geneset_response['title'],
                          'GO-BP-0000006:la liga')
         self.assertEqual(geneset_response['tip_item_count'], 3)
 
     def testLoadDOToTribe(self):
-        geneset_response = load_to_tribe(self.main_config_file,
-                                         self.do_terms[0], self.tribe_token)
+        geneset_response = self.tribe_client.load_to_tribe(
+            self.do_terms[0])
 
         self.assertEqual(geneset_response['title'], 'DO-374:nutrition disease')
         self.assertEqual(geneset_response['tip_item_count'], 6)
@@ -822,9 +2795,8 @@ class LoaderTest(unittest.TestCase):
 
         selected_kegg_term = self.kegg_sets[1]
 
-        geneset_response = load_to_tribe(self.main_config_file,
-                                         selected_kegg_term, self.tribe_token,
-                                         prefer_update=True)
+        geneset_response = self.tribe_client.load_to_tribe(
+            selected_kegg_term, prefer_update=True)
 
         self.assertEqual(
             geneset_response['title'], 'KEGG-Pathway-hsa00020: Citrate cycle '
@@ -837,9 +2809,8 @@ class LoaderTest(unittest.TestCase):
             3418: [], 3419: [], 3420: [], 3421: [], 5432: []
         }
 
-        version_response = load_to_tribe(self.main_config_file,
-                                         selected_kegg_term, self.tribe_token,
-                                         prefer_update=True)
+        version_response = self.tribe_client.load_to_tribe(
+            selected_kegg_term, prefer_update=True)
 
         self.assertEqual(len(version_response['annotations']), 11)
 
@@ -850,9 +2821,8 @@ class LoaderTest(unittest.TestCase):
 
         selected_go_term = self.go_terms[1]
 
-        geneset_response = load_to_tribe(
-            self.main_config_file, selected_go_term, self.tribe_token,
-            prefer_update=True)
+        geneset_response = self.tribe_client.load_to_tribe(
+            selected_go_term, prefer_update=True)
 
         self.assertEqual(geneset_response['title'],
                          'GO-BP-0000007:european team')
@@ -862,9 +2832,8 @@ class LoaderTest(unittest.TestCase):
         selected_go_term['annotations'] = {
             'A0A024R214': [], 'A0A024QZP7': [], 'A0A024R216': []}
 
-        version_response = load_to_tribe(
-            self.main_config_file, selected_go_term, self.tribe_token,
-            prefer_update=True)
+        version_response = self.tribe_client.load_to_tribe(
+            selected_go_term, prefer_update=True)
 
         self.assertEqual(len(version_response['annotations']), 3)
 
@@ -875,9 +2844,8 @@ class LoaderTest(unittest.TestCase):
 
         selected_do_term = self.do_terms[1]
 
-        geneset_response = load_to_tribe(
-            self.main_config_file, selected_do_term, self.tribe_token,
-            prefer_update=True)
+        geneset_response = self.tribe_client.load_to_tribe(
+            selected_do_term, prefer_update=True)
 
         self.assertEqual(geneset_response['title'],
                          'DO-0014667:disease of metabolism')
@@ -887,9 +2855,8 @@ class LoaderTest(unittest.TestCase):
         selected_do_term['annotations'] = {
             4160: [], 8431: [], 51738: [], 5443: [], 6492: [], 4321: []}
 
-        version_response = load_to_tribe(
-            self.main_config_file, selected_do_term, self.tribe_token,
-            prefer_update=True)
+        version_response = self.tribe_client.load_to_tribe(
+            selected_do_term, prefer_update=True)
 
         self.assertEqual(len(version_response['annotations']), 6)
 
@@ -907,18 +2874,16 @@ class LoaderTest(unittest.TestCase):
 
         selected_go_term = self.go_terms[2]
 
-        geneset_response = load_to_tribe(
-            self.main_config_file, selected_go_term, self.tribe_token,
-            prefer_update=True)
+        geneset_response = self.tribe_client.load_to_tribe(
+            selected_go_term, prefer_update=True)
 
         self.assertEqual(geneset_response['title'],
                          'GO-BP-0000005:premier league')
         self.assertEqual(geneset_response['tip_item_count'], 1)
 
         # Do not change the annotations, just try to save to Tribe again
-        response = load_to_tribe(
-            self.main_config_file, selected_go_term, self.tribe_token,
-            prefer_update=True)
+        response = self.tribe_client.load_to_tribe(
+            selected_go_term, prefer_update=True)
 
         self.assertEqual(response['status_code'], 409)
         self.assertEqual(
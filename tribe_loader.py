@@ -1,8 +1,14 @@
 import sys
+import json
+import time
+import threading
 import requests
+from multiprocessing.pool import ThreadPool
 from ConfigParser import SafeConfigParser
 
-from utils import translate_gene_ids
+from utils import iter_batches, translate_gene_ids
+from geneset_hashes import (
+    CONTENT_HASH_KEY, get_annotations_digest, read_hashes, write_hashes)
 
 # Import and set logger
 import logging
@@ -13,8 +19,7 @@ logger.addHandler(logging.NullHandler())
 # installed in the same python environment where the functions are run from.
 try:
     from tribe_client.utils import (
-        obtain_token_using_credentials, create_remote_geneset,
-        create_remote_version, download_organism_public_genesets
+        obtain_token_using_credentials, download_organism_public_genesets
     )
 except ImportError:
     logger.error('The package "tribe-client" has not been installed in '
@@ -22,8 +27,47 @@ except ImportError:
                  ' proceed.')
     sys.exit(1)
 
+# Default number of gene sets that upload_genesets() saves to Tribe at the
+# same time
+MAX_UPLOADS = 4
 
-def get_oauth_token(tribe_url, secrets_location):
+# Number of gene IDs in each request to translate the genes of many gene
+# sets at once (see translate_genes_in_batches())
+TRANSLATE_BATCH_SIZE = 1000
+
+# Number of seconds before it expires that a TribeClient requests a new
+# access token
+TOKEN_EXPIRY_MARGIN = 60
+
+# Most gene sets that Tribe returns in a response
+GENESETS_PER_REQUEST = 1000
+
+# Number of gene sets of a stream that TribeClient.iter_upload_responses()
+# saves to Tribe together, whose genes are translated in the same requests
+GENESETS_PER_UPLOAD = 1000
+
+# Ways TribeClient.get_all_changed_genesets() tells which gene sets have
+# changed: by comparing the full annotations of every gene set in Tribe, or
+# by comparing the version hashes of the gene sets in Tribe with the ones
+# whose annotations were last found to be the same as the processed ones
+CHANGE_DETECTION_MODES = ('annotations', 'digests')
+
+# Suffix of the files in GENESET_HASHES_DIR with the Tribe versions of the
+# gene sets of each species, and the digests of their annotations
+TRIBE_VERSIONS_SUFFIX = '.tribe_versions.json'
+
+
+def read_tribe_secrets(secrets_location):
+    """
+    Read the TRIBE_ID, TRIBE_SECRET, USERNAME and PASSWORD in the
+    "Tribe secrets" section of the secrets file at secrets_location, which
+    are needed to request an OAuth2 token. Logs an error and exits if
+    any of them is missing.
+
+    Returns:
+    A dictionary with the 'tribe_id', 'tribe_secret', 'username' and
+    'password'.
+    """
     secrets_file = SafeConfigParser()
     secrets_file.read(secrets_location)
 
@@ -42,15 +86,18 @@ def get_oauth_token(tribe_url, secrets_location):
                      ' processed genesets to Tribe.')
         sys.exit(1)
 
-    tribe_id = secrets_file.get('Tribe secrets', 'TRIBE_ID')
-    tribe_secret = secrets_file.get('Tribe secrets', 'TRIBE_SECRET')
-    username = secrets_file.get('Tribe secrets', 'USERNAME')
-    password = secrets_file.get('Tribe secrets', 'PASSWORD')
+    return dict((secret, secrets_file.get('Tribe secrets', secret))
+                for secret in required_secrets)
+
+
+def get_oauth_token(tribe_url, secrets_location):
+    secrets = read_tribe_secrets(secrets_location)
 
     access_token_url = tribe_url + '/oauth2/token/'
     access_token = obtain_token_using_credentials(
-        username, password, tribe_id, tribe_secret, access_token_url)
-    return access_token, username
+        secrets['username'], secrets['password'], secrets['tribe_id'],
+        secrets['tribe_secret'], access_token_url)
+    return access_token, secrets['username']
 
 
 def load_to_tribe(main_config_file, geneset_info, access_token,
@@ -116,6 +163,160 @@ def load_to_tribe(main_config_file, geneset_info, access_token,
     or b) False (and logs an error), if the geneset_info did not contain a
     title or annotations.
 
+    """
+    mc_file = SafeConfigParser()
+    mc_file.read(main_config_file)
+
+    if not mc_file.has_section('Tribe parameters'):
+        logger.error('Main INI config file has no "Tribe parameters" section, '
+                     'which is needed to run the load_to_tribe function.')
+        sys.exit(1)
+
+    tribe_url = mc_file.get('Tribe parameters', 'TRIBE_URL')
+
+    return save_geneset(tribe_url, geneset_info, access_token,
+                        creator_username, prefer_update=prefer_update)
+
+
+def create_tribe_session(max_uploads=MAX_UPLOADS):
+    """
+    Return a requests.Session for the requests to the Tribe API, which
+    keeps up to max_uploads connections to Tribe open and reuses them.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=max_uploads)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_tribe_organism_uri(tribe_url, organism, session=None,
+                           organism_uris=None):
+    """
+    Return the resource URI of organism (a scientific name) in Tribe, like
+    tribe_client.utils.get_organism_uri(). If the optional dictionary
+    organism_uris is given, the URI is looked up there first, and saved in
+    it after it is requested.
+    """
+    if organism_uris is not None and organism in organism_uris:
+        return organism_uris[organism]
+
+    organism_request = (session or requests).get(
+        tribe_url + '/api/v1/organism',
+        params={'scientific_name': organism})
+    organism_uri = organism_request.json()['objects'][0]['resource_uri']
+
+    if organism_uris is not None:
+        organism_uris[organism] = organism_uri
+    return organism_uri
+
+
+def post_to_tribe(url, access_token, data, session=None):
+    """
+    Send data as JSON in a POST request to url, as
+    tribe_client.utils.create_remote_geneset() and create_remote_version()
+    do.
+
+    Returns:
+    The created resource (as a dictionary), or the response from Tribe if
+    it was not created.
+    """
+    headers = {'Authorization': 'OAuth ' + access_token,
+               'Content-Type': 'application/json'}
+    response = (session or requests).post(url, data=json.dumps(data),
+                                          headers=headers)
+
+    if response.status_code != 201:
+        return response
+    try:
+        return response.json()
+    except ValueError:
+        return response
+
+
+def create_geneset(tribe_url, access_token, geneset_info, session=None,
+                   organism_uris=None):
+    """
+    Create a geneset in Tribe, like
+    tribe_client.utils.create_remote_geneset(), but with the optional
+    requests.Session session and dictionary of organism URIs organism_uris
+    (see get_tribe_organism_uri()). geneset_info is left as it is, and the
+    'organism' of the geneset sent to Tribe is its resource URI, and its
+    content hash (see geneset_hashes.py) is not sent.
+    """
+    geneset_data = dict(geneset_info)
+    geneset_data.pop(CONTENT_HASH_KEY, None)
+    geneset_data['organism'] = get_tribe_organism_uri(
+        tribe_url, geneset_info['organism'], session, organism_uris)
+    return post_to_tribe(tribe_url + '/api/v1/geneset', access_token,
+                         geneset_data, session)
+
+
+def create_version(tribe_url, access_token, version_info, session=None):
+    """
+    Create a new version of an existing geneset in Tribe, like
+    tribe_client.utils.create_remote_version(), but with the optional
+    requests.Session session. The content hash of version_info (see
+    geneset_hashes.py) is not sent.
+    """
+    version_data = dict(version_info)
+    version_data.pop(CONTENT_HASH_KEY, None)
+    return post_to_tribe(tribe_url + '/api/v1/version', access_token,
+                         version_data, session)
+
+
+def translate_genes_in_batches(tribe_url, genes, from_id, to_id,
+                               session=None,
+                               batch_size=TRANSLATE_BATCH_SIZE):
+    """
+    Translate genes from the from_id to the to_id cross-reference gene
+    identifiers with Tribe, sending batch_size genes per request.
+
+    Returns:
+    gene_xrids -- A dictionary of gene (as a string, as Tribe returns
+    them) -> list of translated identifiers, or None (and logs an error) if
+    a request failed.
+    """
+    genes = list(genes)
+    gene_xrids = {}
+    for start in range(0, len(genes), batch_size):
+        gene_list = genes[start:start + batch_size]
+        translate_response = translate_gene_ids(tribe_url, gene_list,
+                                                from_id, to_id, session)
+        if translate_response.status_code != 200:
+            logger.error('Tribe request to translate %s gene IDs from %s to '
+                         '%s with Tribe url=%s failed with status code %s.',
+                         len(gene_list), from_id, to_id, tribe_url,
+                         translate_response.status_code)
+            return None
+        gene_xrids.update(translate_response.json())
+    return gene_xrids
+
+
+def save_geneset(tribe_url, geneset_info, access_token, creator_username,
+                 prefer_update=False, session=None, gene_entrezids=None,
+                 organism_uris=None):
+    """
+    Create a new geneset or version of a geneset in Tribe, as described in
+    load_to_tribe(), at tribe_url.
+
+    Arguments:
+    The same as load_to_tribe(), and:
+
+    session -- Optional. The requests.Session to send the requests with
+    (see create_tribe_session()).
+
+    gene_entrezids -- Optional. With prefer_update, a dictionary of gene
+    (as a string) -> list of Entrez IDs, with the genes of geneset_info (see
+    translate_genes_in_batches()). If this is not given, the genes are
+    translated with one request for this geneset.
+
+    organism_uris -- Optional. A dictionary of organism URIs (see
+    get_tribe_organism_uri()).
+
+    Returns:
+    The same as load_to_tribe().
     """
     if 'title' not in geneset_info:
         logger.error('Data for geneset must contain a "title" key and value'
@@ -128,16 +329,6 @@ def load_to_tribe(main_config_file, geneset_info, access_token,
                      'be a non-empty list of annotations.')
         return False
 
-    mc_file = SafeConfigParser()
-    mc_file.read(main_config_file)
-
-    if not mc_file.has_section('Tribe parameters'):
-        logger.error('Main INI config file has no "Tribe parameters" section, '
-                     'which is needed to run the load_to_tribe function.')
-        sys.exit(1)
-
-    tribe_url = mc_file.get('Tribe parameters', 'TRIBE_URL')
-
     if prefer_update:
 
         gs_url = tribe_url + '/api/v1/geneset/' + creator_username + '/' + \
@@ -147,7 +338,8 @@ def load_to_tribe(main_config_file, geneset_info, access_token,
                       'full_annotations': 'true', 'show_tip': 'true',
                       'xrid': 'Entrez'}
 
-        check_gs_request = requests.get(gs_url, params=parameters)
+        check_gs_request = (session or requests).get(gs_url,
+                                                     params=parameters)
 
         if check_gs_request.status_code == 200:
             gs_response = check_gs_request.json()
@@ -162,31 +354,32 @@ def load_to_tribe(main_config_file, geneset_info, access_token,
 
                 logger.info('Creating new version for geneset %s',
                             geneset_info['title'])
-                response = create_remote_version(access_token, geneset_info,
-                                                 tribe_url)
+                response = create_version(tribe_url, access_token,
+                                          geneset_info, session)
                 return response
 
             old_annotations = {}
             for annotation in annotations:
                 gene = annotation['gene']['entrezid']
-                old_annotations[gene] = set()
-                for pub in annotation['pubs']:
-                    old_annotations[gene].add(pub['pmid'])
-
-            gene_list = geneset_info['annotations'].keys()
-            translate_response = translate_gene_ids(tribe_url, gene_list,
-                                                    geneset_info['xrdb'],
-                                                    'Entrez')
-            if translate_response.status_code != 200:
-                logger.error(('Tribe request to translate gene IDs with Tribe '
-                              'url={0} gene_list={1} and from_id={2} failed.'
-                              'Previous annotations could not be retrieved, '
-                              'and new version of geneset with data {3} will '
-                              'not be created.').format(tribe_url, gene_list,
-                             geneset_info['xrdb'], geneset_info))
-                return False
-
-            gene_entrezids = translate_response.json()
+                old_annotations[gene] = [pub['pmid'] for pub in
+                                         annotation['pubs']]
+
+            if gene_entrezids is None:
+                gene_list = geneset_info['annotations'].keys()
+                translate_response = translate_gene_ids(
+                    tribe_url, gene_list, geneset_info['xrdb'], 'Entrez',
+                    session)
+                if translate_response.status_code != 200:
+                    logger.error(('Tribe request to translate gene IDs with '
+                                  'Tribe url={0} gene_list={1} and from_id={2}'
+                                  ' failed. Previous annotations could not be '
+                                  'retrieved, and new version of geneset with '
+                                  'data {3} will not be created.').format(
+                                      tribe_url, gene_list,
+                                      geneset_info['xrdb'], geneset_info))
+                    return False
+
+                gene_entrezids = translate_response.json()
 
             pub_set_annotations = {}
             for gene, publist in geneset_info['annotations'].iteritems():
@@ -197,13 +390,14 @@ def load_to_tribe(main_config_file, geneset_info, access_token,
                         logger.warning('There was more than one Entrez ID '
                                        'found for gene %s', gene)
                     gene = gene_entrezids[gene][0]
-                    pub_set_annotations[gene] = set(publist)
+                    pub_set_annotations[gene] = publist
                 else:
                     logger.warning('No Entrez IDs were found for gene %s '
                                    'and cross-reference DB %s.',
                                    gene, geneset_info['xrdb'])
 
-            if pub_set_annotations != old_annotations:
+            if get_annotations_digest(pub_set_annotations) != \
+                    get_annotations_digest(old_annotations):
                 # Annotations have changed
                 geneset_info['geneset'] = gs_response['resource_uri']
                 geneset_info['parent'] = gs_response['tip']['resource_uri']
@@ -211,8 +405,8 @@ def load_to_tribe(main_config_file, geneset_info, access_token,
 
                 logger.info('Creating new version for geneset %s',
                             geneset_info['title'])
-                response = create_remote_version(access_token, geneset_info,
-                                                 tribe_url)
+                response = create_version(tribe_url, access_token,
+                                          geneset_info, session)
             else:
                 # Do not create a new version or geneset
                 logger.info('Geneset with title %s already exists with the '
@@ -230,22 +424,149 @@ def load_to_tribe(main_config_file, geneset_info, access_token,
             # No geneset with this geneset 'slug' and creator username exists
             # yet, so create it
             logger.info('Creating geneset %s', geneset_info['title'])
-            response = create_remote_geneset(access_token, geneset_info,
-                                             tribe_url)
+            response = create_geneset(tribe_url, access_token, geneset_info,
+                                      session, organism_uris)
 
     else:
         logger.info('Creating geneset %s', geneset_info['title'])
-        response = create_remote_geneset(access_token, geneset_info,
-                                         tribe_url)
+        response = create_geneset(tribe_url, access_token, geneset_info,
+                                  session, organism_uris)
     return response
 
 
+def upload_genesets(tribe_url, genesets, access_token, creator_username,
+                    prefer_update=False, max_uploads=MAX_UPLOADS,
+                    translate_batch_size=TRANSLATE_BATCH_SIZE, session=None,
+                    organism_uris=None):
+    """
+    Save many genesets to Tribe, as load_to_tribe() does for each of them,
+    but with the requests of all of them sent over the pooled connections
+    of one requests.Session, up to max_uploads genesets at the same time.
+    The organism URIs of the genesets are requested once, and with
+    prefer_update, the genes of all the genesets with the same 'xrdb' are
+    translated to Entrez IDs together, translate_batch_size genes per
+    request, instead of once per geneset. If that fails, the genes of each
+    geneset that already exists in Tribe are translated on their own, as
+    save_geneset() does.
+
+    Arguments:
+    tribe_url -- A string, the URL of the Tribe instance.
+
+    genesets -- A list of geneset_info dictionaries (see load_to_tribe()).
+
+    access_token, creator_username and prefer_update -- The same as in
+    load_to_tribe().
+
+    max_uploads -- Optional. Maximum number of genesets saved at the same
+    time.
+
+    translate_batch_size -- Optional. Number of genes in each translation
+    request.
+
+    session -- Optional. The requests.Session to send the requests with,
+    which is left open. If this is not given, a new one is created (see
+    create_tribe_session()) and closed once the genesets are saved.
+
+    organism_uris -- Optional. A dictionary of organism URIs (see
+    get_tribe_organism_uri()).
+
+    Returns:
+    responses -- A list of the return values of load_to_tribe() for each
+    geneset, in the same order as genesets. It is False for genesets that
+    could not be saved.
+    """
+    own_session = session is None
+    if own_session:
+        session = create_tribe_session(max_uploads)
+    if organism_uris is None:
+        organism_uris = {}
+    try:
+        for organism in set(geneset.get('organism') for geneset in genesets):
+            if organism is not None:
+                get_tribe_organism_uri(tribe_url, organism, session,
+                                       organism_uris)
+
+        translations = {}
+        if prefer_update:
+            genes_by_xrdb = {}
+            for geneset in genesets:
+                genes_by_xrdb.setdefault(geneset.get('xrdb'), set()).update(
+                    geneset.get('annotations') or ())
+            for (xrdb, genes) in genes_by_xrdb.iteritems():
+                translations[xrdb] = translate_genes_in_batches(
+                    tribe_url, genes, xrdb, 'Entrez', session,
+                    translate_batch_size)
+
+        def upload(geneset):
+            # None if the genes could not be translated together, in which
+            # case save_geneset() only translates them if it needs to
+            gene_entrezids = translations.get(geneset.get('xrdb'))
+            try:
+                return save_geneset(tribe_url, geneset, access_token,
+                                    creator_username, prefer_update,
+                                    session, gene_entrezids, organism_uris)
+            except (requests.RequestException, ValueError) as e:
+                logger.error('Geneset %s could not be saved to Tribe: %s',
+                             geneset.get('title'), e)
+                return False
+
+        if len(genesets) < 2 or max_uploads < 2:
+            return [upload(geneset) for geneset in genesets]
+
+        pool = ThreadPool(min(max_uploads, len(genesets)))
+        try:
+            return pool.map(upload, genesets)
+        finally:
+            pool.terminate()
+    finally:
+        if own_session:
+            session.close()
+
+
+def was_saved(response):
+    """
+    Return True if a return value of load_to_tribe() or upload_genesets()
+    means that the geneset is saved in Tribe: it was created, or it was
+    already there with the same annotations. Otherwise (False, or the
+    requests.Response of a failed request), return False.
+    """
+    if response is False:
+        return False
+    return not isinstance(response, requests.Response) or response.ok
+
+
+def get_tribe_annotations(tribe_geneset, xrdb):
+    """
+    Return the annotations of the tip version of tribe_geneset, a gene set
+    retrieved from Tribe with full annotations, as a dictionary of gene (in
+    the xrdb cross-reference gene identifiers) -> list of publications, like
+    the annotations of the processed gene sets.
+    """
+    retrieved_annotations = {}
+    for annotation in tribe_geneset['tip']['annotations']:
+        gene = annotation['gene']
+
+        # Get desired gene identifier
+        if xrdb == 'Entrez':
+            gene = gene['entrezid']
+        elif xrdb == 'Symbol':
+            gene = gene['systematic_name']
+        else:
+            gene = gene['xrid']
+
+        retrieved_annotations[gene] = [pub['pmid'] for pub in
+                                       annotation['pubs']]
+    return retrieved_annotations
+
+
 def get_changed_genesets_by_xrid(tribe_genesets, processed_genesets):
     """
     Function that compares a list of processed gene sets to a list of
     retrieved gene sets from Tribe and returns only processed gene sets
     that have different annotations from their equivalent Tribe gene
-    sets (meaning they have the same slug).
+    sets (meaning they have the same slug). The annotations are compared
+    by their digests (see geneset_hashes.get_annotations_digest()), which
+    do not depend on the order of the genes and publications.
 
     Arguments:
     tribe_genesets -- A list of gene sets that have been retrieved from
@@ -289,14 +610,6 @@ def get_changed_genesets_by_xrid(tribe_genesets, processed_genesets):
             changed_genesets.append(v)
             continue
 
-        # Publications must be converted to a set instead of a list, because
-        # the ones in the retrieved gene sets may be the same as the ones in
-        # the processed gene sets, but just in a different order.
-        processed_annotations = {}
-        for gid, pub_list in v['annotations'].iteritems():
-            processed_annotations[gid] = set(pub_list)
-
-        retrieved_annotations = {}
         if corr_tribe_gs['tip'] is None:
             logger.info('Gene set with slug %s had no "tip" version. '
                         'Adding to list of gene set versions to be created.',
@@ -304,26 +617,11 @@ def get_changed_genesets_by_xrid(tribe_genesets, processed_genesets):
             changed_genesets.append(v)
             continue
 
-        for annotation in corr_tribe_gs['tip']['annotations']:
-            gene = annotation['gene']
-            xrdb = v['xrdb']
+        retrieved_annotations = get_tribe_annotations(corr_tribe_gs,
+                                                      v['xrdb'])
 
-            # Get desired gene identifier
-            if xrdb == 'Entrez':
-                gene = gene['entrezid']
-            elif xrdb == 'Symbol':
-                gene = gene['systematic_name']
-            else:
-                gene = gene['xrid']
-
-            pubs = set()
-
-            for pub in annotation['pubs']:
-                pubs.add(pub['pmid'])
-
-            retrieved_annotations[gene] = pubs
-
-        if processed_annotations != retrieved_annotations:
+        if get_annotations_digest(v['annotations']) != \
+                get_annotations_digest(retrieved_annotations):
             logger.debug('Annotations for gene set with slug %s have changed -'
                          ' Adding to list of gene set versions to be created.',
                          corr_tribe_gs['slug'])
@@ -336,6 +634,25 @@ def get_changed_genesets_by_xrid(tribe_genesets, processed_genesets):
     return changed_genesets
 
 
+def get_genesets_by_xrid(processed_genesets):
+    """
+    Put all gene sets that have annotations in a common xrid inside a list
+    in the returned genesets_by_xrid dictionary (of xrid -> list of gene
+    sets).
+    """
+    genesets_by_xrid = {}
+    for geneset in processed_genesets:
+        key = geneset['xrdb']
+        if key not in genesets_by_xrid:
+            genesets_by_xrid[key] = []
+        genesets_by_xrid[key].append(geneset)
+
+    logger.info('The processed gene sets contain the following '
+                'cross-reference gene identifiers: %s',
+                genesets_by_xrid.keys())
+    return genesets_by_xrid
+
+
 def get_all_changed_genesets(species_file, processed_genesets,
                              access_token, creator_username):
     """
@@ -375,18 +692,7 @@ def get_all_changed_genesets(species_file, processed_genesets,
 
     all_changed_genesets = []
 
-    # Put all gene sets that have annotations in a common xrid inside
-    # a list in the genesets_by_xrid dictionary.
-    genesets_by_xrid = {}
-    for geneset in processed_genesets:
-        key = geneset['xrdb']
-        if key not in genesets_by_xrid:
-            genesets_by_xrid[key] = []
-        genesets_by_xrid[key].append(geneset)
-
-    logger.info('The processed gene sets contain the following '
-                'cross-reference gene identifiers: %s',
-                genesets_by_xrid.keys())
+    genesets_by_xrid = get_genesets_by_xrid(processed_genesets)
 
     for xrid, proc_geneset_list in genesets_by_xrid.iteritems():
         tribe_geneset_dict = download_organism_public_genesets(
@@ -406,3 +712,501 @@ def get_all_changed_genesets(species_file, processed_genesets,
         all_changed_genesets.extend(changed_genesets)
 
     return all_changed_genesets
+
+
+class TribeClient(object):
+    """
+    Client of one Tribe instance, which reads the Tribe settings of the
+    main configuration file and the Tribe secrets once, and then saves and
+    compares the gene sets of any number of species with:
+
+    * The same OAuth2 access token, which is only requested again once it
+      expires (see get_access_token()).
+
+    * The same requests.Session, whose connections to Tribe (up to
+      MAX_UPLOADS of them) are reused by all the requests.
+
+    * The same dictionary of organism URIs (see get_tribe_organism_uri()).
+
+    It is used by run_refinery.main() instead of the load_to_tribe(),
+    upload_genesets() and get_all_changed_genesets() functions, which read
+    the main configuration file, or open a new session, every time they are
+    called. Call close() once done with it.
+    """
+
+    def __init__(self, main_config_file):
+        """
+        Arguments:
+        main_config_file -- Either a string, location of the main INI
+        configuration file, or a SafeConfigParser that it has been read into.
+        Its "Tribe parameters" section must have a TRIBE_URL, and it may
+        have TRIBE_PUBLIC, PREFER_UPDATE, MAX_UPLOADS and CHANGE_DETECTION
+        options (CHANGE_DETECTION: digests needs the GENESET_HASHES_DIR
+        option of the "main" section). The
+        SECRETS_FILE of its "main" section must have a "Tribe secrets"
+        section (see read_tribe_secrets()).
+        """
+        if isinstance(main_config_file, basestring):
+            mc_file = SafeConfigParser()
+            mc_file.read(main_config_file)
+        else:
+            mc_file = main_config_file
+
+        if not mc_file.has_option('Tribe parameters', 'TRIBE_URL'):
+            logger.error('"Tribe parameters" section needs "TRIBE_URL" '
+                         'option to be able to save to Tribe.')
+            sys.exit(1)
+        self.tribe_url = mc_file.get('Tribe parameters', 'TRIBE_URL')
+
+        self.public = False
+        if mc_file.has_option('Tribe parameters', 'TRIBE_PUBLIC'):
+            self.public = mc_file.getboolean('Tribe parameters',
+                                             'TRIBE_PUBLIC')
+
+        self.prefer_update = False
+        if mc_file.has_option('Tribe parameters', 'PREFER_UPDATE'):
+            self.prefer_update = mc_file.getboolean('Tribe parameters',
+                                                    'PREFER_UPDATE')
+
+        # Number of gene sets that are saved to Tribe at the same time
+        self.max_uploads = MAX_UPLOADS
+        if mc_file.has_option('Tribe parameters', 'MAX_UPLOADS'):
+            try:
+                self.max_uploads = mc_file.getint('Tribe parameters',
+                                                  'MAX_UPLOADS')
+            except ValueError:
+                self.max_uploads = 0
+            if self.max_uploads < 1:
+                logger.error('MAX_UPLOADS option in the "Tribe parameters" '
+                             'section of the main configuration file must '
+                             'be a positive integer.')
+                sys.exit(1)
+
+        # How get_all_changed_genesets() tells which gene sets have changed
+        self.change_detection = 'annotations'
+        if mc_file.has_option('Tribe parameters', 'CHANGE_DETECTION'):
+            self.change_detection = mc_file.get(
+                'Tribe parameters', 'CHANGE_DETECTION').strip().lower()
+            if self.change_detection not in CHANGE_DETECTION_MODES:
+                logger.error('CHANGE_DETECTION option in the "Tribe '
+                             'parameters" section of the main configuration '
+                             'file must be one of: %s.',
+                             ', '.join(CHANGE_DETECTION_MODES))
+                sys.exit(1)
+
+        # Folder of the Tribe versions of the gene sets of each species
+        self.hashes_dir = None
+        if self.change_detection == 'digests':
+            if not mc_file.has_option('main', 'GENESET_HASHES_DIR'):
+                logger.error('Main configuration file must have a '
+                             '"GENESET_HASHES_DIR" option in the "main" '
+                             'section for CHANGE_DETECTION to be "digests".')
+                sys.exit(1)
+            self.hashes_dir = mc_file.get('main', 'GENESET_HASHES_DIR')
+
+        secrets_location = None
+        if mc_file.has_option('main', 'SECRETS_FILE'):
+            secrets_location = mc_file.get('main', 'SECRETS_FILE')
+        if not secrets_location:
+            logger.error('Main configuration file needs a "SECRETS_FILE" '
+                         'option in the "main" section to be able to save '
+                         'to Tribe.')
+            sys.exit(1)
+        self.secrets = read_tribe_secrets(secrets_location)
+        self.creator_username = self.secrets['username']
+
+        self.session = create_tribe_session(self.max_uploads)
+        self.organism_uris = {}
+
+        self.access_token = None
+        # time.time() after which access_token has to be requested again
+        self.token_expiry = 0
+        self.token_lock = threading.Lock()
+
+    def get_access_token(self):
+        """
+        Return the OAuth2 access token, requested with the Tribe secrets
+        the first time, and again only when it is about to expire (within
+        TOKEN_EXPIRY_MARGIN seconds). If Tribe does not say when the token
+        expires, it is kept for as long as the client is used.
+        """
+        with self.token_lock:
+            if self.access_token is None or time.time() >= self.token_expiry:
+                payload = {'grant_type': 'password',
+                           'username': self.secrets['username'],
+                           'password': self.secrets['password'],
+                           'client_id': self.secrets['tribe_id'],
+                           'client_secret': self.secrets['tribe_secret']}
+                response = self.session.post(
+                    self.tribe_url + '/oauth2/token/', data=payload)
+                response.raise_for_status()
+                token_info = response.json()
+
+                self.access_token = token_info['access_token']
+                if token_info.get('expires_in') is None:
+                    self.token_expiry = float('inf')
+                else:
+                    self.token_expiry = (time.time() +
+                                         float(token_info['expires_in']) -
+                                         TOKEN_EXPIRY_MARGIN)
+                logger.info('Obtained a new Tribe access token.')
+            return self.access_token
+
+    def load_to_tribe(self, geneset_info, prefer_update=None):
+        """
+        Create a new geneset or version of a geneset in Tribe, as the
+        load_to_tribe() function does. prefer_update defaults to the
+        PREFER_UPDATE option of the main configuration file.
+        """
+        if prefer_update is None:
+            prefer_update = self.prefer_update
+        return save_geneset(self.tribe_url, geneset_info,
+                            self.get_access_token(), self.creator_username,
+                            prefer_update=prefer_update, session=self.session,
+                            organism_uris=self.organism_uris)
+
+    def upload_genesets(self, genesets, prefer_update=None,
+                        translate_batch_size=TRANSLATE_BATCH_SIZE):
+        """
+        Save many genesets to Tribe, MAX_UPLOADS of them at the same time,
+        as the upload_genesets() function does, and return the list of their
+        responses. prefer_update defaults to the PREFER_UPDATE option of the
+        main configuration file.
+        """
+        if prefer_update is None:
+            prefer_update = self.prefer_update
+        return upload_genesets(self.tribe_url, genesets,
+                               self.get_access_token(), self.creator_username,
+                               prefer_update=prefer_update,
+                               max_uploads=self.max_uploads,
+                               translate_batch_size=translate_batch_size,
+                               session=self.session,
+                               organism_uris=self.organism_uris)
+
+    def iter_genesets(self, species_name, **request_params):
+        """
+        Generate the gene sets of species_name that the creator has saved
+        in Tribe, like
+        tribe_client.utils.download_organism_public_genesets() (but from
+        this Tribe instance, over the session of the client). The pages of
+        gene sets are requested one after the other, as the gene sets of the
+        previous page are used, so that only one page is held at a time.
+        request_params are sent with the first request for each annotation
+        type (e.g. xrid='Entrez'). Logs an error and leaves out the rest of
+        the gene sets of an annotation type if a request fails.
+        """
+        for annot_type in ('GO', 'KEGG', 'DO'):
+            params = {'organism__scientific_name': species_name,
+                      'creator__username': self.creator_username,
+                      'title__startswith': annot_type, 'show_tip': 'true',
+                      'limit': GENESETS_PER_REQUEST,
+                      'oauth_consumer_key': self.get_access_token()}
+            params.update(request_params)
+            genesets_url = self.tribe_url + '/api/v1/geneset/'
+
+            while genesets_url is not None:
+                response = self.session.get(genesets_url, params=params)
+                try:
+                    response.raise_for_status()
+                    result = response.json()
+                    page = result['objects']
+                    next_page = result['meta']['next']
+                except (requests.RequestException, ValueError,
+                        KeyError) as e:
+                    logger.error('Could not retrieve the %s gene sets of %s '
+                                 'from Tribe: %s', annot_type, species_name,
+                                 e)
+                    break
+
+                for geneset in page:
+                    yield geneset
+
+                # The next page URL already has all the parameters
+                params = None
+                genesets_url = (None if next_page is None else
+                                self.tribe_url + next_page)
+
+    def download_genesets(self, species_name, xrid):
+        """
+        Return the list of the gene sets of species_name that the creator
+        has saved in Tribe, with full annotations in the xrid
+        cross-reference gene identifiers (see iter_genesets()).
+        """
+        return list(self.iter_genesets(species_name, xrid=xrid,
+                                       full_annotations='true'))
+
+    def iter_tip_versions(self, species_name):
+        """
+        Generate a (slug, version hash) tuple for each gene set of
+        species_name that the creator has saved in Tribe, with the
+        'ver_hash' of its tip version (or None if it has no tip version),
+        which Tribe changes with every new version. The gene sets are
+        requested without their full annotations.
+        """
+        for geneset in self.iter_genesets(species_name):
+            tip = geneset.get('tip')
+            yield (geneset['slug'], tip.get('ver_hash') if tip else None)
+
+    def fetch_geneset(self, slug, xrid):
+        """
+        Return the gene set with slug that the creator has saved in Tribe,
+        with the full annotations of its tip version in the xrid
+        cross-reference gene identifiers, or None (and logs an error) if it
+        could not be retrieved.
+        """
+        response = self.session.get(
+            self.tribe_url + '/api/v1/geneset/' + self.creator_username +
+            '/' + slug,
+            params={'oauth_consumer_key': self.get_access_token(),
+                    'full_annotations': 'true', 'show_tip': 'true',
+                    'xrid': xrid})
+        try:
+            response.raise_for_status()
+            return response.json()
+        except (requests.RequestException, ValueError) as e:
+            logger.error('Could not retrieve gene set %s from Tribe: %s',
+                         slug, e)
+            return None
+
+    def get_tribe_versions(self, species_name, xrid):
+        """
+        Return a dictionary of slug -> [tip version hash, annotations
+        digest] of the gene sets of species_name that the creator has saved
+        in Tribe with a tip version, with the digest of their full
+        annotations in the xrid cross-reference gene identifiers (see
+        geneset_hashes.get_annotations_digest()). The gene sets are listed a
+        page at a time, and only their digests are kept.
+        """
+        versions = {}
+        for tribe_geneset in self.iter_genesets(species_name, xrid=xrid,
+                                                full_annotations='true'):
+            if tribe_geneset.get('tip') is None:
+                continue
+            versions[tribe_geneset['slug']] = [
+                tribe_geneset['tip'].get('ver_hash'),
+                get_annotations_digest(get_tribe_annotations(tribe_geneset,
+                                                             xrid))]
+
+        logger.info('%s existing gene sets were retrieved from Tribe',
+                    len(versions))
+        return versions
+
+    def compare_genesets(self, genesets_and_digests):
+        """
+        Retrieve the gene set in Tribe with the slug of each processed gene
+        set in genesets_and_digests, a list of (geneset, annotations digest)
+        tuples, up to MAX_UPLOADS of them at the same time.
+
+        Returns:
+        A list of a (geneset, version) tuple for each of them, with the
+        [tip version hash, digest] of the gene set in Tribe if its
+        annotations are the same as the ones of geneset, and None
+        otherwise.
+        """
+        def compare(geneset_and_digest):
+            (geneset, digest) = geneset_and_digest
+            tribe_geneset = self.fetch_geneset(geneset['slug'],
+                                               geneset['xrdb'])
+            if tribe_geneset is None or tribe_geneset.get('tip') is None:
+                return (geneset, None)
+            if get_annotations_digest(get_tribe_annotations(
+                    tribe_geneset, geneset['xrdb'])) != digest:
+                return (geneset, None)
+            return (geneset, [tribe_geneset['tip'].get('ver_hash'), digest])
+
+        if len(genesets_and_digests) < 2 or self.max_uploads < 2:
+            return [compare(item) for item in genesets_and_digests]
+
+        pool = ThreadPool(min(self.max_uploads, len(genesets_and_digests)))
+        try:
+            return pool.map(compare, genesets_and_digests)
+        finally:
+            pool.terminate()
+
+    def iter_changed_genesets_by_digest(self, species_file,
+                                        processed_genesets):
+        """
+        Generate the processed gene sets of the species in species_file
+        that are not saved in Tribe yet, or whose annotations have changed,
+        without retrieving the annotations of every gene set in Tribe.
+        processed_genesets can be any iterable of gene sets, such as a
+        generator, and only GENESETS_PER_REQUEST of them are held at a time.
+
+        Only the slugs and tip version hashes of the gene sets in Tribe are
+        retrieved (see iter_tip_versions()). A file in GENESET_HASHES_DIR
+        keeps, for each slug, the version hash that the gene set had the
+        last time that its annotations in Tribe were found to be the same as
+        the processed ones, with the digest of those annotations (see
+        geneset_hashes.get_annotations_digest()). A processed gene set whose
+        tip version and annotations digest are both the same as in that
+        file is unchanged. The full annotations in Tribe are only retrieved
+        for the other ones (see compare_genesets()), or if the file has the
+        tip versions of fewer than half of the gene sets in Tribe (e.g. the
+        first time), all of them are listed with their full annotations
+        instead, a page at a time (see get_tribe_versions()).
+        Unchanged gene sets are recorded in the file once all the gene sets
+        have been generated. Gene sets that are saved to Tribe get a new
+        version, so they are compared with their full annotations once more
+        by the next run.
+        """
+        species_fh = SafeConfigParser()
+        species_fh.read(species_file)
+        species_name = species_fh.get('species_info', 'SCIENTIFIC_NAME')
+
+        saved_versions = read_hashes(self.hashes_dir, species_file,
+                                     TRIBE_VERSIONS_SUFFIX)
+        tip_versions = dict(self.iter_tip_versions(species_name))
+        known_versions = sum(
+            1 for (slug, ver_hash) in tip_versions.iteritems()
+            if ver_hash is not None and
+            saved_versions.get(slug, [None])[0] == ver_hash)
+        list_all = known_versions * 2 < len(tip_versions)
+
+        verified_versions = {}
+        tribe_versions = {}
+        counts = {'changed': 0, 'same_version': 0, 'compared': 0}
+
+        def get_changed(genesets_and_digests):
+            # The gene sets of genesets_and_digests that have changed
+            counts['compared'] += len(genesets_and_digests)
+            changed_genesets = []
+            for (geneset, version) in self.compare_genesets(
+                    genesets_and_digests):
+                if version is None:
+                    changed_genesets.append(geneset)
+                else:
+                    verified_versions[geneset['slug']] = version
+            return changed_genesets
+
+        genesets_to_compare = []
+        changed_genesets = []
+        for geneset in processed_genesets:
+            slug = geneset['slug']
+            ver_hash = tip_versions.get(slug)
+            if ver_hash is None:
+                changed_genesets = [geneset]
+            else:
+                digest = get_annotations_digest(geneset['annotations'])
+                if saved_versions.get(slug) == [ver_hash, digest]:
+                    counts['same_version'] += 1
+                    verified_versions[slug] = [ver_hash, digest]
+                elif list_all:
+                    xrid = geneset['xrdb']
+                    if xrid not in tribe_versions:
+                        tribe_versions[xrid] = self.get_tribe_versions(
+                            species_name, xrid)
+                    version = tribe_versions[xrid].get(slug)
+                    counts['compared'] += 1
+                    if version is not None and version[1] == digest:
+                        verified_versions[slug] = version
+                    else:
+                        changed_genesets = [geneset]
+                else:
+                    genesets_to_compare.append((geneset, digest))
+                    if len(genesets_to_compare) == GENESETS_PER_REQUEST:
+                        changed_genesets = get_changed(genesets_to_compare)
+                        genesets_to_compare = []
+
+            for changed_geneset in changed_genesets:
+                counts['changed'] += 1
+                yield changed_geneset
+            changed_genesets = []
+
+        for changed_geneset in get_changed(genesets_to_compare):
+            counts['changed'] += 1
+            yield changed_geneset
+
+        write_hashes(self.hashes_dir, species_file, verified_versions,
+                     TRIBE_VERSIONS_SUFFIX)
+
+        logger.info('%s gene sets have the same version in Tribe as when '
+                    'they were last compared, and the full annotations of '
+                    '%s were compared.', counts['same_version'],
+                    counts['compared'])
+        logger.info('%s gene sets have changed, saving them to Tribe',
+                    counts['changed'])
+        logger.info('%s gene sets were unchanged', len(verified_versions))
+
+    def get_changed_genesets_by_digest(self, species_file,
+                                       processed_genesets):
+        """
+        Return the list of the gene sets that
+        iter_changed_genesets_by_digest() generates.
+        """
+        return list(self.iter_changed_genesets_by_digest(
+            species_file, processed_genesets))
+
+    def iter_changed_genesets(self, species_file, processed_genesets):
+        """
+        Generate the processed gene sets of the species in species_file
+        that are not saved in Tribe yet, or whose annotations have changed,
+        as the get_all_changed_genesets() function finds them, or with
+        CHANGE_DETECTION: digests, as iter_changed_genesets_by_digest()
+        does. processed_genesets can be any iterable of gene sets, such as a
+        generator, and each one is generated (or not) as soon as it has
+        been compared. The gene sets in Tribe are listed with their full
+        annotations the first time that a processed gene set with their
+        cross-reference gene identifiers comes by, and only the digests of
+        their annotations are kept (see get_tribe_versions()).
+        """
+        if self.change_detection == 'digests':
+            for geneset in self.iter_changed_genesets_by_digest(
+                    species_file, processed_genesets):
+                yield geneset
+            return
+
+        species_fh = SafeConfigParser()
+        species_fh.read(species_file)
+        species_name = species_fh.get('species_info', 'SCIENTIFIC_NAME')
+
+        tribe_versions = {}
+        counts = {'changed': 0, 'unchanged': 0}
+        for geneset in processed_genesets:
+            xrid = geneset['xrdb']
+            if xrid not in tribe_versions:
+                tribe_versions[xrid] = self.get_tribe_versions(species_name,
+                                                               xrid)
+            version = tribe_versions[xrid].get(geneset['slug'])
+            if version is not None and version[1] == \
+                    get_annotations_digest(geneset['annotations']):
+                counts['unchanged'] += 1
+            else:
+                counts['changed'] += 1
+                yield geneset
+
+        logger.info('%s gene sets have changed, saving them to Tribe',
+                    counts['changed'])
+        logger.info('%s gene sets were unchanged', counts['unchanged'])
+
+    def get_all_changed_genesets(self, species_file, processed_genesets):
+        """
+        Return the list of the gene sets that iter_changed_genesets()
+        generates.
+        """
+        return list(self.iter_changed_genesets(species_file,
+                                               processed_genesets))
+
+    def iter_upload_responses(self, genesets, prefer_update=None):
+        """
+        Save genesets (any iterable of gene sets, such as a generator) to
+        Tribe with upload_genesets(), GENESETS_PER_UPLOAD of them at a time,
+        each with its 'public' set to the TRIBE_PUBLIC option of the main
+        configuration file.
+
+        Returns:
+        A generator of a (geneset, response) tuple for each gene set, once
+        the batch of gene sets it is in has been saved, with the return
+        value of load_to_tribe() for it (see was_saved()).
+        """
+        for batch in iter_batches(genesets, GENESETS_PER_UPLOAD):
+            for geneset in batch:
+                geneset['public'] = self.public
+            for geneset_and_response in zip(batch, self.upload_genesets(
+                    batch, prefer_update)):
+                yield geneset_and_response
+
+    def close(self):
+        """
+        Close the connections of the session of the client.
+        """
+        self.session.close()
@@ -1,14 +1,36 @@
+import io
 import os
+import re
+import fcntl
+import gzip
+import signal
 import tempfile
-import shutil
 import requests
-import urllib
+import subprocess
+from contextlib import contextmanager
+from distutils.spawn import find_executable
 from urlparse import urlsplit
 
+import download_cache
+
 import logging
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
+# Suffix of the file that a download is written to until it is complete
+PARTIAL_SUFFIX = '.partial'
+
+# Number of bytes that downloads are read and written in at a time
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+# Content-Range header of a 206 Partial Content response: "bytes
+# <first>-<last>/<total size, or * if unknown>"
+CONTENT_RANGE_PATTERN = re.compile(r'bytes (\d+)-\d+/(\d+|\*)$')
+
+# External program that open_assoc_file() decompresses gzipped files with,
+# in its own process, or None to decompress them in this process.
+GZIP_DECOMPRESSOR = find_executable('pigz') or find_executable('gzip')
+
 
 def check_create_folder(folder_name):
     """
@@ -18,18 +40,26 @@ def check_create_folder(folder_name):
     logger.info('Creating folder ' + folder_name + '...')
 
     if not os.path.exists(folder_name):
-        os.mkdir(folder_name)
+        try:
+            os.mkdir(folder_name)
+        except OSError:
+            # Another process of a parallel run may have just created it
+            if not os.path.isdir(folder_name):
+                raise
         logger.info(folder_name + ' folder created.')
     else:
         logger.info('Folder ' + folder_name + ' already exists. ' +
                     'Saving downloaded files to this folder.')
 
 
-def download_from_url(url, download_folder, file_name=None):
+def download_from_url(url, download_folder, file_name=None,
+                      revalidate=False):
     """
-    In case the downloading process gets interrupted, a dummy tempfile is
-    created in the download_folder for every file that is being downloaded.
-    This tempfile is then erased once the file finishes downloading.
+    In case the downloading process gets interrupted, files are downloaded
+    to a partial file in the download_folder, which is renamed to the
+    target file once the download is complete and has the size the server
+    sent. An interrupted download is resumed from the partial file the next
+    time (see download_http_file() and download_ftp_file()).
 
     Arguments:
     url -- The URL string where the annotation file must be downloaded from.
@@ -41,9 +71,14 @@ def download_from_url(url, download_folder, file_name=None):
     will have in download_folder. If this is None, it will be assigned the last
     part of the url.
 
+    revalidate -- Optional. If True, a file that already exists is
+    downloaded again if it has changed on the server, which is checked with
+    the manifest written next to it when it was downloaded (see
+    download_cache.py).
+
     Returns:
-    True if file did not already exist and was able to be downloaded.
-    Otherwise, return False.
+    True if file did not already exist (or had changed) and was able to be
+    downloaded. Otherwise, return False.
 
     """
     if file_name:
@@ -53,52 +88,328 @@ def download_from_url(url, download_folder, file_name=None):
 
     target_filename = os.path.join(download_folder, filename)
 
-    if os.path.exists(target_filename):
+    if os.path.exists(target_filename) and not revalidate:
         logger.warning('Not downloading file ' + filename + ', as it already'
                        ' exists in the download_folder specified.')
         return False
 
+    # Another species of a parallel run (see run_refinery.py) may be
+    # downloading the same file into a common folder.
+    with file_lock(target_filename + '.lock'):
+        manifest = None
+        if os.path.exists(target_filename):
+            if not revalidate:
+                logger.warning('Not downloading file ' + filename + ', as '
+                               'it already exists in the download_folder '
+                               'specified.')
+                return False
+            manifest = download_cache.read_manifest(target_filename, url)
+
+        partial_file = target_filename + PARTIAL_SUFFIX
+        try:
+            if url.startswith('ftp'):
+                if revalidate:
+                    validators = download_cache.get_ftp_validators(url)
+                    if download_cache.is_unchanged_on_ftp(manifest,
+                                                          validators):
+                        logger.info('File %s has not changed on the server.',
+                                    filename)
+                        return False
+
+                validators = download_ftp_file(url, partial_file)
+
+            else:
+                response = download_http_file(
+                    url, partial_file,
+                    headers=download_cache.get_conditional_headers(manifest))
+                if response is None:
+                    logger.info('File %s has not changed on the server.',
+                                filename)
+                    return False
+                validators = download_cache.get_http_validators(response)
+
+            return download_cache.save_download(
+                partial_file, target_filename, url, validators, revalidate,
+                manifest)
+
+        except:
+            logger.error('There was an error when downloading the file "' +
+                         filename + '" - downloading could not be completed.')
+            return False
+
+
+def _get_or_raise(url, headers):
+    """
+    Send a streamed GET request for url with requests.get(), and raise
+    requests.HTTPError if it fails.
+    """
+    response = requests.get(url, headers=headers, stream=True)
+    response.raise_for_status()
+    return response
+
+
+def download_http_file(url, partial_file, get=None, headers=None):
+    """
+    Download an HTTP(S) url to partial_file, in DOWNLOAD_CHUNK_SIZE chunks.
+
+    If partial_file is left from an interrupted download of the same
+    version of the file (see download_cache.get_resume_validator()), the
+    download is resumed from its end with a Range request. The If-Range
+    header makes the server send the whole file instead if it has changed
+    since.
+
+    Arguments:
+    url -- The URL string to download.
+
+    partial_file -- A string. Location of the file to download to.
+
+    get -- Optional function that sends a streamed GET request for a url
+    with a dictionary of headers and returns the requests.Response, or
+    raises requests.HTTPError for an error status, such as
+    download_manager.DownloadManager.get(). requests.get() is used by
+    default.
+
+    headers -- Optional dictionary of extra headers for the request, such
+    as those of download_cache.get_conditional_headers().
+
+    Returns:
+    The (closed) requests.Response of the download, or None if the server
+    answered that the file has not changed (304 Not Modified).
+
+    Raises requests.RequestException if the request fails, or a plain
+    IOError if the connection is lost during the download or the file is
+    not complete, in which case partial_file is kept for the next attempt
+    to resume.
+    """
+    if get is None:
+        get = _get_or_raise
+    headers = dict(headers or {})
+    # Ranges and sizes refer to the bytes of the file itself
+    headers['Accept-Encoding'] = 'identity'
+
+    offset = 0
+    if_range = download_cache.get_resume_validator(partial_file, url)
+    if if_range:
+        offset = os.path.getsize(partial_file)
+    if offset:
+        headers['Range'] = 'bytes=%d-' % offset
+        headers['If-Range'] = if_range
+
     try:
-        if url.startswith('ftp'):
-            urllib.urlretrieve(url, target_filename)
+        response = get(url, headers)
+    except requests.HTTPError as e:
+        if offset and e.response is not None and \
+                e.response.status_code == 416:
+            # The partial file cannot be resumed, so start over
+            download_cache.remove_partial_download(partial_file)
+            return download_http_file(url, partial_file, get, headers=dict(
+                (key, value) for (key, value) in headers.iteritems()
+                if key not in ('Range', 'If-Range')))
+        raise
 
-            # Because this is an FTP connection, we need to clear the
-            # cache from previous calls. For more info, see:
-            # https://stackoverflow.com/questions/44733710/downloading-second-file-from-ftp-fails
-            # https://docs.python.org/2/library/urllib.html#urllib.urlcleanup
-            urllib.urlcleanup()
-            return True
+    try:
+        if response.status_code == 304:
+            return None
 
+        if response.status_code == 206:
+            match = CONTENT_RANGE_PATTERN.match(
+                response.headers.get('Content-Range', ''))
+            if not match or int(match.group(1)) != offset:
+                raise IOError('Unexpected Content-Range %r for %s' % (
+                    response.headers.get('Content-Range'), url))
+            total_size = match.group(2)
+            if total_size == '*':
+                total_size = None
+            logger.info('Resuming download of %s from byte %d.', url, offset)
+            mode = 'ab'
         else:
-            temp = tempfile.NamedTemporaryFile(prefix=filename + '.',
-                                               dir=download_folder)
-
-            download_request = requests.get(url, stream=True)
-
-            # chunk_size is in bytes
-            for chunk in download_request.iter_content(chunk_size=4096):
-                if chunk:
-                    temp.write(chunk)
-                    temp.flush()
-
-            # Go back to the beginning of the tempfile and copy it to
-            # target folder
-            temp.seek(0)
-            target_fh = open(target_filename, 'w+b')
-            shutil.copyfileobj(temp, target_fh)
-            temp.close()  # This erases the tempfile
-            return True
-
-    except:
-        logger.error('There was an error when downloading the file "' +
-                     filename + '" - downloading could not be completed.')
-        return False
+            total_size = response.headers.get('Content-Length')
+            download_cache.write_resume_validators(
+                partial_file, url,
+                download_cache.get_http_validators(response))
+            mode = 'wb'
+
+        with open(partial_file, mode) as partial_fh:
+            try:
+                for chunk in response.iter_content(
+                        chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    partial_fh.write(chunk)
+            except requests.RequestException as e:
+                raise IOError('Download of %s was interrupted: %s' % (url, e))
+    finally:
+        response.close()
+
+    check_download_size(url, partial_file, total_size)
+    return response
+
+
+def download_ftp_file(url, partial_file, timeout=60):
+    """
+    Download an FTP url to partial_file, resuming an interrupted download
+    of the same version of the file (the same MDTM) from the end of
+    partial_file with a REST command.
+
+    Returns:
+    validators -- A dictionary of the 'mdtm' and 'remote_size' of the file
+    (see download_cache.read_ftp_validators()).
+
+    Raises one of ftplib.all_errors if the download fails, or IOError if
+    the file is not complete, in which case partial_file is kept for the
+    next attempt to resume.
+    """
+    (dirname, basename) = os.path.split(urlsplit(url).path)
+    ftp = download_cache.connect_ftp(url, timeout)
+    try:
+        if dirname:
+            ftp.cwd(dirname)
+        validators = download_cache.read_ftp_validators(ftp, basename)
+
+        offset = 0
+        if validators['mdtm'] and validators['mdtm'] == \
+                download_cache.get_resume_validator(partial_file, url):
+            offset = os.path.getsize(partial_file)
+            if validators['remote_size'] is not None and \
+                    offset > validators['remote_size']:
+                offset = 0
+        if not offset:
+            download_cache.write_resume_validators(partial_file, url,
+                                                   validators)
+
+        if offset and offset == validators['remote_size']:
+            logger.info('Download of %s was already complete.', url)
+        else:
+            if offset:
+                logger.info('Resuming download of %s from byte %d.', url,
+                            offset)
+            with open(partial_file, 'ab' if offset else 'wb') as partial_fh:
+                ftp.retrbinary('RETR ' + basename, partial_fh.write,
+                               DOWNLOAD_CHUNK_SIZE, offset or None)
+        ftp.quit()
+    finally:
+        ftp.close()
+
+    check_download_size(url, partial_file, validators['remote_size'])
+    return validators
+
+
+def check_download_size(url, partial_file, total_size):
+    """
+    Raise IOError if the size of the downloaded partial_file is not the
+    total_size of url that the server sent (if it sent one).
+    """
+    size = os.path.getsize(partial_file)
+    if total_size is not None and size != int(total_size):
+        raise IOError('Download of %s is incomplete: %d of %s bytes' % (
+            url, size, total_size))
+
+
+@contextmanager
+def file_lock(lock_file):
+    """
+    Context manager that holds an exclusive lock on lock_file, which is
+    created if it does not exist, so that the processes of a parallel run
+    do not write the same shared file at the same time. The lock file is
+    left in place afterwards.
+    """
+    with open(lock_file, 'a') as lock_fh:
+        fcntl.flock(lock_fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_fh, fcntl.LOCK_UN)
+
+
+def write_atomically(filename, write):
+    """
+    Call write() with a temporary file in the folder of filename, and
+    rename it to filename once written.
+    """
+    (tmp_fd, tmp_file) = tempfile.mkstemp(
+        prefix=os.path.basename(filename) + '.',
+        dir=os.path.dirname(filename) or '.')
+    try:
+        with os.fdopen(tmp_fd, 'wb') as tmp_fh:
+            write(tmp_fh)
+        os.rename(tmp_file, filename)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def iter_batches(items, batch_size):
+    """
+    Generate lists of up to batch_size of items (any iterable, such as a
+    generator), taking only one batch of them from items at a time.
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def open_assoc_file(assoc_file):
+    """
+    Open a GO association file, which may be gzipped.
+
+    Gzipped files are decompressed by the GZIP_DECOMPRESSOR program (pigz
+    or gzip) in a separate process, and read from its output pipe, so that
+    decompression runs in parallel with the parsing of the lines. If
+    GZIP_DECOMPRESSOR is None, they are decompressed in this process
+    instead, wrapped in a large read buffer, as iterating over the lines
+    of a GzipFile directly is several times slower.
+
+    Returns:
+    A file object of the uncompressed lines, to be used in a 'with'
+    statement.
+    """
+    if not assoc_file.endswith('.gz'):
+        return open(assoc_file, 'r')
+    if GZIP_DECOMPRESSOR:
+        return decompress_pipe(assoc_file, GZIP_DECOMPRESSOR)
+    return io.BufferedReader(gzip.open(assoc_file, 'rb'),
+                             buffer_size=1 << 20)
+
+
+@contextmanager
+def decompress_pipe(filename, decompressor):
+    """
+    Context manager that runs "decompressor -dc" on filename and yields
+    the read end of its output. Raises IOError if the decompressor fails,
+    but not when it is stopped because the output was closed before the
+    end of the file.
+    """
+    with open(filename, 'rb') as compressed_fh:
+        process = subprocess.Popen(
+            [decompressor, '-dc'], stdin=compressed_fh,
+            stdout=subprocess.PIPE, bufsize=1 << 20,
+            preexec_fn=_restore_sigpipe)
+    try:
+        yield process.stdout
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+    if returncode > 0:
+        raise IOError('%s could not decompress %s (exit status %d)' % (
+            decompressor, filename, returncode))
+
+
+def _restore_sigpipe():
+    """
+    Python ignores SIGPIPE, and child processes inherit that. Restore the
+    default action, so that a decompressor whose output pipe is closed
+    just exits.
+    """
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
 
 
-def translate_gene_ids(tribe_url, gene_list, from_id, to_id):
+def translate_gene_ids(tribe_url, gene_list, from_id, to_id, session=None):
     payload = {'gene_list': gene_list, 'from_id': from_id, 'to_id': to_id}
-    response = requests.post(tribe_url + '/api/v1/gene/xrid_translate',
-                             data=payload)
+    response = (session or requests).post(
+        tribe_url + '/api/v1/gene/xrid_translate', data=payload)
     return response
 
 